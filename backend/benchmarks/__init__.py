@@ -0,0 +1,5 @@
+"""
+Benchmarks de custo de coleta contra o servidor New Relic local (utils.fake_newrelic_server).
+
+    python -m benchmarks.collection --entidades 100 1000 10000 --perfis local wan --saida resultados.json
+"""
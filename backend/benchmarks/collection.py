@@ -0,0 +1,233 @@
+"""
+Benchmark de throughput de coleta.
+
+Cada cenário roda um dos coletores contra o servidor New Relic local com N entidades e um
+perfil de latência. Cada execução é um subprocesso próprio, com diretório de trabalho
+temporário: caches de processo (respostas NRQL, agregador incremental, tabela delta, rate
+limiter) começam vazios, o pico de RSS é só da execução e ``historico/cache_completo.json``
+é o gravado por ela.
+
+Por execução são medidos: tempo de parede, requisições recebidas pelo servidor (e quantas
+tomaram 429), requisições por entidade, pico de RSS e bytes de ``historico/cache_completo.json``.
+Cenários cujo coletor não grava o arquivo persistem o resultado como a camada de cache faz
+(``utils.cache.salvar_cache_no_disco``).
+
+O resultado é um JSON com uma entrada por (cenário, entidades, perfil), para comparar entre
+versões:
+
+    python -m benchmarks.collection --entidades 100 1000 --perfis local wan --saida resultados.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+    RESOURCE_DISPONIVEL = True
+except ImportError:  # Windows
+    RESOURCE_DISPONIVEL = False
+
+from utils.fake_newrelic_server import ConfigServidor, FakeNewRelicServer
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+ARQUIVO_CACHE = Path("historico") / "cache_completo.json"
+TIMEOUT_EXECUCAO = 1800  # segundos por execução
+
+# latencia/jitter em segundos, taxa_429 em probabilidade por requisição
+PERFIS_LATENCIA = {
+    "local": {"latencia": 0.0, "jitter": 0.0, "taxa_429": 0.0},
+    "lan": {"latencia": 0.005, "jitter": 0.005, "taxa_429": 0.0},
+    "wan": {"latencia": 0.05, "jitter": 0.05, "taxa_429": 0.0},
+    "limitado": {"latencia": 0.02, "jitter": 0.02, "taxa_429": 0.02},
+}
+
+
+# -- Cenários (executados no subprocesso) ----------------------------------------------------------
+
+async def _persistir(dados: Dict[str, Any]):
+    from utils import cache
+    cache._cache["dados"] = dados
+    await cache.salvar_cache_no_disco()
+
+
+async def _cenario_collect_full_data() -> int:
+    from utils.newrelic_advanced_collector import collect_full_data
+    resultado = await collect_full_data()
+    await _persistir(resultado)
+    return len(resultado.get("entidades", []))
+
+
+async def _cenario_collect_entities_with_metrics() -> int:
+    from utils.newrelic_collector import NEW_RELIC_ACCOUNT_ID, NEW_RELIC_API_KEY, NEW_RELIC_QUERY_KEY, NewRelicCollector
+    coletor = NewRelicCollector(NEW_RELIC_API_KEY, NEW_RELIC_ACCOUNT_ID, NEW_RELIC_QUERY_KEY)
+    entidades = await coletor.collect_entities_with_metrics() or []
+    await _persistir({"entidades": entidades, "total_entidades": len(entidades)})
+    return len(entidades)
+
+
+async def _cenario_full_collector_collect_all_data() -> int:
+    from utils.new_relic_full_collector import NewRelicFullCollector
+    coletor = NewRelicFullCollector(cache_dir=".")
+    await coletor.collect_all_data()
+    return coletor.stats.get("entities_collected", 0)
+
+
+async def _cenario_advanced_collect_full_entity_data() -> int:
+    from utils.advanced_newrelic_collector import AdvancedNewRelicCollector
+    resultado = await AdvancedNewRelicCollector().collect_full_entity_data()
+    await _persistir(resultado)
+    if resultado.get("error"):
+        raise RuntimeError(resultado["error"])
+    return sum(len(v) for v in (resultado.get("entities") or {}).values() if isinstance(v, list))
+
+
+CENARIOS = {
+    "collect_full_data": _cenario_collect_full_data,
+    "collect_entities_with_metrics": _cenario_collect_entities_with_metrics,
+    "NewRelicFullCollector.collect_all_data": _cenario_full_collector_collect_all_data,
+    "AdvancedNewRelicCollector.collect_full_entity_data": _cenario_advanced_collect_full_entity_data,
+}
+
+
+def _pico_rss_mb() -> Optional[float]:
+    if not RESOURCE_DISPONIVEL:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reporta em KB, macOS em bytes
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def executar_cenario(nome: str) -> Dict[str, Any]:
+    """Roda um cenário no processo atual (diretório de trabalho = área isolada da execução)."""
+    async def rodar():
+        from utils.newrelic_common import close_shared_session
+        try:
+            return await CENARIOS[nome]()
+        finally:
+            await close_shared_session()
+
+    inicio = time.perf_counter()
+    erro = None
+    entidades_coletadas = None
+    try:
+        entidades_coletadas = asyncio.run(rodar())
+    except Exception as e:
+        erro = f"{type(e).__name__}: {e}"
+    return {
+        "tempo_s": round(time.perf_counter() - inicio, 3),
+        "entidades_coletadas": entidades_coletadas,
+        "pico_rss_mb": _pico_rss_mb(),
+        "bytes_cache_completo": ARQUIVO_CACHE.stat().st_size if ARQUIVO_CACHE.exists() else 0,
+        "erro": erro,
+    }
+
+
+# -- Orquestração (processo principal) -------------------------------------------------------------
+
+async def medir(cenario: str, entidades: int, perfil: str, env_extra: Optional[Dict[str, str]] = None,
+                timeout: float = TIMEOUT_EXECUCAO) -> Dict[str, Any]:
+    """Sobe o servidor local, roda o cenário num subprocesso e combina as medições."""
+    config = ConfigServidor(entidades=entidades, **PERFIS_LATENCIA[perfil])
+    async with FakeNewRelicServer(config) as servidor:
+        with tempfile.TemporaryDirectory(prefix="bench_coleta_") as area:
+            # Alguns coletores gravam log em logs/ relativo ao diretório de trabalho
+            os.makedirs(os.path.join(area, "logs"))
+            env = dict(os.environ)
+            env.update(env_extra or {})
+            env["NEW_RELIC_BASE_URL"] = servidor.url
+            env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(BACKEND_DIR), env.get("PYTHONPATH")]))
+            processo = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "benchmarks.collection", "--executar-cenario", cenario,
+                cwd=area, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            )
+            try:
+                saida, _ = await asyncio.wait_for(processo.communicate(), timeout)
+                linhas = saida.decode(errors="replace").strip().splitlines()
+                medicao = json.loads(linhas[-1]) if linhas else {"erro": f"saída vazia (código {processo.returncode})"}
+            except asyncio.TimeoutError:
+                processo.kill()
+                await processo.wait()
+                medicao = {"erro": f"timeout após {timeout}s"}
+            except json.JSONDecodeError:
+                medicao = {"erro": f"saída inválida (código {processo.returncode})"}
+
+        requisicoes = servidor.stats["requisicoes"]
+        return dict(
+            medicao,
+            cenario=cenario,
+            entidades=entidades,
+            perfil=perfil,
+            requisicoes=requisicoes,
+            requisicoes_429=servidor.stats["rate_limited"],
+            requisicoes_por_entidade=round(requisicoes / entidades, 3) if entidades else None,
+            bytes_respostas=servidor.stats["bytes_enviados"],
+        )
+
+
+async def rodar_benchmarks(cenarios: List[str], entidades: List[int], perfis: List[str],
+                           env_extra: Optional[Dict[str, str]] = None,
+                           timeout: float = TIMEOUT_EXECUCAO) -> Dict[str, Any]:
+    resultados = []
+    for cenario in cenarios:
+        for total in entidades:
+            for perfil in perfis:
+                logger.info(f"Benchmark {cenario} com {total} entidades (perfil {perfil})")
+                resultado = await medir(cenario, total, perfil, env_extra, timeout)
+                logger.info(
+                    f"  {resultado.get('tempo_s')}s, {resultado['requisicoes']} requisições "
+                    f"({resultado['requisicoes_por_entidade']}/entidade), RSS {resultado.get('pico_rss_mb')} MB"
+                    + (f", erro: {resultado['erro']}" if resultado.get("erro") else "")
+                )
+                resultados.append(resultado)
+    return {
+        "gerado_em": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "perfis": {p: PERFIS_LATENCIA[p] for p in perfis},
+        "resultados": resultados,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark de throughput de coleta New Relic")
+    parser.add_argument("--cenarios", nargs="+", choices=list(CENARIOS), default=list(CENARIOS))
+    parser.add_argument("--entidades", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--perfis", nargs="+", choices=list(PERFIS_LATENCIA), default=["local", "wan"])
+    parser.add_argument("--env", action="append", default=[], metavar="CHAVE=VALOR",
+                        help="variável de ambiente extra para os coletores (repetível)")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT_EXECUCAO)
+    parser.add_argument("--saida", help="arquivo JSON de resultados (padrão: stdout)")
+    parser.add_argument("--executar-cenario", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.executar_cenario:
+        # Subprocesso: só a medição em JSON na última linha do stdout
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(executar_cenario(args.executar_cenario)))
+        return
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(name)s: %(message)s")
+    env_extra = dict(item.split("=", 1) for item in args.env)
+    relatorio = asyncio.run(rodar_benchmarks(args.cenarios, args.entidades, args.perfis, env_extra, args.timeout))
+    texto = json.dumps(relatorio, indent=2, ensure_ascii=False)
+    if args.saida:
+        Path(args.saida).write_text(texto, encoding="utf-8")
+        logger.info(f"Resultados gravados em {args.saida}")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
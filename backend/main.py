@@ -2042,3 +2042,13 @@ app.add_middleware(
 
 # Incluir os endpoints do router principal
 app.include_router(api_router, prefix="/api")
+
+
+@app.on_event("shutdown")
+async def fechar_pool_http_newrelic():
+    """Fecha o pool HTTP compartilhado dos coletores New Relic no shutdown."""
+    from utils.newrelic_common import close_shared_session
+    from utils.cache_persistence import get_persistence_service
+    await close_shared_session()
+    # Gravações do cache ainda na fila
+    await get_persistence_service().aguardar()
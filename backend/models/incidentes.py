@@ -15,6 +15,10 @@ class DadosAvancadosModel(BaseModel):
     queries: Optional[Any] = None
     distributed_trace: Optional[Any] = None
     metricas: Optional[Any] = None
+    code_execution: Optional[Any] = None
+    # Modo agregado de traces: eventos brutos de exemplo e o modo em que foram coletados
+    exemplares: Optional[Any] = None
+    modo_traces: Optional[str] = None
 
 class EntidadeModel(BaseModel):
     guid: str
@@ -11,6 +11,9 @@ async def lifespan(app):
     yield
     logger.info("Finalizando API de Incidentes...")
     await salvar_dados_no_disco()
+    # Fecha o pool HTTP compartilhado dos coletores New Relic
+    from utils.newrelic_common import close_shared_session
+    await close_shared_session()
 # Função para correlacionar incidentes com entidades do New Relic
 async def correlacionar_incidentes_entidades():
     entidades = await carregar_entidades_newrelic()
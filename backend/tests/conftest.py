@@ -0,0 +1,7 @@
+import os
+
+# Os coletores leem as credenciais ao serem importados. Sem credenciais no ambiente, a suíte
+# aponta para um servidor local (nada chega à API real) e recebe credenciais fictícias
+# (ver newrelic_common.carregar_credenciais); precisa valer antes da coleta dos testes.
+if not all(os.getenv(nome) for nome in ("NEW_RELIC_API_KEY", "NEW_RELIC_QUERY_KEY", "NEW_RELIC_ACCOUNT_ID")):
+    os.environ.setdefault("NEW_RELIC_BASE_URL", "http://127.0.0.1:9")
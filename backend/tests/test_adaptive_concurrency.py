@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from utils.adaptive_concurrency import AdaptiveConcurrencyController
+
+
+async def rodar(controller, n, latencia=0.0, status=200, excecao=None):
+    maximo = 0
+
+    async def requisicao():
+        nonlocal maximo
+        async with controller.request() as slot:
+            maximo = max(maximo, controller.in_flight)
+            await asyncio.sleep(latencia)
+            if excecao:
+                raise excecao
+            slot.mark(status)
+
+    await asyncio.gather(*[requisicao() for _ in range(n)], return_exceptions=True)
+    return maximo
+
+
+@pytest.mark.asyncio
+async def test_respeita_o_limite_e_cresce_com_respostas_saudaveis():
+    controller = AdaptiveConcurrencyController(min_limit=1, max_limit=16, initial_limit=4, target_p95=1.0)
+    maximo = await rodar(controller, 200, latencia=0.001)
+    assert maximo <= 16
+    assert controller.limit > 4
+    assert controller.get_status()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_reduz_multiplicativamente_em_429_e_timeout():
+    controller = AdaptiveConcurrencyController(min_limit=2, max_limit=64, initial_limit=32)
+    await rodar(controller, 1, status=429)
+    assert controller.limit == 16
+    # Mesma rajada de falhas (cooldown) não derruba o limite de novo
+    await rodar(controller, 5, status=429)
+    assert controller.limit == 16
+
+    controller._last_decrease = 0
+    await rodar(controller, 1, excecao=asyncio.TimeoutError())
+    assert controller.limit == 8
+    status = controller.get_status()
+    assert status["overloads"] == 7 and status["decreases"] == 2
+
+
+@pytest.mark.asyncio
+async def test_reduz_quando_p95_passa_do_alvo():
+    controller = AdaptiveConcurrencyController(min_limit=1, max_limit=64, initial_limit=10, target_p95=0.005)
+    await rodar(controller, 20, latencia=0.01)
+    assert controller.limit < 10
+
+
+@pytest.mark.asyncio
+async def test_requisicoes_do_coletor_ocupam_vagas_do_controlador_da_conta(monkeypatch):
+    from utils.fake_newrelic_server import ConfigServidor, FakeNewRelicServer
+    from utils.newrelic_accounts import ContaNewRelic, usar_conta
+    from utils.newrelic_collector import NewRelicCollector
+    from utils.nrql_cache import get_query_cache
+
+    monkeypatch.setattr(get_query_cache(), "enabled", False)
+    async with FakeNewRelicServer(ConfigServidor(entidades=5, conta=404, semente=4)) as srv:
+        conta = ContaNewRelic(404, "k4", nome="pagamentos", base_url=srv.url)
+        coletor = NewRelicCollector(api_key="k4", account_id="404", query_key="k4")
+        coletor.base_url = conta.graphql_url("padrao")
+        guid = srv.conta.entidades[0]["guid"]
+        with usar_conta(conta):
+            entidades, _ = await coletor._fetch_entity_page()
+            await asyncio.gather(
+                coletor.collect_entity_health_status(guid),
+                coletor.collect_entity_related_entities(guid),
+                coletor.collect_entity_alerts(guid),
+                coletor.collect_entity_deployments(guid),
+            )
+        requisicoes = srv.stats["graphql"]
+
+    assert entidades and requisicoes == 5
+    # Cada POST passou pelo token bucket e por uma vaga AIMD da conta, com o status marcado
+    assert conta.rate_limiter.buckets["graphql"].acquired == requisicoes
+    status = conta.concurrency.get_status()
+    assert status["completed"] == requisicoes and status["in_flight"] == 0
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+from utils import cache, cache_persistence
+from utils.cache_persistence import PersistenceService, gravar_json_atomico, serializar_json
+
+
+def test_gravacao_atomica_compacta_e_sem_resto_em_falha(tmp_path, monkeypatch):
+    destino = tmp_path / "cache.json"
+    gravar_json_atomico(destino, {"a": [1, 2], "texto": "ção", 3: "chave int"})
+    conteudo = destino.read_bytes()
+    assert b"\n" not in conteudo and b": " not in conteudo
+    assert json.loads(conteudo) == {"a": [1, 2], "texto": "ção", "3": "chave int"}
+    assert serializar_json({"n": 2 ** 70}) == b'{"n":1180591620717411303424}'
+
+    # Queda no meio da troca: o arquivo anterior continua inteiro e o temporário some
+    def falhar(*args):
+        raise OSError("disco cheio")
+    monkeypatch.setattr(cache_persistence.os, "replace", falhar)
+    with pytest.raises(OSError):
+        gravar_json_atomico(destino, {"novo": True})
+    assert json.loads(destino.read_bytes())["a"] == [1, 2]
+    assert [p.name for p in tmp_path.iterdir()] == ["cache.json"]
+
+
+@pytest.mark.asyncio
+async def test_rajada_agrupada_em_uma_escrita_fora_do_event_loop():
+    servico = PersistenceService(debounce=0.05)
+    escritas = []
+
+    def gravar(valor):
+        time.sleep(0.2)
+        escritas.append((valor, threading.current_thread().name))
+        return valor
+
+    ticks = 0
+
+    async def contar_ticks():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    contador = asyncio.create_task(contar_ticks())
+    futuros = [servico.agendar("cache", lambda v=v: gravar(v)) for v in range(10)]
+    resultados = await asyncio.gather(*futuros)
+    # Um pedido durante a escrita gera exatamente mais uma escrita, com o estado mais novo
+    primeiro = servico.agendar("cache", lambda: gravar("a"))
+    await asyncio.sleep(0.1)
+    atrasados = [servico.agendar("cache", lambda v=v: gravar(v)) for v in ("b", "c")]
+    assert await primeiro == "a" and await asyncio.gather(*atrasados) == ["c", "c"]
+    contador.cancel()
+
+    assert resultados == [9] * 10
+    assert [v for v, _ in escritas] == [9, "a", "c"]
+    assert all(nome.startswith("persistencia-cache") for _, nome in escritas)
+    assert servico.stats["agrupados"] == 10 and servico.stats["gravacoes"] == 3
+    # O event loop continuou atendendo durante as escritas
+    assert ticks > 30
+
+
+@pytest.mark.asyncio
+async def test_cache_salva_em_segundo_plano(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "SEGMENT_CACHE_ENABLED", False)
+    monkeypatch.setattr(cache, "_cache", {"dados": {"timestamp": "t", "entidades": [{"guid": "g1"}]},
+                                          "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    servico = PersistenceService(debounce=0.05)
+    monkeypatch.setattr(cache_persistence, "_service", servico)
+
+    assert all(await asyncio.gather(*(cache.salvar_cache_no_disco() for _ in range(5))))
+    assert servico.stats["gravacoes"] == 1
+    assert json.loads(cache.CACHE_FILE.read_text(encoding="utf-8"))["entidades"] == [{"guid": "g1"}]
+
+    assert await cache.salvar_consulta_historica("quais apps estão lentas?", cache._cache["dados"])
+    assert "quais apps estão lentas?" not in cache._cache["consultas_historicas"]
+    await servico.aguardar()
+    await asyncio.sleep(0)
+    registro = cache._cache["consultas_historicas"]["quais apps estão lentas?"]
+    assert json.loads(open(registro["arquivo"], encoding="utf-8").read())["resultado"]["entidades"] == [{"guid": "g1"}]
+    assert not [p for p in os.listdir(cache.CACHE_HISTORICO_DIR) if p.endswith(".tmp")]
+
+
+@pytest.mark.asyncio
+async def test_carga_do_disco_fora_do_event_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "SEGMENT_CACHE_ENABLED", False)
+    monkeypatch.setattr(cache, "MMAP_CACHE_ENABLED", False)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    servico = PersistenceService(debounce=0.05)
+    monkeypatch.setattr(cache_persistence, "_service", servico)
+    gravar_json_atomico(cache.CACHE_FILE, {"timestamp": "t", "entidades": [{"guid": "g1", "domain": "APM"}]})
+
+    threads = []
+    carregar = cache._carregar_dados_do_disco
+
+    def espiao():
+        threads.append(threading.current_thread())
+        return carregar()
+
+    monkeypatch.setattr(cache, "_carregar_dados_do_disco", espiao)
+    assert await cache.carregar_cache_do_disco()
+    assert threads and threading.main_thread() not in threads
+    assert [e["guid"] for e in cache._cache["dados"]["entidades"]] == ["g1"]
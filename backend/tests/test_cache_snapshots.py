@@ -0,0 +1,87 @@
+import pytest
+from utils import cache, mmap_cache
+
+
+def _dados():
+    entidades = [{"guid": f"g{i}", "name": f"svc-{i}", "domain": "APM" if i < 3 else "INFRA"} for i in range(5)]
+    return {
+        "timestamp": "2026-01-01T00:00:00",
+        "entidades": entidades,
+        "APM": entidades[:3],
+        "INFRA": entidades[3:],
+        "logs": ["x"],
+    }
+
+
+@pytest.fixture
+def cache_vazio(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+
+
+@pytest.mark.asyncio
+async def test_leitor_mantem_versao_consistente_durante_invalidacao(cache_vazio):
+    await cache.atualizar_cache_com_dados(_dados())
+    antes = cache.get_retrato()
+    entidades_antes = list(antes.dados["entidades"])
+
+    assert await cache.invalidar_cache_seletivo({"dominio": "APM"})
+    depois = cache.get_retrato()
+
+    # A versão guardada pelo leitor não mudou; a nova tem as entidades trocadas por cópias
+    assert depois.versao > antes.versao and depois.dados is not antes.dados
+    assert antes.dados["entidades"] == entidades_antes
+    assert all("cache_valido" not in e for e in antes.dados["entidades"])
+    assert [e.get("cache_valido") for e in depois.dados["entidades"]] == [False, False, False, None, None]
+    assert depois.dados["APM"][1] is depois.dados["entidades"][1]
+    assert depois.dados["INFRA"] is antes.dados["INFRA"] and depois.dados["logs"] is antes.dados["logs"]
+
+    # Atribuição direta (scripts de manutenção) também vira uma versão nova
+    cache._cache["dados"] = {"timestamp": "2026-01-02T00:00:00", "entidades": []}
+    assert cache.get_versao_cache() == depois.versao + 1
+
+
+@pytest.mark.asyncio
+async def test_falha_no_meio_nao_publica_versao(cache_vazio, monkeypatch):
+    import utils.newrelic_collector as coletor
+
+    await cache.atualizar_cache_com_dados(_dados())
+    versao = cache.get_versao_cache()
+
+    async def falhar(guid):
+        raise RuntimeError("API indisponível")
+
+    monkeypatch.setattr(coletor, "coletar_entidade_especifica", falhar)
+    assert await cache.atualizar_cache_incremental(None, {"guid": "g1"}) is False
+    assert cache.get_versao_cache() == versao
+
+    async def coletar(guid):
+        return {"guid": guid, "name": "nova", "domain": "APM"}
+
+    monkeypatch.setattr(coletor, "coletar_entidade_especifica", coletar)
+    assert await cache.atualizar_cache_incremental(None, {"guid": "g9"})
+    dados = cache.get_retrato().dados
+    assert [e["guid"] for e in dados["APM"]] == ["g0", "g1", "g2", "g9"] and dados["entidades"][-1]["name"] == "nova"
+
+
+@pytest.mark.asyncio
+async def test_consulta_historica_expira_com_nova_versao_e_dados_mapeados_derivam(cache_vazio):
+    await cache.atualizar_cache_com_dados(_dados())
+    await cache.salvar_consulta_historica("apps lentas?", {"resposta": 1})
+    await cache.get_persistence_service().aguardar()
+    assert await cache.get_cache(consulta="apps lentas?") == {"resposta": 1}
+
+    assert await cache.invalidar_cache_seletivo({"entidade": "svc-4"})
+    # Com outra versão publicada, o ``rapido`` não aceita a resposta; ``padrao`` e ``longo`` aceitam
+    assert await cache.get_cache(consulta="apps lentas?", tipo_cache="rapido") is cache.get_retrato().dados
+    assert await cache.get_cache(consulta="apps lentas?", tipo_cache="longo") == {"resposta": 1}
+
+    # Nova versão de um cache mapeado: as chaves não lidas continuam sob demanda
+    await cache.get_persistence_service().aguardar()
+    cache._cache["dados"] = {}
+    mapeados = cache.get_cache_sync()
+    assert isinstance(mapeados, mmap_cache.DadosMapeados)
+    cache._invalidar_entidades(["g0"], {"cache_valido": False})
+    novo = cache.get_retrato().dados
+    assert isinstance(novo, mmap_cache.DadosMapeados) and "logs" in novo._pendentes
+    assert novo["entidades"][0]["cache_valido"] is False and "cache_valido" not in mapeados["entidades"][0]
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+from benchmarks import collection
+
+
+@pytest.mark.asyncio
+async def test_benchmark_gera_relatorio_em_json():
+    relatorio = await collection.rodar_benchmarks(["collect_full_data"], [20], ["local"], timeout=300)
+    json.dumps(relatorio)
+
+    resultado, = relatorio["resultados"]
+    assert resultado["erro"] is None
+    assert resultado["cenario"] == "collect_full_data"
+    assert resultado["entidades_coletadas"] == 20
+    assert resultado["requisicoes"] > 0
+    assert resultado["requisicoes_por_entidade"] == pytest.approx(resultado["requisicoes"] / 20, abs=1e-3)
+    assert resultado["bytes_cache_completo"] > 0
+    assert resultado["tempo_s"] > 0
+    if collection.RESOURCE_DISPONIVEL:
+        assert resultado["pico_rss_mb"] > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cenario", [c for c in collection.CENARIOS if c != "collect_full_data"])
+async def test_todos_os_cenarios_medem_coleta_real(cenario):
+    resultado, = (await collection.rodar_benchmarks([cenario], [20], ["local"], timeout=300))["resultados"]
+    assert resultado["erro"] is None
+    assert 0 < resultado["entidades_coletadas"] <= 20
+    assert resultado["requisicoes"] > 0 and resultado["bytes_cache_completo"] > 0
@@ -0,0 +1,118 @@
+import pytest
+from utils import newrelic_advanced_collector as coletor
+from utils.collection_journal import CollectionJournal
+from utils.fake_newrelic_server import ConfigServidor, FakeNewRelicServer
+from utils.nrql_cache import get_query_cache
+
+
+def test_journal_retoma_e_ignora_linha_interrompida(tmp_path):
+    caminho = tmp_path / "checkpoint.ndjson"
+    journal = CollectionJournal(caminho)
+    assert not journal.retomar(agora=1000).retomando
+    journal.registrar_entidade({"guid": "a", "domain": "APM"})
+    journal.registrar_pagina("cursor-1", 1)
+    journal.registrar_entidade({"guid": "b", "domain": "APM"})
+    journal.fechar()
+    with open(caminho, "a", encoding="utf-8") as f:
+        f.write('{"t": "entidade", "guid": "c", "da')  # queda no meio da escrita
+
+    journal = CollectionJournal(caminho)
+    estado = journal.retomar(agora=1010)
+    assert set(estado.concluidas) == {"a", "b"}
+    assert (estado.cursor, estado.posicao) == ("cursor-1", 1)
+    journal.registrar_pagina(None, 2)
+    journal.fechar()
+
+    estado = CollectionJournal(caminho).retomar(agora=1020)
+    assert estado.listagem_concluida and set(estado.concluidas) == {"a", "b"}
+
+    # Journal expirado ou concluído começa do zero
+    assert not CollectionJournal(caminho, max_age=5).retomar(agora=5000).retomando
+    journal = CollectionJournal(caminho)
+    journal.retomar()
+    journal.concluir()
+    assert not caminho.exists()
+
+
+@pytest.mark.asyncio
+async def test_coleta_completa_retomada_pula_guids_concluidos(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(get_query_cache(), "enabled", False)
+    coletadas = []
+    original = coletor.collect_entities_complete_data
+
+    async def espiao(entidades, *args, **kwargs):
+        coletadas.append([e["guid"] for e in entidades])
+        return await original(entidades, *args, **kwargs)
+
+    async with FakeNewRelicServer(ConfigServidor(entidades=60, page_size=20)) as servidor:
+        monkeypatch.setattr(coletor, "NR_GRAPHQL_URL", f"{servidor.url}/graphql")
+        monkeypatch.setattr(coletor, "collect_entities_complete_data", espiao)
+
+        # Primeira execução cai depois da segunda página
+        registrar_pagina = CollectionJournal.registrar_pagina
+
+        def cair_na_segunda(self, cursor, posicao):
+            registrar_pagina(self, cursor, posicao)
+            if posicao == 40:
+                raise RuntimeError("queda simulada")
+
+        monkeypatch.setattr(CollectionJournal, "registrar_pagina", cair_na_segunda)
+        assert "erro" in await coletor.collect_full_data()
+        assert sum(len(c) for c in coletadas) == 40
+
+        monkeypatch.setattr(CollectionJournal, "registrar_pagina", registrar_pagina)
+        coletadas.clear()
+        resultado = await coletor.collect_full_data()
+
+    assert sum(len(c) for c in coletadas) == 20  # só a terceira página
+    assert resultado["total_entidades"] == 60
+    assert len({e["guid"] for e in resultado["entidades"]}) == 60
+    assert not (tmp_path / "historico" / "coleta_checkpoint.ndjson").exists()
+
+
+@pytest.mark.asyncio
+async def test_cursor_expirado_relista_e_pagina_com_erro_nao_conclui_listagem(tmp_path, monkeypatch):
+    from utils.entity_pager import ErroDePagina
+
+    monkeypatch.chdir(tmp_path)
+    paginas = [[{"guid": f"g{i}", "domain": "APM"}] for i in range(3)]
+    falhar_em = {"2"}
+
+    async def listar(session=None, cursor=None, com_cursor=False):
+        if cursor == "expirado":
+            raise ErroDePagina("cursor inválido")
+        indice = int(cursor or 0)
+        while indice < len(paginas):
+            if str(indice) in falhar_em:
+                raise ErroDePagina("All attempts failed")
+            proximo = str(indice + 1) if indice + 1 < len(paginas) else None
+            yield paginas[indice], proximo
+            indice += 1
+
+    async def coletar(entidades, *args, ao_concluir=None, **kwargs):
+        for e in entidades:
+            ao_concluir(e)
+        return entidades
+
+    async def sem_globais(session):
+        return {}
+
+    monkeypatch.setattr(coletor, "iter_entity_pages", listar)
+    monkeypatch.setattr(coletor, "collect_entities_complete_data", coletar)
+    monkeypatch.setattr(coletor, "collect_global_data", sem_globais)
+    caminho = tmp_path / "historico" / "coleta_checkpoint.ndjson"
+
+    # Página com erro no meio: a coleta falha e o journal não marca a listagem como concluída
+    assert "erro" in await coletor.collect_full_data()
+    estado = CollectionJournal(caminho)._ler()
+    assert not estado.listagem_concluida and estado.cursor == "2" and set(estado.concluidas) == {"g0", "g1"}
+
+    # Retomada com cursor expirado: relista do início pulando o que já foi coletado
+    journal = CollectionJournal(caminho)
+    journal.retomar()
+    journal.registrar_pagina("expirado", 2)
+    journal.fechar()
+    falhar_em.clear()
+    resultado = await coletor.collect_full_data()
+    assert resultado["total_entidades"] == 3 and not caminho.exists()
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from utils import cache, newrelic_accounts, segment_store
+from utils import newrelic_advanced_collector as coletor
+from utils.collection_shards import AnelConsistente, CoordenadorShards, coletar_shard, executar_worker, publicar_rodada
+from utils.fake_newrelic_server import ConfigServidor, FakeNewRelicServer
+from utils.nrql_cache import get_query_cache
+
+
+def test_anel_distribui_e_move_pouco_ao_crescer():
+    guids = [f"guid-{i}" for i in range(4000)]
+    quatro, cinco = AnelConsistente(4), AnelConsistente(5)
+    por_shard = [sum(1 for g in guids if quatro.shard_de(g) == s) for s in range(4)]
+    assert all(600 < n < 1400 for n in por_shard)
+    movidas = sum(1 for g in guids if quatro.shard_de(g) != cinco.shard_de(g))
+    # Só as entidades que foram para o shard novo mudam de dono
+    assert movidas < len(guids) * 0.35
+    assert all(cinco.shard_de(g) == 4 for g in guids if quatro.shard_de(g) != cinco.shard_de(g))
+
+
+def test_concessao_expira_e_tentativas_se_esgotam(tmp_path):
+    coordenador = CoordenadorShards(tmp_path / "c.sqlite3", lease=60, max_tentativas=2)
+    rodada = coordenador.iniciar_rodada(2, agora=1000)
+    assert coordenador.reivindicar("a", rodada, agora=1000) == 0
+    assert coordenador.reivindicar("b", rodada, agora=1000) == 1
+    assert coordenador.reivindicar("c", rodada, agora=1030) is None
+
+    # "a" caiu sem heartbeat: o shard 0 volta para outro worker e a saída de "a" é recusada
+    assert coordenador.renovar(rodada, 1, "b", agora=1050)
+    assert coordenador.reivindicar("c", rodada, agora=1100) == 0
+    assert not coordenador.concluir(rodada, 0, "a", "x", 1)
+    assert coordenador.concluir(rodada, 0, "c", "saida-0", 3)
+
+    assert coordenador.falhar(rodada, 1, "b", "boom")
+    assert coordenador.reivindicar("d", rodada, agora=1110) == 1
+    assert coordenador.falhar(rodada, 1, "d", "boom")
+    assert coordenador.reivindicar("e", rodada, agora=1120) is None
+    assert coordenador.rodada_esgotada(rodada) and not coordenador.rodada_concluida(rodada)
+    assert coordenador.get_status(rodada)["por_status"] == {"concluido": 1, "falhou": 1}
+
+
+@pytest.mark.asyncio
+async def test_rodada_com_workers_em_paralelo_cobre_todas_as_entidades(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(get_query_cache(), "enabled", False)
+    monkeypatch.setattr(newrelic_accounts, "_contas", [])
+    coordenador = CoordenadorShards(tmp_path / "c.sqlite3")
+    rodada = coordenador.iniciar_rodada(3)
+
+    async with FakeNewRelicServer(ConfigServidor(entidades=30)) as servidor:
+        monkeypatch.setattr(coletor, "NR_GRAPHQL_URL", f"{servidor.url}/graphql")
+        concluidos = await asyncio.gather(*(
+            executar_worker(coordenador, f"w{i}", rodada, raiz=tmp_path / "shards") for i in range(2)
+        ))
+        # Referência: a mesma coleta sem particionar
+        await coletar_shard(0, 1, tmp_path / "unico")
+
+    assert sum(concluidos) == 3 and coordenador.rodada_concluida(rodada)
+    shards = coordenador.shards(rodada)
+    assert all(s["entidades"] > 0 for s in shards)
+
+    # O coordenador publica as saídas como geração do cache em segmentos, sem carregá-las
+    raiz_segmentos = tmp_path / "segmentos"
+    manifesto = publicar_rodada(coordenador, rodada, raiz_segmentos)
+    assert manifesto["origem"] == segment_store.ORIGEM_SHARDS
+    assert manifesto["total_registros"] == sum(s["entidades"] for s in shards)
+    dados = segment_store.carregar_dados(raiz_segmentos)
+    assert "shard" not in dados and dados["shards"] == {"rodada": rodada, "total": 3}
+    guids = [e["guid"] for e in dados["entidades"]]
+    referencia = segment_store.carregar_dados(tmp_path / "unico")["entidades"]
+    assert len(guids) == len(set(guids)) == len(referencia) > 0
+    assert set(guids) == {e["guid"] for e in referencia}
+    assert sum(dados["contagem_por_dominio"].values()) == len(guids)
+    assert "logs" in dados and "status_global" in dados
+    # Cada shard gravou só as entidades que o anel atribui a ele
+    anel = AnelConsistente(3)
+    for s in shards:
+        assert all(anel.shard_de(e["guid"]) == s["shard"] for e in segment_store.carregar_dados(s["saida"])["entidades"])
+
+
+@pytest.mark.asyncio
+async def test_servidor_carrega_geracao_publicada_pelos_shards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    saidas = []
+    for shard in range(2):
+        saida = tmp_path / f"shard-{shard}"
+        globais = {"timestamp": "t", "shard": {"indice": shard, "total": 2}}
+        if shard == 0:
+            globais["logs"] = ["x"]
+        segment_store.gravar_dados({"entidades": [{"guid": f"g{shard}", "domain": "APM"}], **globais}, saida)
+        saidas.append(saida)
+
+    segment_store.publicar_geracao(saidas, segment_store.SEGMENT_DIR, globais={"shard": None}, origem=segment_store.ORIGEM_SHARDS)
+    assert await cache.recarregar_geracao_shards()
+    dados = cache._cache["dados"]
+    assert [e["guid"] for e in dados["entidades"]] == ["g0", "g1"] and dados["logs"] == ["x"]
+    assert len(dados["APM"]) == 2
+    # A mesma geração não é recarregada; as gravações do próprio servidor também não
+    assert not await cache.recarregar_geracao_shards()
+    await cache.salvar_cache_no_disco()
+    await cache.get_persistence_service().aguardar()
+    assert not await cache.recarregar_geracao_shards()
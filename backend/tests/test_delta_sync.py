@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta
+import pytest
+from utils.delta_sync import FingerprintTable, entity_fingerprint, sincronizar
+
+
+def entidade(guid, domain="APM", reporting=True, tags=None, alerta=None):
+    return {"guid": guid, "name": f"app-{guid}", "domain": domain, "entityType": "APPLICATION",
+            "reporting": reporting, "tags": tags or [{"key": "env", "values": ["prod"]}], "alertSeverity": alerta}
+
+
+def coletor(chamadas, falhar=()):
+    async def coletar(alvo):
+        chamadas.append([e["guid"] for e in alvo])
+        resultado = []
+        for e in alvo:
+            completa = dict(e, metricas={"30min": {"apdex": 1}})
+            if e["guid"] in falhar:
+                completa["problema"] = "ERRO_COLETA: timeout"
+            resultado.append(completa)
+        return resultado
+    return coletar
+
+
+def test_fingerprint_ignora_ordem_das_tags_e_detecta_reporting():
+    a = entidade("a", tags=[{"key": "x", "values": ["2", "1"]}, {"key": "env", "values": ["prod"]}])
+    b = entidade("a", tags=[{"key": "env", "values": ["prod"]}, {"key": "x", "values": ["1", "2"]}])
+    assert entity_fingerprint(a) == entity_fingerprint(b)
+    assert entity_fingerprint(a) != entity_fingerprint(dict(a, reporting=False))
+
+
+@pytest.mark.asyncio
+async def test_segundo_ciclo_recoleta_so_o_delta(tmp_path):
+    tabela = FingerprintTable(tmp_path / "delta.json")
+    chamadas = []
+    listagem = [entidade("a"), entidade("b"), entidade("c")]
+    cache, _ = await sincronizar(tabela, listagem, {}, coletor(chamadas))
+    assert chamadas == [["a", "b", "c"]]
+
+    anteriores = {e["guid"]: e for e in cache}
+    listagem = [entidade("a"), entidade("b", reporting=False), entidade("c", alerta="CRITICAL"), entidade("d")]
+    cache, plano = await sincronizar(tabela, listagem, anteriores, coletor(chamadas))
+    assert sorted(chamadas[1]) == ["b", "c", "d"]
+    assert [e["guid"] for e in plano.unchanged] == ["a"]
+    assert cache[0] is anteriores["a"]
+    assert [e["guid"] for e in cache] == ["a", "b", "c", "d"]
+    assert tabela.entries["b"]["last_reporting_change"] is not None
+
+
+@pytest.mark.asyncio
+async def test_removidas_viram_lapides_respeitando_o_escopo(tmp_path):
+    tabela = FingerprintTable(tmp_path / "delta.json")
+    await sincronizar(tabela, [entidade("a"), entidade("b"), entidade("i", domain="INFRA")], {}, coletor([]))
+
+    anteriores = {"a": entidade("a"), "b": entidade("b")}
+    cache, plano = await sincronizar(tabela, [entidade("a")], anteriores, coletor([]), escopo="APM")
+    assert plano.removed == ["b"]
+    assert [e["guid"] for e in cache] == ["a"]
+    assert [t["guid"] for t in tabela.tombstones()] == ["b"]
+
+    # Entidade que reaparece é tratada como nova
+    plano = tabela.plan([entidade("b")], escopo="APM")
+    assert [e["guid"] for e in plano.new] == ["b"]
+
+    # Lápides expiradas são descartadas
+    tabela.aplicar(tabela.plan([], escopo="APM"), agora=datetime.now() + timedelta(seconds=tabela.tombstone_ttl + 1))
+    assert "b" not in tabela.entries and "i" in tabela.entries
+
+
+@pytest.mark.asyncio
+async def test_falha_de_coleta_e_expiracao_forcam_nova_coleta(tmp_path):
+    tabela = FingerprintTable(tmp_path / "delta.json", max_age=60)
+    await sincronizar(tabela, [entidade("a"), entidade("b")], {}, coletor([], falhar={"b"}))
+    assert "b" not in tabela.entries
+
+    plano = tabela.plan([entidade("a"), entidade("b")], agora=datetime.now() + timedelta(seconds=120))
+    assert [e["guid"] for e in plano.new] == ["b"]
+    assert [e["guid"] for e in plano.stale] == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_tabela_persiste_entre_execucoes(tmp_path):
+    caminho = tmp_path / "historico" / "delta.json"
+    tabela = FingerprintTable(caminho)
+    await sincronizar(tabela, [entidade("a")], {}, coletor([]))
+    tabela.save()
+
+    recarregada = FingerprintTable(caminho).load()
+    assert recarregada.entries["a"]["fingerprint"] == entity_fingerprint(entidade("a"))
+    assert [e["guid"] for e in recarregada.plan([entidade("a")]).unchanged] == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_pagina_com_erro_no_meio_nao_remove_entidades(tmp_path, monkeypatch):
+    from utils import cache, delta_sync
+    import utils.newrelic_advanced_collector as coletor_avancado
+    from utils.entity_pager import iter_pages, parse_entity_search_page
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    monkeypatch.setattr(delta_sync, "_table", FingerprintTable(tmp_path / "delta.json"))
+    listagem = [entidade(g) for g in "abcd"]
+    await sincronizar(delta_sync._table, listagem, {}, coletor([]))
+    await cache.atualizar_cache_com_dados({"timestamp": "2026-01-01T00:00:00", "entidades": listagem})
+    versao = cache.get_versao_cache()
+
+    async def paginas_com_erro(session=None, **kwargs):
+        async def fetch_page(cursor):
+            if cursor:  # segunda página: erro transitório da API
+                return parse_entity_search_page({"error": "All attempts failed"})
+            return listagem[:1], "c1"
+        async for page in iter_pages(fetch_page):
+            yield page
+
+    async def nao_coletar(*args, **kwargs):
+        raise AssertionError("não deveria coletar com a listagem incompleta")
+
+    monkeypatch.setattr(coletor_avancado, "iter_entity_pages", paginas_com_erro)
+    monkeypatch.setattr(coletor_avancado, "collect_entities_complete_data", nao_coletar)
+    assert await cache.atualizar_cache_delta() is False
+    assert cache.get_versao_cache() == versao
+    assert delta_sync._table.tombstones() == []
+    assert [e["guid"] for e in cache.get_retrato().dados["entidades"]] == list("abcd")
+
+
+@pytest.mark.asyncio
+async def test_save_async_grava_fora_do_loop(tmp_path):
+    from utils.cache_persistence import get_persistence_service
+
+    tabela = FingerprintTable(tmp_path / "delta.json")
+    await sincronizar(tabela, [entidade("a")], {}, coletor([]))
+    await tabela.save_async()
+    await get_persistence_service().aguardar()
+    assert FingerprintTable(tmp_path / "delta.json").load().entries.keys() == {"a"}
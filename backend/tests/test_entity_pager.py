@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+from utils.entity_pager import ErroDePagina, iter_pages, parse_entity_search_page
+from utils.newrelic_collector import NewRelicCollector
+
+
+def paginas_fake(n, atraso=0.0, chamadas=None):
+    async def fetch_page(cursor):
+        indice = int(cursor) if cursor else 0
+        if chamadas is not None:
+            chamadas.append(indice)
+        await asyncio.sleep(atraso)
+        proximo = str(indice + 1) if indice + 1 < n else None
+        return [{"guid": f"g{indice}"}], proximo
+    return fetch_page
+
+
+@pytest.mark.asyncio
+async def test_itera_todas_as_paginas_com_prefetch():
+    chamadas = []
+    paginas = []
+    async for page in iter_pages(paginas_fake(3, chamadas=chamadas)):
+        # A página seguinte já foi solicitada antes de a atual ser processada
+        await asyncio.sleep(0)
+        paginas.append(page)
+        if len(paginas) < 3:
+            assert len(chamadas) == len(paginas) + 1
+    assert [p[0]["guid"] for p in paginas] == ["g0", "g1", "g2"]
+
+
+@pytest.mark.asyncio
+async def test_processamento_se_sobrepoe_a_busca():
+    inicio = asyncio.get_running_loop().time()
+    async for _ in iter_pages(paginas_fake(4, atraso=0.05)):
+        await asyncio.sleep(0.05)  # "coleta de métricas" da página
+    # Sem prefetch seriam ~0.4s (4 x busca + 4 x processamento)
+    assert asyncio.get_running_loop().time() - inicio < 0.33
+
+
+@pytest.mark.asyncio
+async def test_cursor_repetido_interrompe_e_interrupcao_cancela_prefetch():
+    async def sempre_mesmo_cursor(cursor):
+        return [{"guid": "x"}], "c"
+
+    paginas = [p async for p in iter_pages(sempre_mesmo_cursor)]
+    assert len(paginas) == 2
+
+    async for _ in iter_pages(paginas_fake(100, atraso=0.01)):
+        break  # sai cedo: o prefetch pendente é cancelado sem erro
+
+
+def test_parse_entity_search_page():
+    resposta = {"data": {"actor": {"entitySearch": {"results": {"entities": [{"guid": "a"}], "nextCursor": "n"}}}}}
+    assert parse_entity_search_page(resposta) == ([{"guid": "a"}], "n")
+    with pytest.raises(ErroDePagina):
+        parse_entity_search_page({"errors": ["x"]})
+    with pytest.raises(ErroDePagina):
+        parse_entity_search_page({"data": None})
+
+
+@pytest.mark.asyncio
+async def test_pagina_com_erro_no_meio_interrompe_com_excecao():
+    async def fetch_page(cursor):
+        if cursor == "2":
+            return parse_entity_search_page({"error": "All attempts failed"})
+        indice = int(cursor or 0)
+        return [{"guid": f"g{indice}"}], str(indice + 1)
+
+    paginas = []
+    with pytest.raises(ErroDePagina):
+        async for page in iter_pages(fetch_page):
+            paginas.append(page)
+    assert len(paginas) == 2
+
+
+@pytest.mark.asyncio
+async def test_collect_entities_percorre_todas_as_paginas():
+    coletor = NewRelicCollector(api_key="x", account_id="1", query_key="x")
+    coletor._fetch_entity_page = paginas_fake(5)
+    entidades = await coletor.collect_entities()
+    assert [e["guid"] for e in entidades] == [f"g{i}" for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_collect_entities_with_metrics_processa_pagina_a_pagina(monkeypatch):
+    import utils.newrelic_collector as modulo
+
+    coletor = NewRelicCollector(api_key="x", account_id="1", query_key="x")
+    coletor._fetch_entity_page = paginas_fake(3)
+
+    async def sem_listagem_completa():
+        raise AssertionError("não deveria carregar todas as entidades antes das métricas")
+
+    class LoteVazio:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def coletar(self, entidades):
+            assert len(entidades) == 1  # uma página por vez
+            return {}
+
+    async def metricas(entity, lote=None):
+        return {**entity, "metricas": {"30min": {"x": 1}}}
+
+    coletor.collect_entities = sem_listagem_completa
+    coletor.collect_entity_metrics = metricas
+    monkeypatch.setattr(modulo, "NRQLBatchEngine", LoteVazio)
+    entidades = await coletor.collect_entities_with_metrics()
+    assert [e["guid"] for e in entidades] == ["g0", "g1", "g2"]
@@ -0,0 +1,113 @@
+import json
+import os
+
+import pytest
+from utils import cache
+from utils.entity_store import EntityStore
+
+
+def _entidade(i, dominio="APM", time="time-1"):
+    return {
+        "guid": f"g{i}", "name": f"svc-{i}", "domain": dominio, "entityType": f"{dominio}_APPLICATION_ENTITY",
+        "tags": [{"key": "team", "values": [time]}], "metricas": {"30min": {"apdex": 0.9}},
+    }
+
+
+def test_indices_leituras_pontuais_e_atualizacao_parcial(tmp_path):
+    store = EntityStore(tmp_path / "e.sqlite3")
+    store.gravar_muitas([_entidade(i, "APM" if i % 2 else "BROWSER", f"time-{i % 3}") for i in range(9)])
+
+    assert store.obter("g4")["name"] == "svc-4" and store.obter("nao-existe") is None
+    assert store.guids(nome="svc-7") == ["g7"]
+    assert store.guids(dominio="APM") == ["g1", "g3", "g5", "g7"]
+    assert store.guids(tipo="BROWSER_APPLICATION_ENTITY", tag=("team", "time-0")) == ["g0", "g6"]
+    assert store.contagem_por_dominio() == {"APM": 4, "BROWSER": 5}
+    plano = " ".join(r[-1] for r in store._consultar("EXPLAIN QUERY PLAN SELECT guid FROM entidades WHERE nome = ?", ("x",)))
+    assert "idx_entidades_nome" in plano
+
+    # Atualização parcial reindexa só a entidade alterada
+    store.atualizar_parcial("g4", {"name": "renomeada", "tags": [{"key": "team", "values": ["time-9"]}]})
+    assert store.guids(nome="renomeada") == ["g4"] and store.guids(nome="svc-4") == []
+    assert store.guids(tag=("team", "time-9")) == ["g4"]
+    assert store.obter("g4")["metricas"] == {"30min": {"apdex": 0.9}}
+    assert store.atualizar_campos(["g1", "g3", "x"], {"cache_valido": False}) == 2
+
+
+def test_substituir_grava_so_o_que_mudou_e_remonta_os_dados(tmp_path):
+    store = EntityStore(tmp_path / "e.sqlite3")
+    entidades = [_entidade(i) for i in range(4)]
+    dados = {"timestamp": "t1", "logs": {"sample": [1]}, "APM": entidades, "entidades": entidades}
+    assert store.substituir(dados) == {"gravadas": 4, "removidas": 0, "inalteradas": 0}
+
+    alterada = dict(entidades[1], metricas={"30min": {"apdex": 0.5}})
+    novas = [entidades[0], alterada, entidades[3], _entidade(9)]
+    resumo = store.substituir({"timestamp": "t2", "APM": novas, "entidades": novas})
+    assert resumo == {"gravadas": 2, "removidas": 1, "inalteradas": 2}
+
+    montados = store.montar_dados()
+    assert montados["timestamp"] == "t2" and "logs" not in montados
+    assert [e["guid"] for e in montados["entidades"]] == ["g0", "g1", "g3", "g9"]
+    assert montados["APM"] == montados["entidades"]
+    assert montados["entidades"][1]["metricas"]["30min"]["apdex"] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_cache_usa_o_armazenamento_como_base(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    entidades = [_entidade(i, "APM" if i < 3 else "INFRA") for i in range(5)]
+    await cache.atualizar_cache_com_dados({"timestamp": "2026-01-01T00:00:00", "entidades": entidades, "logs": ["x"]})
+
+    assert await cache.invalidar_cache_seletivo({"entidade": "svc-3"})
+    assert cache._cache["dados"]["entidades"][3]["cache_valido"] is False
+    assert await cache.invalidar_cache_seletivo({"dominio": "APM"})
+    store = cache.get_entity_store()
+    assert [e["guid"] for e in store.buscar(dominio="APM") if e["cache_valido"] is False] == ["g0", "g1", "g2"]
+    assert store.obter("g3")["cache_valido"] is False and "cache_valido" not in store.obter("g4")
+
+    # Reinício do processo: a visão de compatibilidade vem do armazenamento indexado
+    cache._cache["dados"] = {}
+    dados = cache.get_cache_sync()
+    assert [e["guid"] for e in dados["entidades"]] == [f"g{i}" for i in range(5)]
+    assert dados["logs"] == ["x"] and len(dados["INFRA"]) == 2
+    assert dados["entidades"][0]["cache_valido"] is False
+
+    # Um cache_completo.json gravado depois por outra ferramenta prevalece e realimenta o armazenamento
+    externo = {"timestamp": "2026-01-02T00:00:00", "entidades": [_entidade(7)]}
+    cache.CACHE_FILE.write_text(json.dumps(externo), encoding="utf-8")
+    futuro = store.gravado_em() + 10
+    os.utime(cache.CACHE_FILE, (futuro, futuro))
+    cache._cache["dados"] = {}
+    assert await cache.carregar_cache_do_disco()
+    assert [e["guid"] for e in cache._cache["dados"]["entidades"]] == ["g7"]
+    assert store.guids() == ["g7"]
+
+
+@pytest.mark.asyncio
+async def test_gravacoes_pontuais_rodam_na_thread_de_persistencia(tmp_path, monkeypatch):
+    import threading
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    await cache.atualizar_cache_com_dados({"timestamp": "2026-01-01T00:00:00", "entidades": [_entidade(i) for i in range(3)]})
+    threads = []
+    gravar_muitas = EntityStore.gravar_muitas
+
+    def espiao(self, entidades):
+        threads.append(threading.current_thread())
+        return gravar_muitas(self, entidades)
+
+    class AgendadorFalso:
+        def atualizar_entidades(self, entidades):
+            pass
+
+        async def atualizar_sinais(self):
+            pass
+
+        async def executar_ciclo(self):
+            return [dict(_entidade(1), metricas={"30min": {"apdex": 0.2}})]
+
+    monkeypatch.setattr(EntityStore, "gravar_muitas", espiao)
+    assert await cache.atualizar_cache_prioritario(AgendadorFalso(), salvar=False) == 1
+    assert threads and threading.main_thread() not in threads
+    assert cache.get_entity_store().obter("g1")["metricas"]["30min"]["apdex"] == 0.2
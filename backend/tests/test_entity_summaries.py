@@ -0,0 +1,44 @@
+import pytest
+import utils.newrelic_advanced_collector as nac
+
+
+@pytest.mark.asyncio
+async def test_get_entities_summaries_em_blocos(monkeypatch):
+    chamadas = []
+
+    async def fake_graphql(query, variables=None, timeout=None, session=None):
+        chamadas.append(variables["guids"])
+        assert "entities(guids: $guids)" in query
+        entidades = []
+        for guid in variables["guids"]:
+            if guid == "sem-summary":
+                entidades.append({"guid": guid, "domain": "EXT"})
+            else:
+                entidades.append({"guid": guid, "domain": "APM", "apmSummary": {"apdexScore": 0.9}})
+        return {"data": {"actor": {"entities": entidades}}}
+
+    monkeypatch.setattr(nac, "execute_graphql_query", fake_graphql)
+    guids = [f"g{i}" for i in range(60)] + ["sem-summary", "g0", None]
+    summaries = await nac.get_entities_summaries(guids)
+
+    # 61 GUIDs únicos -> 3 requisições de até 25
+    assert [len(c) for c in chamadas] == [25, 25, 11]
+    assert summaries["g59"] == {"apdexScore": 0.9}
+    assert summaries["sem-summary"] == {}
+
+
+@pytest.mark.asyncio
+async def test_coleta_completa_reusa_summary_do_lote(monkeypatch):
+    async def fake_summaries(*args, **kwargs):
+        raise AssertionError("não deveria consultar summary individualmente")
+
+    async def fake_advanced(entity, period_key="7d", session=None):
+        return {}
+
+    monkeypatch.setattr(nac, "get_entities_summaries", fake_summaries)
+    monkeypatch.setattr(nac, "get_entity_advanced_data", fake_advanced)
+    entidade = await nac.collect_entity_complete_data(
+        {"guid": "g1", "name": "app", "domain": "APM"}, summary={"apdexScore": 0.8}
+    )
+    for period_key in nac.PERIODOS:
+        assert entidade["metricas"][period_key] == {"apdexScore": 0.8}
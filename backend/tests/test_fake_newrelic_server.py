@@ -0,0 +1,106 @@
+import aiohttp
+import pytest
+from utils.entity_pager import iter_pages, parse_entity_search_page
+from utils.fake_newrelic_server import (
+    MODO_GRAVAR, MODO_REPLAY, ConfigServidor, ContaSintetica, FakeNewRelicServer, responder_graphql, responder_nrql,
+)
+from utils.newrelic_common import carregar_credenciais, usando_servidor_local
+from utils.nrql_batch import NRQLBatchEngine
+
+SEARCH = """
+query EntitiesQuery($cursor: String) {
+  actor { entitySearch(query: "domain IN ('APM','INFRA')") { results(cursor: $cursor) { entities { guid domain } nextCursor } } }
+}
+"""
+
+
+def nrql_graphql(nrql):
+    return {"query": '{ actor { account(id: 1) { nrql(query: "%s") { results } } } }' % nrql}
+
+
+def test_credenciais_ficticias_so_contra_servidor_local(monkeypatch):
+    for nome in ("NEW_RELIC_API_KEY", "NEW_RELIC_QUERY_KEY", "NEW_RELIC_ACCOUNT_ID", "NEW_RELIC_BASE_URL"):
+        monkeypatch.delenv(nome, raising=False)
+    assert carregar_credenciais() == (None, None, None)
+    monkeypatch.setenv("NEW_RELIC_BASE_URL", "http://127.0.0.1:8765")
+    monkeypatch.setenv("NEW_RELIC_ACCOUNT_ID", "7")
+    assert usando_servidor_local()
+    assert carregar_credenciais() == ("local-api-key", "local-query-key", "7")
+
+
+def test_nrql_sintetica_facet_e_timeseries():
+    conta = ContaSintetica(10)
+    guids = [e["guid"] for e in conta.entidades[:2]]
+    lista = ", ".join(f"'{g}'" for g in guids)
+    nrql = (f"SELECT average(cpuPercent) as 'avg.cpu', count(cpuPercent) as 'amostras' FROM Metric "
+            f"WHERE entity.guid IN ({lista}) FACET entity.guid SINCE 24 HOURS AGO TIMESERIES 3 HOURS LIMIT MAX")
+    linhas = responder_nrql(conta, nrql, agora=1_000_000)
+    assert {l["facet"] for l in linhas} == set(guids)
+    assert len(linhas) == 2 * 9  # janela de 24h alinhada em buckets de 3h
+    assert all(0 <= l["avg.cpu"] <= 100 and isinstance(l["amostras"], int) for l in linhas)
+    assert linhas == responder_nrql(conta, nrql, agora=1_000_000)  # determinístico
+
+
+def test_entity_search_filtra_por_query_builder_e_tipo():
+    conta = ContaSintetica(50)
+
+    def guids(query, variaveis=None):
+        resposta = responder_graphql(conta, query, variaveis, page_size=1000)
+        return [e["guid"] for e in resposta["data"]["actor"]["entitySearch"]["results"]["entities"]]
+
+    por_dominio = "query($domain: EntityDomainType!) { actor { entitySearch(queryBuilder: {domain: $domain}) { results { entities { guid } } } } }"
+    assert guids(por_dominio, {"domain": "INFRA"}) == [e["guid"] for e in conta.entidades if e["domain"] == "INFRA"]
+    assert guids("{ actor { entitySearch(query: \"domain = 'APM'\") { results { entities { guid } } } } }") == \
+        [e["guid"] for e in conta.entidades if e["domain"] == "APM"]
+    assert guids("{ actor { entitySearch(query: \"type = 'APM_APPLICATION_ENTITY'\") { results { entities { guid entityType } } } } }") == \
+        [e["guid"] for e in conta.entidades if e["entityType"] == "APM_APPLICATION_ENTITY"] != []
+    assert guids("{ actor { entitySearch(query: \"type = 'DASHBOARD'\") { results { entities { guid } } } } }") == []
+
+
+@pytest.mark.asyncio
+async def test_paginacao_e_metricas_em_lote_contra_o_servidor():
+    async with FakeNewRelicServer(ConfigServidor(entidades=500, page_size=100)) as servidor:
+        async with aiohttp.ClientSession() as session:
+            async def fetch_page(cursor):
+                corpo = {"query": SEARCH, "variables": {"cursor": cursor} if cursor else {}}
+                async with session.post(f"{servidor.url}/graphql", json=corpo) as resposta:
+                    return parse_entity_search_page(await resposta.json())
+
+            entidades = []
+            async for pagina in iter_pages(fetch_page):
+                entidades.extend(pagina)
+            esperadas = [e for e in servidor.conta.entidades if e["domain"] in ("APM", "INFRA")]
+            assert [e["guid"] for e in entidades] == [e["guid"] for e in esperadas]
+
+            async def executar(nrql):
+                async with session.post(f"{servidor.url}/graphql", json=nrql_graphql(nrql)) as resposta:
+                    return await resposta.json()
+
+            resultado = await NRQLBatchEngine(executar, {"24h": "SINCE 24 HOURS AGO"}).coletar(entidades[:5])
+            assert all(resultado[e["guid"]]["24h"] for e in entidades[:5])
+
+
+@pytest.mark.asyncio
+async def test_injecao_de_429_e_replay(tmp_path):
+    arquivo = str(tmp_path / "gravacoes.json")
+    async with FakeNewRelicServer(ConfigServidor(entidades=10, limite_rps=2, retry_after=3)) as servidor:
+        async with aiohttp.ClientSession() as session:
+            status = []
+            for _ in range(4):
+                async with session.post(f"{servidor.url}/graphql", json=nrql_graphql("SELECT count(*) FROM Log")) as r:
+                    status.append((r.status, r.headers.get("Retry-After")))
+            assert status[:2] == [(200, None), (200, None)]
+            assert status[2:] == [(429, "3"), (429, "3")]
+            assert servidor.stats["rate_limited"] == 2
+
+    # Grava contra um "upstream" (outro servidor local) e reproduz depois sem ele
+    async with FakeNewRelicServer(ConfigServidor(entidades=10, semente=1)) as upstream:
+        async with FakeNewRelicServer(ConfigServidor(modo=MODO_GRAVAR, upstream=upstream.url, arquivo_gravacoes=arquivo)) as gravador:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{gravador.url}/graphql", json={"query": SEARCH}) as r:
+                    gravada = await r.json()
+    async with FakeNewRelicServer(ConfigServidor(entidades=3, modo=MODO_REPLAY, arquivo_gravacoes=arquivo)) as replay:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{replay.url}/graphql", json={"query": SEARCH}) as r:
+                assert await r.json() == gravada
+        assert replay.stats["replay_hits"] == 1
@@ -0,0 +1,150 @@
+import re
+
+import pytest
+from utils.incremental_aggregator import IncrementalAggregator, alinhar
+from utils.nrql_batch import NRQLBatchEngine, consultas_por_metrica
+from utils.period_engine import HistogramaMesclavel, SeriePlanejada, derivar_periodos
+
+HORA = 3600
+SERIE = SeriePlanejada(janela=24 * HORA, bucket=3 * HORA, periodos={"24h": 8, "3h": 1})
+MEDIA = {"rollup": "media", "campo": "v", "peso": "n"}
+
+
+def linhas_desde(guid, desde, valores):
+    return [
+        {"facet": guid, "beginTimeSeconds": desde + i * SERIE.bucket, "v": v, "n": 1}
+        for i, v in enumerate(valores)
+    ]
+
+
+def valor_no_minuto(t):
+    """Um evento por minuto; o valor muda a cada hora (não acompanha os buckets de 3 h)."""
+    return float((t // HORA) % 7)
+
+
+def media_real(inicio, fim):
+    """Média ponderada dos eventos em ``[inicio, fim)``: o valor exato da janela deslizante."""
+    valores = [valor_no_minuto(t) for t in range(-(-int(inicio) // 60) * 60, int(fim), 60)]
+    return (sum(valores) / len(valores), len(valores)) if valores else (None, 0)
+
+
+def responder_serie(guid, desde, agora):
+    """Resposta de ``SINCE <desde> TIMESERIES 3 HOURS`` até ``agora`` (o último bucket é parcial)."""
+    linhas = []
+    for inicio_bucket in range(desde, alinhar(agora, SERIE.bucket) + SERIE.bucket, SERIE.bucket):
+        media, n = media_real(inicio_bucket, min(inicio_bucket + SERIE.bucket, agora))
+        if n:
+            linhas.append({"facet": guid, "beginTimeSeconds": inicio_bucket, "v": media, "n": n})
+    return linhas
+
+
+def responder_trechos(guid, agora):
+    trechos = {}
+    for chave, (inicio, fim) in IncrementalAggregator.trechos_iniciais(SERIE, agora).items():
+        media, n = media_real(inicio, fim)
+        trechos[chave] = [{"facet": guid, "v": media, "n": n}] if n else []
+    return trechos
+
+
+def test_primeiro_ciclo_consulta_a_janela_e_os_seguintes_so_o_trecho_novo():
+    agregador = IncrementalAggregator()
+    agora = 1_000_000 * SERIE.bucket + 100 * 60 + 17
+    inicio = agregador.inicio_consulta("cpu", ["g1"], SERIE, agora)
+    assert inicio == alinhar(agora, SERIE.bucket) - 7 * SERIE.bucket
+
+    agregador.registrar("cpu", ["g1"], SERIE, responder_serie("g1", inicio, agora), inicio, MEDIA, agora)
+    valores = agregador.derivar("cpu", ["g1"], SERIE, MEDIA, agora, trechos=responder_trechos("g1", agora))
+    # Janela deslizante exata: [agora - 24 h, agora) e [agora - 3 h, agora)
+    assert valores["g1"]["24h"] == pytest.approx(media_real(agora - 24 * HORA, agora)[0])
+    assert valores["g1"]["3h"] == pytest.approx(media_real(agora - 3 * HORA, agora)[0])
+    # Só os buckets alinhados, o "3h" seria só o trecho do bucket corrente desde o seu início
+    assert agregador.derivar("cpu", ["g1"], SERIE, MEDIA, agora)["g1"]["3h"] != pytest.approx(valores["g1"]["3h"])
+
+    # Dois buckets e alguns minutos depois: consulta a partir do bucket que estava incompleto
+    depois = agora + 2 * SERIE.bucket + 41 * 60
+    desde = agregador.inicio_consulta("cpu", ["g1"], SERIE, depois)
+    assert desde == alinhar(agora, SERIE.bucket)
+    agregador.registrar("cpu", ["g1"], SERIE, responder_serie("g1", desde, depois), desde, MEDIA, depois)
+    assert len(agregador.linhas("cpu", ["g1"], SERIE, depois)) == 8
+    valores = agregador.derivar("cpu", ["g1"], SERIE, MEDIA, depois, trechos=responder_trechos("g1", depois))
+    assert valores["g1"]["24h"] == pytest.approx(media_real(depois - 24 * HORA, depois)[0])
+    assert valores["g1"]["3h"] == pytest.approx(media_real(depois - 3 * HORA, depois)[0])
+
+    # Entidade nova no bloco força a janela inteira
+    assert agregador.inicio_consulta("cpu", ["g1", "g2"], SERIE, depois) == agregador.inicio_janela(SERIE, depois)
+    agregador.esquecer(["g1"])
+    assert agregador.get_status()["series"] == 0
+
+
+def test_histograma_mesclavel():
+    a = HistogramaMesclavel(10, 10, [0, 0, 10])
+    b = HistogramaMesclavel(10, 10, {"buckets": [{"count": 0}] * 9 + [{"count": 10}]})
+    a.mesclar(b)
+    assert a.total == 20
+    assert a.quantil(0.5) == pytest.approx(3.0)
+    assert a.quantil(0.95) == pytest.approx(9.9)
+    with pytest.raises(ValueError):
+        a.mesclar(HistogramaMesclavel(5, 10))
+
+
+@pytest.mark.asyncio
+async def test_engine_com_agregador_consulta_so_o_trecho_novo():
+    queries = []
+
+    async def executar(query):
+        queries.append(query)
+        return []
+
+    agregador = IncrementalAggregator()
+    periodos = {"24h": "SINCE 24 HOURS AGO", "7d": "SINCE 7 DAYS AGO"}
+    entidades = [{"guid": "infra-1", "domain": "INFRA"}]
+    await NRQLBatchEngine(executar, periodos, agregador=agregador).coletar(entidades)
+    await NRQLBatchEngine(executar, periodos, agregador=agregador).coletar(entidades)
+
+    # Por métrica e ciclo: a série (TIMESERIES 1 DAYS) e o trecho inicial de 24h e de 7d
+    series = [q for q in queries if "TIMESERIES" in q]
+    trechos = [q for q in queries if "TIMESERIES" not in q]
+    assert len(series) == 2 * 3 and len(trechos) == 2 * 3 * 2
+    assert consultas_por_metrica(periodos) == 3
+    assert agregador.get_status()["consultas_completas"] == 3
+    assert agregador.get_status()["consultas_incrementais"] == 3
+    assert all("TIMESERIES 1 DAYS" in q and "SINCE 1" in q for q in series)
+    assert all(re.search(r"SINCE \d+ UNTIL \d+ LIMIT MAX$", q) for q in trechos)
+
+
+def test_buffers_compactos_derivam_como_as_linhas_e_expiram():
+    agregador = IncrementalAggregator()
+    agora = 1_000_000 * SERIE.bucket + 100
+    inicio = agregador.inicio_consulta("cpu", ["g1", "g2"], SERIE, agora)
+    linhas = linhas_desde("g1", inicio, [1.0, 2.0, None, 4.0, 5.0, 6.0, 7.0, 8.0]) + linhas_desde("g2", inicio, [3.0] * 8)
+    agregador.registrar("cpu", ["g1", "g2"], SERIE, [l for l in linhas if l["v"] is not None], inicio, MEDIA, agora)
+    esperado = derivar_periodos(agregador.linhas("cpu", ["g1", "g2"], SERIE, agora), MEDIA, SERIE.periodos)
+    assert agregador.derivar("cpu", ["g1", "g2"], SERIE, MEDIA, agora) == esperado
+    assert esperado["g1"]["3h"] == 8.0
+
+    # Próximo ciclo: só o bucket refeito e o novo são devolvidos com ``desde``
+    depois = agora + SERIE.bucket
+    desde = agregador.inicio_consulta("cpu", ["g1"], SERIE, depois)
+    agregador.registrar("cpu", ["g1"], SERIE, linhas_desde("g1", desde, [8.5, 9.0]), desde, MEDIA, depois)
+    alteradas = agregador.linhas("cpu", ["g1"], SERIE, depois, desde=desde)
+    assert [(l["beginTimeSeconds"], l["v"]) for l in alteradas] == [(desde, 8.5), (desde + SERIE.bucket, 9.0)]
+    # g2 não foi consultada neste ciclo: o bucket corrente dela fica vazio, o resto continua válido
+    assert agregador.derivar("cpu", ["g2"], SERIE, MEDIA, depois)["g2"] == {"24h": 3.0}
+
+    # Uma janela inteira sem coleta: a série de g2 é descartada na poda seguinte
+    muito_depois = depois + SERIE.janela
+    desde = agregador.inicio_consulta("cpu", ["g1"], SERIE, muito_depois)
+    agregador.registrar("cpu", ["g1"], SERIE, linhas_desde("g1", desde, [1.0] * 8), desde, MEDIA, muito_depois)
+    assert agregador.get_status()["series"] == 1
+    assert agregador.derivar("cpu", ["g2"], SERIE, MEDIA, muito_depois) == {}
+
+
+def test_percentis_a_partir_dos_buffers():
+    serie_p = {"rollup": "percentil", "campo": "h", "quantil": 0.5, "teto": 10, "bins": 10}
+    agregador = IncrementalAggregator()
+    agora = 1_000_000 * SERIE.bucket + 100
+    inicio = agregador.inicio_janela(SERIE, agora)
+    linhas = [{"facet": "g1", "beginTimeSeconds": inicio + i * SERIE.bucket, "h": [0] * 9 + [4] if i == 7 else [4] + [0] * 9}
+              for i in range(8)]
+    agregador.registrar("lat", ["g1"], SERIE, linhas, inicio, serie_p, agora)
+    assert agregador.derivar("lat", ["g1"], SERIE, serie_p, agora) == derivar_periodos(linhas, serie_p, SERIE.periodos)
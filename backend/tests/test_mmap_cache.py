@@ -0,0 +1,108 @@
+import json
+
+import pytest
+from utils import cache, mmap_cache
+from utils.cache_persistence import serializar_json
+
+
+def _dados(total=6):
+    entidades = [
+        {"guid": f"g{i}", "name": f"svc-{i}", "domain": "APM" if i % 2 else "INFRA", "metricas": {"30min": {"apdex": i / 10}}}
+        for i in range(total)
+    ]
+    return {
+        "timestamp": "2026-01-01T00:00:00",
+        "entidades": entidades,
+        "APM": [e for e in entidades if e["domain"] == "APM"],
+        "INFRA": [e for e in entidades if e["domain"] == "INFRA"],
+        "logs": {"amostra": ["erro 1", "erro 2"]},
+        "incidentes": [],
+    }
+
+
+def test_carga_sob_demanda_e_compatibilidade_com_dict(tmp_path):
+    original = _dados()
+    mmap_cache.gravar(original, tmp_path / "cache.bin")
+    dados = mmap_cache.abrir_dados(tmp_path / "cache.bin")
+
+    # Abrir lê só o índice: nada foi decodificado
+    assert dados.leitor.decodificados == 0
+    assert len(dados) == 6 and "logs" in dados and "inexistente" not in dados
+    assert dados.total_entidades() == 6 and dados.leitor.decodificados == 0
+
+    assert dados["logs"] == {"amostra": ["erro 1", "erro 2"]}
+    assert dados.leitor.decodificados == 1
+    assert dados.entidade("g3")["name"] == "svc-3" and dados.leitor.decodificados == 2
+
+    # A entidade é o mesmo objeto em ``entidades`` e na lista do domínio, como no cache em memória
+    assert dados["APM"][1] is dados["entidades"][3] is dados.entidade("g3")
+    assert dados.leitor.decodificados == 1 + 6
+
+    assert list(dados) == list(original) and dados == original
+    assert json.loads(serializar_json(dados)) == original and json.loads(json.dumps(dados)) == original
+    dados["novo"] = 1
+    del dados["incidentes"]
+    assert dados.pop("timestamp") == "2026-01-01T00:00:00"
+    assert dados.copy() == {k: v for k, v in original.items() if k not in ("incidentes", "timestamp")} | {"novo": 1}
+
+
+def test_geracoes_e_arquivo_invalido(tmp_path):
+    base = tmp_path / "cache.bin"
+    mmap_cache.gravar(_dados(2), base)
+    antigo = mmap_cache.abrir(base)
+    mmap_cache.gravar(_dados(4), base)
+
+    # Quem mapeava a geração anterior continua lendo dela; a carga nova vê a geração nova
+    assert len(antigo.valor("entidades")) == 2
+    assert mmap_cache.abrir_dados(base).total_entidades() == 4
+    antigo.fechar()
+    mmap_cache.gravar(_dados(5), base)
+    assert len(mmap_cache.geracoes(base)) == 1
+
+    # Geração corrompida é ignorada em favor da anterior válida
+    mmap_cache.geracoes(base)[0].with_name("cache.99999999999999999999.bin").write_bytes(b"lixo")
+    assert mmap_cache.abrir_dados(base).total_entidades() == 5
+
+
+@pytest.mark.asyncio
+async def test_cache_sobe_do_binario_sem_decodificar(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    await cache.atualizar_cache_com_dados(_dados())
+    assert mmap_cache.geracoes(cache.CACHE_BIN_FILE)
+
+    cache._cache["dados"] = {}
+    assert await cache.carregar_cache_do_disco()
+    dados = cache._cache["dados"]
+    assert isinstance(dados, mmap_cache.DadosMapeados)
+    assert dados.leitor.decodificados == 1  # só o timestamp, lido na carga
+    assert [e["guid"] for e in dados["entidades"]] == [f"g{i}" for i in range(6)]
+
+    # A invalidação salva o cache, e a próxima subida vê o binário novo
+    assert await cache.invalidar_cache_seletivo({"entidade": "svc-2"})
+    await cache.get_persistence_service().aguardar()
+    cache._cache["dados"] = {}
+    assert isinstance(cache.get_cache_sync(), mmap_cache.DadosMapeados)
+    assert cache._cache["dados"]["entidades"][2]["cache_valido"] is False
+
+    # Gravações pontuais só no armazenamento de entidades (o agendador prioritário) não
+    # descartam o binário: as entidades alteradas são sobrepostas a ele pelo GUID
+    store = cache.get_entity_store()
+    store.atualizar_parcial("g4", {"name": "renomeada"})
+    cache._cache["dados"] = {}
+    dados = cache.get_cache_sync()
+    assert isinstance(dados, mmap_cache.DadosMapeados)
+    assert dados["entidades"][4]["name"] == "renomeada" and dados.entidade("g4")["name"] == "renomeada"
+    assert [e["name"] for e in dados[dados["entidades"][4]["domain"]] if e["guid"] == "g4"] == ["renomeada"]
+
+    # Entidade nova (fora do binário) ou remoção: o armazenamento passa a valer
+    store.gravar({"guid": "g-nova", "name": "nova", "domain": "APM"})
+    cache._cache["dados"] = {}
+    assert not isinstance(cache.get_cache_sync(), mmap_cache.DadosMapeados)
+    assert cache._cache["dados"]["entidades"][-1]["guid"] == "g-nova"
+    await cache.salvar_cache_no_disco()
+    await cache.get_persistence_service().aguardar()
+    store.remover(["g-nova"])
+    cache._cache["dados"] = {}
+    assert not isinstance(cache.get_cache_sync(), mmap_cache.DadosMapeados)
+    assert "g-nova" not in [e["guid"] for e in cache._cache["dados"]["entidades"]]
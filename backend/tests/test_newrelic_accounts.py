@@ -0,0 +1,84 @@
+import json
+
+import pytest
+from utils import newrelic_advanced_collector as coletor
+from utils.fake_newrelic_server import ConfigServidor, FakeNewRelicServer
+from utils.newrelic_accounts import ContaNewRelic, carregar_contas, conta_atual, escopo_cache, usar_conta
+from utils.newrelic_collector import NewRelicCollector
+from utils.nrql_cache import get_query_cache
+from utils.rate_limiter import get_rate_limiter
+
+
+def test_carregar_contas_do_ambiente(monkeypatch):
+    monkeypatch.delenv("NEW_RELIC_ACCOUNTS", raising=False)
+    monkeypatch.delenv("NEW_RELIC_ACCOUNTS_FILE", raising=False)
+    assert carregar_contas() == []
+
+    monkeypatch.setenv("NR_KEY_VAREJO", "chave-varejo")
+    monkeypatch.setenv("NEW_RELIC_ACCOUNTS", json.dumps([
+        {"nome": "varejo", "account_id": 11, "api_key_env": "NR_KEY_VAREJO", "nrql_rate": 5, "concurrency_max": 4},
+        {"nome": "financeiro", "account_id": 22, "api_key": "chave-fin", "base_url": "https://api.eu.newrelic.com/"},
+    ]))
+    varejo, financeiro = carregar_contas()
+    assert varejo.api_key == "chave-varejo" and varejo.rate_limiter.buckets["nrql"].rate == 5
+    assert varejo.concurrency.max_limit == 4
+    assert financeiro.graphql_url("padrao") == "https://api.eu.newrelic.com/graphql"
+    assert varejo.rate_limiter is not financeiro.rate_limiter
+
+    assert conta_atual() is None and escopo_cache("u") == "u"
+    with usar_conta(varejo):
+        assert conta_atual() is varejo and escopo_cache("u") == "u#conta=11"
+    assert conta_atual() is None
+
+    monkeypatch.setenv("NEW_RELIC_ACCOUNTS", json.dumps([{"nome": "a", "account_id": 1}, {"nome": "a", "account_id": 2}]))
+    with pytest.raises(ValueError):
+        carregar_contas()
+
+
+@pytest.mark.asyncio
+async def test_coleta_multi_conta_em_paralelo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(get_query_cache(), "enabled", False)
+    async with FakeNewRelicServer(ConfigServidor(entidades=15, conta=101, semente=1)) as varejo_srv, \
+            FakeNewRelicServer(ConfigServidor(entidades=25, conta=202, semente=2)) as financeiro_srv:
+        contas = [
+            ContaNewRelic(101, "k1", nome="varejo", base_url=varejo_srv.url),
+            ContaNewRelic(202, "k2", nome="financeiro", base_url=financeiro_srv.url),
+        ]
+        coletadas = []
+        resultado = await coletor.collect_all_accounts(contas, ao_coletar=coletadas.append)
+
+        assert varejo_srv.stats["requisicoes"] > 0 and financeiro_srv.stats["requisicoes"] > 0
+        recoletadas = await coletor.collect_entities_by_account(
+            [e for e in coletadas if e["conta"] == "financeiro"][:3], contas=contas)
+
+    # Com ao_coletar as entidades ficam só com o chamador
+    assert resultado["total_entidades"] == 40 and len(coletadas) == 40 and resultado["entidades"] == []
+    por_conta = {nome: [e for e in coletadas if e["conta"] == nome] for nome in ("varejo", "financeiro")}
+    assert len(por_conta["varejo"]) == 15 and len(por_conta["financeiro"]) == 25
+    assert all(e["accountId"] == 101 for e in por_conta["varejo"])
+    assert set(resultado["contas"]) == {"varejo", "financeiro"}
+    assert resultado["contas"]["financeiro"]["account_id"] == "202"
+    assert sum(resultado["contagem_por_dominio"].values()) == 40
+    # Cada conta consumiu os próprios buckets
+    assert all(c.rate_limiter.buckets["graphql"].acquired > 0 for c in contas)
+    assert [e["conta"] for e in recoletadas] == ["financeiro"] * 3
+    assert not list((tmp_path / "historico").glob("coleta_checkpoint*"))
+
+
+@pytest.mark.asyncio
+async def test_relacionamentos_consomem_buckets_da_conta(monkeypatch):
+    monkeypatch.setattr(get_query_cache(), "enabled", False)
+    async with FakeNewRelicServer(ConfigServidor(entidades=5, conta=303, semente=3)) as srv:
+        conta = ContaNewRelic(303, "k3", nome="logistica", base_url=srv.url)
+        nr = NewRelicCollector(api_key="k3", account_id="303", query_key="k3")
+        nr.base_url = conta.graphql_url("padrao")
+        global_antes = get_rate_limiter().buckets["graphql"].acquired
+        with usar_conta(conta):
+            await nr.collect_entity_dependencies(srv.conta.entidades[0]["guid"])
+
+        # Upstream e downstream: uma requisição e um token da conta para cada uma
+        assert srv.stats["graphql"] == 2
+    assert conta.rate_limiter.buckets["graphql"].acquired == 2
+    assert get_rate_limiter().buckets["graphql"].acquired == global_antes
+    assert nr.rate_controller.request_count == 2 and nr.rate_controller.consecutive_failures == 0
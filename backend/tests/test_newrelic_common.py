@@ -1,7 +1,17 @@
 import asyncio
 import aiohttp
 import pytest
-from utils.newrelic_common import execute_nrql_query_common, execute_graphql_query_common
+import pytest_asyncio
+from utils.newrelic_common import (
+    execute_nrql_query_common, execute_graphql_query_common,
+    get_shared_session, close_shared_session
+)
+
+@pytest_asyncio.fixture(autouse=True)
+async def fechar_pool_compartilhado():
+    # Cada teste roda em um event loop próprio; fecha o pool ao final
+    yield
+    await close_shared_session()
 
 @pytest.mark.asyncio
 async def test_nrql_query_closed_session():
@@ -58,3 +68,31 @@ async def test_graphql_query_concurrent():
         )
     results = await asyncio.gather(*[run_query() for _ in range(5)])
     assert all(isinstance(r, dict) for r in results)
+
+@pytest.mark.asyncio
+async def test_shared_session_reused_and_closed():
+    s1 = get_shared_session()
+    s2 = get_shared_session()
+    # Mesma sessão (mesmo pool de conexões) para todos os chamadores
+    assert s1 is s2
+    await close_shared_session()
+    assert s1.closed
+    # Após o fechamento, uma nova sessão é criada sob demanda
+    s3 = get_shared_session()
+    assert s3 is not s1 and not s3.closed
+    await close_shared_session()
+
+def test_shared_session_por_event_loop():
+    sessoes = []
+
+    async def usar():
+        session = get_shared_session()
+        assert get_shared_session() is session and not session.closed
+        assert all(anterior is not session for anterior in sessoes)
+        sessoes.append(session)
+        await close_shared_session()
+
+    # Cada asyncio.run tem o próprio loop: a sessão de um loop anterior não é reaproveitada
+    asyncio.run(usar())
+    asyncio.run(usar())
+    assert len(sessoes) == 2 and all(s.closed for s in sessoes)
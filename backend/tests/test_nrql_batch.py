@@ -0,0 +1,68 @@
+import pytest
+from utils.nrql_batch import (
+    NRQLBatchEngine, METRICAS_POR_DOMINIO, montar_query_facet, distribuir_linhas
+)
+
+PERIODOS = {"30min": "SINCE 30 MINUTES AGO", "24h": "SINCE 24 HOURS AGO"}
+
+
+def resposta_graphql(linhas):
+    return {"data": {"actor": {"account": {"nrql": {"results": linhas}}}}}
+
+
+def test_montar_query_facet():
+    spec = METRICAS_POR_DOMINIO["APM"][0]
+    query = montar_query_facet(spec, ["g1", "g2"], "SINCE 1 HOUR AGO")
+    assert "WHERE entity.guid IN ('g1', 'g2')" in query
+    assert "FACET entity.guid SINCE 1 HOUR AGO LIMIT MAX" in query
+
+
+def test_distribuir_linhas_com_facets_extras():
+    spec = {"chave": "erros", "facets": ["error.message"], "limite_por_entidade": 2, "destinos": ["erros"]}
+    linhas = [
+        {"facet": ["g1", "timeout"], "count": 3},
+        {"facet": ["g1", "500"], "count": 2},
+        {"facet": ["g1", "ignorada"], "count": 1},
+        {"facet": ["g2", "timeout"], "count": 1},
+    ]
+    por_guid = distribuir_linhas(spec, linhas)
+    assert por_guid["g1"] == [
+        {"count": 3, "error.message": "timeout"},
+        {"count": 2, "error.message": "500"},
+    ]
+    assert len(por_guid["g2"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_engine_agrupa_guids_e_redistribui_por_periodo():
+    queries = []
+
+    async def executar(query):
+        queries.append(query)
+        if "apdexScore" in query and "30 MINUTES" in query:
+            return resposta_graphql([
+                {"facet": "apm-1", "entity.guid": "apm-1", "score": 0.9},
+                {"facet": "apm-2", "entity.guid": "apm-2", "score": 0.5},
+            ])
+        if "cpuPercent" in query:
+            return [{"facet": "infra-1", "avg.cpu": 42.0}]
+        return resposta_graphql([])
+
+    entidades = [
+        {"guid": "apm-1", "domain": "APM"},
+        {"guid": "apm-2", "domain": "APM"},
+        {"guid": "apm-3", "domain": "apm"},
+        {"guid": "infra-1", "domain": "INFRA"},
+        {"guid": "ext-1", "domain": "EXT"},
+    ]
+    engine = NRQLBatchEngine(executar, PERIODOS, chunk_size=2, usar_series=False)
+    resultado = await engine.coletar(entidades)
+
+    # APM: 2 blocos x 6 métricas x 2 períodos; INFRA: 1 bloco x 3 métricas x 2 períodos
+    assert len(queries) == engine.queries_executadas == 2 * 6 * 2 + 3 * 2
+    assert resultado["apm-1"] == {"30min": {"apdex": 0.9}}
+    assert resultado["apm-2"] == {"30min": {"apdex": 0.5}}
+    assert resultado["apm-3"] == {}
+    assert resultado["infra-1"] == {"30min": {"cpu_usage": 42.0}, "24h": {"cpu_usage": 42.0}}
+    # Domínios sem métricas em lote continuam no caminho por entidade
+    assert "ext-1" not in resultado
@@ -0,0 +1,67 @@
+import pytest
+from utils import newrelic_common
+from utils.nrql_cache import QueryResponseCache, normalize_query, ttl_for_query
+
+
+def test_ttl_por_janela_since():
+    assert ttl_for_query("SELECT count(*) FROM Log SINCE 30 MINUTES AGO") == 30
+    assert ttl_for_query("SELECT count(*) FROM Log SINCE 24 hours ago") == 300
+    assert ttl_for_query("SELECT count(*) FROM Log SINCE 7 DAYS AGO") == 900
+    assert ttl_for_query("SELECT count(*) FROM Log SINCE 30 DAYS AGO") == 3600
+    assert ttl_for_query("{ actor { user { name } } }") == 60
+
+
+def test_chave_normaliza_texto_e_agrupa_por_bucket():
+    cache = QueryResponseCache(max_bytes=10_000)
+    k1 = cache.make_key("acc", "SELECT *\n   FROM Log  SINCE 30 MINUTES AGO", now=1000)
+    k2 = cache.make_key("acc", "SELECT * FROM Log SINCE 30 MINUTES AGO", now=1010)
+    k3 = cache.make_key("acc", "SELECT * FROM Log SINCE 30 MINUTES AGO", now=1030)
+    assert k1 == k2
+    assert k1 != k3  # bucket de 30 s seguinte
+    assert cache.make_key("acc", "mutation { x }") is None
+    # Páginas de listagem por cursor nunca são reaproveitadas
+    pagina = "{ actor { entitySearch(query: \"domain = 'APM'\") { results { entities { guid } nextCursor } } } }"
+    assert cache.make_key("acc", pagina) is None
+    assert cache.make_key("acc", "query($c: String) { x(cursor: $c) { y } }", {"c": "abc"}) is None
+    assert cache.make_key("acc", "{ actor { user { name } } }", {"cursor": None}) is None
+    assert normalize_query("  a \n b ") == "a b"
+
+
+def test_lru_por_bytes_e_contadores():
+    cache = QueryResponseCache(max_bytes=45)
+    ka, kb, kc = (cache.make_key("acc", q) for q in ("a", "b", "c"))
+    cache.set(ka, {"v": "x" * 10})
+    cache.set(kb, {"v": "y" * 10})
+    assert cache.get(ka) == {"v": "x" * 10}  # ka passa a ser a mais recente
+    cache.set(kc, {"v": "z" * 10})            # excede 45 bytes: despeja kb
+    assert cache.get(kb) is None
+    assert cache.get(kc) is not None
+    cache.set(ka, {"error": "falhou"})         # erros não substituem nem entram no cache
+    stats = cache.get_stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1 and stats["evictions"] == 1
+    assert stats["bytes"] <= 45
+
+
+def test_leitura_devolve_copia_independente():
+    cache = QueryResponseCache()
+    key = cache.make_key("acc", "SELECT 1")
+    cache.set(key, {"results": [1]})
+    cache.get(key)["results"].append(2)
+    assert cache.get(key) == {"results": [1]}
+
+
+@pytest.mark.asyncio
+async def test_execute_nrql_query_common_usa_cache(monkeypatch):
+    cache = QueryResponseCache()
+    monkeypatch.setattr(newrelic_common, "get_query_cache", lambda: cache)
+    key = cache.make_key("http://nr/graphql", "SELECT count(*) FROM Log SINCE 30 MINUTES AGO")
+    cache.set(key, {"data": {"cached": True}})
+
+    def sem_rede(*args, **kwargs):
+        raise AssertionError("não deveria acessar a rede")
+
+    monkeypatch.setattr(newrelic_common, "resolve_session", sem_rede)
+    result = await newrelic_common.execute_nrql_query_common(
+        "SELECT count(*)   FROM Log SINCE 30 MINUTES AGO", headers={}, url="http://nr/graphql"
+    )
+    assert result == {"data": {"cached": True}}
@@ -0,0 +1,91 @@
+import pytest
+from utils import period_engine
+from utils.nrql_batch import NRQLBatchEngine
+from utils.period_engine import derivar_periodos, duracao_periodo, planejar_series
+
+PERIODOS = {
+    "30min": "SINCE 30 MINUTES AGO",
+    "3h": "SINCE 3 HOURS AGO",
+    "24h": "SINCE 24 HOURS AGO",
+    "7d": "SINCE 7 DAYS AGO",
+    "30d": "SINCE 30 DAYS AGO",
+}
+
+
+def linhas_serie(guid, valores, campo="v", pesos=None):
+    linhas = []
+    for i, valor in enumerate(valores):
+        linha = {"facet": guid, "beginTimeSeconds": 1000 + i * 60, "endTimeSeconds": 1060 + i * 60, campo: valor}
+        if pesos is not None:
+            linha["n"] = pesos[i]
+        linhas.append(linha)
+    return linhas
+
+
+def test_planejamento_respeita_limite_de_buckets():
+    assert duracao_periodo("SINCE 7 DAYS AGO") == 7 * 86400
+    assert duracao_periodo("SINCE yesterday") is None
+
+    series, avulsos = planejar_series(dict(PERIODOS, custom="SINCE yesterday"))
+    assert avulsos == {"custom": "SINCE yesterday"}
+    assert [s.clausula for s in series] == [
+        "SINCE 30 DAYS AGO TIMESERIES 3 HOURS",
+        "SINCE 30 MINUTES AGO TIMESERIES 30 MINUTES",
+    ]
+    assert series[0].periodos == {"30d": 240, "7d": 56, "24h": 8, "3h": 1}
+    assert series[1].periodos == {"30min": 1}
+    assert all(s.janela // s.bucket <= period_engine.MAX_BUCKETS for s in series)
+
+
+@pytest.mark.parametrize("numpy_disponivel", [True, False])
+def test_rollups_por_fatia(monkeypatch, numpy_disponivel):
+    if numpy_disponivel and not period_engine.NUMPY_DISPONIVEL:
+        pytest.skip("numpy não instalado")
+    monkeypatch.setattr(period_engine, "NUMPY_DISPONIVEL", numpy_disponivel)
+    janelas = {"ultimo_bucket": 1, "tres": 3, "tudo": 4}
+
+    linhas = linhas_serie("g1", [1.0, 5.0, None, 2.0]) + linhas_serie("g2", [None, None, None, None])
+    assert derivar_periodos(linhas, {"rollup": "max", "campo": "v"}, janelas) == {
+        "g1": {"ultimo_bucket": 2.0, "tres": 5.0, "tudo": 5.0}, "g2": {}
+    }
+    assert derivar_periodos(linhas, {"rollup": "ultimo", "campo": "v"}, {"tres": 3})["g1"] == {"tres": 2.0}
+    assert derivar_periodos(linhas, {"rollup": "soma", "campo": "v"}, {"tudo": 4})["g1"] == {"tudo": 8.0}
+
+    ponderada = linhas_serie("g1", [1.0, 0.5, 0.0, 0.8], pesos=[10, 30, 0, 10])
+    resultado = derivar_periodos(ponderada, {"rollup": "media", "campo": "v", "peso": "n"}, {"tudo": 4, "ultimo_bucket": 1})
+    assert resultado["g1"]["tudo"] == pytest.approx((10 + 15 + 8) / 50)
+    assert resultado["g1"]["ultimo_bucket"] == pytest.approx(0.8)
+
+    memoria = [
+        {"facet": "g1", "beginTimeSeconds": 0, "usado": 2.0, "total": 8.0},
+        {"facet": "g1", "beginTimeSeconds": 60, "usado": 6.0, "total": 8.0},
+    ]
+    serie = {"rollup": "razao", "numerador": "usado", "denominador": "total", "fator": 100}
+    assert derivar_periodos(memoria, serie, {"1": 1, "2": 2})["g1"] == {"1": 75.0, "2": 50.0}
+
+
+@pytest.mark.asyncio
+async def test_engine_usa_uma_serie_por_metrica_e_mantem_o_contrato():
+    queries = []
+
+    async def executar(query):
+        queries.append(query)
+        if "cpuPercent" in query and "TIMESERIES 3 HOURS" in query:
+            return [
+                {"facet": "infra-1", "beginTimeSeconds": i, "avg.cpu": float(i), "amostras": 1}
+                for i in range(240)
+            ]
+        return []
+
+    engine = NRQLBatchEngine(executar, PERIODOS)
+    resultado = await engine.coletar([{"guid": "infra-1", "domain": "INFRA"}])
+
+    # INFRA: 3 métricas x 2 séries, no lugar de 3 métricas x 5 períodos
+    assert len(queries) == 3 * 2
+    assert all("FACET entity.guid SINCE" in q and "TIMESERIES" in q for q in queries)
+    metricas = resultado["infra-1"]
+    assert metricas["3h"] == {"cpu_usage": 239.0}
+    assert metricas["24h"]["cpu_usage"] == pytest.approx(sum(range(232, 240)) / 8)
+    assert metricas["7d"]["cpu_usage"] == pytest.approx(sum(range(184, 240)) / 56)
+    assert metricas["30d"]["cpu_usage"] == pytest.approx(sum(range(240)) / 240)
+    assert "30min" not in metricas
@@ -0,0 +1,129 @@
+import pytest
+from utils.priority_scheduler import (
+    NIVEL_FRIO, NIVEL_MORNO, NIVEL_QUENTE, PriorityCollectionScheduler, SinaisPrioridade,
+    classificar, coletar_sinais,
+)
+
+INTERVALOS = {NIVEL_QUENTE: 60, NIVEL_MORNO: 900, NIVEL_FRIO: 21600}
+
+
+def entidade(guid, reporting=True, **metricas):
+    return {"guid": guid, "domain": "APM", "reporting": reporting, "metricas": metricas}
+
+
+def coletor(chamadas):
+    async def coletar(alvo):
+        chamadas.append([e["guid"] for e in alvo])
+        return [dict(e) for e in alvo]
+    return coletar
+
+
+def test_classificacao_por_sinais_e_metricas():
+    sinais = SinaisPrioridade(incidentes={"inc"}, deploys={"dep"})
+    assert classificar(entidade("inc", reporting=False), sinais) == (NIVEL_QUENTE, ["incidente_aberto"])
+    assert classificar(entidade("dep"), sinais)[1] == ["deploy_recente"]
+    assert classificar(entidade("a", **{"30min": {"apdex": 0.5}}))[1] == ["apdex_ruim"]
+    erro = entidade("e", **{"30min": {"error_rate": 6.0}, "24h": {"error_rate": 2.0}})
+    assert classificar(erro)[1] == ["erro_subindo"]
+    estavel = entidade("s", **{"30min": {"errorRate": 2.1, "apdexScore": 0.95}, "24h": {"errorRate": 2.0}})
+    assert classificar(estavel) == (NIVEL_MORNO, [])
+    assert classificar(entidade("parada", reporting=False)) == (NIVEL_FRIO, ["sem_reporte"])
+
+
+@pytest.mark.asyncio
+async def test_quentes_voltam_a_cada_minuto_e_frios_em_cadencia_longa():
+    chamadas = []
+    agendador = PriorityCollectionScheduler(coletor(chamadas), intervalos=INTERVALOS)
+    agendador.atualizar_entidades(
+        [entidade("quente", **{"30min": {"apdex": 0.3}}), entidade("morna"), entidade("fria", reporting=False)],
+        agora=0,
+    )
+    await agendador.executar_ciclo(agora=0)
+    assert sorted(chamadas[0]) == ["fria", "morna", "quente"]
+
+    await agendador.executar_ciclo(agora=61)
+    assert chamadas[-1] == ["quente"]
+    await agendador.executar_ciclo(agora=901)
+    assert sorted(chamadas[-1]) == ["morna", "quente"]
+    assert agendador.get_status()["por_nivel"] == {NIVEL_QUENTE: 1, NIVEL_MORNO: 1, NIVEL_FRIO: 1}
+
+
+@pytest.mark.asyncio
+async def test_incidente_novo_antecipa_a_coleta():
+    chamadas = []
+    agendador = PriorityCollectionScheduler(coletor(chamadas), intervalos=INTERVALOS)
+    agendador.atualizar_entidades([entidade("a"), entidade("b")], agora=0)
+    await agendador.executar_ciclo(agora=0)
+
+    agendador.aplicar_sinais(SinaisPrioridade(incidentes={"b"}), agora=30)
+    await agendador.executar_ciclo(agora=60)
+    assert chamadas[-1] == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_orcamento_por_ciclo_e_protecao_contra_inanicao():
+    chamadas = []
+    agendador = PriorityCollectionScheduler(
+        coletor(chamadas), orcamento=10, custo_entidade=lambda e: 5,
+        intervalos=INTERVALOS, aging_seconds=60, max_starvation=3600,
+    )
+    quentes = [entidade(f"q{i}", **{"30min": {"apdex": 0.1}}) for i in range(3)]
+    agendador.atualizar_entidades(quentes + [entidade("fria", reporting=False)], agora=0)
+
+    # Orçamento para 2 entidades: quentes primeiro, o resto fica na fila
+    await agendador.executar_ciclo(agora=0)
+    assert chamadas[-1] == ["q0", "q1"]
+    assert agendador.get_status()["adiadas_por_orcamento"] == 2
+
+    # Atrasadas acumulam prioridade (aging) e a fria acaba passando na frente das quentes
+    for agora in range(60, 3601, 60):
+        await agendador.executar_ciclo(agora=agora)
+    assert any("fria" in ciclo for ciclo in chamadas)
+    assert all(len(ciclo) <= 2 for ciclo in chamadas)
+
+
+@pytest.mark.asyncio
+async def test_coletar_sinais():
+    async def executar(nrql):
+        if "NrAiIncident" in nrql:
+            return [{"facet": "g1", "evento": "open"}, {"facet": "g2", "evento": "close"}]
+        return [{"facet": ["g3"], "count": 2}]
+
+    sinais = await coletar_sinais(executar)
+    assert sinais.incidentes == {"g1"}
+    assert sinais.deploys == {"g3"}
+
+
+@pytest.mark.asyncio
+async def test_queries_de_sinais_saem_do_orcamento_do_ciclo():
+    chamadas = []
+    consultas = []
+
+    async def executar(nrql):
+        consultas.append(nrql)
+        return []
+
+    agendador = PriorityCollectionScheduler(
+        coletor(chamadas), executar, orcamento=12, custo_entidade=lambda e: 5, custo_sinais=2,
+        intervalos=INTERVALOS,
+    )
+    agendador.atualizar_entidades([entidade(f"m{i}") for i in range(3)], agora=0)
+    await agendador.atualizar_sinais(agora=0)
+    await agendador.executar_ciclo(agora=0)
+    # 2 queries de sinais + 2 entidades de 5 = 12; a terceira fica para o próximo ciclo
+    assert len(consultas) == 2 and len(chamadas[-1]) == 2
+    assert agendador.get_status()["gasto_ultimo_ciclo"] == 12
+
+    # Sem nova busca de sinais o ciclo seguinte tem o orçamento inteiro
+    await agendador.executar_ciclo(agora=1)
+    assert len(chamadas[-1]) == 1 and agendador.get_status()["gasto_ultimo_ciclo"] == 5
+
+
+def test_custo_real_por_dominio():
+    from utils.newrelic_advanced_collector import consultas_apm_agregadas, custo_coleta_entidade
+
+    apm = custo_coleta_entidade({"domain": "APM"})
+    # Consultas avançadas do modo agregado (+ SQL lento) + relacionamentos, mais a fração em lote
+    assert len(consultas_apm_agregadas("g", "")) + 2 <= apm < len(consultas_apm_agregadas("g", "")) + 3
+    assert 4 <= custo_coleta_entidade({"domain": "INFRA"}) < 5
+    assert 1 <= custo_coleta_entidade({"domain": "SYNTH"}) < 2
@@ -0,0 +1,74 @@
+import asyncio
+import time
+import pytest
+from utils.rate_limiter import (
+    TokenBucket, NewRelicRateLimiter, parse_retry_after, endpoint_for_url,
+    ENDPOINT_GRAPHQL, ENDPOINT_NRQL, ENDPOINT_REST
+)
+
+
+@pytest.mark.asyncio
+async def test_bucket_permite_rajada_e_depois_limita_taxa():
+    bucket = TokenBucket("teste", rate=20, capacity=5)
+    inicio = time.monotonic()
+    for _ in range(5):
+        assert await bucket.acquire() == 0
+    # Sem saldo: os próximos 2 tokens levam ~0.1s a 20/s
+    await bucket.acquire()
+    await bucket.acquire()
+    assert time.monotonic() - inicio >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_429_pausa_apenas_o_bucket_do_endpoint():
+    limiter = NewRelicRateLimiter({
+        ENDPOINT_GRAPHQL: (100, 10), ENDPOINT_NRQL: (100, 10), ENDPOINT_REST: (100, 10)
+    })
+    pausa = limiter.observe_response(ENDPOINT_GRAPHQL, 429, {"Retry-After": "0.2"})
+    assert pausa == pytest.approx(0.2)
+    assert limiter.get_status()[ENDPOINT_GRAPHQL]["throttled"] == 1
+
+    assert await limiter.acquire(ENDPOINT_NRQL) == 0
+    espera = await limiter.acquire(ENDPOINT_GRAPHQL)
+    assert espera >= 0.15
+
+
+def test_headers_x_ratelimit_sem_saldo():
+    limiter = NewRelicRateLimiter()
+    assert limiter.observe_response(ENDPOINT_REST, 200, {"X-RateLimit-Remaining": "5"}) is None
+    pausa = limiter.observe_response(ENDPOINT_REST, 200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "3"})
+    assert pausa == 3
+
+
+def test_parse_retry_after_e_classificacao_de_url():
+    assert parse_retry_after("12") == 12
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("lixo") is None
+    assert endpoint_for_url("https://api.newrelic.com/graphql") == ENDPOINT_GRAPHQL
+    assert endpoint_for_url("https://insights-api.newrelic.com/v1/accounts/1/query") == ENDPOINT_NRQL
+    assert endpoint_for_url("https://api.newrelic.com/v2/applications.json") == ENDPOINT_REST
+
+
+@pytest.mark.asyncio
+async def test_apos_pausa_libera_em_ordem_sem_rajada():
+    bucket = TokenBucket("teste", rate=20, capacity=5)
+    for _ in range(5):
+        await bucket.acquire()
+    bucket.pause(0.2)
+    liberados = []
+
+    async def pedir(i):
+        await bucket.acquire()
+        liberados.append((i, time.monotonic()))
+
+    inicio = time.monotonic()
+    tarefas = [asyncio.create_task(pedir(i)) for i in range(4)]
+    await asyncio.sleep(0.3)  # a pausa acabou, mas nada foi reposto durante ela
+    tarefas.append(asyncio.create_task(pedir(4)))
+    await asyncio.gather(*tarefas)
+
+    # Ordem de chegada, um a cada 1/20 s depois do fim da pausa (sem rajada de 5 tokens)
+    assert [i for i, _ in liberados] == [0, 1, 2, 3, 4]
+    instantes = [t - inicio for _, t in liberados]
+    assert instantes[0] >= 0.24
+    assert all(b - a >= 0.04 for a, b in zip(instantes, instantes[1:]))
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+from utils import cache, entity_processor, segment_store
+from utils import newrelic_advanced_collector as coletor
+from utils.segment_store import SegmentWriter, carregar_dados, exportar_json, ler_manifesto
+
+
+def _entidade(i, dominio="APM"):
+    return {"guid": f"g{i}", "name": f"svc-{i}", "domain": dominio, "metricas": {"30min": {"apdex": 0.9}}}
+
+
+def test_segmentos_rotacionam_e_remontam_o_cache(tmp_path):
+    writer = SegmentWriter(tmp_path, max_registros=2)
+    for i in range(5):
+        writer.escrever(_entidade(i, "APM" if i % 2 else "BROWSER"))
+    # Cada entidade já está em disco antes do fechamento da geração
+    assert sum(1 for seg in writer.segmentos for _ in open(tmp_path / seg["arquivo"])) == 5
+    assert ler_manifesto(tmp_path) is None
+
+    manifesto = writer.finalizar({"timestamp": "t1", "APM": ["bruta"], "entidades": ["bruta"], "logs": [1]})
+    assert len(manifesto["segmentos"]) == 3 and manifesto["total_registros"] == 5
+    dados = carregar_dados(tmp_path)
+    assert [e["guid"] for e in dados["entidades"]] == [f"g{i}" for i in range(5)]
+    assert [e["guid"] for e in dados["APM"]] == ["g1", "g3"]
+    assert len(dados["BROWSER"]) == 3
+    assert dados["logs"] == [1] and dados["timestamp"] == "t1"
+
+    # Coleta abortada não toca na geração publicada; a seguinte substitui e apaga a anterior
+    abortada = SegmentWriter(tmp_path)
+    abortada.escrever(_entidade(9))
+    abortada.abortar()
+    assert carregar_dados(tmp_path)["entidades"][0]["guid"] == "g0"
+    nova = SegmentWriter(tmp_path)
+    nova.escrever(_entidade(7))
+    nova.finalizar({"timestamp": "t2"})
+    assert [e["guid"] for e in carregar_dados(tmp_path)["entidades"]] == ["g7"]
+    assert [p.name for p in tmp_path.iterdir() if p.is_dir()] == [nova.geracao]
+
+
+def test_exportar_json_equivale_ao_dump(tmp_path):
+    dados = {"timestamp": "t", "entidades": [_entidade(1), _entidade(2)], "vazia": [], "status": {"ok": "ção"}}
+    destino = tmp_path / "cache_completo.json"
+    exportar_json(dados, destino)
+    assert json.loads(destino.read_text(encoding="utf-8")) == dados
+
+
+@pytest.mark.asyncio
+async def test_atualizacao_avancada_grava_em_stream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    monkeypatch.setattr(entity_processor, "filtrar_entidade", lambda e: None if e["guid"] == "g2" else dict(e, filtrada=True))
+    monkeypatch.setattr(cache, "LOTE_SEGMENTOS", 2)
+    gravadas_durante_coleta = []
+
+    async def coleta_falsa(ao_coletar=None):
+        entidades = [_entidade(i) for i in range(4)]
+        for entidade in entidades:
+            ao_coletar(entidade)
+        # Os lotes cheios já estão na fila da thread de persistência, na ordem da coleta
+        await cache.get_persistence_service().executar(lambda: None)
+        diretorio = next(segment_store.SEGMENT_DIR.iterdir())
+        gravadas_durante_coleta.extend(json.loads(l)["guid"] for f in diretorio.glob("*.ndjson") for l in open(f))
+        return {"entidades": entidades, "APM": entidades, "timestamp": "t", "logs": ["x"]}
+
+    monkeypatch.setattr(coletor, "collect_full_data", coleta_falsa)
+    assert await cache.atualizar_cache_completo_avancado()
+    assert gravadas_durante_coleta == ["g0", "g1"]
+
+    dados = cache._cache["dados"]
+    assert [e["guid"] for e in dados["entidades"]] == ["g0", "g1", "g3"]
+    assert dados["APM"] == dados["entidades"] and all(e["filtrada"] for e in dados["entidades"])
+    assert json.loads(cache.CACHE_FILE.read_text(encoding="utf-8"))["entidades"] == dados["entidades"]
+
+    # Reinício do processo: o cache volta dos segmentos
+    cache._cache["dados"] = {}
+    assert await cache.carregar_cache_do_disco()
+    assert cache._cache["dados"]["entidades"] == dados["entidades"]
+    assert cache._cache["dados"]["logs"] == ["x"]
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+from utils import newrelic_common
+from utils.nrql_cache import QueryResponseCache
+from utils.single_flight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_chamadas_simultaneas_compartilham_uma_execucao():
+    flight = SingleFlight()
+    execucoes = 0
+
+    async def consulta():
+        nonlocal execucoes
+        execucoes += 1
+        await asyncio.sleep(0.05)
+        return {"results": [1]}
+
+    resultados = await asyncio.gather(*[flight.do("q", consulta) for _ in range(10)])
+    assert execucoes == 1
+    assert all(r == {"results": [1]} for r in resultados)
+    # Cada chamador recebe sua própria cópia
+    resultados[0]["results"].append(2)
+    assert resultados[1] == {"results": [1]}
+    assert flight.get_stats() == {"in_flight": 0, "executions": 1, "coalesced": 9}
+
+    # Após terminar, uma nova chamada executa de novo
+    await flight.do("q", consulta)
+    assert execucoes == 2
+
+
+@pytest.mark.asyncio
+async def test_excecao_propagada_e_cancelamento_isolado():
+    flight = SingleFlight()
+
+    async def falha():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("NR fora")
+
+    resultados = await asyncio.gather(flight.do("k", falha), flight.do("k", falha), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in resultados)
+
+    async def lenta():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    primeiro = asyncio.ensure_future(flight.do("l", lenta))
+    segundo = asyncio.ensure_future(flight.do("l", lenta))
+    await asyncio.sleep(0)
+    primeiro.cancel()
+    # Cancelar um chamador não cancela a consulta compartilhada
+    assert await segundo == "ok"
+
+
+@pytest.mark.asyncio
+async def test_execute_graphql_query_common_coalesce(monkeypatch):
+    monkeypatch.setattr(newrelic_common, "get_query_cache", lambda: QueryResponseCache(enabled=False))
+    chamadas = 0
+
+    async def fake_post(*args, **kwargs):
+        nonlocal chamadas
+        chamadas += 1
+        await asyncio.sleep(0.05)
+        return {"data": {"ok": True}}
+
+    monkeypatch.setattr(newrelic_common, "_post_with_retries", fake_post)
+    resultados = await asyncio.gather(*[
+        newrelic_common.execute_graphql_query_common("{ actor { user { name } } }", headers={}, url="http://nr/graphql")
+        for _ in range(5)
+    ])
+    assert chamadas == 1
+    assert all(r == {"data": {"ok": True}} for r in resultados)
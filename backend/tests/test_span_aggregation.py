@@ -0,0 +1,37 @@
+import json
+
+import pytest
+from utils import newrelic_advanced_collector as coletor
+from utils.fake_newrelic_server import ConfigServidor, FakeNewRelicServer
+from utils.nrql_cache import get_query_cache
+
+
+def test_consultas_agregadas_usam_facet_e_poucos_exemplares():
+    consultas = coletor.consultas_apm_agregadas("G1", "SINCE 7 DAYS AGO")
+    assert "FACET name" in consultas["traces"] and "FROM Span" in consultas["traces"]
+    assert "FACET error.class" in consultas["errors"]
+    assert "FACET packageName, className, method" in consultas["code_execution"]
+    for chave in ("exemplares.errors", "exemplares.traces"):
+        assert consultas[chave].endswith(f"LIMIT {coletor.EXEMPLARES_POR_TIPO}")
+    assert all("entityGuid = 'G1'" in q for q in consultas.values())
+
+
+@pytest.mark.asyncio
+async def test_modo_agregado_encolhe_dados_avancados(monkeypatch):
+    monkeypatch.setattr(get_query_cache(), "enabled", False)
+    async with FakeNewRelicServer(ConfigServidor(entidades=20)) as servidor:
+        monkeypatch.setattr(coletor, "NR_GRAPHQL_URL", f"{servidor.url}/graphql")
+        entidade = next(e for e in servidor.conta.entidades if e["domain"] == "APM")
+
+        monkeypatch.setattr(coletor, "SPAN_AGGREGATION_ENABLED", False)
+        bruto = await coletor.get_entity_advanced_data(entidade, "7d")
+        monkeypatch.setattr(coletor, "SPAN_AGGREGATION_ENABLED", True)
+        agregado = await coletor.get_entity_advanced_data(entidade, "7d")
+
+    assert len(bruto["traces"]) == 1000 and len(bruto["errors"]) == 100
+    assert agregado["modo_traces"] == "agregado"
+    assert {"duracao_total", "chamadas", "duracao_p95", "trace_exemplo"} <= set(agregado["traces"][0])
+    assert "ocorrencias" in agregado["errors"][0] and "tempo_total" in agregado["code_execution"][0]
+    assert all(len(v) <= coletor.EXEMPLARES_POR_TIPO for v in agregado["exemplares"].values())
+    assert agregado["exemplares"]["errors"]
+    assert len(json.dumps(bruto)) >= 10 * len(json.dumps(agregado))
@@ -0,0 +1,82 @@
+import asyncio
+import time
+import pytest
+from utils.task_graph import TaskGraph
+from utils.newrelic_collector import NewRelicCollector
+
+
+@pytest.mark.asyncio
+async def test_independentes_em_paralelo_e_dependentes_em_ordem():
+    ordem = []
+
+    def tarefa(nome, valor, atraso=0.05):
+        async def executar(deps):
+            await asyncio.sleep(atraso)
+            ordem.append(nome)
+            return valor if not deps else valor + sum(deps.values())
+        return executar
+
+    grafo = TaskGraph()
+    grafo.add("a", tarefa("a", 1))
+    grafo.add("b", tarefa("b", 2))
+    grafo.add("c", tarefa("c", 3))
+    grafo.add("soma", tarefa("soma", 0, atraso=0), depends_on=["a", "b"])
+
+    inicio = time.monotonic()
+    resultados = await grafo.run()
+    # a, b e c rodam juntos: o tempo total é o da cadeia mais longa, não a soma
+    assert time.monotonic() - inicio < 0.12
+    assert resultados == {"a": 1, "b": 2, "c": 3, "soma": 3}
+    assert ordem.index("soma") > max(ordem.index("a"), ordem.index("b"))
+
+
+@pytest.mark.asyncio
+async def test_falha_de_no_e_dependencias_invalidas():
+    async def falha(deps):
+        raise RuntimeError("boom")
+
+    async def dependente(deps):
+        return deps
+
+    grafo = TaskGraph().add("x", falha).add("y", dependente, depends_on=["x"])
+    resultados = await grafo.run()
+    assert resultados == {"x": None, "y": {"x": None}}
+    assert isinstance(grafo.errors["x"], RuntimeError)
+
+    with pytest.raises(ValueError):
+        await TaskGraph().add("a", dependente, depends_on=["inexistente"]).run()
+    with pytest.raises(ValueError):
+        await TaskGraph().add("a", dependente, depends_on=["b"]).add("b", dependente, depends_on=["a"]).run()
+
+
+@pytest.mark.asyncio
+async def test_collect_entity_metrics_sem_chamadas_duplicadas():
+    coletor = NewRelicCollector(api_key="x", account_id="1", query_key="x")
+    chamadas = []
+
+    def fake(nome, retorno):
+        async def coletar(guid, *args, **kwargs):
+            chamadas.append(nome)
+            await asyncio.sleep(0.01)
+            return retorno
+        return coletar
+
+    for nome in dir(coletor):
+        if nome.startswith("collect_entity_") and nome not in ("collect_entity_metrics", "collect_entity_owners"):
+            setattr(coletor, nome, fake(nome, []))
+    coletor.collect_entity_alerts = fake("collect_entity_alerts", [{"openedAt": 1000}])
+    coletor.collect_entity_deployments = fake("collect_entity_deployments", [{"timestamp": 1500}])
+    coletor.collect_entity_logs = fake("collect_entity_logs", [{"message": "timeout"}])
+
+    entidade = await coletor.collect_entity_metrics(
+        {"guid": "g1", "name": "app", "domain": "APM"}, metricas_em_lote={"30min": {"error_rate": 0.2}}
+    )
+
+    assert len(chamadas) == len(set(chamadas))
+    assert entidade["log_patterns"] == {"timeout": [{"message": "timeout"}]}
+    # Correlação e diagnóstico já enxergam alertas, deployments e métricas
+    assert entidade["alert_deployment_correlation"] == [
+        {"alert": {"openedAt": 1000}, "deployment": {"timestamp": 1500}}
+    ]
+    assert entidade["diagnosis_explanation"].startswith("Aumento de erros após deploy")
+    assert entidade["metricas"]["30min"] == {"error_rate": 0.2}
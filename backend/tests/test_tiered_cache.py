@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+from utils import cache
+from utils.tiered_cache import CamadaDisco, CamadaMemoria, TieredCache
+
+
+def _camadas(tmp_path, quente=400, morna=800, fria=100_000):
+    return TieredCache([
+        CamadaMemoria("quente", quente, ttl=60),
+        CamadaDisco("morna", tmp_path / "morna.sqlite3", morna, ttl=3600),
+        CamadaDisco("fria", tmp_path / "fria.sqlite3", fria, ttl=86400, comprimir=True),
+    ])
+
+
+def _valor(i):
+    return {"id": i, "texto": "x" * 60}  # ~80 bytes em JSON
+
+
+def test_despejo_lru_rebaixa_e_acerto_promove(tmp_path):
+    camadas = _camadas(tmp_path)
+    quente, morna, fria = camadas.camadas
+    for i in range(20):
+        camadas.guardar(f"k{i}", _valor(i))
+        assert quente.bytes <= 400 and morna.bytes <= 800
+
+    # As mais antigas desceram: quente (5) -> morna (10) -> fria (comprimida)
+    assert [len(quente), len(morna), len(fria)] == [5, 10, 5]
+    assert quente.obter("k19") and quente.obter("k0") is None and morna.obter("k5") is not None
+    assert fria.obter("k0") is not None and fria.obter("k5") is None
+    assert camadas.stats["rebaixamentos"] == 20 and camadas.stats["descartes"] == 0
+    linha = fria._conexao.execute("SELECT tamanho FROM entradas WHERE chave = 'k0'").fetchone()
+    assert linha[0] < 80
+
+    # Acerto na fria promove para a quente (e empurra a menos usada de lá para baixo)
+    assert camadas.obter("k0") == _valor(0)
+    assert quente.obter("k0") is not None and fria.obter("k0") is None
+    assert camadas.stats["acertos"] == {"quente": 0, "morna": 0, "fria": 1} and camadas.stats["promocoes"] == 1
+    assert camadas.obter("k0") == _valor(0) and camadas.stats["acertos"]["quente"] == 1
+
+    # Entrada grande demais para a quente vai direto para a morna
+    camadas.guardar("grande", {"texto": "y" * 150})
+    assert quente.obter("grande") is None and morna.obter("grande") is not None
+    assert camadas.obter("inexistente", padrao="nada") == "nada" and camadas.stats["faltas"] == 1
+
+
+def test_permanencia_idade_e_versao(tmp_path):
+    camadas = _camadas(tmp_path)
+    quente, morna, fria = camadas.camadas
+    agora = time.time()
+    camadas.guardar("recente", _valor(1), versao=7)
+    camadas.guardar("hora", _valor(2), criado_em=agora - 120)   # passou da permanência da quente
+    camadas.guardar("dia", _valor(3), criado_em=agora - 7200)   # só cabe na fria
+    camadas.guardar("velha", _valor(4), criado_em=agora - 90000)  # passou de todas: descartada
+    assert quente.obter("hora") is None and morna.obter("hora") is not None
+    assert fria.obter("dia") is not None and camadas.stats["descartes"] == 1
+
+    # Quem pede dados mais novos ou outra versão não recebe a entrada, mas ela continua lá
+    assert camadas.obter("hora", idade_maxima=30) is None
+    assert camadas.obter("hora", idade_maxima=300) == _valor(2)
+    assert camadas.obter("recente", versao=8) is None and camadas.obter("recente", versao=7) == _valor(1)
+    assert camadas.stats["desatualizadas"] == 2
+
+    # A manutenção rebaixa pela idade; na fria, vencida é descartada
+    camadas.manutencao(agora + 3601)
+    assert quente.obter("recente") is None and fria.obter("recente") is not None
+    camadas.manutencao(agora + 90000)
+    assert len(quente) + len(morna) + len(fria) == 0
+
+    # Os limites de bytes das camadas em disco sobrevivem à reabertura
+    camadas.guardar("k", _valor(5))
+    camadas.manutencao(time.time() + 120)
+    camadas.fechar()
+    reaberta = _camadas(tmp_path)
+    assert reaberta.camadas[1].bytes == len(reaberta.camadas[1].obter("k").conteudo)
+    assert reaberta.obter("k") == _valor(5)
+
+
+@pytest.mark.asyncio
+async def test_visoes_e_consultas_usam_as_camadas(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    entidades = [{"guid": f"g{i}", "name": f"svc-{i}", "domain": "APM"} for i in range(3)]
+    await cache.atualizar_cache_com_dados({"timestamp": "2026-01-01T00:00:00", "entidades": entidades})
+
+    calculos = []
+
+    def contar(dados):
+        calculos.append(1)
+        return {"total": len(dados["entidades"])}
+
+    assert await cache.obter_visao("contagem", contar) == {"total": 3}
+    assert await cache.obter_visao("contagem", contar) == {"total": 3} and len(calculos) == 1
+    assert await cache.invalidar_cache_seletivo({"entidade": "svc-1"})
+    assert await cache.obter_visao("contagem", contar) == {"total": 3} and len(calculos) == 2
+
+    # Resposta de consulta gravada em segundo plano vem das camadas, sem reler o arquivo
+    await cache.salvar_consulta_historica("apps lentas?", {"resposta": 1})
+    await cache.get_persistence_service().aguardar()
+    arquivo = cache._cache["consultas_historicas"]["apps lentas?"]["arquivo"]
+    (tmp_path / arquivo).unlink()
+    assert await cache.get_cache(consulta="apps lentas?") == {"resposta": 1}
+    assert cache.diagnosticar_cache()["cache_em_camadas"]["acertos"]["quente"] >= 2
+
+
+@pytest.mark.asyncio
+async def test_camadas_em_disco_servem_versao_anterior_fora_do_event_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "_cache", {"dados": {}, "metadados": {"ultima_atualizacao": None}, "consultas_historicas": {}})
+    entidades = [{"guid": f"g{i}", "name": f"svc-{i}", "domain": "APM"} for i in range(3)]
+    await cache.atualizar_cache_com_dados({"timestamp": "2026-01-01T00:00:00", "entidades": entidades})
+    camadas = cache.get_tiered_cache()
+    calculos = []
+
+    def contar(dados):
+        calculos.append(1)
+        return {"total": len(dados["entidades"])}
+
+    assert await cache.obter_visao("historico", contar, tipo_cache="longo") == {"total": 3}
+    assert await cache.obter_visao("resumo", contar, tipo_cache="padrao") == {"total": 3}
+    # As duas visões foram despejadas da quente; a de 2 h também da morna
+    agora = time.time()
+    for chave, nivel, idade in (("visao:resumo", 1, 120), ("visao:historico", 2, 7200)):
+        entrada = camadas.camadas[0].remover(chave)
+        entrada.criado_em = agora - idade
+        camadas._inserir(nivel, chave, entrada, agora)
+    assert camadas.camadas[1].obter("visao:resumo") and camadas.camadas[2].obter("visao:historico")
+
+    # Nova versão publicada: ``longo`` acerta na fria e ``padrao`` na morna, sem recalcular;
+    # a leitura do SQLite não roda na thread do event loop
+    assert await cache.invalidar_cache_seletivo({"entidade": "svc-1"})
+    threads = []
+    obter = type(camadas).obter
+
+    def espiao(self, *args, **kwargs):
+        threads.append(threading.get_ident())
+        return obter(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(camadas), "obter", espiao)
+    antes = dict(camadas.stats["acertos"])
+    assert await cache.obter_visao("historico", contar, tipo_cache="longo") == {"total": 3}
+    assert await cache.obter_visao("resumo", contar, tipo_cache="padrao") == {"total": 3}
+    assert len(calculos) == 2
+    assert camadas.stats["acertos"]["fria"] == antes["fria"] + 1 and camadas.stats["acertos"]["morna"] == antes["morna"] + 1
+    assert threads and threading.get_ident() not in threads
+
+    # Promovida, a visão responde da quente, no event loop; o ``rapido`` exige a versão corrente
+    assert await cache.obter_visao("resumo", contar, tipo_cache="padrao") == {"total": 3} and len(threads) == 2
+    assert await cache.obter_visao("resumo", contar, tipo_cache="rapido") == {"total": 3} and len(calculos) == 3
@@ -27,7 +27,7 @@ from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
 # Importar utils necessários
-from utils.cache import get_cache, atualizar_cache_completo
+from utils.cache import get_cache, atualizar_cache_completo, obter_visao
 from utils.entity_processor import filter_entities_with_data, is_entity_valid
 from utils.newrelic_collector import coletar_contexto_completo
 from utils.openai_connector import gerar_resposta_ia
@@ -321,7 +321,12 @@ async def get_kpis():
     """
     Endpoint aprimorado para KPIs que fornece dados mais completos para o frontend
     """
-    cache = await get_cache()
+    await get_cache()
+    # Calculado uma vez por versão do cache (e no máximo a cada 30 s), não a cada requisição
+    return await obter_visao("kpis", _calcular_kpis)
+
+def _calcular_kpis(cache):
+    """KPIs e detalhes dos serviços a partir dos dados do cache."""
     entidades = cache.get("entidades", [])
     total = len(entidades)
     
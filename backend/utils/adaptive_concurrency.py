@@ -0,0 +1,211 @@
+"""
+Controle adaptativo de concorrência (AIMD) para as requisições à New Relic.
+
+O limite de requisições simultâneas cresce de forma aditiva enquanto o p95 de latência e a
+taxa de erro estão saudáveis, e cai de forma multiplicativa em 429, timeouts ou degradação
+de latência. Assim uma sincronização completa usa a maior concorrência que a conta suporta
+sem ajuste manual.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY_MIN = int(os.getenv("NEW_RELIC_CONCURRENCY_MIN", "2"))
+CONCURRENCY_MAX = int(os.getenv("NEW_RELIC_CONCURRENCY_MAX", "64"))
+CONCURRENCY_INITIAL = int(os.getenv("NEW_RELIC_CONCURRENCY_INITIAL", "8"))
+TARGET_P95_LATENCY = float(os.getenv("NEW_RELIC_TARGET_P95_LATENCY", "3.0"))  # segundos
+MAX_ERROR_RATE = 0.05
+DECREASE_FACTOR = 0.5          # queda em 429/timeout
+LATENCY_DECREASE_FACTOR = 0.9  # queda suave quando só a latência degrada
+DECREASE_COOLDOWN = 1.0        # evita várias quedas pela mesma rajada de falhas (s)
+SAMPLE_WINDOW = 100
+MIN_SAMPLES = 10
+
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_OVERLOAD = "overload"
+
+
+class _RequestSlot:
+    """Contexto de uma requisição; ``mark(status)`` classifica o resultado pelo status HTTP."""
+
+    def __init__(self, controller: "AdaptiveConcurrencyController"):
+        self.controller = controller
+        self.outcome: Optional[str] = None
+        self.started_at = 0.0
+
+    def mark(self, status: int):
+        if status == 429:
+            self.outcome = OUTCOME_OVERLOAD
+        elif status >= 500:
+            self.outcome = OUTCOME_ERROR
+        elif self.outcome is None:
+            self.outcome = OUTCOME_OK
+
+    async def __aenter__(self):
+        await self.controller.acquire()
+        self.started_at = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        latency = time.monotonic() - self.started_at
+        if exc_type is not None and issubclass(exc_type, asyncio.TimeoutError):
+            outcome = OUTCOME_OVERLOAD
+        elif exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+            outcome = None  # cancelamento não diz nada sobre a saúde da API
+        elif exc_type is not None:
+            outcome = OUTCOME_ERROR
+        else:
+            outcome = self.outcome or OUTCOME_OK
+        self.controller.release(latency, outcome)
+        return False
+
+
+class AdaptiveConcurrencyController:
+    """
+    Limitador de requisições simultâneas com limite ajustado por AIMD.
+
+    Uso:
+        async with controller.request() as req:
+            async with session.post(...) as response:
+                req.mark(response.status)
+    """
+
+    def __init__(
+        self,
+        min_limit: int = CONCURRENCY_MIN,
+        max_limit: int = CONCURRENCY_MAX,
+        initial_limit: int = CONCURRENCY_INITIAL,
+        target_p95: float = TARGET_P95_LATENCY,
+        max_error_rate: float = MAX_ERROR_RATE,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.target_p95 = target_p95
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._latencies: Deque[float] = deque(maxlen=SAMPLE_WINDOW)
+        self._outcomes: Deque[bool] = deque(maxlen=SAMPLE_WINDOW)
+        self._last_decrease = 0.0
+        self.completed = 0
+        self.overloads = 0
+        self.errors = 0
+        self.increases = 0
+        self.decreases = 0
+
+    def request(self) -> _RequestSlot:
+        return _RequestSlot(self)
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Acordado e cancelado ao mesmo tempo: repassa a vaga para o próximo
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def _wake(self):
+        livres = int(self.limit) - self.in_flight
+        while livres > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                livres -= 1
+
+    def release(self, latency: float, outcome: Optional[str]):
+        self.in_flight = max(0, self.in_flight - 1)
+        if outcome is not None:
+            self._record(latency, outcome)
+        self._wake()
+
+    def p95(self) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordenadas = sorted(self._latencies)
+        return ordenadas[min(len(ordenadas) - 1, int(0.95 * len(ordenadas)))]
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return 1 - (sum(self._outcomes) / len(self._outcomes))
+
+    def _decrease(self, factor: float, motivo: str):
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        anterior = self.limit
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        self.decreases += 1
+        logger.info(f"Concorrência New Relic reduzida {anterior:.1f} -> {self.limit:.1f} ({motivo})")
+
+    def _record(self, latency: float, outcome: str):
+        self.completed += 1
+        if outcome == OUTCOME_OVERLOAD:
+            self.overloads += 1
+            self._outcomes.append(False)
+            self._decrease(DECREASE_FACTOR, "429/timeout")
+            return
+        if outcome == OUTCOME_ERROR:
+            self.errors += 1
+        self._outcomes.append(outcome == OUTCOME_OK)
+        self._latencies.append(latency)
+
+        if len(self._latencies) < MIN_SAMPLES:
+            return
+        p95 = self.p95()
+        if p95 is not None and p95 > self.target_p95:
+            self._decrease(LATENCY_DECREASE_FACTOR, f"p95 {p95:.2f}s")
+        elif self.error_rate() > self.max_error_rate:
+            self._decrease(LATENCY_DECREASE_FACTOR, f"taxa de erro {self.error_rate():.1%}")
+        elif self.limit < self.max_limit and self.in_flight + 1 >= int(self.limit):
+            # Aumento aditivo: ~+1 a cada "limit" respostas saudáveis, só quando o limite está em uso
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.increases += 1
+
+    def get_status(self) -> Dict:
+        p95 = self.p95()
+        return {
+            "limit": int(self.limit),
+            "limit_exact": round(self.limit, 2),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "p95_latency": round(p95, 3) if p95 is not None else None,
+            "target_p95": self.target_p95,
+            "error_rate": round(self.error_rate(), 4),
+            "completed": self.completed,
+            "overloads": self.overloads,
+            "errors": self.errors,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+
+# Instância única do processo
+_controller: Optional[AdaptiveConcurrencyController] = None
+
+
+def get_concurrency_controller() -> AdaptiveConcurrencyController:
+    """Retorna o controlador de concorrência compartilhado do processo."""
+    global _controller
+    if _controller is None:
+        _controller = AdaptiveConcurrencyController()
+    return _controller
@@ -7,10 +7,16 @@ import asyncio
 import traceback
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Any, Optional, Set
+from typing import AsyncIterator, Dict, List, Any, Optional, Set
 import aiohttp
 import time
 
+from utils.newrelic_common import carregar_credenciais, fetch_coalesced, get_shared_session, nr_base_url, usando_servidor_local
+from utils.rate_limiter import ENDPOINT_GRAPHQL, endpoint_for_url
+from utils.nrql_cache import get_query_cache
+from utils.entity_pager import iter_pages, parse_entity_search_page
+from utils.newrelic_accounts import get_concurrency_controller_atual, get_rate_limiter_atual
+
 # Configurar logging
 logging.basicConfig(
     level=logging.INFO,
@@ -31,7 +37,6 @@ DEFAULT_TIMEOUT = 30.0  # Timeout padrão para requisições (segundos)
 MAX_RETRIES = 3  # Número máximo de tentativas para requisições
 RETRY_DELAY = 1.0  # Tempo entre tentativas (segundos)
 MAX_ENTITIES_PER_REQUEST = 500  # Máximo de entidades por requisição
-RATE_LIMIT_PAUSE = 1.0  # Pausa entre requisições para evitar rate limiting (segundos)
 
 # Lista completa de domínios do New Relic
 DOMINIOS_NEWRELIC = [
@@ -148,9 +153,10 @@ class AdvancedNewRelicCollector:
             account_id: ID da conta do New Relic
         """
         # Carregar de variáveis de ambiente se não fornecidas
-        self.api_key = api_key or os.environ.get("NEW_RELIC_API_KEY")
-        self.query_key = query_key or os.environ.get("NEW_RELIC_QUERY_KEY")
-        self.account_id = account_id or os.environ.get("NEW_RELIC_ACCOUNT_ID")
+        env_api_key, env_query_key, env_account_id = carregar_credenciais()
+        self.api_key = api_key or env_api_key
+        self.query_key = query_key or env_query_key
+        self.account_id = account_id or env_account_id
         
         # Validar configurações
         if not self.api_key:
@@ -176,39 +182,24 @@ class AdvancedNewRelicCollector:
         }
         
         # URLs base
-        self.graphql_url = "https://api.newrelic.com/graphql"
-        self.rest_api_url = f"https://api.newrelic.com/v2"
-        self.insights_url = f"https://insights-api.newrelic.com/v1/accounts/{self.account_id}/query"
+        self.graphql_url = f"{nr_base_url()}/graphql"
+        self.rest_api_url = f"{nr_base_url()}/v2"
+        if usando_servidor_local():
+            self.insights_url = f"{nr_base_url()}/v1/accounts/{self.account_id}/query"
+        else:
+            self.insights_url = f"https://insights-api.newrelic.com/v1/accounts/{self.account_id}/query"
         
         # Controle de requisições
         self.last_request_time = 0
         self.request_count = 0
-        self.max_requests_per_minute = 100  # Ajustar conforme limites da API
         
         logger.info(f"Coletor avançado New Relic inicializado. Account ID: {self.account_id}")
         
-    async def rate_limit_control(self):
-        """Controla o rate limit das chamadas de API."""
+    async def rate_limit_control(self, endpoint: str = ENDPOINT_GRAPHQL):
+        """Controla o rate limit das chamadas de API via token bucket da conta em coleta (ou o do processo)."""
         self.request_count += 1
-        
-        # Aplicar controle de taxa se necessário
-        now = time.time()
-        elapsed = now - self.last_request_time
-        
-        # Se já fizemos muitas requisições em um minuto
-        if self.request_count > self.max_requests_per_minute and elapsed < 60:
-            pause_time = max(60 - elapsed, RATE_LIMIT_PAUSE)
-            logger.debug(f"Rate limit: pausando por {pause_time:.2f} segundos...")
-            await asyncio.sleep(pause_time)
-            self.request_count = 0
-            self.last_request_time = time.time()
-        elif elapsed >= 60:
-            # Reset se passou um minuto
-            self.request_count = 1
-            self.last_request_time = now
-        
-        # Pausa mínima entre requisições para não sobrecarregar
-        await asyncio.sleep(RATE_LIMIT_PAUSE)
+        self.last_request_time = time.time()
+        await get_rate_limiter_atual().acquire(endpoint)
     
     async def make_request(self, url, headers, method="GET", data=None, params=None) -> Dict:
         """
@@ -224,25 +215,28 @@ class AdvancedNewRelicCollector:
         Returns:
             Dict contendo a resposta JSON ou erro
         """
-        await self.rate_limit_control()
+        endpoint = endpoint_for_url(url)
+        limiter = get_rate_limiter_atual()
         # Sempre use o valor global, nunca modifique DEFAULT_TIMEOUT
         timeout_value = float(globals().get('DEFAULT_TIMEOUT', 30.0))
         for attempt in range(MAX_RETRIES):
             try:
-                # Configurações para evitar problemas de SSL e timeouts
+                # Cada tentativa consome um token; 429/Retry-After pausa o bucket para todos os coletores
+                await self.rate_limit_control(endpoint)
                 timeout = aiohttp.ClientTimeout(total=timeout_value * 2)  # Aumentar timeout
-                ssl_context = None  # Usar o SSL padrão do sistema
-                # Usar context manager com tcp_nodelay para reduzir latência
-                conn = aiohttp.TCPConnector(ssl=ssl_context, force_close=True)
-                async with aiohttp.ClientSession(timeout=timeout, connector=conn) as session:
+                # Pool HTTP compartilhado (keep-alive) em vez de uma sessão por requisição
+                session = get_shared_session()
+                # Vaga no limite adaptativo (AIMD) de requisições simultâneas
+                async with get_concurrency_controller_atual().request() as slot:
                     if method.upper() == "GET":
-                        async with session.get(url, headers=headers, params=params) as response:
+                        async with session.get(url, headers=headers, params=params, timeout=timeout) as response:
+                            slot.mark(response.status)
+                            pause = limiter.observe_response(endpoint, response.status, response.headers)
                             if response.status == 200:
                                 return await response.json()
                             elif response.status == 429:  # Rate limiting
-                                retry_after = int(response.headers.get("Retry-After", "60"))
-                                logger.warning(f"Rate limit atingido. Aguardando {retry_after} segundos...")
-                                await asyncio.sleep(retry_after)
+                                # A pausa fica no bucket; a próxima tentativa aguarda em rate_limit_control
+                                logger.warning(f"Rate limit atingido. Aguardando {pause:.0f} segundos...")
                                 continue
                             else:
                                 error_text = await response.text()
@@ -250,13 +244,14 @@ class AdvancedNewRelicCollector:
                                 if attempt == MAX_RETRIES - 1:
                                     return {"error": f"HTTP {response.status}", "message": error_text}
                     elif method.upper() == "POST":
-                        async with session.post(url, headers=headers, json=data) as response:
+                        async with session.post(url, headers=headers, json=data, timeout=timeout) as response:
+                            slot.mark(response.status)
+                            pause = limiter.observe_response(endpoint, response.status, response.headers)
                             if response.status == 200:
                                 return await response.json()
                             elif response.status == 429:  # Rate limiting
-                                retry_after = int(response.headers.get("Retry-After", "60"))
-                                logger.warning(f"Rate limit atingido. Aguardando {retry_after} segundos...")
-                                await asyncio.sleep(retry_after)
+                                # A pausa fica no bucket; a próxima tentativa aguarda em rate_limit_control
+                                logger.warning(f"Rate limit atingido. Aguardando {pause:.0f} segundos...")
                                 continue
                             else:
                                 error_text = await response.text()
@@ -309,11 +304,15 @@ class AdvancedNewRelicCollector:
         if variables:
             payload["variables"] = variables
             
-        return await self.make_request(
-            url=self.graphql_url,
-            headers=self.graphql_headers,
-            method="POST",
-            data=payload
+        # Cache de respostas + coalescência de chamadas idênticas em andamento
+        return await fetch_coalesced(
+            get_query_cache().make_key(self.graphql_url, query, variables),
+            lambda: self.make_request(
+                url=self.graphql_url,
+                headers=self.graphql_headers,
+                method="POST",
+                data=payload
+            )
         )
     
     async def execute_nrql_query(self, nrql, timeout=60) -> Dict:
@@ -340,27 +339,25 @@ class AdvancedNewRelicCollector:
         logger.info(f"Enviando NRQL (GET): {nrql}")
         # Montar parâmetros de query string
         params = {"nrql": nrql}
-        return await self.make_request(
-            url=self.insights_url,
-            headers=self.insights_headers,
-            method="GET",
-            params=params
+        # Cache de respostas + coalescência de chamadas idênticas em andamento
+        return await fetch_coalesced(
+            get_query_cache().make_key(self.insights_url, nrql),
+            lambda: self.make_request(
+                url=self.insights_url,
+                headers=self.insights_headers,
+                method="GET",
+                params=params
+            )
         )
 
-    async def get_all_entities(self, cursor=None, entities_collected=None) -> List[Dict]:
+    async def iter_entity_pages(self, cursor=None) -> AsyncIterator[List[Dict]]:
         """
-        Obtém todas as entidades disponíveis no New Relic usando paginação.
+        Gera as páginas de entidades conforme chegam, buscando a próxima página (cursor)
+        enquanto o chamador processa a atual.
         
         Args:
-            cursor: Cursor para paginação
-            entities_collected: Lista de entidades já coletadas
-            
-        Returns:
-            Lista de todas as entidades
+            cursor: Cursor inicial (opcional) para retomar a paginação
         """
-        if entities_collected is None:
-            entities_collected = []
-            
         query = """
         query EntitiesQuery($cursor: String) {
             actor {
@@ -388,31 +385,37 @@ class AdvancedNewRelicCollector:
             }
         }
         """
+
+        async def fetch_page(page_cursor):
+            page_cursor = page_cursor or cursor
+            variables = {"cursor": page_cursor} if page_cursor else {}
+            result = await self.execute_graphql_query(query, variables)
+            if "error" in result:
+                logger.error(f"Erro ao obter entidades: {result}")
+            return parse_entity_search_page(result)
+
+        async for page in iter_pages(fetch_page):
+            yield page
+
+    async def get_all_entities(self, cursor=None, entities_collected=None) -> List[Dict]:
+        """
+        Obtém todas as entidades disponíveis no New Relic usando paginação.
         
-        variables = {}
-        if cursor:
-            variables["cursor"] = cursor
+        Args:
+            cursor: Cursor para paginação
+            entities_collected: Lista de entidades já coletadas
             
-        result = await self.execute_graphql_query(query, variables)
-        
-        if "error" in result:
-            logger.error(f"Erro ao obter entidades: {result}")
-            return entities_collected
+        Returns:
+            Lista de todas as entidades
+        """
+        if entities_collected is None:
+            entities_collected = []
             
         try:
-            search_results = result.get("data", {}).get("actor", {}).get("entitySearch", {}).get("results", {})
-            entities = search_results.get("entities", [])
-            next_cursor = search_results.get("nextCursor")
-            
-            # Adicionar entidades à lista
-            entities_collected.extend(entities)
-            logger.info(f"Coletadas {len(entities)} entidades. Total até agora: {len(entities_collected)}")
-            
-            # Se tem próxima página, continuar a busca
-            if next_cursor:
-                logger.debug(f"Buscando próxima página com cursor: {next_cursor}")
-                return await self.get_all_entities(cursor=next_cursor, entities_collected=entities_collected)
-                
+            async for entities in self.iter_entity_pages(cursor):
+                # Adicionar entidades à lista
+                entities_collected.extend(entities)
+                logger.info(f"Coletadas {len(entities)} entidades. Total até agora: {len(entities_collected)}")
             return entities_collected
             
         except Exception as e:
@@ -450,6 +453,9 @@ class AdvancedNewRelicCollector:
                                 key
                                 values
                             }
+                            ... on AlertableEntityOutline {
+                                alertSeverity
+                            }
                         }
                         nextCursor
                     }
@@ -458,43 +464,21 @@ class AdvancedNewRelicCollector:
         }
         """
         
-        entities_collected = []
-        cursor = None
-        
-        while True:
-            variables = {
-                "domain": domain
-            }
-            
+        async def fetch_page(cursor):
+            variables = {"domain": domain}
             if cursor:
                 variables["cursor"] = cursor
-                
             result = await self.execute_graphql_query(query, variables)
-            
             if "error" in result:
                 logger.error(f"Erro ao obter entidades do domínio {domain}: {result}")
-                break
-                
-            try:
-                search_results = result.get("data", {}).get("actor", {}).get("entitySearch", {}).get("results", {})
-                entities = search_results.get("entities", [])
-                next_cursor = search_results.get("nextCursor")
-                
-                # Adicionar entidades à lista
-                entities_collected.extend(entities)
-                logger.info(f"Coletadas {len(entities)} entidades do domínio {domain}. Total: {len(entities_collected)}")
-                
-                # Se não tem próxima página, terminar
-                if not next_cursor:
-                    break
-                    
-                cursor = next_cursor
-                    
-            except Exception as e:
-                logger.error(f"Erro ao processar resultados de entidades do domínio {domain}: {e}")
-                logger.error(traceback.format_exc())
-                break
-                
+            return parse_entity_search_page(result)
+
+        # Uma página com erro levanta ErroDePagina: uma listagem parcial não pode ser tratada
+        # como completa (a sincronização delta daria as entidades faltantes como removidas)
+        entities_collected = []
+        async for entities in iter_pages(fetch_page):
+            entities_collected.extend(entities)
+            logger.info(f"Coletadas {len(entities)} entidades do domínio {domain}. Total: {len(entities_collected)}")
         return entities_collected
     
     async def get_entity_metrics(self, entity_guid) -> Dict:
@@ -1073,6 +1057,60 @@ class AdvancedNewRelicCollector:
             
         return alerts_data
     
+    async def fetch_entities_by_domain(self, domain) -> List[Dict]:
+        """Entidades de um domínio (nome usado por ``collect_full_entity_data``)."""
+        return await self.get_entities_by_domain(domain)
+
+    @staticmethod
+    def _sample_entities(entities_by_domain: Dict[str, List[Dict]], max_per_domain: int = 5) -> Dict[str, List[Dict]]:
+        """As primeiras ``max_per_domain`` entidades de cada domínio."""
+        return {domain: list(entities[:max_per_domain]) for domain, entities in entities_by_domain.items() if entities}
+
+    async def _nrql_results(self, nrql, descricao) -> List[Dict]:
+        """``results`` de uma consulta NRQL, ou lista vazia (com log) em caso de erro."""
+        result = await self.execute_nrql_query(nrql)
+        if "error" in result:
+            logger.error(f"Erro ao obter {descricao}: {result}")
+            return []
+        return result.get("results", [])
+
+    async def fetch_logs_sample(self, limit=100) -> List[Dict]:
+        """Amostra dos logs mais recentes da conta."""
+        return await self._nrql_results(f"SELECT * FROM Log SINCE 1 hour ago LIMIT {limit}", "amostra de logs")
+
+    async def fetch_distributed_tracing_sample(self, limit=100) -> List[Dict]:
+        """Amostra dos spans de Distributed Tracing mais recentes da conta."""
+        return await self._nrql_results(
+            f"SELECT * FROM Span SINCE 30 MINUTES AGO LIMIT {limit}", "amostra de rastreamento distribuído")
+
+    async def collect_serverless_metrics(self, function_guid) -> Dict:
+        """Invocações, duração e erros de uma função Lambda na última hora."""
+        results = await self._nrql_results(
+            "SELECT count(*) AS invocations, average(duration) AS avg_duration, "
+            "percentage(count(*), WHERE error IS true) AS error_rate "
+            f"FROM AwsLambdaInvocation WHERE entityGuid = '{function_guid}' SINCE 1 hour ago",
+            f"métricas da função {function_guid}")
+        return results[0] if results else {}
+
+    async def collect_entity_complete_data(self, entity: Dict) -> Dict:
+        """
+        Dados completos de uma entidade da listagem: métricas detalhadas do domínio, violações
+        de alerta e logs recentes, juntados à própria entidade.
+        """
+        guid = entity.get("guid")
+        detailed_metrics, alerts, logs = await asyncio.gather(
+            self.get_entity_detailed_metrics(guid, entity.get("domain") or ""),
+            self.get_alerts_for_entity(guid),
+            self.get_logs_for_entity(guid),
+        )
+        return {
+            **entity,
+            "detailed_metrics": detailed_metrics or {},
+            "alerts": {"violations": alerts or []},
+            "logs": logs or [],
+            "collected_at": datetime.now().isoformat(),
+        }
+
     async def collect_full_entity_data(self) -> Dict:
         """
         Coleta todos os dados disponíveis do New Relic, incluindo entidades, métricas, logs,
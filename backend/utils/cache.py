@@ -1,11 +1,22 @@
 import asyncio
 import logging
 from datetime import datetime, timedelta
-import aiofiles
 import json
 import traceback
 from pathlib import Path
 import os
+import time
+
+from utils.delta_sync import DELTA_SYNC_ENABLED
+from utils.priority_scheduler import PRIORITY_SCHEDULER_ENABLED, PRIORITY_TICK
+from utils import segment_store
+from utils.segment_store import SEGMENT_CACHE_ENABLED, JSON_EXPORT_ENABLED
+from utils.entity_store import ENTITY_STORE_ENABLED, get_entity_store
+from utils.cache_persistence import copia_rasa, get_persistence_service, gravar_atomico, gravar_json_atomico, serializar_json
+from utils import mmap_cache
+from utils.mmap_cache import MMAP_CACHE_ENABLED
+from utils.single_flight import SingleFlight
+from utils.tiered_cache import TIERED_CACHE_ENABLED, CAMADA_MORNA_FILE, CAMADA_FRIA_FILE, get_tiered_cache
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +31,39 @@ _cache = {
     "consultas_historicas": {}
 }
 
+# Entidades por escrita nos segmentos durante a coleta completa (feita na thread de persistência)
+LOTE_SEGMENTOS = 200
+# Intervalo (s) entre verificações de geração nova publicada pela coleta em shards
+SHARD_WATCH_INTERVAL = int(os.getenv("NEW_RELIC_SHARD_WATCH_INTERVAL", "60"))
+
+# Agendador por prioridade em execução (criado pelo agendador_prioritario_loop)
+_agendador_prioritario = None
+
+# Posição de cada GUID na lista ``entidades`` em memória; refeito quando a lista é trocada
+_indice_memoria = {"lista": None, "posicoes": {}}
+
+class RetratoCache:
+    """
+    Versão publicada de ``_cache["dados"]``. Os escritores não alteram uma versão publicada:
+    montam a próxima (cópia rasa, com as listas e entidades alteradas trocadas) e a publicam de
+    uma vez, então quem guarda o retrato lê um estado consistente enquanto outras versões são
+    publicadas. ``versao`` cresce a cada troca e serve de chave de invalidação para caches
+    derivados dos dados.
+    """
+    __slots__ = ("versao", "dados", "publicado_em")
+
+    def __init__(self, versao, dados, publicado_em):
+        self.versao = versao
+        self.dados = dados
+        self.publicado_em = publicado_em
+
+# Versão corrente do cache (ver ``get_retrato``). Começa no relógio (ms) para que os números não
+# se repitam entre execuções: o cache em camadas guarda em disco visões marcadas com a versão
+_versao = {"numero": int(time.time() * 1000), "retrato": None}
+
+# Cálculos de visões em andamento (pedidos simultâneos da mesma visão calculam uma vez)
+_visoes_em_calculo = SingleFlight()
+
 def atualizar_coverage_cache():
     """
     Calcula e preenche o campo 'coverage' em metadata do cache,
@@ -92,11 +136,9 @@ def atualizar_coverage_cache():
             if dom not in coverage:
                 coverage[dom] = {"total_entities": 0, "complete_entities": 0}
 
-        # Preenche no metadata
-        if "metadata" not in cache_dados:
-            cache_dados["metadata"] = {}
-        cache_dados["metadata"]["coverage"] = coverage
-        _cache["dados"] = cache_dados
+        # Preenche no metadata (nova versão do cache; a publicada não é alterada)
+        metadata = dict(cache_dados.get("metadata") or {}, coverage=coverage)
+        _publicar(_derivar(cache_dados, {"metadata": metadata}))
         logger.info(f"Coverage atualizado no cache: {coverage}")
         return coverage
     except Exception as e:
@@ -113,29 +155,236 @@ CACHE_LONG_INTERVAL = 86400  # Cache longa duração: 24 horas (para dados hist
 CACHE_HISTORICO_DIR = Path("historico")
 CACHE_CONSULTA_DIR = Path("consultas")  # Diretório para consultas históricas
 CACHE_FILE = CACHE_HISTORICO_DIR / "cache_completo.json"
-CACHE_SHORT_FILE = CACHE_HISTORICO_DIR / "cache_rapido.json"
-CACHE_LONG_FILE = CACHE_HISTORICO_DIR / "cache_longo.json"
+CACHE_BIN_FILE = CACHE_HISTORICO_DIR / "cache_completo.bin"  # base das gerações do cache binário (mmap)
+
+# Idade máxima aceita por tipo de cache em ``get_cache``/``obter_visao``
+INTERVALO_POR_TIPO = {"rapido": CACHE_SHORT_INTERVAL, "padrao": CACHE_UPDATE_INTERVAL, "longo": CACHE_LONG_INTERVAL}
+# Tipos que só aceitam resultados da versão corrente do cache; os demais aceitam os de versões
+# anteriores dentro da idade do tipo (é o que deixa as camadas morna e fria servirem)
+TIPOS_DA_VERSAO_CORRENTE = {"rapido"}
+
+def _versao_exigida(tipo_cache, versao):
+    """Versão que ``tipo_cache`` exige das entradas guardadas (None: qualquer uma dentro da idade)."""
+    return versao if tipo_cache in TIPOS_DA_VERSAO_CORRENTE else None
 
 # Adicionado para integração com o coletor avançado
 USAR_COLETOR_AVANCADO = os.getenv("USAR_COLETOR_AVANCADO", "true").lower() == "true"
 
+def _carregar_segmentos():
+    """
+    Dados do cache em segmentos, se houver geração válida e ela não for mais velha que o
+    ``cache_completo.json`` (que outras ferramentas ainda podem gravar diretamente).
+    """
+    if not SEGMENT_CACHE_ENABLED:
+        return None
+    manifesto = segment_store.ler_manifesto(segment_store.SEGMENT_DIR)
+    if manifesto is None:
+        return None
+    if CACHE_FILE.exists() and CACHE_FILE.stat().st_mtime > manifesto.get("gravado_em", 0):
+        logger.info(f"{CACHE_FILE} é mais recente que o cache em segmentos, usando o JSON")
+        return None
+    return segment_store.carregar_dados(segment_store.SEGMENT_DIR)
+
+def _no_store(operacao):
+    """
+    Executa ``operacao(store)`` no armazenamento indexado de entidades, se habilitado. Falhas
+    são registradas e não interrompem a atualização do cache em memória.
+    """
+    if not ENTITY_STORE_ENABLED:
+        return None
+    try:
+        return operacao(get_entity_store())
+    except Exception as e:
+        logger.error(f"Erro no armazenamento de entidades: {e}", exc_info=True)
+        return None
+
+async def _no_store_async(operacao):
+    """
+    ``_no_store`` na thread de persistência: as operações no armazenamento esperam o lock dele,
+    que uma ``substituir`` pode segurar por muito tempo, sem travar o event loop; e ficam na
+    ordem das demais gravações.
+    """
+    if not ENTITY_STORE_ENABLED:
+        return None
+    return await get_persistence_service().executar(lambda: _no_store(operacao))
+
+def _posicao_em_memoria(guid, entidades=None):
+    """Posição da entidade na lista ``entidades`` em memória (índice por GUID, sem varredura)."""
+    if entidades is None:
+        entidades = _cache["dados"].get("entidades") or []
+    posicao = _indice_memoria["posicoes"].get(guid) if _indice_memoria["lista"] is entidades else None
+    if posicao is None or posicao >= len(entidades) or entidades[posicao].get("guid") != guid:
+        # Lista trocada ou alterada fora daqui: refaz o índice
+        _indice_memoria["lista"] = entidades
+        _indice_memoria["posicoes"] = {e.get("guid"): i for i, e in enumerate(entidades) if e.get("guid")}
+        posicao = _indice_memoria["posicoes"].get(guid)
+    return posicao
+
+def get_retrato():
+    """Retrato da versão corrente do cache: referência barata (sem cópia) a um estado consistente."""
+    retrato = _versao["retrato"]
+    if retrato is None or retrato.dados is not _cache["dados"]:
+        # Troca feita por atribuição direta a ``_cache["dados"]`` (scripts de manutenção): nova versão
+        retrato = _publicar(_cache["dados"])
+    return retrato
+
+def get_versao_cache():
+    """Número da versão corrente do cache (muda a cada atualização publicada)."""
+    return get_retrato().versao
+
+def _publicar(dados):
+    """Publica ``dados`` como a nova versão do cache (troca única da referência)."""
+    _versao["numero"] += 1
+    retrato = RetratoCache(_versao["numero"], dados, datetime.now().isoformat())
+    _cache["dados"] = dados
+    _versao["retrato"] = retrato
+    return retrato
+
+def _derivar(dados, alteracoes=None, remover=()):
+    """
+    Próxima versão de ``dados``: cópia rasa com as chaves de ``alteracoes`` trocadas e as de
+    ``remover`` retiradas. A versão de origem não é alterada.
+    """
+    if isinstance(dados, mmap_cache.DadosMapeados):
+        # Chaves ainda não lidas do arquivo continuam sob demanda na nova versão
+        return dados.derivar(alteracoes or {}, remover)
+    novo = dict(dados)
+    for chave in remover:
+        novo.pop(chave, None)
+    novo.update(alteracoes or {})
+    return novo
+
+def _trocar_entidades(dados, por_guid, acrescentar=False):
+    """
+    Alterações (para ``_derivar``) que trocam as entidades de ``por_guid`` em ``entidades`` e nas
+    listas por domínio, em listas novas. Com ``acrescentar``, as que não existem entram no fim.
+    """
+    anteriores = dados.get("entidades") or []
+    entidades = list(anteriores)
+    novas = []
+    for guid, entidade in por_guid.items():
+        posicao = _posicao_em_memoria(guid, anteriores)
+        if posicao is not None:
+            entidades[posicao] = entidade
+        elif acrescentar:
+            entidades.append(entidade)
+            novas.append(entidade)
+    alteracoes = {"entidades": entidades}
+    for dominio in {e.get("domain", "UNKNOWN") for e in por_guid.values()}:
+        lista = dados.get(dominio)
+        if isinstance(lista, list):
+            alteracoes[dominio] = [por_guid.get(e.get("guid"), e) if isinstance(e, dict) else e for e in lista]
+            alteracoes[dominio].extend(e for e in novas if e.get("domain", "UNKNOWN") == dominio)
+    # Mesmas posições na lista nova (mais as acrescentadas): o índice por GUID continua valendo
+    if _indice_memoria["lista"] is anteriores:
+        _indice_memoria["lista"] = entidades
+        for posicao in range(len(anteriores), len(entidades)):
+            _indice_memoria["posicoes"][entidades[posicao].get("guid")] = posicao
+    return alteracoes
+
+async def _guids_por(**filtros):
+    """GUIDs das entidades com os atributos indexados (``nome``, ``dominio``, ``tipo``, ``tag``)."""
+    guids = await _no_store_async(lambda store: store.guids(**filtros))
+    if guids is not None:
+        return guids
+    campos = {"nome": "name", "dominio": "domain", "tipo": "entityType"}
+    return [e.get("guid") for e in _cache["dados"].get("entidades", [])
+            if all(e.get(campos[k]) == v for k, v in filtros.items() if k in campos)]
+
+def _carregar_store():
+    """
+    Dados remontados do armazenamento de entidades, se ele tiver sido gravado depois do cache
+    em segmentos e do ``cache_completo.json``.
+    """
+    def carregar(store):
+        gravado_em = store.gravado_em()
+        if gravado_em is None:
+            return None
+        manifesto = segment_store.ler_manifesto(segment_store.SEGMENT_DIR) if SEGMENT_CACHE_ENABLED else None
+        if manifesto and manifesto.get("gravado_em", 0) > gravado_em:
+            return None
+        if CACHE_FILE.exists() and CACHE_FILE.stat().st_mtime > gravado_em:
+            logger.info(f"{CACHE_FILE} é mais recente que o armazenamento de entidades, usando o JSON")
+            return None
+        return store.montar_dados()
+    return _no_store(carregar)
+
+def _carregar_mapeado():
+    """
+    Dados do cache binário mapeado em memória, se ele for a gravação mais recente entre as fontes
+    em disco. Só o índice é lido aqui; cada chave é decodificada no primeiro acesso.
+    """
+    if not MMAP_CACHE_ENABLED:
+        return None
+    leitor = mmap_cache.abrir(CACHE_BIN_FILE)
+    if leitor is None:
+        return None
+    concorrentes = [CACHE_FILE.stat().st_mtime if CACHE_FILE.exists() else 0]
+    manifesto = segment_store.ler_manifesto(segment_store.SEGMENT_DIR) if SEGMENT_CACHE_ENABLED else None
+    if manifesto:
+        concorrentes.append(manifesto.get("gravado_em", 0))
+    # Do armazenamento de entidades só contam as sincronizações completas: as gravações pontuais
+    # (o agendador prioritário grava a cada ciclo, o binário só a cada ``intervalo_gravacao``)
+    # são sobrepostas ao binário pelo GUID
+    concorrentes.append(_no_store(lambda store: store.sincronizado_em()) or 0)
+    alteradas = _no_store(lambda store: store.alteradas_desde(leitor.gravado_em)) or []
+    if max(concorrentes) > leitor.gravado_em or not all(leitor.sobrepor(e) for e in alteradas):
+        leitor.fechar()
+        return None
+    if alteradas:
+        logger.info(f"{len(alteradas)} entidades do armazenamento de entidades sobrepostas ao cache binário")
+    return mmap_cache.DadosMapeados(leitor)
+
+def _total_entidades(dados):
+    """Total de entidades sem decodificar a lista quando os dados vêm do cache mapeado."""
+    if isinstance(dados, mmap_cache.DadosMapeados):
+        return dados.total_entidades()
+    return len(dados.get("entidades", []))
+
+def _carregar_dados_do_disco():
+    """
+    Dados do cache na fonte mais recente: cache binário mapeado, armazenamento de entidades,
+    segmentos NDJSON ou o JSON completo. Quando vêm dos arquivos JSON, o armazenamento de
+    entidades é sincronizado com eles. Retorna (dados, origem), ou (None, None) se não houver
+    cache em disco.
+    """
+    dados = _carregar_mapeado()
+    if dados is not None:
+        return dados, str(dados.leitor.caminho)
+    dados = _carregar_store()
+    if dados is not None:
+        return dados, "armazenamento de entidades"
+    dados, origem = _carregar_segmentos(), "segmentos"
+    if dados is None and CACHE_FILE.exists():
+        # Usando open normal em vez de aiofiles para evitar problemas com o await
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            dados, origem = json.load(f), str(CACHE_FILE)
+    if dados is None:
+        return None, None
+    _no_store(lambda store: store.substituir(dados))
+    return dados, origem
+
 async def carregar_cache_do_disco():
-    """Carrega o cache do disco se existir."""
+    """Carrega o cache do disco se existir (armazenamento de entidades, segmentos NDJSON ou o JSON completo)."""
     try:        # Certifique-se de que o diretório existe
         os.makedirs(CACHE_HISTORICO_DIR, exist_ok=True)
         
-        if CACHE_FILE.exists():
-            logger.info(f"Carregando cache do arquivo: {CACHE_FILE}")
-            # Usando open normal em vez de aiofiles para evitar problemas com o await
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                conteudo = f.read()
-                dados_carregados = json.loads(conteudo)
-                
-                # Atualiza o cache em memória com os dados do disco
-                _cache["dados"] = dados_carregados
-                _cache["metadados"]["ultima_atualizacao"] = dados_carregados.get("timestamp")
-                logger.info(f"Cache carregado com sucesso. Timestamp: {_cache['metadados']['ultima_atualizacao']}")
-                return True
+        def carregar():
+            dados, origem = _carregar_dados_do_disco()
+            manifesto = segment_store.ler_manifesto(segment_store.SEGMENT_DIR) if dados is not None and SEGMENT_CACHE_ENABLED else None
+            return dados, origem, manifesto
+        
+        # json.load, leitura dos segmentos e EntityStore.substituir na thread de persistência,
+        # fora do event loop e na ordem das gravações já enfileiradas
+        dados_carregados, origem, manifesto = await get_persistence_service().executar(carregar)
+        if dados_carregados is not None:
+            # A geração de segmentos em disco já está refletida no que foi carregado
+            _cache["metadados"]["geracao_segmentos"] = manifesto.get("geracao") if manifesto else None
+            # Atualiza o cache em memória com os dados do disco
+            _publicar(dados_carregados)
+            _cache["metadados"]["ultima_atualizacao"] = dados_carregados.get("timestamp")
+            logger.info(f"Cache carregado de {origem} ({_total_entidades(dados_carregados)} entidades). Timestamp: {_cache['metadados']['ultima_atualizacao']}")
+            return True
         else:
             logger.warning(f"Arquivo de cache não encontrado: {CACHE_FILE}")
             return False
@@ -144,18 +393,40 @@ async def carregar_cache_do_disco():
         logger.error(traceback.format_exc())
         return False
 
+def _gravar_cache(dados):
+    """Grava o cache em disco (executada na thread de persistência, fora do event loop)."""
+    if SEGMENT_CACHE_ENABLED:
+        # JSON de compatibilidade antes do manifesto: a geração publicada por último é a que vale na carga
+        if JSON_EXPORT_ENABLED:
+            segment_store.exportar_json(dados, CACHE_FILE)
+        segment_store.gravar_dados(dados, segment_store.SEGMENT_DIR)
+        # Entidades já vão para o armazenamento indexado em cada atualização; aqui só os globais
+        _no_store(lambda store: store.gravar_globais(dados))
+    else:
+        gravar_json_atomico(CACHE_FILE, dados)
+    # Por último: o cache binário é a fonte da próxima subida se nada for gravado depois dele
+    if MMAP_CACHE_ENABLED:
+        mmap_cache.gravar(dados, CACHE_BIN_FILE)
+
+async def _sincronizar_store(dados):
+    """``EntityStore.substituir`` na thread de persistência (serializa todas as entidades para comparar)."""
+    if ENTITY_STORE_ENABLED:
+        retrato = copia_rasa(dados)
+        await get_persistence_service().executar(lambda: _no_store(lambda store: store.substituir(retrato)))
+
 async def salvar_cache_no_disco():
-    """Salva o cache atual no disco."""
+    """
+    Salva o cache atual no disco, numa thread de gravação e com troca atômica dos arquivos.
+    Pedidos em rajada são agrupados numa única escrita com o estado mais recente.
+    """
     try:
-        # Certifique-se de que o diretório existe
-        os.makedirs(CACHE_HISTORICO_DIR, exist_ok=True)
         # Adiciona timestamp antes de salvar
         if "timestamp" not in _cache["dados"]:
-            _cache["dados"]["timestamp"] = datetime.now().isoformat()
-            
-        # Usando open normal em vez de aiofiles para evitar problemas
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(_cache["dados"], ensure_ascii=False, indent=2))
+            _publicar(_derivar(_cache["dados"], {"timestamp": datetime.now().isoformat()}))
+        
+        # Retrato das listas no momento do pedido (scripts de manutenção ainda alteram listas no lugar)
+        dados = copia_rasa(get_retrato().dados)
+        await get_persistence_service().salvar("cache_principal", lambda: _gravar_cache(dados))
         
         logger.info(f"Cache salvo em disco com sucesso: {CACHE_FILE}")
         return True
@@ -167,6 +438,9 @@ async def salvar_cache_no_disco():
 async def salvar_consulta_historica(consulta, resultado):
     """Salva uma consulta específica no histórico."""
     try:
+        # Versão do cache de que o resultado foi tirado: com outra versão publicada, a consulta expira
+        versao = get_versao_cache()
+        instante = time.time()
         # Gera um nome de arquivo baseado na consulta (versão simplificada)
         consulta_hash = hash(consulta) % 10000000
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -178,17 +452,29 @@ async def salvar_consulta_historica(consulta, resultado):
             "resultado": resultado
         }
         
-        os.makedirs(CACHE_HISTORICO_DIR, exist_ok=True)
-        with open(arquivo, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(dados, ensure_ascii=False, indent=2))
+        if isinstance(resultado, dict):
+            dados["resultado"] = copia_rasa(resultado)
         
-        # Atualiza cache em memória
-        _cache["consultas_historicas"][consulta] = {
-            "timestamp": datetime.now().isoformat(),
-            "arquivo": str(arquivo)
-        }
+        # Gravação em segundo plano: a resposta não espera o disco. A consulta só entra no
+        # histórico em memória depois que o arquivo existe por inteiro
+        def registrar(futuro):
+            if futuro.cancelled() or futuro.exception() is not None:
+                logger.error(f"Erro ao salvar consulta em {arquivo}: {futuro.exception() if not futuro.cancelled() else 'cancelada'}")
+                return
+            _cache["consultas_historicas"][consulta] = {
+                "timestamp": dados["timestamp"],
+                "arquivo": str(arquivo),
+                "versao": versao
+            }
+            logger.info(f"Consulta salva em: {arquivo}")
+        
+        def gravar():
+            conteudo = serializar_json(dados)
+            gravar_atomico(arquivo, conteudo)
+            if TIERED_CACHE_ENABLED:
+                get_tiered_cache().guardar_serializado(f"consulta:{consulta}", conteudo, versao=versao, criado_em=instante)
         
-        logger.info(f"Consulta salva em: {arquivo}")
+        get_persistence_service().agendar(str(arquivo), gravar).add_done_callback(registrar)
         return True
     except Exception as e:
         logger.error(f"Erro ao salvar consulta: {e}")
@@ -209,12 +495,8 @@ async def get_cache(forcar_atualizacao=False, consulta=None, tipo_cache="padrao"
     inicio = datetime.now()
     cache_hit = False
     
-    # Define o intervalo baseado no tipo de cache solicitado
-    intervalo = CACHE_UPDATE_INTERVAL  # Padrão: 1 hora
-    if tipo_cache == "rapido":
-        intervalo = CACHE_SHORT_INTERVAL  # 30 segundos
-    elif tipo_cache == "longo":
-        intervalo = CACHE_LONG_INTERVAL  # 24 horas
+    # Define o intervalo baseado no tipo de cache solicitado: rapido 30 s, padrao 1 h, longo 24 h
+    intervalo = INTERVALO_POR_TIPO.get(tipo_cache, CACHE_UPDATE_INTERVAL)
     
     # Inicializa contadores de estatísticas se não existirem
     if "cache_hits" not in _cache["metadados"]:
@@ -231,12 +513,22 @@ async def get_cache(forcar_atualizacao=False, consulta=None, tipo_cache="padrao"
         logger.info("Cache vazio, carregando do disco...")
         await carregar_cache_do_disco()
     
+    # Consulta já respondida dentro da idade do tipo (e, no ``rapido``, com a versão corrente):
+    # cache em camadas (memória, disco ou comprimido), sem reler o arquivo do histórico
+    versao = _versao_exigida(tipo_cache, get_versao_cache())
+    if consulta and TIERED_CACHE_ENABLED:
+        registro = await get_tiered_cache().obter_async(f"consulta:{consulta}", idade_maxima=intervalo, versao=versao)
+        if registro is not None:
+            logger.info(f"Cache HIT (camadas): Usando cache para consulta: {consulta[:50]}...")
+            _cache["metadados"]["cache_hits"] += 1
+            return registro["resultado"]
+
     # Verifica se uma consulta específica está no histórico
     if consulta and consulta in _cache["consultas_historicas"]:
         consulta_info = _cache["consultas_historicas"][consulta]
         consulta_timestamp = datetime.fromisoformat(consulta_info["timestamp"])
-        # Se a consulta é recente (dentro do intervalo), usa o cache
-        if (agora - consulta_timestamp).total_seconds() < intervalo:
+        # Se a consulta é recente (dentro do intervalo) e de uma versão aceita pelo tipo, usa o cache
+        if (agora - consulta_timestamp).total_seconds() < intervalo and versao in (None, consulta_info.get("versao")):
             logger.info(f"Cache HIT: Usando cache para consulta: {consulta[:50]}...")
             try:
                 arquivo = consulta_info["arquivo"]
@@ -291,7 +583,32 @@ async def get_cache(forcar_atualizacao=False, consulta=None, tipo_cache="padrao"
     if not cache_hit:
         logger.info("Usando cache atual enquanto atualização ocorre em background...")
     
-    return _cache["dados"]
+    return get_retrato().dados
+
+async def obter_visao(nome, calcular, tipo_cache="rapido"):
+    """
+    Visão calculada sobre os dados do cache (ex.: KPIs do dashboard), guardada no cache em
+    camadas com a versão de origem. É recalculada quando passa da idade do ``tipo_cache`` e, no
+    ``rapido``, também quando outra versão é publicada; ``padrao`` e ``longo`` aceitam a visão
+    de uma versão anterior. ``calcular(dados)`` pode ser função comum ou corrotina.
+    """
+    retrato = get_retrato()
+    chave = f"visao:{nome}"
+    if TIERED_CACHE_ENABLED:
+        valor = await get_tiered_cache().obter_async(chave, idade_maxima=INTERVALO_POR_TIPO.get(tipo_cache, CACHE_SHORT_INTERVAL),
+                                                     versao=_versao_exigida(tipo_cache, retrato.versao))
+        if valor is not None:
+            return valor
+
+    async def calcular_e_guardar():
+        valor = calcular(retrato.dados)
+        if asyncio.iscoroutine(valor):
+            valor = await valor
+        if TIERED_CACHE_ENABLED:
+            await get_tiered_cache().guardar_async(chave, valor, versao=retrato.versao)
+        return valor
+
+    return await _visoes_em_calculo.do((chave, retrato.versao), calcular_e_guardar)
 
 async def atualizar_cache_completo(coletar_contexto_fn):
     """
@@ -331,12 +648,13 @@ async def atualizar_cache_completo(coletar_contexto_fn):
             # Atualiza o cache
             resultado["entidades"] = entidades_filtradas
             resultado["timestamp"] = datetime.now().isoformat()
-            _cache["dados"] = resultado
+            _publicar(resultado)
             _cache["metadados"]["ultima_atualizacao"] = datetime.now().isoformat()
             _cache["metadados"]["tipo_ultima_atualizacao"] = "completa"
             _cache["metadados"]["atualizacao_forcada"] = False
             
             # Salva o cache atualizado
+            await _sincronizar_store(resultado)
             await salvar_cache_no_disco()
             
             logger.info(f"Cache atualizado com sucesso: {len(entidades_filtradas)} entidades válidas")
@@ -364,42 +682,96 @@ async def atualizar_cache_completo_avancado():
         bool: True se a atualização foi bem-sucedida, False caso contrário
     """
     try:
-        from utils.newrelic_advanced_collector import collect_full_data
-        from utils.entity_processor import filter_entities_with_data
+        from utils.newrelic_advanced_collector import collect_all_accounts
+        from utils.entity_processor import filtrar_entidade
         
         logger.info("Iniciando atualização do cache com o coletor avançado...")
         
-        # Coleta completa usando o coletor avançado
-        resultado = await collect_full_data()
+        # Cada entidade é filtrada assim que coletada (o coletor não guarda a bruta) e, com o cache
+        # em segmentos, vai para o disco em lotes na thread de persistência; o cache em memória é
+        # montado com esses mesmos registros
+        CACHE_HISTORICO_DIR.mkdir(parents=True, exist_ok=True)
+        writer = segment_store.SegmentWriter(segment_store.SEGMENT_DIR) if SEGMENT_CACHE_ENABLED else None
+        servico = get_persistence_service()
+        entidades_filtradas = []
+        lote_segmentos = []
+        gravacoes = []
+        brutas = 0
+
+        def gravar_lote():
+            if writer and lote_segmentos:
+                lote = list(lote_segmentos)
+                lote_segmentos.clear()
+
+                def escrever():
+                    for entidade in lote:
+                        writer.escrever(entidade)
+
+                gravacoes.append(servico.enfileirar(escrever))
+
+        def ao_coletar(entidade):
+            nonlocal brutas
+            brutas += 1
+            try:
+                processada = filtrar_entidade(entidade)
+            except Exception as e:
+                logger.error(f"Erro ao processar entidade: {str(e)}")
+                return
+            if processada:
+                entidades_filtradas.append(processada)
+                if writer:
+                    lote_segmentos.append(processada)
+                    if len(lote_segmentos) >= LOTE_SEGMENTOS:
+                        gravar_lote()
+
+        async def abortar_segmentos():
+            if writer:
+                await asyncio.gather(*gravacoes, return_exceptions=True)
+                await servico.executar(writer.abortar)
+
+        # Coleta completa usando o coletor avançado (todas as contas configuradas, em paralelo)
+        try:
+            resultado = await collect_all_accounts(ao_coletar=ao_coletar)
+            gravar_lote()
+            await asyncio.gather(*gravacoes)
+        except BaseException:
+            await abortar_segmentos()
+            raise
         
         if not resultado or "erro" in resultado:
+            await abortar_segmentos()
             logger.error(f"Erro na coleta de dados avançados: {resultado.get('erro', 'Desconhecido')}")
             return False
         
-        # Recupera e filtra as entidades
-        entidades_raw = resultado.get("entidades", [])
-        
-        logger.info(f"Coletadas {len(entidades_raw)} entidades brutas. Filtrando...")
-        
-        # Filtra entidades com dados reais
-        entidades_filtradas = filter_entities_with_data(entidades_raw)
+        logger.info(f"Filtradas {len(entidades_filtradas)} entidades válidas de {brutas} totais")
         
-        logger.info(f"Filtradas {len(entidades_filtradas)} entidades válidas de {len(entidades_raw)} totais")
-        
-        # Substitui as entidades filtradas no resultado
+        # Substitui as entidades (e as listas por domínio) pelas filtradas
+        dominios = set(resultado.get("contagem_por_dominio") or {})
+        dominios.update(e.get("domain", "UNKNOWN") for e in resultado.get("entidades", []))
+        for dominio in dominios:
+            resultado.pop(dominio, None)
+        for entidade in entidades_filtradas:
+            resultado.setdefault(entidade.get("domain", "UNKNOWN"), []).append(entidade)
         resultado["entidades"] = entidades_filtradas
         resultado["timestamp_atualizacao"] = datetime.now().isoformat()
         
-        # Verifica se o diretório existe
-        CACHE_HISTORICO_DIR.mkdir(parents=True, exist_ok=True)
-        
-        # Salva em disco
-        async with aiofiles.open(CACHE_FILE, "w", encoding="utf-8") as f:
-            await f.write(json.dumps(resultado, ensure_ascii=False, indent=2))
+        # Salva em disco na thread de persistência: JSON de compatibilidade (em stream), o
+        # manifesto dos segmentos, o armazenamento indexado e, por último, o cache binário
+        retrato = copia_rasa(resultado)
+
+        def publicar():
+            if writer is None or JSON_EXPORT_ENABLED:
+                segment_store.exportar_json(retrato, CACHE_FILE)
+            if writer:
+                writer.finalizar(retrato)
+            _no_store(lambda store: store.substituir(retrato))
+            if MMAP_CACHE_ENABLED:
+                mmap_cache.gravar(retrato, CACHE_BIN_FILE)
+
+        await get_persistence_service().executar(publicar)
         
         # Atualiza o cache em memória
-        global _cache
-        _cache["dados"] = resultado
+        _publicar(resultado)
         _cache["metadados"]["ultima_atualizacao"] = resultado["timestamp_atualizacao"]
         _cache["metadados"]["tipo_ultima_atualizacao"] = "avançada"
 
@@ -409,7 +781,7 @@ async def atualizar_cache_completo_avancado():
         except Exception as e:
             logger.error(f"Erro ao atualizar coverage após coleta avançada: {e}")
 
-        logger.info(f"Cache atualizado com dados avançados e salvo em: {CACHE_FILE}")
+        logger.info(f"Cache atualizado com dados avançados e salvo em: {segment_store.SEGMENT_DIR if writer else CACHE_FILE}")
         logger.info(f"Entidades por domínio: {resultado.get('contagem_por_dominio', {})}")
 
         return True
@@ -417,6 +789,145 @@ async def atualizar_cache_completo_avancado():
         logger.error(f"Erro ao atualizar cache com dados avançados: {str(e)}", exc_info=True)
         return False
 
+async def atualizar_cache_com_dados(resultado, tipo="externa"):
+    """
+    Publica no cache principal dados já coletados e filtrados fora do fluxo normal de coleta
+    (ex.: scripts de manutenção) e os grava em disco.
+    """
+    resultado["timestamp_atualizacao"] = datetime.now().isoformat()
+    _publicar(resultado)
+    _cache["metadados"]["ultima_atualizacao"] = resultado["timestamp_atualizacao"]
+    _cache["metadados"]["tipo_ultima_atualizacao"] = tipo
+    try:
+        atualizar_coverage_cache()
+    except Exception as e:
+        logger.error(f"Erro ao atualizar coverage após atualização {tipo}: {e}")
+    await _sincronizar_store(_cache["dados"])
+    await salvar_cache_no_disco()
+    logger.info(f"Cache atualizado ({tipo}) com {len(resultado.get('entidades', []))} entidades")
+    return True
+
+async def recarregar_geracao_shards():
+    """
+    Carrega no cache a geração de segmentos publicada pelo coordenador da coleta em shards
+    (``utils.collection_shards``, em outro processo), se ela ainda não foi carregada. A leitura
+    das entidades e a sincronização do armazenamento rodam na thread de persistência.
+
+    Retorna:
+        bool: True se uma geração nova foi carregada
+    """
+    if not SEGMENT_CACHE_ENABLED:
+        return False
+    manifesto = await asyncio.to_thread(segment_store.ler_manifesto, segment_store.SEGMENT_DIR)
+    if (not manifesto or manifesto.get("origem") != segment_store.ORIGEM_SHARDS
+            or manifesto.get("geracao") == _cache["metadados"].get("geracao_segmentos")):
+        return False
+    servico = get_persistence_service()
+    dados = await servico.executar(lambda: segment_store.carregar_dados(segment_store.SEGMENT_DIR))
+    if dados is None:
+        return False
+    _cache["metadados"]["geracao_segmentos"] = manifesto["geracao"]
+    dados["timestamp_atualizacao"] = datetime.now().isoformat()
+    _publicar(dados)
+    _cache["metadados"]["ultima_atualizacao"] = dados["timestamp_atualizacao"]
+    _cache["metadados"]["tipo_ultima_atualizacao"] = "shards"
+    try:
+        atualizar_coverage_cache()
+    except Exception as e:
+        logger.error(f"Erro ao atualizar coverage após carregar a geração dos shards: {e}")
+    await _sincronizar_store(dados)
+    if MMAP_CACHE_ENABLED:
+        # Próxima subida lê a mesma geração do cache binário
+        await servico.executar(lambda: mmap_cache.gravar(dados, CACHE_BIN_FILE))
+    logger.info(f"Geração {manifesto['geracao']} da coleta em shards carregada ({manifesto.get('total_registros')} entidades)")
+    return True
+
+async def geracoes_shards_loop(intervalo=SHARD_WATCH_INTERVAL):
+    """Observa o manifesto do cache em segmentos e carrega as gerações publicadas pelos shards."""
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await recarregar_geracao_shards()
+        except Exception as e:
+            logger.error(f"Erro ao carregar geração da coleta em shards: {e}")
+            logger.error(traceback.format_exc())
+
+async def atualizar_cache_delta():
+    """
+    Atualiza o cache pela sincronização delta: lista as entidades (consulta leve), compara
+    com a tabela de fingerprints e recoleta dados completos só das entidades novas, alteradas,
+    em alerta ou com coleta expirada. Entidades que sumiram ganham lápide e saem do cache.
+    Sem cache anterior, cai na atualização avançada completa.
+
+    Retorna:
+        bool: True se a atualização foi bem-sucedida, False caso contrário
+    """
+    if not _cache["dados"].get("entidades"):
+        logger.info("Cache sem entidades, sincronização delta substituída por atualização completa")
+        return await atualizar_cache_completo_avancado()
+    from utils.newrelic_accounts import get_contas
+    if get_contas():
+        # A listagem delta é de uma conta só: com várias, uma entidade de outra conta pareceria removida
+        logger.info("Coleta multi-conta configurada, sincronização delta substituída por atualização completa")
+        return await atualizar_cache_completo_avancado()
+    try:
+        from utils.newrelic_advanced_collector import iter_entity_pages, collect_entities_complete_data, collect_global_data
+        from utils.newrelic_common import get_shared_session
+        from utils.entity_processor import filter_entities_with_data
+        from utils.delta_sync import get_fingerprint_table, sincronizar
+
+        session = get_shared_session()
+        listagem = []
+        async for page in iter_entity_pages(session=session):
+            listagem.extend(page)
+        if not listagem:
+            logger.warning("Listagem de entidades vazia, mantendo o cache atual")
+            return False
+
+        anteriores = {e.get("guid"): e for e in _cache["dados"].get("entidades", []) if e.get("guid")}
+        tabela = get_fingerprint_table()
+        entidades, plano = await sincronizar(
+            tabela, listagem, anteriores,
+            lambda alvo: collect_entities_complete_data(alvo, session=session)
+        )
+        await tabela.save_async()
+        if plano.removed:
+            from utils.incremental_aggregator import get_incremental_aggregator
+            get_incremental_aggregator().esquecer(plano.removed)
+
+        globais = await collect_global_data(session)
+        entidades = filter_entities_with_data(entidades)
+        por_dominio = {}
+        for e in entidades:
+            por_dominio.setdefault(e.get("domain", "UNKNOWN"), []).append(e)
+        agora = datetime.now().isoformat()
+        # Nova versão montada sobre a corrente (sem await até a publicação) com listas novas
+        resultado = _derivar(_cache["dados"], {
+            **globais,
+            **por_dominio,
+            "entidades": entidades,
+            "entidades_removidas": tabela.tombstones(),
+            "delta": plano.resumo(),
+            "total_entidades": len(entidades),
+            "contagem_por_dominio": {dominio: len(lista) for dominio, lista in por_dominio.items()},
+            "timestamp": agora,
+            "timestamp_atualizacao": agora,
+        }, remover={e.get("domain", "UNKNOWN") for e in anteriores.values()} - set(por_dominio))
+
+        _publicar(resultado)
+        _cache["metadados"]["ultima_atualizacao"] = resultado["timestamp"]
+        _cache["metadados"]["tipo_ultima_atualizacao"] = "delta"
+        _cache["metadados"]["atualizacao_forcada"] = False
+        # Só as entidades recoletadas mudam de hash: o armazenamento regrava apenas essas
+        await _sincronizar_store(resultado)
+        await salvar_cache_no_disco()
+
+        logger.info(f"Cache atualizado por delta: {plano.resumo()}, {len(entidades)} entidades válidas")
+        return True
+    except Exception as e:
+        logger.error(f"Erro na sincronização delta do cache: {e}", exc_info=True)
+        return False
+
 async def atualizar_cache_incremental(coletar_contexto_fn, filtro=None):
     """
     Atualiza apenas partes específicas do cache com base em filtros.
@@ -428,6 +939,7 @@ async def atualizar_cache_incremental(coletar_contexto_fn, filtro=None):
                {"guid": "abc123"} - Atualiza apenas uma entidade específica
                {"tipo": "ERRO"} - Atualiza apenas entidades com erro
                {"periodo": "30min"} - Atualiza apenas métricas dos últimos 30 minutos
+               {"delta": True} - Recoleta só entidades novas, alteradas ou em alerta
     """
     logger.info(f"Iniciando atualização incremental do cache com filtro: {filtro}")
     try:
@@ -436,10 +948,13 @@ async def atualizar_cache_incremental(coletar_contexto_fn, filtro=None):
             logger.info("Cache vazio ou sem filtro, realizando atualização completa")
             return await atualizar_cache_completo(coletar_contexto_fn)
         
-        # Guarda o cache atual como backup
-        cache_atual = _cache["dados"].copy()
+        # Sem backup: as alterações montam uma versão nova, publicada só no fim. Uma falha no
+        # meio deixa a versão corrente intacta
         
         # Determina o tipo de atualização baseado no filtro
+        if filtro.get("delta"):
+            return await atualizar_cache_delta()
+
         if "domain" in filtro:
             # Atualização de um domínio específico
             dominio = filtro["domain"]
@@ -463,8 +978,15 @@ async def atualizar_cache_incremental(coletar_contexto_fn, filtro=None):
                     # Adiciona novas entidades do domínio atualizado
                     entidades_atualizadas.extend(novo_dados["entidades"])
                     
+                    # No armazenamento indexado, troca só os registros do domínio
+                    novos_guids = {e.get("guid") for e in novo_dados["entidades"]}
+                    def trocar_dominio(store):
+                        store.remover([g for g in store.guids(dominio=dominio) if g not in novos_guids])
+                        store.gravar_muitas(novo_dados["entidades"])
+                    await _no_store_async(trocar_dominio)
+                    
                     # Atualiza o cache
-                    _cache["dados"]["entidades"] = entidades_atualizadas
+                    _publicar(_derivar(_cache["dados"], {"entidades": entidades_atualizadas}))
                     _cache["metadados"]["ultima_atualizacao_parcial"] = datetime.now().isoformat()
                     _cache["metadados"]["tipo_ultima_atualizacao"] = f"incremental_dominio_{dominio}"
                     
@@ -490,24 +1012,11 @@ async def atualizar_cache_incremental(coletar_contexto_fn, filtro=None):
                 nova_entidade = await coletar_entidade_especifica(guid)
                 
                 if nova_entidade:
-                    # Substitui ou adiciona a entidade no cache
-                    entidades_atualizadas = []
-                    entidade_encontrada = False
-                    
-                    # Procura e substitui a entidade específica
-                    for e in _cache["dados"].get("entidades", []):
-                        if e.get("guid") == guid:
-                            entidades_atualizadas.append(nova_entidade)
-                            entidade_encontrada = True
-                        else:
-                            entidades_atualizadas.append(e)
-                    
-                    # Se não encontrou, adiciona como nova entidade
-                    if not entidade_encontrada:
-                        entidades_atualizadas.append(nova_entidade)
+                    # Substitui ou adiciona a entidade no cache (posição pelo índice de GUIDs)
+                    dados = _cache["dados"]
+                    _publicar(_derivar(dados, _trocar_entidades(dados, {guid: nova_entidade}, acrescentar=True)))
+                    await _no_store_async(lambda store: store.gravar(nova_entidade))
                     
-                    # Atualiza o cache
-                    _cache["dados"]["entidades"] = entidades_atualizadas
                     _cache["metadados"]["ultima_atualizacao_parcial"] = datetime.now().isoformat()
                     _cache["metadados"]["tipo_ultima_atualizacao"] = f"incremental_entidade_{guid}"
                     
@@ -529,16 +1038,79 @@ async def atualizar_cache_incremental(coletar_contexto_fn, filtro=None):
     except Exception as e:
         logger.error(f"Erro na atualização incremental: {e}")
         logger.error(traceback.format_exc())
-        # Em caso de falha, restaura o cache anterior
-        _cache["dados"] = cache_atual
         return False
 
+async def atualizar_cache_prioritario(agendador, salvar=True):
+    """
+    Executa um ciclo do agendador por prioridade sobre as entidades do cache: atualiza os
+    sinais (incidentes abertos, deploys recentes), recoleta as entidades vencidas dentro do
+    orçamento do ciclo e mescla o resultado por GUID no cache.
+
+    Retorna:
+        int: número de entidades atualizadas no ciclo
+    """
+    entidades = _cache["dados"].get("entidades") or []
+    if not entidades:
+        return 0
+    agendador.atualizar_entidades(entidades)
+    await agendador.atualizar_sinais()
+    atualizadas = await agendador.executar_ciclo()
+    if not atualizadas:
+        return 0
+
+    por_guid = {e["guid"]: e for e in atualizadas}
+    # Reaplica sobre a versão corrente: uma sincronização pode ter publicado outra durante a coleta
+    dados = _cache["dados"]
+    _publicar(_derivar(dados, {**_trocar_entidades(dados, por_guid), "timestamp_prioritario": datetime.now().isoformat()}))
+    await _no_store_async(lambda store: store.gravar_muitas(atualizadas))
+    if salvar:
+        await salvar_cache_no_disco()
+    return len(atualizadas)
+
+async def agendador_prioritario_loop(intervalo=PRIORITY_TICK, intervalo_gravacao=300):
+    """
+    Loop do agendador por prioridade: entidades quentes (incidente, deploy, apdex ruim, erro
+    subindo) são recoletadas a cada minuto e as saudáveis ou sem reporte em cadência longa,
+    entre as sincronizações completas/delta do ``cache_updater_loop``. O cache em disco é
+    regravado no máximo a cada ``intervalo_gravacao`` segundos.
+    """
+    from utils.newrelic_accounts import get_contas
+    from utils.newrelic_advanced_collector import collect_entities_by_account, custo_coleta_entidade, execute_nrql_all_accounts
+    from utils.newrelic_common import get_shared_session
+    from utils.priority_scheduler import QUERIES_DE_SINAIS, PriorityCollectionScheduler
+
+    global _agendador_prioritario
+    session = get_shared_session()
+    # Cada entidade é recoletada na conta dela; os sinais (incidentes, deploys) vêm de todas as contas
+    _agendador_prioritario = PriorityCollectionScheduler(
+        lambda alvo: collect_entities_by_account(alvo, session=session),
+        lambda nrql: execute_nrql_all_accounts(nrql, session=session),
+        custo_entidade=custo_coleta_entidade,
+        custo_sinais=QUERIES_DE_SINAIS * max(1, len(get_contas())),
+    )
+    logger.info(f"Iniciando agendador de coleta por prioridade (ciclo de {intervalo}s)")
+    ultima_gravacao = datetime.now()
+    while True:
+        try:
+            gravar = (datetime.now() - ultima_gravacao).total_seconds() >= intervalo_gravacao
+            atualizadas = await atualizar_cache_prioritario(_agendador_prioritario, salvar=gravar)
+            if atualizadas and gravar:
+                ultima_gravacao = datetime.now()
+        except Exception as e:
+            logger.error(f"Erro no agendador por prioridade: {e}")
+            logger.error(traceback.format_exc())
+        await asyncio.sleep(intervalo)
+
 async def cache_updater_loop(coletar_contexto_fn):
     """
     Loop contínuo para atualização periódica do cache (1x ao dia)
     """
     logger.info("Iniciando loop de atualização de cache (1x ao dia)")
     await carregar_cache_do_disco()
+    if USAR_COLETOR_AVANCADO and PRIORITY_SCHEDULER_ENABLED:
+        asyncio.create_task(agendador_prioritario_loop())
+    if SEGMENT_CACHE_ENABLED:
+        asyncio.create_task(geracoes_shards_loop())
     while True:
         try:
             atualizar = False
@@ -556,7 +1128,10 @@ async def cache_updater_loop(coletar_contexto_fn):
                 atualizar = True
             if atualizar:
                 # Usar o coletor avançado se configurado
-                if USAR_COLETOR_AVANCADO:
+                if USAR_COLETOR_AVANCADO and DELTA_SYNC_ENABLED and _cache["dados"].get("entidades"):
+                    logger.info("Usando sincronização delta para atualização do cache")
+                    sucesso = await atualizar_cache_delta()
+                elif USAR_COLETOR_AVANCADO:
                     logger.info("Usando coletor avançado para atualização do cache (100% dos dados do New Relic)")
                     sucesso = await atualizar_cache_completo_avancado()
                 else:
@@ -571,6 +1146,14 @@ async def cache_updater_loop(coletar_contexto_fn):
             logger.error(traceback.format_exc())
         await asyncio.sleep(3600)  # Checa a cada hora, mas só atualiza se passou 24h
 
+def _status_contas():
+    from utils.newrelic_accounts import get_contas
+    try:
+        return [conta.get_status() for conta in get_contas()]
+    except Exception as e:
+        logger.error(f"Erro ao ler configuração multi-conta: {e}")
+        return []
+
 def diagnosticar_cache():
     """
     Diagnóstico detalhado do estado do cache com métricas avançadas.
@@ -579,7 +1162,9 @@ def diagnosticar_cache():
     logger.info("Realizando diagnóstico detalhado do cache.")
     
     # Estatísticas básicas
+    retrato = get_retrato()
     estatisticas = {
+        "versao": {"numero": retrato.versao, "publicada_em": retrato.publicado_em},
         "total_chaves_dados": len(_cache["dados"]) if _cache["dados"] else 0,
         "chaves_dados": list(_cache["dados"].keys()) if _cache["dados"] else [],
         "metadados": _cache["metadados"],
@@ -589,15 +1174,19 @@ def diagnosticar_cache():
         "status": "não inicializado",
         "performance": {},
         "qualidade_dados": {},
-        "arquivos_cache": {}
+        "arquivos_cache": {},
+        "agendador_prioritario": _agendador_prioritario.get_status() if _agendador_prioritario else None,
+        "contas_new_relic": _status_contas(),
+        "persistencia": get_persistence_service().get_status(),
+        "cache_em_camadas": get_tiered_cache().get_status() if TIERED_CACHE_ENABLED else None
     }
     
     # Verifica tamanho e existência de todos os arquivos de cache
     arquivos_cache = {
         "principal": CACHE_FILE,
         "consultas": CACHE_CONSULTA_DIR,
-        "rapido": CACHE_SHORT_FILE,
-        "longo": CACHE_LONG_FILE
+        "camada_morna": CAMADA_MORNA_FILE,
+        "camada_fria": CAMADA_FRIA_FILE
     }
     
     tamanho_total = 0
@@ -626,9 +1215,45 @@ def diagnosticar_cache():
                 "existe": False
             }
     
+    manifesto = segment_store.ler_manifesto(segment_store.SEGMENT_DIR)
+    if manifesto:
+        tamanho = sum(seg["bytes"] for seg in manifesto["segmentos"]) / (1024 * 1024)
+        estatisticas["arquivos_cache"]["segmentos"] = {
+            "existe": True,
+            "geracao": manifesto["geracao"],
+            "total_arquivos": len(manifesto["segmentos"]),
+            "total_registros": manifesto["total_registros"],
+            "tamanho_mb": round(tamanho, 2),
+            "modificado": datetime.fromtimestamp(manifesto["gravado_em"]).isoformat()
+        }
+        tamanho_total += tamanho
+    
+    status_store = _no_store(lambda store: store.get_status())
+    if status_store and status_store["gravado_em"]:
+        estatisticas["arquivos_cache"]["entidades_indexadas"] = {
+            "existe": True,
+            "total_registros": status_store["total_entidades"],
+            "tamanho_mb": status_store["tamanho_mb"],
+            "modificado": datetime.fromtimestamp(status_store["gravado_em"]).isoformat()
+        }
+        tamanho_total += status_store["tamanho_mb"]
+    
+    leitor = mmap_cache.abrir(CACHE_BIN_FILE) if MMAP_CACHE_ENABLED else None
+    if leitor is not None:
+        tamanho = leitor.caminho.stat().st_size / (1024 * 1024)
+        estatisticas["arquivos_cache"]["binario_mapeado"] = {
+            "existe": True,
+            "arquivo": leitor.caminho.name,
+            "total_registros": leitor.total_registros,
+            "tamanho_mb": round(tamanho, 2),
+            "modificado": datetime.fromtimestamp(leitor.gravado_em).isoformat()
+        }
+        tamanho_total += tamanho
+        leitor.fechar()
+    
     estatisticas["tamanho_disco_mb"] = round(tamanho_total, 2)
     
-    if CACHE_FILE.exists():
+    if CACHE_FILE.exists() or manifesto:
         estatisticas["status"] = "carregado"
     
     # Verifica idade e validade do cache
@@ -751,8 +1376,9 @@ async def limpar_cache_de_entidades_invalidas():
         entidades_validas = filter_entities_with_data(_cache["dados"]["entidades"])
         
         # Atualiza o cache com apenas entidades válidas
-        _cache["dados"]["entidades"] = entidades_validas
-        total_depois = len(_cache["dados"]["entidades"])
+        _publicar(_derivar(_cache["dados"], {"entidades": entidades_validas}))
+        await _sincronizar_store(_cache["dados"])
+        total_depois = len(entidades_validas)
         
         # Adiciona metadados sobre a limpeza
         _cache["metadados"]["ultima_limpeza"] = datetime.now().isoformat()
@@ -770,6 +1396,18 @@ async def limpar_cache_de_entidades_invalidas():
         logger.error(traceback.format_exc())
         return 0
 
+def _invalidar_entidades(guids, invalidacao):
+    """Publica uma versão do cache com ``invalidacao`` aplicada (em cópias) às entidades dos GUIDs."""
+    dados = _cache["dados"]
+    entidades = dados.get("entidades") or []
+    por_guid = {}
+    for guid in guids:
+        posicao = _posicao_em_memoria(guid, entidades)
+        if posicao is not None:
+            por_guid[guid] = {**entidades[posicao], **invalidacao}
+    if por_guid:
+        _publicar(_derivar(dados, _trocar_entidades(dados, por_guid)))
+
 async def invalidar_cache_seletivo(criterio, coletar_contexto_fn=None):
     """
     Invalida e atualiza seletivamente partes do cache com base em critérios específicos.
@@ -796,21 +1434,20 @@ async def invalidar_cache_seletivo(criterio, coletar_contexto_fn=None):
             nome_entidade = criterio["entidade"]
             logger.info(f"Invalidando cache para entidade: {nome_entidade}")
             
-            # Procura a entidade pelo nome
-            for i, entidade in enumerate(_cache["dados"].get("entidades", [])):
-                if entidade.get("name") == nome_entidade:
-                    # Marca como desatualizada
-                    _cache["dados"]["entidades"][i]["cache_valido"] = False
-                    _cache["dados"]["entidades"][i]["ultima_atualizacao"] = None
-                    
-                    # Se houver função coletora, atualiza apenas esta entidade
-                    if coletar_contexto_fn:
-                        logger.info(f"Atualizando dados da entidade: {nome_entidade}")
-                        filtro = {"guid": entidade.get("guid")} if entidade.get("guid") else {"name": nome_entidade}
-                        await atualizar_cache_incremental(coletar_contexto_fn, filtro)
-                    
-                    await salvar_cache_no_disco()
-                    return True
+            # Procura a entidade pelo nome (índice do armazenamento de entidades)
+            for guid in (await _guids_por(nome=nome_entidade))[:1]:
+                # Marca como desatualizada
+                invalidacao = {"cache_valido": False, "ultima_atualizacao": None}
+                _invalidar_entidades([guid], invalidacao)
+                await _no_store_async(lambda store: store.atualizar_parcial(guid, invalidacao))
+                
+                # Se houver função coletora, atualiza apenas esta entidade
+                if coletar_contexto_fn:
+                    logger.info(f"Atualizando dados da entidade: {nome_entidade}")
+                    await atualizar_cache_incremental(coletar_contexto_fn, {"guid": guid})
+                
+                await salvar_cache_no_disco()
+                return True
             
             logger.warning(f"Entidade não encontrada no cache: {nome_entidade}")
             return False
@@ -820,12 +1457,11 @@ async def invalidar_cache_seletivo(criterio, coletar_contexto_fn=None):
             logger.info(f"Invalidando cache para domínio: {dominio}")
             
             # Marca todas as entidades do domínio como desatualizadas
-            entidades_afetadas = 0
-            for i, entidade in enumerate(_cache["dados"].get("entidades", [])):
-                if entidade.get("domain") == dominio:
-                    _cache["dados"]["entidades"][i]["cache_valido"] = False
-                    _cache["dados"]["entidades"][i]["ultima_atualizacao"] = None
-                    entidades_afetadas += 1
+            invalidacao = {"cache_valido": False, "ultima_atualizacao": None}
+            guids = await _guids_por(dominio=dominio)
+            _invalidar_entidades(guids, invalidacao)
+            await _no_store_async(lambda store: store.atualizar_campos(guids, invalidacao))
+            entidades_afetadas = len(guids)
             
             # Se houver função coletora, atualiza o domínio
             if coletar_contexto_fn and entidades_afetadas > 0:
@@ -888,16 +1524,15 @@ async def _initialize_cache(force=False):
         # Se não conseguir carregar do disco, tenta inicializar vazio
         if not success:
             logger.warning("Não foi possível carregar cache do disco, inicializando vazio")
-            _cache["dados"] = {
+            _publicar({
                 "timestamp": datetime.now().isoformat(),
                 "entidades": [],
                 "contagem_por_dominio": {}
-            }
+            })
             
             # Tenta criar o arquivo de cache vazio
-            os.makedirs(CACHE_HISTORICO_DIR, exist_ok=True)
-            with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(_cache["dados"], f, ensure_ascii=False, indent=2)
+            vazio = dict(_cache["dados"])
+            await get_persistence_service().salvar("cache_principal", lambda: gravar_json_atomico(CACHE_FILE, vazio))
         
         return True
     except Exception as e:
@@ -918,12 +1553,11 @@ def get_cache_sync():
     # Se o cache não estiver carregado, carrega do disco de forma síncrona
     if not _cache["dados"]:
         try:
-            if CACHE_FILE.exists():
-                with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                    dados_carregados = json.load(f)
-                    _cache["dados"] = dados_carregados
-                    _cache["metadados"]["ultima_atualizacao"] = dados_carregados.get("timestamp")
-                    logger.info(f"Cache carregado de forma síncrona. Timestamp: {_cache['metadados']['ultima_atualizacao']}")
+            dados_carregados, origem = _carregar_dados_do_disco()
+            if dados_carregados is not None:
+                _publicar(dados_carregados)
+                _cache["metadados"]["ultima_atualizacao"] = dados_carregados.get("timestamp")
+                logger.info(f"Cache carregado de forma síncrona de {origem}. Timestamp: {_cache['metadados']['ultima_atualizacao']}")
         except Exception as e:
             logger.error(f"Erro ao carregar cache síncrono: {e}")
     
@@ -0,0 +1,215 @@
+"""
+Persistência do cache fora do event loop.
+
+``salvar_cache_no_disco``, ``_initialize_cache`` e ``salvar_consulta_historica`` faziam
+``open().write(json.dumps(..., indent=2))`` dentro de funções async: toda requisição da API
+ficava parada durante a serialização, e uma queda no meio da escrita corrompia o arquivo.
+
+Aqui a gravação roda numa thread dedicada (``PersistenceService``), com um encoder rápido e
+sem indentação (``orjson`` se instalado, senão ``json`` compacto), e o arquivo é trocado de
+forma atômica (temporário + fsync + rename). Pedidos de gravação com a mesma chave que chegam
+em rajada são agrupados: enquanto uma gravação espera ou está em andamento, os pedidos novos
+substituem o pendente e todos são atendidos pela próxima escrita, com o estado mais recente.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+PERSIST_DEBOUNCE = float(os.getenv("NEW_RELIC_PERSIST_DEBOUNCE", "0.25"))  # segundos de espera para agrupar pedidos
+
+
+def serializar_json(dados: Any) -> bytes:
+    """JSON compacto em UTF-8, com ``orjson`` quando disponível."""
+    if isinstance(dados, dict) and type(dados) is not dict:
+        # Dicts com chaves carregadas sob demanda (mmap_cache): o orjson leria só o armazenamento interno
+        dados = dict(dados.items())
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(dados, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except (orjson.JSONEncodeError, TypeError):
+            # Ex.: inteiros acima de 64 bits, que o json da biblioteca padrão aceita
+            pass
+    return json.dumps(dados, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def serializar_texto(dados: Any) -> str:
+    return serializar_json(dados).decode("utf-8")
+
+
+def desserializar_json(conteudo: bytes) -> Any:
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.loads(conteudo)
+        except orjson.JSONDecodeError:
+            # Ex.: inteiros acima de 64 bits gravados pelo json da biblioteca padrão
+            pass
+    return json.loads(conteudo)
+
+
+def gravar_atomico(destino, conteudo: bytes):
+    """Grava num temporário ao lado do destino, faz fsync e troca por rename."""
+    destino = Path(destino)
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    temporario = destino.with_name(f".{destino.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(temporario, "wb") as f:
+            f.write(conteudo)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, destino)
+    except BaseException:
+        temporario.unlink(missing_ok=True)
+        raise
+    if hasattr(os, "O_DIRECTORY"):
+        # Garante que o rename também sobreviva a uma queda de energia
+        descritor = os.open(destino.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descritor)
+        finally:
+            os.close(descritor)
+
+
+def gravar_json_atomico(destino, dados: Any):
+    gravar_atomico(destino, serializar_json(dados))
+
+
+def copia_rasa(dados: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Cópia do dict e das suas listas de primeiro nível (sem copiar os itens): a thread de
+    gravação itera sobre a cópia enquanto o event loop continua trocando ou estendendo as listas.
+    """
+    return {chave: list(valor) if isinstance(valor, list) else valor for chave, valor in dados.items()}
+
+
+class PersistenceService:
+    """Fila de gravações por chave, executadas numa thread própria e agrupadas em rajadas."""
+
+    def __init__(self, debounce: float = PERSIST_DEBOUNCE):
+        self.debounce = debounce
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistencia-cache")
+        self._pendentes: Dict[str, Tuple[Callable[[], Any], List[asyncio.Future]]] = {}
+        self._tarefas: Dict[str, asyncio.Task] = {}
+        self.stats = {"pedidos": 0, "gravacoes": 0, "agrupados": 0, "falhas": 0, "tempo_total": 0.0, "ultimo_erro": None}
+
+    def agendar(self, chave: str, funcao: Callable[[], Any]) -> asyncio.Future:
+        """
+        Agenda ``funcao`` (executada na thread de gravação) para a chave. Se já houver uma
+        gravação pendente da mesma chave, ela é substituída por esta. Retorna um future com o
+        resultado da escrita que atender o pedido.
+        """
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        self.stats["pedidos"] += 1
+        tarefa = self._tarefas.get(chave)
+        if tarefa is not None and tarefa.get_loop() is not loop:
+            # Pedido pendente de um event loop anterior (já encerrado): o novo estado o substitui
+            self._pendentes.pop(chave, None)
+            tarefa = None
+        anterior = self._pendentes.get(chave)
+        if anterior is not None:
+            self.stats["agrupados"] += 1
+            self._pendentes[chave] = (funcao, anterior[1] + [futuro])
+        else:
+            self._pendentes[chave] = (funcao, [futuro])
+        if tarefa is None or tarefa.done():
+            self._tarefas[chave] = loop.create_task(self._drenar(chave))
+        return futuro
+
+    async def salvar(self, chave: str, funcao: Callable[[], Any]) -> Any:
+        """Agenda a gravação e espera a escrita que a atender."""
+        return await self.agendar(chave, funcao)
+
+    async def executar(self, funcao: Callable[[], Any]) -> Any:
+        """
+        Executa ``funcao`` na thread de gravação sem agrupar (para gravações que não podem ser
+        substituídas, como a publicação de uma geração de segmentos), na ordem dos pedidos.
+        """
+        return await self.enfileirar(funcao)
+
+    def enfileirar(self, funcao: Callable[[], Any]) -> asyncio.Future:
+        """
+        Como ``executar``, mas o pedido entra na fila já na chamada e o future é devolvido sem
+        esperar (para callbacks síncronos que precisam manter a ordem das gravações).
+        """
+        self.stats["pedidos"] += 1
+        return asyncio.get_running_loop().run_in_executor(self._executor, self._medir, funcao)
+
+    def _medir(self, funcao: Callable[[], Any]) -> Any:
+        inicio = time.perf_counter()
+        try:
+            resultado = funcao()
+        except Exception as e:
+            self.stats["falhas"] += 1
+            self.stats["ultimo_erro"] = str(e)
+            raise
+        finally:
+            self.stats["tempo_total"] += time.perf_counter() - inicio
+        self.stats["gravacoes"] += 1
+        return resultado
+
+    async def _drenar(self, chave: str):
+        loop = asyncio.get_running_loop()
+        while chave in self._pendentes:
+            if self.debounce:
+                await asyncio.sleep(self.debounce)
+            funcao, futuros = self._pendentes.pop(chave)
+            inicio = time.perf_counter()
+            try:
+                resultado = await loop.run_in_executor(self._executor, funcao)
+            except Exception as e:
+                self.stats["falhas"] += 1
+                self.stats["ultimo_erro"] = f"{chave}: {e}"
+                logger.error(f"Erro na gravação em segundo plano de {chave}: {e}")
+                for futuro in futuros:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+            else:
+                self.stats["gravacoes"] += 1
+                for futuro in futuros:
+                    if not futuro.done():
+                        futuro.set_result(resultado)
+            finally:
+                self.stats["tempo_total"] += time.perf_counter() - inicio
+
+    async def aguardar(self):
+        """Espera as gravações pendentes deste event loop (ex.: no desligamento)."""
+        loop = asyncio.get_running_loop()
+        tarefas = [t for t in self._tarefas.values() if t.get_loop() is loop and not t.done()]
+        if tarefas:
+            await asyncio.gather(*tarefas, return_exceptions=True)
+
+    def get_status(self) -> Dict[str, Any]:
+        gravacoes = self.stats["gravacoes"] + self.stats["falhas"]
+        return {
+            **self.stats,
+            "encoder": "orjson" if ORJSON_AVAILABLE else "json",
+            "pendentes": list(self._pendentes),
+            "tempo_medio_ms": round(self.stats["tempo_total"] / gravacoes * 1000, 2) if gravacoes else 0,
+        }
+
+
+# Instância única do processo (uma thread de gravação: escritas do mesmo arquivo nunca se sobrepõem)
+_service: Optional[PersistenceService] = None
+
+
+def get_persistence_service() -> PersistenceService:
+    global _service
+    if _service is None:
+        _service = PersistenceService()
+    return _service
@@ -0,0 +1,184 @@
+"""
+Journal de checkpoint da coleta completa (retomada após queda ou reinício).
+
+Sem journal, uma coleta completa só chega ao disco no fim (``salvar_cache_no_disco``): se o
+processo cai no meio, tudo o que já foi coletado se perde. Aqui cada entidade concluída é
+anexada a um arquivo NDJSON, e ao fim de cada página da listagem grava-se o cursor da próxima
+página e a posição na listagem. Uma coleta reiniciada relê o journal, pula os GUIDs já
+concluídos e continua a partir do último cursor.
+
+Registros (um JSON por linha):
+    {"t": "inicio", "ts": ...}
+    {"t": "entidade", "guid": ..., "dados": {...}}
+    {"t": "pagina", "cursor": ..., "posicao": ...}
+    {"t": "fim", "ts": ...}
+
+Cada registro é gravado com flush (sobrevive à queda do processo); o fsync acontece a cada
+página (ou a cada entidade, com ``fsync_por_entidade``). Uma última linha incompleta, de uma
+escrita interrompida, é ignorada na leitura. Journals concluídos ou mais velhos que
+``CHECKPOINT_MAX_AGE`` não são retomados: os dados já estariam velhos demais.
+
+Com ``em_segundo_plano`` (coleta no event loop) a leitura, as escritas e o fsync rodam numa
+thread própria, na ordem em que foram pedidos; ``aguardar`` espera os pendentes.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_ENABLED = os.getenv("NEW_RELIC_CHECKPOINT", "true").lower() == "true"
+CHECKPOINT_FILE = Path("historico") / "coleta_checkpoint.ndjson"
+CHECKPOINT_MAX_AGE = int(os.getenv("NEW_RELIC_CHECKPOINT_MAX_AGE", str(6 * 3600)))  # segundos
+
+# Thread única de escrita dos journals: mantém a ordem dos registros (entidades antes da página)
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-coleta")
+
+
+class EstadoRetomada:
+    """O que uma coleta reiniciada aproveita do journal."""
+
+    def __init__(self, concluidas: Optional[Dict[str, Dict[str, Any]]] = None,
+                 cursor: Optional[str] = None, posicao: int = 0, iniciado_em: Optional[float] = None):
+        self.concluidas = concluidas or {}
+        self.cursor = cursor
+        self.posicao = posicao
+        self.iniciado_em = iniciado_em
+        self.paginas = 0
+
+    @property
+    def listagem_concluida(self) -> bool:
+        """A última página da listagem já foi registrada (só faltaria o fechamento)."""
+        return self.paginas > 0 and self.cursor is None
+
+    @property
+    def retomando(self) -> bool:
+        return bool(self.concluidas) or self.cursor is not None
+
+
+class CollectionJournal:
+    """Journal NDJSON de uma coleta completa."""
+
+    def __init__(self, path=CHECKPOINT_FILE, max_age: int = CHECKPOINT_MAX_AGE, fsync_por_entidade: bool = False,
+                 em_segundo_plano: bool = False):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.fsync_por_entidade = fsync_por_entidade
+        self.em_segundo_plano = em_segundo_plano
+        self._arquivo = None
+        self._pendentes = []
+
+    def _ler(self) -> Optional[EstadoRetomada]:
+        if not self.path.exists():
+            return None
+        estado = EstadoRetomada()
+        concluido = False
+        with open(self.path, "r", encoding="utf-8") as f:
+            for numero, linha in enumerate(f, 1):
+                try:
+                    registro = json.loads(linha)
+                except json.JSONDecodeError:
+                    logger.warning(f"Linha {numero} do journal de coleta ilegível (escrita interrompida), ignorada")
+                    continue
+                tipo = registro.get("t")
+                if tipo == "inicio":
+                    estado.iniciado_em = registro.get("ts")
+                elif tipo == "entidade" and registro.get("guid"):
+                    estado.concluidas[registro["guid"]] = registro.get("dados") or {}
+                elif tipo == "pagina":
+                    estado.paginas += 1
+                    estado.cursor = registro.get("cursor")
+                    estado.posicao = registro.get("posicao", estado.posicao)
+                elif tipo == "fim":
+                    concluido = True
+        return None if concluido else estado
+
+    def retomar(self, agora: Optional[float] = None) -> EstadoRetomada:
+        """
+        Abre o journal para escrita. Se houver uma coleta interrompida recente, devolve o estado
+        dela e continua anexando ao mesmo arquivo; senão começa um journal novo.
+        """
+        agora = time.time() if agora is None else agora
+        try:
+            estado = self._ler()
+        except OSError as e:
+            logger.warning(f"Erro ao ler journal de coleta {self.path}: {e}")
+            estado = None
+        if estado is not None and (estado.iniciado_em is None or agora - estado.iniciado_em > self.max_age):
+            logger.info("Journal de coleta expirado, iniciando coleta do zero")
+            estado = None
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if estado is not None and estado.retomando:
+            logger.info(f"Retomando coleta: {len(estado.concluidas)} entidades concluídas, posição {estado.posicao}")
+            self._arquivo = open(self.path, "a", encoding="utf-8")
+            if self._arquivo.tell() and not self._termina_em_nova_linha():
+                # Fecha a linha interrompida para o próximo registro não se misturar a ela
+                self._arquivo.write("\n")
+            return estado
+
+        self._arquivo = open(self.path, "w", encoding="utf-8")
+        self._escrever(self._arquivo, {"t": "inicio", "ts": agora}, fsync=True)
+        return EstadoRetomada(iniciado_em=agora)
+
+    async def retomar_async(self, agora: Optional[float] = None) -> EstadoRetomada:
+        """``retomar`` na thread de escrita, depois do que os journals anteriores pediram."""
+        return await asyncio.get_running_loop().run_in_executor(_executor, self.retomar, agora)
+
+    def _termina_em_nova_linha(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _executar(self, funcao, *args):
+        if self.em_segundo_plano:
+            self._pendentes.append(asyncio.get_running_loop().run_in_executor(_executor, funcao, *args))
+        else:
+            funcao(*args)
+
+    @staticmethod
+    def _escrever(arquivo, registro: Dict[str, Any], fsync: bool):
+        arquivo.write(json.dumps(registro, ensure_ascii=False, default=str) + "\n")
+        arquivo.flush()
+        if fsync:
+            os.fsync(arquivo.fileno())
+
+    def _gravar(self, registro: Dict[str, Any], fsync: bool):
+        if self._arquivo is not None:
+            self._executar(self._escrever, self._arquivo, registro, fsync)
+
+    async def aguardar(self):
+        """Espera as escritas em segundo plano pedidas até aqui (propaga a primeira falha)."""
+        pendentes, self._pendentes = self._pendentes, []
+        if pendentes:
+            await asyncio.gather(*pendentes)
+
+    def registrar_entidade(self, entidade: Dict[str, Any]):
+        self._gravar({"t": "entidade", "guid": entidade.get("guid"), "dados": entidade}, fsync=self.fsync_por_entidade)
+
+    def registrar_pagina(self, cursor: Optional[str], posicao: int):
+        """Marca a página como concluída: ``cursor`` é o da próxima página (None no fim da listagem)."""
+        self._gravar({"t": "pagina", "cursor": cursor, "posicao": posicao}, fsync=True)
+
+    def concluir(self):
+        """Fecha o journal de uma coleta que terminou; os dados já estão no resultado final."""
+        self._gravar({"t": "fim", "ts": time.time()}, fsync=True)
+        self.fechar()
+        self._executar(self._remover)
+
+    def _remover(self):
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+    def fechar(self):
+        if self._arquivo is not None:
+            self._executar(self._arquivo.close)
+            self._arquivo = None
@@ -0,0 +1,426 @@
+"""
+Coleta distribuída em shards (workers em processos ou máquinas diferentes).
+
+Acima de ~20 mil entidades, um único event loop não dá conta da coleta e do pós-processamento
+JSON ao mesmo tempo. Aqui o espaço de GUIDs é dividido por hashing consistente
+(``AnelConsistente``) em N shards: cada worker lista as entidades, fica só com as do seu
+shard, roda o pipeline de coleta (summaries em lote, métricas, dados avançados e filtragem) e
+grava a saída em segmentos NDJSON (``utils.segment_store``). O coordenador publica as saídas
+como uma geração do cache em segmentos sem carregá-las (os arquivos entram por hard link), e o
+servidor, que observa o manifesto, carrega a geração nova (``cache.recarregar_geracao_shards``).
+
+A coordenação usa um SQLite em diretório compartilhado (``SHARD_DB``): uma rodada tem N shards;
+cada worker reivindica um shard pendente (ou um cuja concessão expirou sem heartbeat, de um
+worker que caiu), renova a concessão enquanto coleta e marca o shard como concluído apontando
+para a saída. Shards que falham voltam para a fila até ``SHARD_MAX_TENTATIVAS``. As chamadas ao
+SQLite (que podem esperar pelo lock de outro worker) rodam fora do event loop.
+
+Uso:
+    python -m utils.collection_shards rodada --shards 4            # coordenador + 4 workers locais
+    python -m utils.collection_shards worker --rodada 12 --worker-id maquina-b
+"""
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import time
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils import segment_store
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR = Path("historico") / "shards"
+SHARD_DB = SHARDS_DIR / "coordenacao.sqlite3"
+SHARD_VNODES = int(os.getenv("NEW_RELIC_SHARD_VNODES", "64"))  # pontos por shard no anel
+SHARD_LEASE = int(os.getenv("NEW_RELIC_SHARD_LEASE", "300"))  # segundos sem heartbeat até o shard ser retomado
+SHARD_HEARTBEAT = int(os.getenv("NEW_RELIC_SHARD_HEARTBEAT", "30"))
+SHARD_MAX_TENTATIVAS = int(os.getenv("NEW_RELIC_SHARD_MAX_TENTATIVAS", "3"))
+TIMEOUT_RODADA = int(os.getenv("NEW_RELIC_SHARD_TIMEOUT", str(4 * 3600)))
+
+STATUS_PENDENTE = "pendente"
+STATUS_EM_ANDAMENTO = "em_andamento"
+STATUS_CONCLUIDO = "concluido"
+STATUS_FALHOU = "falhou"
+
+
+def _hash(texto: str) -> int:
+    return int.from_bytes(hashlib.md5(texto.encode("utf-8")).digest()[:8], "big")
+
+
+class AnelConsistente:
+    """
+    Anel de hashing consistente com ``vnodes`` pontos por shard: passar de N para N+1 shards
+    move só ~1/(N+1) das entidades, então os caches de consulta de cada worker continuam úteis.
+    """
+
+    def __init__(self, shards: int, vnodes: int = SHARD_VNODES):
+        if shards < 1:
+            raise ValueError("Número de shards deve ser >= 1")
+        self.shards = shards
+        pontos = sorted((_hash(f"shard-{s}#{v}"), s) for s in range(shards) for v in range(vnodes))
+        self._hashes = [h for h, _ in pontos]
+        self._donos = [s for _, s in pontos]
+
+    def shard_de(self, guid: str) -> int:
+        i = bisect.bisect(self._hashes, _hash(guid)) % len(self._hashes)
+        return self._donos[i]
+
+
+class CoordenadorShards:
+    """Estado das rodadas e concessões de shards num SQLite compartilhado."""
+
+    def __init__(self, db_path=SHARD_DB, lease: int = SHARD_LEASE, max_tentativas: int = SHARD_MAX_TENTATIVAS):
+        self.db_path = Path(db_path)
+        self.lease = lease
+        self.max_tentativas = max_tentativas
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._conectar()) as conexao:
+            conexao.executescript("""
+                CREATE TABLE IF NOT EXISTS rodadas (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    total_shards INTEGER NOT NULL,
+                    iniciada_em REAL NOT NULL,
+                    mesclada_em REAL
+                );
+                CREATE TABLE IF NOT EXISTS shards (
+                    rodada INTEGER NOT NULL,
+                    shard INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    heartbeat REAL,
+                    tentativas INTEGER NOT NULL DEFAULT 0,
+                    saida TEXT,
+                    entidades INTEGER,
+                    erro TEXT,
+                    PRIMARY KEY (rodada, shard)
+                );
+            """)
+
+    def _conectar(self) -> sqlite3.Connection:
+        # Autocommit; as transações de escrita são abertas com BEGIN IMMEDIATE
+        conexao = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conexao.row_factory = sqlite3.Row
+        conexao.execute("PRAGMA journal_mode=WAL")
+        return conexao
+
+    def iniciar_rodada(self, total_shards: int, agora: Optional[float] = None) -> int:
+        agora = time.time() if agora is None else agora
+        with closing(self._conectar()) as conexao:
+            conexao.execute("BEGIN IMMEDIATE")
+            rodada = conexao.execute(
+                "INSERT INTO rodadas (total_shards, iniciada_em) VALUES (?, ?)", (total_shards, agora)
+            ).lastrowid
+            conexao.executemany(
+                "INSERT INTO shards (rodada, shard, status) VALUES (?, ?, ?)",
+                [(rodada, s, STATUS_PENDENTE) for s in range(total_shards)],
+            )
+            conexao.execute("COMMIT")
+        logger.info(f"Rodada de coleta {rodada} criada com {total_shards} shards")
+        return rodada
+
+    def ultima_rodada_aberta(self) -> Optional[int]:
+        with closing(self._conectar()) as conexao:
+            linha = conexao.execute("SELECT id FROM rodadas WHERE mesclada_em IS NULL ORDER BY id DESC LIMIT 1").fetchone()
+        return linha["id"] if linha else None
+
+    def total_shards(self, rodada: int) -> int:
+        with closing(self._conectar()) as conexao:
+            return conexao.execute("SELECT total_shards FROM rodadas WHERE id = ?", (rodada,)).fetchone()["total_shards"]
+
+    def reivindicar(self, worker: str, rodada: int, agora: Optional[float] = None) -> Optional[int]:
+        """
+        Concede ao worker um shard da rodada: pendente, com concessão expirada ou que falhou
+        com tentativas restantes. Retorna o número do shard, ou None se não há o que fazer.
+        """
+        agora = time.time() if agora is None else agora
+        with closing(self._conectar()) as conexao:
+            conexao.execute("BEGIN IMMEDIATE")
+            linha = conexao.execute(
+                """
+                SELECT shard FROM shards
+                WHERE rodada = ? AND tentativas < ? AND (
+                    status = ? OR status = ? OR (status = ? AND heartbeat < ?)
+                )
+                ORDER BY tentativas, shard LIMIT 1
+                """,
+                (rodada, self.max_tentativas, STATUS_PENDENTE, STATUS_FALHOU, STATUS_EM_ANDAMENTO, agora - self.lease),
+            ).fetchone()
+            if linha is None:
+                conexao.execute("COMMIT")
+                return None
+            conexao.execute(
+                "UPDATE shards SET status = ?, worker = ?, heartbeat = ?, tentativas = tentativas + 1, erro = NULL "
+                "WHERE rodada = ? AND shard = ?",
+                (STATUS_EM_ANDAMENTO, worker, agora, rodada, linha["shard"]),
+            )
+            conexao.execute("COMMIT")
+        return linha["shard"]
+
+    def _atualizar_concessao(self, rodada: int, shard: int, worker: str, campos: Dict[str, Any]) -> bool:
+        """Atualiza o shard só se a concessão ainda for deste worker (não foi retomada por outro)."""
+        atribuicoes = ", ".join(f"{campo} = ?" for campo in campos)
+        with closing(self._conectar()) as conexao:
+            cursor = conexao.execute(
+                f"UPDATE shards SET {atribuicoes} WHERE rodada = ? AND shard = ? AND worker = ? AND status = ?",
+                (*campos.values(), rodada, shard, worker, STATUS_EM_ANDAMENTO),
+            )
+            return cursor.rowcount == 1
+
+    def renovar(self, rodada: int, shard: int, worker: str, agora: Optional[float] = None) -> bool:
+        return self._atualizar_concessao(rodada, shard, worker, {"heartbeat": time.time() if agora is None else agora})
+
+    def concluir(self, rodada: int, shard: int, worker: str, saida: str, entidades: int) -> bool:
+        return self._atualizar_concessao(rodada, shard, worker, {
+            "status": STATUS_CONCLUIDO, "saida": saida, "entidades": entidades, "heartbeat": time.time(),
+        })
+
+    def falhar(self, rodada: int, shard: int, worker: str, erro: str) -> bool:
+        return self._atualizar_concessao(rodada, shard, worker, {"status": STATUS_FALHOU, "erro": erro[:2000]})
+
+    def shards(self, rodada: int) -> List[Dict[str, Any]]:
+        with closing(self._conectar()) as conexao:
+            linhas = conexao.execute("SELECT * FROM shards WHERE rodada = ? ORDER BY shard", (rodada,)).fetchall()
+        return [dict(linha) for linha in linhas]
+
+    def rodada_concluida(self, rodada: int) -> bool:
+        return all(s["status"] == STATUS_CONCLUIDO for s in self.shards(rodada))
+
+    def rodada_esgotada(self, rodada: int) -> bool:
+        """Algum shard falhou em todas as tentativas: a rodada não vai terminar."""
+        return any(s["status"] == STATUS_FALHOU and s["tentativas"] >= self.max_tentativas for s in self.shards(rodada))
+
+    def marcar_mesclada(self, rodada: int):
+        with closing(self._conectar()) as conexao:
+            conexao.execute("UPDATE rodadas SET mesclada_em = ? WHERE id = ?", (time.time(), rodada))
+
+    def get_status(self, rodada: int) -> Dict[str, Any]:
+        shards = self.shards(rodada)
+        contagem: Dict[str, int] = {}
+        for s in shards:
+            contagem[s["status"]] = contagem.get(s["status"], 0) + 1
+        return {
+            "rodada": rodada,
+            "total_shards": len(shards),
+            "por_status": contagem,
+            "entidades": sum(s["entidades"] or 0 for s in shards),
+            "shards": shards,
+        }
+
+
+# -- Worker ----------------------------------------------------------------------------------------
+
+def diretorio_saida(rodada: int, shard: int, raiz=SHARDS_DIR) -> Path:
+    return Path(raiz) / f"rodada-{rodada}" / f"shard-{shard}"
+
+
+async def coletar_shard(shard: int, total_shards: int, destino, incluir_globais: Optional[bool] = None) -> Dict[str, Any]:
+    """
+    Pipeline de coleta de um shard: lista as entidades (de todas as contas configuradas), coleta
+    e filtra só as do shard e grava tudo em segmentos em ``destino``. O shard 0 também coleta os
+    dados globais (logs, incidentes, status). Retorna o manifesto da saída.
+    """
+    from utils.entity_processor import filtrar_entidade
+    from utils.newrelic_accounts import get_contas, get_concurrency_controller_atual, usar_conta
+    from utils.newrelic_advanced_collector import collect_entities_complete_data, collect_global_data, iter_entity_pages
+    from utils.newrelic_common import get_shared_session
+
+    anel = AnelConsistente(total_shards)
+    incluir_globais = shard == 0 if incluir_globais is None else incluir_globais
+    session = get_shared_session()
+    writer = segment_store.SegmentWriter(destino)
+    globais_por_conta: Dict[str, Dict[str, Any]] = {}
+
+    async def coletar_conta(conta):
+        def gravar(res):
+            if conta is not None:
+                res["conta"] = conta.nome
+            processada = filtrar_entidade(res)
+            if processada:
+                writer.escrever(processada)
+
+        with usar_conta(conta):
+            semaphore = asyncio.Semaphore(get_concurrency_controller_atual().max_limit)
+            async for page in iter_entity_pages(session=session):
+                minhas = [e for e in page if e.get("guid") and anel.shard_de(e["guid"]) == shard]
+                if minhas:
+                    await collect_entities_complete_data(minhas, session=session, semaphore=semaphore, ao_concluir=gravar)
+            if incluir_globais:
+                globais_por_conta[conta.nome if conta else ""] = await collect_global_data(session)
+
+    try:
+        contas = get_contas()
+        await asyncio.gather(*(coletar_conta(c) for c in (contas or [None])))
+        globais: Dict[str, Any] = {}
+        if incluir_globais:
+            if contas:
+                globais["contas"] = {c.nome: dict(globais_por_conta.get(c.nome, {}), account_id=c.account_id) for c in contas}
+                globais.update(globais_por_conta.get(contas[0].nome, {}))
+            else:
+                globais.update(globais_por_conta.get("", {}))
+            globais["dashboards"] = {"list": []}
+            globais["alertas"] = {"policies": []}
+        globais["timestamp"] = datetime.now().isoformat()
+        globais["shard"] = {"indice": shard, "total": total_shards}
+        return writer.finalizar(globais)
+    except BaseException:
+        writer.abortar()
+        raise
+
+
+async def executar_worker(coordenador: CoordenadorShards, worker_id: str, rodada: Optional[int] = None,
+                          raiz=SHARDS_DIR, heartbeat: float = SHARD_HEARTBEAT) -> int:
+    """
+    Reivindica e coleta shards da rodada até não sobrar nenhum. Retorna quantos shards
+    este worker concluiu.
+    """
+    rodada = await asyncio.to_thread(coordenador.ultima_rodada_aberta) if rodada is None else rodada
+    if rodada is None:
+        logger.info("Nenhuma rodada de coleta aberta")
+        return 0
+    total_shards = await asyncio.to_thread(coordenador.total_shards, rodada)
+    concluidos = 0
+    while True:
+        shard = await asyncio.to_thread(coordenador.reivindicar, worker_id, rodada)
+        if shard is None:
+            return concluidos
+        logger.info(f"Worker {worker_id}: coletando shard {shard}/{total_shards} da rodada {rodada}")
+        destino = diretorio_saida(rodada, shard, raiz)
+
+        async def renovar_concessao():
+            while True:
+                await asyncio.sleep(heartbeat)
+                if not await asyncio.to_thread(coordenador.renovar, rodada, shard, worker_id):
+                    logger.warning(f"Worker {worker_id}: concessão do shard {shard} perdida")
+
+        renovacao = asyncio.create_task(renovar_concessao())
+        try:
+            manifesto = await coletar_shard(shard, total_shards, destino)
+        except Exception as e:
+            logger.error(f"Worker {worker_id}: falha no shard {shard} da rodada {rodada}: {e}")
+            await asyncio.to_thread(coordenador.falhar, rodada, shard, worker_id, f"{type(e).__name__}: {e}")
+            continue
+        finally:
+            renovacao.cancel()
+        if await asyncio.to_thread(coordenador.concluir, rodada, shard, worker_id, str(destino), manifesto["total_registros"]):
+            concluidos += 1
+            logger.info(f"Worker {worker_id}: shard {shard} concluído com {manifesto['total_registros']} entidades")
+        else:
+            logger.warning(f"Worker {worker_id}: shard {shard} foi retomado por outro worker, saída descartada")
+
+
+# -- Coordenador -----------------------------------------------------------------------------------
+
+def publicar_rodada(coordenador: CoordenadorShards, rodada: int, raiz_segmentos=None) -> Dict[str, Any]:
+    """
+    Publica as saídas dos shards concluídos como uma geração do cache em segmentos
+    (``segment_store.publicar_geracao``), sem carregar as entidades. Os dados globais vêm do
+    shard 0. Retorna o manifesto publicado.
+    """
+    shards = coordenador.shards(rodada)
+    pendentes = [s["shard"] for s in shards if s["status"] != STATUS_CONCLUIDO]
+    if pendentes:
+        raise RuntimeError(f"Rodada {rodada} com shards não concluídos: {pendentes}")
+    raiz_segmentos = segment_store.SEGMENT_DIR if raiz_segmentos is None else raiz_segmentos
+    return segment_store.publicar_geracao(
+        [s["saida"] for s in shards], raiz_segmentos,
+        globais={"timestamp": datetime.now().isoformat(), "shards": {"rodada": rodada, "total": len(shards)}, "shard": None},
+        origem=segment_store.ORIGEM_SHARDS,
+    )
+
+
+async def executar_rodada_local(total_shards: int, workers: Optional[int] = None, db_path=SHARD_DB,
+                                raiz=SHARDS_DIR, timeout: float = TIMEOUT_RODADA, raiz_segmentos=None) -> Dict[str, Any]:
+    """
+    Coordenador: cria uma rodada, sobe ``workers`` processos worker nesta máquina (outros
+    nós podem se juntar apontando para o mesmo ``db_path``), espera os shards e publica as saídas
+    como geração do cache em segmentos, que o servidor carrega. Retorna o status da rodada.
+    """
+    coordenador = await asyncio.to_thread(CoordenadorShards, db_path)
+    rodada = await asyncio.to_thread(coordenador.iniciar_rodada, total_shards)
+    workers = total_shards if workers is None else workers
+    comando = [sys.executable, "-m", "utils.collection_shards", "worker", "--rodada", str(rodada), "--db", str(db_path), "--raiz", str(raiz)]
+    processos = []
+    for i in range(workers):
+        processos.append(await asyncio.create_subprocess_exec(
+            *comando, "--worker-id", f"{socket.gethostname()}-{os.getpid()}-{i}",
+            stdout=asyncio.subprocess.DEVNULL,
+        ))
+    try:
+        await asyncio.wait_for(asyncio.gather(*(p.wait() for p in processos)), timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Rodada {rodada} excedeu {timeout}s")
+    finally:
+        for processo in processos:
+            if processo.returncode is None:
+                processo.kill()
+                await processo.wait()
+
+    # Um worker que caiu deixa o shard em andamento: este processo termina o que faltou
+    concluida = await asyncio.to_thread(coordenador.rodada_concluida, rodada)
+    if not concluida and not await asyncio.to_thread(coordenador.rodada_esgotada, rodada):
+        await executar_worker(coordenador, f"{socket.gethostname()}-{os.getpid()}-coordenador", rodada, raiz)
+        concluida = await asyncio.to_thread(coordenador.rodada_concluida, rodada)
+
+    status = await asyncio.to_thread(coordenador.get_status, rodada)
+    if not concluida:
+        logger.error(f"Rodada {rodada} incompleta, cache principal mantido: {status['por_status']}")
+        status["erro"] = "rodada incompleta"
+        return status
+    manifesto = await asyncio.to_thread(publicar_rodada, coordenador, rodada, raiz_segmentos)
+    await asyncio.to_thread(coordenador.marcar_mesclada, rodada)
+    # A geração publicada tem os próprios links para os segmentos
+    await asyncio.to_thread(shutil.rmtree, Path(raiz) / f"rodada-{rodada}", True)
+    status["geracao"] = manifesto["geracao"]
+    logger.info(f"Rodada {rodada} publicada: {manifesto['total_registros']} entidades de {total_shards} shards ({manifesto['geracao']})")
+    return status
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Coleta New Relic distribuída em shards")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_rodada = sub.add_parser("rodada", help="coordenador: cria a rodada, sobe workers locais e mescla")
+    p_rodada.add_argument("--shards", type=int, required=True)
+    p_rodada.add_argument("--workers", type=int, help="workers locais (padrão: um por shard)")
+    p_worker = sub.add_parser("worker", help="coleta shards de uma rodada")
+    p_worker.add_argument("--rodada", type=int, help="padrão: última rodada aberta")
+    p_worker.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    p_status = sub.add_parser("status", help="estado de uma rodada")
+    p_status.add_argument("--rodada", type=int)
+    for p in (p_rodada, p_worker, p_status):
+        p.add_argument("--db", default=str(SHARD_DB))
+        p.add_argument("--raiz", default=str(SHARDS_DIR))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(name)s: %(message)s")
+
+    async def rodar():
+        from utils.newrelic_common import close_shared_session
+        try:
+            if args.comando == "rodada":
+                return await executar_rodada_local(args.shards, args.workers, args.db, args.raiz)
+            if args.comando == "worker":
+                return await executar_worker(CoordenadorShards(args.db), args.worker_id, args.rodada, args.raiz)
+            coordenador = CoordenadorShards(args.db)
+            rodada = args.rodada or coordenador.ultima_rodada_aberta()
+            return coordenador.get_status(rodada) if rodada else None
+        finally:
+            await close_shared_session()
+
+    resultado = asyncio.run(rodar())
+    if args.comando != "worker":
+        print(json.dumps(resultado, indent=2, ensure_ascii=False, default=str))
+
+
+if __name__ == "__main__":
+    main()
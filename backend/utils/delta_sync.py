@@ -0,0 +1,280 @@
+"""
+Sincronização delta de entidades do New Relic.
+
+Em vez de recoletar todas as entidades a cada ciclo, mantém uma tabela GUID -> fingerprint
+(flag ``reporting``, tags, tipo, domínio, nome e o instante da última mudança de ``reporting``).
+A cada ciclo a listagem barata (entitySearch) é comparada com a tabela e os dados profundos
+só são recoletados para entidades novas, alteradas, em alerta ou com coleta antiga demais.
+Entidades que sumiram da listagem recebem uma lápide (tombstone) e saem do cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from utils.cache_persistence import get_persistence_service, gravar_json_atomico
+
+logger = logging.getLogger(__name__)
+
+DELTA_SYNC_ENABLED = os.getenv("NEW_RELIC_DELTA_SYNC", "true").lower() == "true"
+DELTA_STATE_FILE = Path("historico") / "delta_sync_estado.json"
+# Entidades sem mudança são recoletadas mesmo assim depois desse tempo (métricas envelhecem)
+DELTA_MAX_AGE = int(os.getenv("NEW_RELIC_DELTA_MAX_AGE", "86400"))  # segundos
+# Lápides ficam na tabela por esse tempo antes de serem descartadas
+TOMBSTONE_TTL = int(os.getenv("NEW_RELIC_DELTA_TOMBSTONE_TTL", str(7 * 86400)))  # segundos
+ALERTING_SEVERITIES = ("CRITICAL", "WARNING")
+
+Coletor = Callable[[List[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]
+
+
+def _normalizar_tags(tags: Any) -> List[Tuple[str, Tuple[str, ...]]]:
+    if not isinstance(tags, list):
+        return []
+    normalizadas = []
+    for tag in tags:
+        if isinstance(tag, dict) and tag.get("key"):
+            normalizadas.append((str(tag["key"]), tuple(sorted(str(v) for v in tag.get("values") or []))))
+    return sorted(normalizadas)
+
+
+def entity_fingerprint(entity: Dict[str, Any]) -> str:
+    """Hash estável dos campos da listagem que indicam mudança relevante na entidade."""
+    campos = {
+        "name": entity.get("name"),
+        "domain": entity.get("domain"),
+        "entityType": entity.get("entityType"),
+        "reporting": entity.get("reporting"),
+        "tags": _normalizar_tags(entity.get("tags")),
+    }
+    serializado = json.dumps(campos, sort_keys=True, default=str)
+    return hashlib.sha1(serializado.encode("utf-8")).hexdigest()
+
+
+def is_alerting(entity: Dict[str, Any]) -> bool:
+    """Entidades com alerta aberto são sempre recoletadas."""
+    return str(entity.get("alertSeverity") or "").upper() in ALERTING_SEVERITIES
+
+
+def _collection_failed(entity: Any) -> bool:
+    return not isinstance(entity, dict) or str(entity.get("problema") or "").startswith("ERRO_COLETA")
+
+
+class DeltaPlan:
+    """Resultado da comparação da listagem atual com a tabela de fingerprints."""
+
+    def __init__(self):
+        self.new: List[Dict[str, Any]] = []
+        self.changed: List[Dict[str, Any]] = []
+        self.alerting: List[Dict[str, Any]] = []
+        self.stale: List[Dict[str, Any]] = []
+        self.unchanged: List[Dict[str, Any]] = []
+        self.removed: List[str] = []
+
+    @property
+    def a_coletar(self) -> List[Dict[str, Any]]:
+        return self.new + self.changed + self.alerting + self.stale
+
+    def resumo(self) -> Dict[str, int]:
+        return {
+            "novas": len(self.new),
+            "alteradas": len(self.changed),
+            "em_alerta": len(self.alerting),
+            "expiradas": len(self.stale),
+            "inalteradas": len(self.unchanged),
+            "removidas": len(self.removed),
+        }
+
+
+class FingerprintTable:
+    """Tabela GUID -> fingerprint persistida em JSON entre os ciclos de sincronização."""
+
+    def __init__(self, path: Path = DELTA_STATE_FILE, max_age: int = DELTA_MAX_AGE, tombstone_ttl: int = TOMBSTONE_TTL):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.tombstone_ttl = tombstone_ttl
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+
+    def load(self) -> "FingerprintTable":
+        self._loaded = True
+        if not self.path.exists():
+            return self
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("entidades", {})
+        except Exception as e:
+            logger.warning(f"Tabela de fingerprints ilegível ({self.path}), recomeçando do zero: {e}")
+            self.entries = {}
+        return self
+
+    def save(self, entries: Optional[Dict[str, Dict[str, Any]]] = None):
+        """Grava a tabela (ou a cópia ``entries`` dela) de forma atômica."""
+        gravar_json_atomico(self.path, {
+            "atualizado_em": datetime.now().isoformat(),
+            "entidades": self.entries if entries is None else entries,
+        })
+
+    async def save_async(self):
+        """
+        Grava na thread de persistência, fora do event loop. As entradas são copiadas antes:
+        a thread serializa a cópia enquanto o loop continua registrando coletas.
+        """
+        entries = {guid: dict(entrada) for guid, entrada in self.entries.items()}
+        await get_persistence_service().salvar(f"delta_sync:{self.path}", lambda: self.save(entries))
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def plan(self, entidades: Iterable[Dict[str, Any]], escopo: Optional[str] = None,
+             agora: Optional[datetime] = None) -> DeltaPlan:
+        """
+        Classifica a listagem atual. ``escopo`` restringe a detecção de remoções a um domínio
+        (listagens parciais não devem gerar lápides para os outros domínios).
+        """
+        self._ensure_loaded()
+        agora = agora or datetime.now()
+        limite = agora - timedelta(seconds=self.max_age)
+        plano = DeltaPlan()
+        vistos = set()
+        for entity in entidades:
+            guid = entity.get("guid")
+            if not guid or guid in vistos:
+                continue
+            vistos.add(guid)
+            entrada = self.entries.get(guid)
+            if entrada is None or entrada.get("tombstoned_at"):
+                plano.new.append(entity)
+            elif entrada.get("fingerprint") != entity_fingerprint(entity):
+                plano.changed.append(entity)
+            elif is_alerting(entity):
+                plano.alerting.append(entity)
+            elif not entrada.get("last_collected") or datetime.fromisoformat(entrada["last_collected"]) < limite:
+                plano.stale.append(entity)
+            else:
+                plano.unchanged.append(entity)
+
+        for guid, entrada in self.entries.items():
+            if guid in vistos or entrada.get("tombstoned_at"):
+                continue
+            if escopo and entrada.get("domain") != escopo:
+                continue
+            plano.removed.append(guid)
+        return plano
+
+    def registrar_coleta(self, entity: Dict[str, Any], agora: Optional[datetime] = None):
+        """Grava o fingerprint de uma entidade cuja coleta profunda terminou com sucesso."""
+        self._ensure_loaded()
+        agora_iso = (agora or datetime.now()).isoformat()
+        guid = entity["guid"]
+        anterior = self.entries.get(guid) or {}
+        reporting = entity.get("reporting")
+        mudou_reporting = "reporting" not in anterior or anterior.get("reporting") != reporting
+        self.entries[guid] = {
+            "fingerprint": entity_fingerprint(entity),
+            "name": entity.get("name"),
+            "domain": entity.get("domain"),
+            "entityType": entity.get("entityType"),
+            "reporting": reporting,
+            "last_reporting_change": agora_iso if mudou_reporting else anterior.get("last_reporting_change"),
+            "first_seen": anterior.get("first_seen") or agora_iso,
+            "last_seen": agora_iso,
+            "last_collected": agora_iso,
+            "tombstoned_at": None,
+        }
+
+    def aplicar(self, plano: DeltaPlan, agora: Optional[datetime] = None):
+        """Atualiza ``last_seen`` das inalteradas, cria lápides das removidas e expira lápides antigas."""
+        self._ensure_loaded()
+        agora = agora or datetime.now()
+        agora_iso = agora.isoformat()
+        for entity in plano.unchanged:
+            entrada = self.entries.get(entity.get("guid"))
+            if entrada:
+                entrada["last_seen"] = agora_iso
+        for guid in plano.removed:
+            entrada = self.entries.get(guid)
+            if entrada and not entrada.get("tombstoned_at"):
+                entrada["tombstoned_at"] = agora_iso
+        limite = agora - timedelta(seconds=self.tombstone_ttl)
+        for guid in [g for g, e in self.entries.items()
+                     if e.get("tombstoned_at") and datetime.fromisoformat(e["tombstoned_at"]) < limite]:
+            del self.entries[guid]
+
+    def tombstones(self) -> List[Dict[str, Any]]:
+        self._ensure_loaded()
+        return [
+            {"guid": guid, "name": e.get("name"), "domain": e.get("domain"), "removido_em": e["tombstoned_at"]}
+            for guid, e in self.entries.items() if e.get("tombstoned_at")
+        ]
+
+    def get_status(self) -> Dict[str, Any]:
+        self._ensure_loaded()
+        lapides = sum(1 for e in self.entries.values() if e.get("tombstoned_at"))
+        return {"entidades": len(self.entries) - lapides, "lapides": lapides, "arquivo": str(self.path)}
+
+
+async def sincronizar(
+    tabela: FingerprintTable,
+    entidades: List[Dict[str, Any]],
+    anteriores: Dict[str, Dict[str, Any]],
+    coletar: Coletor,
+    escopo: Optional[str] = None,
+    forcar: bool = False,
+) -> Tuple[List[Dict[str, Any]], DeltaPlan]:
+    """
+    Aplica o delta de uma listagem de entidades.
+
+    Args:
+        tabela: Tabela de fingerprints (não é salva aqui; o chamador decide quando persistir)
+        entidades: Listagem atual (campos leves do entitySearch)
+        anteriores: Dados profundos já em cache, por GUID, reaproveitados para as inalteradas
+        coletar: Função que recebe as entidades a recoletar e devolve os dados profundos
+        escopo: Domínio coberto pela listagem (limita as remoções)
+        forcar: Recoleta tudo, mas continua registrando fingerprints e lápides
+
+    Returns:
+        (entidades resultantes na ordem da listagem, plano aplicado)
+    """
+    plano = tabela.plan(entidades, escopo=escopo)
+    if forcar:
+        plano.stale.extend(plano.unchanged)
+        plano.unchanged = []
+    # Inalteradas que não estão no cache (ex.: filtradas por falta de dados) voltam quando expirarem
+    alvo = plano.a_coletar
+    logger.info(f"Delta de entidades{f' ({escopo})' if escopo else ''}: {plano.resumo()}")
+
+    coletadas: Dict[str, Dict[str, Any]] = {}
+    if alvo:
+        listagem = {e["guid"]: e for e in alvo}
+        for resultado in await coletar(alvo):
+            if _collection_failed(resultado) or resultado.get("guid") not in listagem:
+                continue
+            coletadas[resultado["guid"]] = resultado
+            tabela.registrar_coleta(listagem[resultado["guid"]])
+    tabela.aplicar(plano)
+
+    resultado_final = []
+    for entity in entidades:
+        guid = entity.get("guid")
+        if guid in coletadas:
+            resultado_final.append(coletadas.pop(guid))
+        elif guid in anteriores:
+            resultado_final.append(anteriores[guid])
+    return resultado_final, plano
+
+
+# Instância única do processo
+_table: Optional[FingerprintTable] = None
+
+
+def get_fingerprint_table() -> FingerprintTable:
+    """Retorna a tabela de fingerprints compartilhada do processo (carregada do disco)."""
+    global _table
+    if _table is None:
+        _table = FingerprintTable().load()
+    return _table
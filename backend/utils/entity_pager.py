@@ -0,0 +1,76 @@
+"""
+Iteração paginada (cursor) de entidades do New Relic como stream assíncrono.
+
+``iter_pages`` entrega cada página assim que chega e já dispara a busca da próxima
+(prefetch) enquanto o chamador processa a atual. Só uma página adiante fica em memória,
+então contas com dezenas de milhares de entidades não precisam ser carregadas inteiras.
+
+Uma página com erro levanta ``ErroDePagina`` em vez de encerrar a listagem: quem compara a
+listagem com o que já conhece (sincronização delta) trataria as entidades das páginas que
+faltaram como removidas.
+"""
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Proteção contra cursores que nunca terminam
+MAX_PAGES = 10000
+
+
+class ErroDePagina(Exception):
+    """Resposta de erro (ou fora do formato) no meio de uma listagem paginada."""
+
+
+PageFetcher = Callable[[Optional[str]], Awaitable[Tuple[List[Dict[str, Any]], Optional[str]]]]
+
+
+def parse_entity_search_page(result: Any) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Extrai ``(entidades, next_cursor)`` de uma resposta GraphQL ``actor.entitySearch.results``.
+    Respostas com erro ou fora do formato levantam ``ErroDePagina``.
+    """
+    if not isinstance(result, dict) or result.get("error") or result.get("errors"):
+        erro = result.get("error") or result.get("errors") if isinstance(result, dict) else result
+        raise ErroDePagina(f"Página de entidades com erro: {str(erro)[:500]}")
+    try:
+        search_results = result["data"]["actor"]["entitySearch"]["results"] or {}
+    except (KeyError, TypeError):
+        raise ErroDePagina("Página de entidades fora do formato esperado")
+    return search_results.get("entities") or [], search_results.get("nextCursor")
+
+
+async def iter_pages(fetch_page: PageFetcher, max_pages: int = MAX_PAGES, cursor: Optional[str] = None,
+                     com_cursor: bool = False) -> AsyncIterator[Any]:
+    """
+    Gera as páginas retornadas por ``fetch_page(cursor) -> (itens, proximo_cursor)``.
+
+    A busca da página seguinte começa antes de a atual ser entregue ao chamador.
+    Se o consumidor interromper a iteração, a busca antecipada é cancelada; um erro em
+    ``fetch_page`` (ex.: ``ErroDePagina``) é propagado ao consumidor.
+    ``cursor`` retoma a listagem a partir de uma página já conhecida. Com ``com_cursor`` cada
+    item gerado é ``(itens, proximo_cursor)`` (inclusive páginas vazias), para quem precisa
+    registrar até onde a listagem chegou.
+    """
+    pending: Optional[asyncio.Future] = asyncio.ensure_future(fetch_page(cursor))
+    seen_cursors = set()
+    pages = 0
+    try:
+        while pending is not None:
+            items, next_cursor = await pending
+            pages += 1
+            pending = None
+            if next_cursor and next_cursor not in seen_cursors and pages < max_pages:
+                seen_cursors.add(next_cursor)
+                pending = asyncio.ensure_future(fetch_page(next_cursor))
+            elif next_cursor:
+                logger.warning(f"Paginação interrompida após {pages} páginas (cursor repetido ou limite atingido)")
+            if com_cursor:
+                yield items, next_cursor
+            elif items:
+                yield items
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
@@ -211,6 +211,60 @@ def flatten_metrics(period_data):
             flat[metric] = value
     return flat
 
+def filtrar_entidade(entity: Dict, metrics_stats: Optional[Dict] = None,
+                     processed_domains: Optional[Dict] = None) -> Optional[Dict]:
+    """
+    Aplica a uma única entidade os critérios de filter_entities_with_data.
+    Retorna a entidade processada se tiver dados válidos, senão None.
+    Usada na coleta em stream, que filtra cada entidade assim que chega.
+    """
+    metrics_stats = metrics_stats if metrics_stats is not None else {
+        'has_apdex': 0, 'has_response_time': 0, 'has_error_rate': 0, 'has_throughput': 0
+    }
+    processed = process_entity_details(entity)
+    
+    # Pula entidades que não puderam ser processadas
+    if not processed:
+        logger.debug(f"Entidade rejeitada: erro no processamento: {entity}")
+        return None
+        
+    # Contagem por domínio
+    if processed_domains is not None:
+        domain = entity.get('domain', 'UNKNOWN')
+        processed_domains[domain] = processed_domains.get(domain, 0) + 1
+    
+    # Verificação pré-validação (estatísticas)
+    has_metrics = False
+    if processed.get('metricas'):
+        for period, period_data in processed['metricas'].items():
+            if isinstance(period_data, dict):
+                # Corrigido: checar 'response_time' além de 'response_time_max'
+                if 'apdex' in period_data and period_data['apdex'] is not None:
+                    metrics_stats['has_apdex'] += 1
+                    has_metrics = True
+                if (('response_time' in period_data and period_data['response_time'] is not None) or
+                    ('response_time_max' in period_data and period_data['response_time_max'] is not None)):
+                    metrics_stats['has_response_time'] += 1
+                    has_metrics = True
+                if ('error_rate' in period_data and period_data['error_rate'] is not None) or \
+                   ('recent_error' in period_data and period_data['recent_error'] is not None):
+                    metrics_stats['has_error_rate'] += 1
+                    has_metrics = True
+                if 'throughput' in period_data and period_data['throughput'] is not None:
+                    metrics_stats['has_throughput'] += 1
+                    has_metrics = True
+    
+    # Rejeita entidades sem métricas válidas
+    if not has_metrics:
+        logger.debug(f"Entidade rejeitada: sem métricas válidas - {processed.get('name')}")
+        return None
+    
+    # Verifica se a entidade é válida usando critérios rigorosos
+    if not is_entity_valid(processed):
+        logger.debug(f"Entidade rejeitada por is_entity_valid: {processed}")
+        return None
+    return processed
+
 def filter_entities_with_data(entities: List[Dict]) -> List[Dict]:
     """
     Filtra uma lista de entidades para retornar apenas aquelas 
@@ -239,53 +293,12 @@ def filter_entities_with_data(entities: List[Dict]) -> List[Dict]:
     # Primeira passagem: processar todas as entidades e coletar estatísticas
     for entity in entities:
         try:
-            # Processa a entidade
-            processed = process_entity_details(entity)
+            processed = filtrar_entidade(entity, metrics_stats, processed_domains)
             processed_count += 1
-            
-            # Pula entidades que não puderam ser processadas
-            if not processed:
-                rejected_count += 1
-                logger.debug(f"Entidade rejeitada: erro no processamento: {entity}")
-                continue
-                
-            # Contagem por domínio
-            domain = entity.get('domain', 'UNKNOWN')
-            processed_domains[domain] = processed_domains.get(domain, 0) + 1
-            
-            # Verificação pré-validação (estatísticas)
-            has_metrics = False
-            if processed and processed.get('metricas'):
-                for period, period_data in processed['metricas'].items():
-                    if isinstance(period_data, dict):
-                        # Corrigido: checar 'response_time' além de 'response_time_max'
-                        if 'apdex' in period_data and period_data['apdex'] is not None:
-                            metrics_stats['has_apdex'] += 1
-                            has_metrics = True
-                        if (('response_time' in period_data and period_data['response_time'] is not None) or
-                            ('response_time_max' in period_data and period_data['response_time_max'] is not None)):
-                            metrics_stats['has_response_time'] += 1
-                            has_metrics = True
-                        if ('error_rate' in period_data and period_data['error_rate'] is not None) or \
-                           ('recent_error' in period_data and period_data['recent_error'] is not None):
-                            metrics_stats['has_error_rate'] += 1
-                            has_metrics = True
-                        if 'throughput' in period_data and period_data['throughput'] is not None:
-                            metrics_stats['has_throughput'] += 1
-                            has_metrics = True
-            
-            # Rejeita entidades sem métricas válidas
-            if not has_metrics:
-                rejected_count += 1
-                logger.debug(f"Entidade rejeitada: sem métricas válidas - {processed.get('name')}")
-                continue
-            
-            # Verifica se a entidade é válida usando critérios rigorosos
-            if is_entity_valid(processed):
+            if processed:
                 valid_entities.append(processed)
             else:
                 rejected_count += 1
-                logger.debug(f"Entidade rejeitada por is_entity_valid: {processed}")
         except Exception as e:
             logger.error(f"Erro ao processar entidade: {str(e)}")
             rejected_count += 1
@@ -0,0 +1,362 @@
+"""
+Armazenamento indexado das entidades do cache (SQLite embutido).
+
+O cache principal era um único dict (``_cache["dados"]``) gravado como um JSON inteiro, e
+toda busca por nome, GUID ou domínio era uma varredura da lista ``entidades``. Aqui cada
+entidade é um registro (JSON) com índices em guid (chave primária), nome, domínio, entityType
+e tags, então leituras pontuais e atualizações parciais custam O(log n) e gravam só o que
+mudou. Os dados globais (logs, incidentes, status, metadados) ficam numa tabela chave/valor.
+
+``utils.cache`` continua expondo o dict de sempre (``get_cache``/``get_cache_sync``), que é
+remontado a partir daqui com ``montar_dados``.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils.cache_persistence import serializar_texto
+
+logger = logging.getLogger(__name__)
+
+ENTITY_STORE_ENABLED = os.getenv("NEW_RELIC_ENTITY_STORE", "true").lower() == "true"
+ENTITY_STORE_FILE = Path("historico") / "entidades.sqlite3"
+
+# Chaves de ``dados`` que não são globais: a lista de entidades e as listas por domínio são
+# remontadas a partir dos registros
+CHAVE_ENTIDADES = "entidades"
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS entidades (
+    guid TEXT PRIMARY KEY,
+    nome TEXT,
+    dominio TEXT,
+    tipo TEXT,
+    hash TEXT NOT NULL,
+    dados TEXT NOT NULL,
+    atualizado_em REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entidades_nome ON entidades (nome);
+CREATE INDEX IF NOT EXISTS idx_entidades_dominio ON entidades (dominio);
+CREATE INDEX IF NOT EXISTS idx_entidades_tipo ON entidades (tipo);
+CREATE INDEX IF NOT EXISTS idx_entidades_atualizado_em ON entidades (atualizado_em);
+CREATE TABLE IF NOT EXISTS tags (
+    guid TEXT NOT NULL,
+    chave TEXT NOT NULL,
+    valor TEXT NOT NULL,
+    PRIMARY KEY (guid, chave, valor)
+);
+CREATE INDEX IF NOT EXISTS idx_tags_chave_valor ON tags (chave, valor);
+CREATE TABLE IF NOT EXISTS globais (
+    chave TEXT PRIMARY KEY,
+    valor TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    chave TEXT PRIMARY KEY,
+    valor TEXT NOT NULL
+);
+"""
+
+
+def _serializar(entidade: Dict[str, Any]) -> Tuple[str, str]:
+    texto = serializar_texto(entidade)
+    return texto, hashlib.md5(texto.encode("utf-8")).hexdigest()
+
+
+def _tags(entidade: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """Pares (chave, valor) das tags no formato do NerdGraph (``[{key, values}]``) ou dict simples."""
+    tags = entidade.get("tags") or []
+    pares = []
+    if isinstance(tags, dict):
+        tags = [{"key": k, "values": v if isinstance(v, list) else [v]} for k, v in tags.items()]
+    for tag in tags:
+        if isinstance(tag, dict) and tag.get("key"):
+            pares.extend((str(tag["key"]), str(valor)) for valor in tag.get("values") or [])
+    return pares
+
+
+class EntityStore:
+    """Registros de entidades com índices secundários, num arquivo SQLite."""
+
+    def __init__(self, caminho=ENTITY_STORE_FILE):
+        self.caminho = Path(caminho)
+        self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conexao = sqlite3.connect(self.caminho, check_same_thread=False, isolation_level=None)
+        self._conexao.execute("PRAGMA journal_mode=WAL")
+        self._conexao.execute("PRAGMA synchronous=NORMAL")
+        self._conexao.executescript(ESQUEMA)
+
+    def fechar(self):
+        with self._lock:
+            self._conexao.close()
+
+    # -- Leitura ---------------------------------------------------------------------------------
+
+    def _consultar(self, sql: str, parametros: Iterable = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conexao.execute(sql, tuple(parametros)).fetchall()
+
+    def obter(self, guid: str) -> Optional[Dict[str, Any]]:
+        linhas = self._consultar("SELECT dados FROM entidades WHERE guid = ?", (guid,))
+        return json.loads(linhas[0][0]) if linhas else None
+
+    def obter_muitos(self, guids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        guids = list(guids)
+        resultado = {}
+        for i in range(0, len(guids), 500):
+            lote = guids[i:i + 500]
+            marcadores = ",".join("?" * len(lote))
+            for guid, dados in self._consultar(f"SELECT guid, dados FROM entidades WHERE guid IN ({marcadores})", lote):
+                resultado[guid] = json.loads(dados)
+        return resultado
+
+    def _filtro(self, nome=None, dominio=None, tipo=None, tag=None) -> Tuple[str, List[Any]]:
+        condicoes, parametros = [], []
+        if nome is not None:
+            condicoes.append("e.nome = ?")
+            parametros.append(nome)
+        if dominio is not None:
+            condicoes.append("e.dominio = ?")
+            parametros.append(dominio)
+        if tipo is not None:
+            condicoes.append("e.tipo = ?")
+            parametros.append(tipo)
+        if tag is not None:
+            chave, valor = tag
+            condicoes.append("e.guid IN (SELECT guid FROM tags WHERE chave = ? AND valor = ?)")
+            parametros.extend((chave, str(valor)))
+        return (" WHERE " + " AND ".join(condicoes)) if condicoes else "", parametros
+
+    def buscar(self, nome: Optional[str] = None, dominio: Optional[str] = None, tipo: Optional[str] = None,
+               tag: Optional[Tuple[str, Any]] = None, limite: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Entidades que atendem a todos os filtros informados (``tag`` é um par chave/valor)."""
+        where, parametros = self._filtro(nome, dominio, tipo, tag)
+        sql = f"SELECT e.dados FROM entidades e{where} ORDER BY e.rowid"
+        if limite is not None:
+            sql += " LIMIT ?"
+            parametros.append(int(limite))
+        return [json.loads(dados) for (dados,) in self._consultar(sql, parametros)]
+
+    def guids(self, nome: Optional[str] = None, dominio: Optional[str] = None, tipo: Optional[str] = None,
+              tag: Optional[Tuple[str, Any]] = None) -> List[str]:
+        where, parametros = self._filtro(nome, dominio, tipo, tag)
+        return [guid for (guid,) in self._consultar(f"SELECT e.guid FROM entidades e{where} ORDER BY e.rowid", parametros)]
+
+    def contar(self) -> int:
+        return self._consultar("SELECT count(*) FROM entidades")[0][0]
+
+    def contagem_por_dominio(self) -> Dict[str, int]:
+        return dict(self._consultar("SELECT dominio, count(*) FROM entidades GROUP BY dominio"))
+
+    def iter_entidades(self) -> Iterator[Dict[str, Any]]:
+        """Entidades na ordem de inserção (a mesma da lista ``entidades`` gravada)."""
+        with self._lock:
+            cursor = self._conexao.execute("SELECT dados FROM entidades ORDER BY rowid")
+            linhas = cursor.fetchall()
+        for (dados,) in linhas:
+            yield json.loads(dados)
+
+    def globais(self) -> Dict[str, Any]:
+        return {chave: json.loads(valor) for chave, valor in self._consultar("SELECT chave, valor FROM globais")}
+
+    def gravado_em(self) -> Optional[float]:
+        """Momento (epoch) da última gravação, ou None se o arquivo nunca recebeu dados."""
+        linhas = self._consultar("SELECT valor FROM meta WHERE chave = 'gravado_em'")
+        return float(linhas[0][0]) if linhas else None
+
+    def sincronizado_em(self) -> Optional[float]:
+        """
+        Momento da última mudança que não é só upsert de entidades (``substituir``, remoções,
+        troca dos globais). Depois dele, o que mudou está em ``alteradas_desde``. Arquivos de
+        antes dessa marca respondem com ``gravado_em``.
+        """
+        linhas = self._consultar("SELECT valor FROM meta WHERE chave = 'sincronizado_em'")
+        return float(linhas[0][0]) if linhas else self.gravado_em()
+
+    def alteradas_desde(self, instante: float) -> List[Dict[str, Any]]:
+        """Entidades gravadas ou atualizadas depois de ``instante`` (epoch)."""
+        return [json.loads(dados) for (dados,) in self._consultar(
+            "SELECT dados FROM entidades WHERE atualizado_em > ? ORDER BY rowid", (instante,))]
+
+    def montar_dados(self) -> Dict[str, Any]:
+        """Dict no formato de ``_cache["dados"]``: globais, ``entidades`` e as listas por domínio."""
+        dados = self.globais()
+        entidades = list(self.iter_entidades())
+        for entidade in entidades:
+            dados.setdefault(entidade.get("domain", "UNKNOWN"), []).append(entidade)
+        dados[CHAVE_ENTIDADES] = entidades
+        return dados
+
+    # -- Escrita ---------------------------------------------------------------------------------
+
+    def _gravar(self, entidades: Iterable[Dict[str, Any]], agora: float, hashes: Optional[Dict[str, str]] = None) -> int:
+        """Upsert das entidades (dentro de uma transação aberta). Pula as que não mudaram."""
+        gravadas = 0
+        for entidade in entidades:
+            guid = entidade.get("guid")
+            if not guid:
+                continue
+            texto, hash_ = _serializar(entidade)
+            if hashes is not None and hashes.get(guid) == hash_:
+                continue
+            self._conexao.execute(
+                """
+                INSERT INTO entidades (guid, nome, dominio, tipo, hash, dados, atualizado_em)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (guid) DO UPDATE SET nome = excluded.nome, dominio = excluded.dominio,
+                    tipo = excluded.tipo, hash = excluded.hash, dados = excluded.dados,
+                    atualizado_em = excluded.atualizado_em
+                """,
+                (guid, entidade.get("name"), entidade.get("domain"), entidade.get("entityType") or entidade.get("type"),
+                 hash_, texto, agora),
+            )
+            self._conexao.execute("DELETE FROM tags WHERE guid = ?", (guid,))
+            self._conexao.executemany("INSERT OR IGNORE INTO tags (guid, chave, valor) VALUES (?, ?, ?)",
+                                      [(guid, chave, valor) for chave, valor in _tags(entidade)])
+            gravadas += 1
+        return gravadas
+
+    def _remover(self, guids: List[str]):
+        for i in range(0, len(guids), 500):
+            lote = guids[i:i + 500]
+            marcadores = ",".join("?" * len(lote))
+            self._conexao.execute(f"DELETE FROM entidades WHERE guid IN ({marcadores})", lote)
+            self._conexao.execute(f"DELETE FROM tags WHERE guid IN ({marcadores})", lote)
+
+    def _marcar_gravacao(self, agora: float):
+        self._conexao.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('gravado_em', ?)", (repr(agora),))
+
+    def _marcar_sincronizacao(self, agora: float):
+        self._marcar_gravacao(agora)
+        self._conexao.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('sincronizado_em', ?)", (repr(agora),))
+
+    def _transacao(self, operacao):
+        with self._lock:
+            self._conexao.execute("BEGIN IMMEDIATE")
+            try:
+                resultado = operacao(time.time())
+            except BaseException:
+                self._conexao.execute("ROLLBACK")
+                raise
+            self._conexao.execute("COMMIT")
+            return resultado
+
+    def gravar(self, entidade: Dict[str, Any]) -> bool:
+        return self.gravar_muitas([entidade]) == 1
+
+    def gravar_muitas(self, entidades: Iterable[Dict[str, Any]]) -> int:
+        """Insere ou substitui as entidades (por GUID). Retorna quantas foram gravadas."""
+        def operacao(agora):
+            gravadas = self._gravar(entidades, agora)
+            self._marcar_gravacao(agora)
+            return gravadas
+        return self._transacao(operacao)
+
+    def _mesclar(self, guid: str, campos: Dict[str, Any], agora: float) -> Optional[Dict[str, Any]]:
+        linhas = self._conexao.execute("SELECT dados FROM entidades WHERE guid = ?", (guid,)).fetchall()
+        if not linhas:
+            return None
+        entidade = json.loads(linhas[0][0])
+        entidade.update(campos)
+        self._gravar([entidade], agora)
+        return entidade
+
+    def atualizar_parcial(self, guid: str, campos: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Mescla ``campos`` no registro da entidade. Retorna a entidade atualizada, ou None se não existir."""
+        def operacao(agora):
+            entidade = self._mesclar(guid, campos, agora)
+            self._marcar_gravacao(agora)
+            return entidade
+        return self._transacao(operacao)
+
+    def atualizar_campos(self, guids: Iterable[str], campos: Dict[str, Any]) -> int:
+        """``atualizar_parcial`` de várias entidades numa transação. Retorna quantas existiam."""
+        guids = list(guids)
+
+        def operacao(agora):
+            atualizadas = sum(1 for guid in guids if self._mesclar(guid, campos, agora) is not None)
+            self._marcar_gravacao(agora)
+            return atualizadas
+        return self._transacao(operacao)
+
+    def remover(self, guids: Iterable[str]) -> int:
+        guids = list(guids)
+
+        def operacao(agora):
+            antes = self._conexao.total_changes
+            self._remover(guids)
+            removidas = self._conexao.total_changes - antes
+            if removidas:
+                self._marcar_sincronizacao(agora)
+            return removidas
+        return self._transacao(operacao)
+
+    def gravar_globais(self, dados: Dict[str, Any]):
+        """Substitui os dados globais pelas chaves de ``dados`` que não são entidades nem listas por domínio."""
+        def operacao(agora):
+            self._gravar_globais(dados)
+            self._marcar_sincronizacao(agora)
+        self._transacao(operacao)
+
+    def _gravar_globais(self, dados: Dict[str, Any]):
+        dominios = {e.get("domain", "UNKNOWN") for e in dados.get(CHAVE_ENTIDADES) or [] if isinstance(e, dict)}
+        dominios.update(r[0] or "UNKNOWN" for r in self._conexao.execute("SELECT DISTINCT dominio FROM entidades"))
+        self._conexao.execute("DELETE FROM globais")
+        self._conexao.executemany(
+            "INSERT INTO globais (chave, valor) VALUES (?, ?)",
+            [(chave, json.dumps(valor, ensure_ascii=False, default=str))
+             for chave, valor in dados.items() if chave != CHAVE_ENTIDADES and chave not in dominios],
+        )
+
+    def substituir(self, dados: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Sincroniza o armazenamento com ``dados`` (formato de ``_cache["dados"]``): grava as
+        entidades novas ou alteradas, remove as que não estão mais na lista e troca os globais,
+        tudo numa transação. Entidades sem mudança não são regravadas.
+        """
+        entidades = [e for e in dados.get(CHAVE_ENTIDADES) or [] if isinstance(e, dict) and e.get("guid")]
+
+        def operacao(agora):
+            hashes = dict(self._conexao.execute("SELECT guid, hash FROM entidades").fetchall())
+            presentes = {e["guid"] for e in entidades}
+            removidas = [guid for guid in hashes if guid not in presentes]
+            self._remover(removidas)
+            gravadas = self._gravar(entidades, agora, hashes)
+            self._gravar_globais(dados)
+            self._marcar_sincronizacao(agora)
+            return {"gravadas": gravadas, "removidas": len(removidas), "inalteradas": len(entidades) - gravadas}
+        resumo = self._transacao(operacao)
+        logger.info(f"Armazenamento de entidades sincronizado: {resumo}")
+        return resumo
+
+    def get_status(self) -> Dict[str, Any]:
+        gravado_em = self.gravado_em()
+        return {
+            "arquivo": str(self.caminho),
+            "total_entidades": self.contar(),
+            "contagem_por_dominio": self.contagem_por_dominio(),
+            "tamanho_mb": round(self.caminho.stat().st_size / (1024 * 1024), 2) if self.caminho.exists() else 0,
+            "gravado_em": gravado_em,
+        }
+
+
+# Instância única do processo (uma por arquivo: o caminho padrão é relativo ao diretório de trabalho)
+_store: Optional[EntityStore] = None
+
+
+def get_entity_store() -> EntityStore:
+    """Armazenamento de entidades compartilhado do processo."""
+    global _store
+    caminho = ENTITY_STORE_FILE.resolve()
+    if _store is None or _store.caminho.resolve() != caminho:
+        if _store is not None:
+            _store.fechar()
+        _store = EntityStore(caminho)
+    return _store
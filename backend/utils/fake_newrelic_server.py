@@ -0,0 +1,635 @@
+"""
+Servidor HTTP local que imita a API da New Relic (NerdGraph + NRQL) para testes e benchmarks.
+
+Modos:
+- ``sintetico``: gera uma conta com N entidades (domínios, tags, reporting, alertSeverity) e
+  responde entitySearch paginado por cursor, ``entities(guids:)``/``entity(guid:)`` com summaries
+  e NRQL (FACET entity.guid, TIMESERIES) com valores determinísticos por (guid, coluna, bucket);
+  consultas sem agregação devolvem eventos brutos até o LIMIT.
+- ``replay``: responde com gravações feitas no modo ``gravar`` (chave = query + variáveis).
+  Gravações ausentes caem no modo sintético.
+- ``gravar``: repassa as requisições para a API real (``upstream``) e grava as respostas.
+
+Latência configurável, injeção de 429 (probabilidade e/ou limite de requisições por segundo,
+com Retry-After) e contadores em ``GET /__stats`` (``POST /__stats/reset`` zera).
+
+Para apontar os coletores para o servidor: ``NEW_RELIC_BASE_URL=http://127.0.0.1:8765``
+(as credenciais ausentes recebem valores fictícios, ver ``utils.newrelic_common``).
+
+Uso:
+    python -m utils.fake_newrelic_server --entidades 10000 --latencia 0.05 --taxa-429 0.01
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiohttp import ClientSession, web
+
+logger = logging.getLogger(__name__)
+
+MODO_SINTETICO = "sintetico"
+MODO_REPLAY = "replay"
+MODO_GRAVAR = "gravar"
+
+PAGE_SIZE = 200            # entidades por página do entitySearch (mesmo tamanho da API real)
+MAX_BUCKETS = 366          # limite de buckets TIMESERIES da NRQL
+MAX_LINHAS_SEM_FILTRO = 50 # linhas de FACET entity.guid quando a NRQL não filtra por GUID
+LIMITE_EVENTOS_PADRAO = 100  # linhas de uma consulta de eventos brutos sem LIMIT (como na NRQL)
+MAX_LINHAS_EVENTOS = 5000    # LIMIT MAX da NRQL
+# Atributos de um evento bruto em ``SELECT *`` (Span, TransactionError, Log...)
+CAMPOS_EVENTO = ("timestamp", "name", "duration", "trace.id", "transactionName", "error.class",
+                 "error.message", "host", "entityGuid", "appName")
+
+TIPOS_POR_DOMINIO = {
+    "APM": "APM_APPLICATION_ENTITY",
+    "BROWSER": "BROWSER_APPLICATION_ENTITY",
+    "INFRA": "INFRASTRUCTURE_HOST_ENTITY",
+    "MOBILE": "MOBILE_APPLICATION_ENTITY",
+    "SYNTH": "SYNTHETIC_MONITOR_ENTITY",
+    "EXT": "EXTERNAL_ENTITY",
+}
+DISTRIBUICAO_PADRAO = {"APM": 0.35, "INFRA": 0.35, "BROWSER": 0.1, "MOBILE": 0.05, "SYNTH": 0.1, "EXT": 0.05}
+UNIDADES_SEGUNDOS = {"MINUTE": 60, "HOUR": 3600, "DAY": 86400, "WEEK": 7 * 86400}
+
+# nrql(query: "..."), nrql(query: """...""") ou nrql(query: $variavel)
+RE_NRQL_GRAPHQL = re.compile(r'nrql\(\s*query:\s*(?:"""(.*?)"""|"((?:[^"\\]|\\.)*)"|\$(\w+))', re.S)
+RE_DOMINIOS = re.compile(r"domain\s+IN\s*\(([^)]*)\)", re.I)
+RE_DOMINIO_IGUAL = re.compile(r"\bdomain\s*=\s*'(\w+)'", re.I)
+# entitySearch(queryBuilder: {domain: $domain}) ou {domain: APM}
+RE_QUERY_BUILDER_DOMINIO = re.compile(r"queryBuilder:\s*\{[^}]*\bdomain:\s*(?:\$(\w+)|\"?(\w+)\"?)")
+RE_TIPO_IGUAL = re.compile(r"\btype\s*=\s*'([^']+)'", re.I)
+RE_ACCOUNT_ID = re.compile(r"accountId\s*=\s*(\d+)", re.I)
+RE_GUIDS_IN = re.compile(r"entity\.guid\s+IN\s*\(([^)]*)\)", re.I)
+RE_GUID_LITERAL = re.compile(r'entity\(\s*guid:\s*\\?"([^"\\]+)\\?"')
+RE_TIMESERIES = re.compile(r"TIMESERIES\s+(\d+)\s+(MINUTE|HOUR|DAY|WEEK)S?", re.I)
+RE_SINCE_RELATIVO = re.compile(r"SINCE\s+(\d+)\s+(MINUTE|HOUR|DAY|WEEK)S?\s+AGO", re.I)
+RE_SINCE_EPOCH = re.compile(r"SINCE\s+(\d{10,13})\b", re.I)
+RE_ALIAS = re.compile(r"\s+as\s+(?:'([^']+)'|`([^`]+)`|(\w+))\s*$", re.I)
+RE_LIMIT = re.compile(r"\bLIMIT\s+(\d+|MAX)\b", re.I)
+RE_FUNCAO = re.compile(r"^\s*(\w+)\s*\((.*)\)\s*$", re.S)
+
+
+class ConfigServidor:
+    """Parâmetros do servidor local."""
+
+    def __init__(
+        self,
+        entidades: int = 1000,
+        conta: int = 1,
+        semente: int = 42,
+        modo: str = MODO_SINTETICO,
+        arquivo_gravacoes: Optional[str] = None,
+        upstream: Optional[str] = None,
+        latencia: float = 0.0,
+        jitter: float = 0.0,
+        taxa_429: float = 0.0,
+        limite_rps: Optional[float] = None,
+        retry_after: int = 1,
+        page_size: int = PAGE_SIZE,
+        distribuicao: Optional[Dict[str, float]] = None,
+    ):
+        self.entidades = entidades
+        self.conta = conta
+        self.semente = semente
+        self.modo = modo
+        self.arquivo_gravacoes = arquivo_gravacoes
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.latencia = latencia
+        self.jitter = jitter
+        self.taxa_429 = taxa_429
+        self.limite_rps = limite_rps
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.distribuicao = distribuicao or DISTRIBUICAO_PADRAO
+
+
+def _unidade(valor: float, chave: str) -> float:
+    """Número determinístico em [0, 1) a partir de uma chave (crc32, barato o bastante para 100k entidades)."""
+    return ((zlib.crc32(chave.encode()) ^ int(valor)) & 0xFFFFFFFF) / 2 ** 32
+
+
+class ContaSintetica:
+    """Conta New Relic gerada deterministicamente a partir da semente."""
+
+    def __init__(self, total: int, conta: int = 1, semente: int = 42,
+                 distribuicao: Optional[Dict[str, float]] = None):
+        self.conta = conta
+        self.semente = semente
+        rng = random.Random(semente)
+        distribuicao = distribuicao or DISTRIBUICAO_PADRAO
+        dominios = list(distribuicao)
+        pesos = [distribuicao[d] for d in dominios]
+        self.entidades: List[Dict[str, Any]] = []
+        self.por_guid: Dict[str, Dict[str, Any]] = {}
+        for i in range(total):
+            dominio = rng.choices(dominios, pesos)[0]
+            tipo = TIPOS_POR_DOMINIO.get(dominio, "GENERIC_ENTITY")
+            guid = base64.b64encode(f"{conta}|{dominio}|{tipo}|{i}".encode()).decode().rstrip("=")
+            sorteio = rng.random()
+            entidade = {
+                "guid": guid,
+                "name": f"{dominio.lower()}-servico-{i:06d}",
+                "domain": dominio,
+                "entityType": tipo,
+                "accountId": conta,
+                "reporting": rng.random() < 0.9,
+                "tags": [
+                    {"key": "environment", "values": [rng.choice(["production", "staging", "dev"])]},
+                    {"key": "team", "values": [f"time-{rng.randint(1, 20)}"]},
+                ],
+                "alertSeverity": "CRITICAL" if sorteio < 0.02 else "WARNING" if sorteio < 0.05 else "NOT_ALERTING",
+            }
+            self.entidades.append(entidade)
+            self.por_guid[guid] = entidade
+
+    def valor(self, guid: str, coluna: str, bucket: int = 0) -> float:
+        return _unidade(self.semente, f"{guid}|{coluna}|{bucket}")
+
+    def summary(self, entidade: Dict[str, Any]) -> Dict[str, Any]:
+        """Bloco de summary no formato dos fragments de ENTITY_SUMMARY_FRAGMENTS."""
+        guid = entidade["guid"]
+        v = lambda campo, escala=1.0: round(self.valor(guid, campo) * escala, 4)
+        dominio = entidade["domain"]
+        if dominio == "APM":
+            return {"apmSummary": {
+                "apdexScore": round(0.5 + v("apdex") / 2, 3), "errorRate": v("errorRate", 5),
+                "hostCount": 1 + int(v("hostCount", 10)), "instanceCount": 1 + int(v("instanceCount", 20)),
+                "nonWebResponseTimeAverage": v("nonWeb", 2), "nonWebThroughput": v("nonWebTp", 100),
+                "responseTimeAverage": v("responseTime", 2), "throughput": v("throughput", 1000),
+                "webResponseTimeAverage": v("webResponse", 2), "webThroughput": v("webTp", 1000),
+            }}
+        if dominio == "BROWSER":
+            return {"browserSummary": {
+                "ajaxRequestThroughput": v("ajaxTp", 500), "ajaxResponseTimeAverage": v("ajaxRt", 2),
+                "jsErrorRate": v("jsErrorRate", 5), "pageLoadThroughput": v("pageTp", 300),
+                "pageLoadTimeAverage": v("pageLoad", 5), "pageLoadTimeMedian": v("pageLoadMedian", 4),
+            }}
+        if dominio == "INFRA":
+            return {"infrastructureSummary": {
+                "cpuUtilizationPercent": v("cpu", 100), "diskUsedPercent": v("disk", 100),
+                "memoryUsedPercent": v("memory", 100), "networkReceiveRate": v("rx", 1e6),
+                "networkTransmitRate": v("tx", 1e6),
+            }}
+        if dominio == "MOBILE":
+            return {"mobileSummary": {
+                "appLaunchCount": int(v("launch", 1e4)), "crashCount": int(v("crash", 50)),
+                "crashRate": v("crashRate", 2), "httpErrorRate": v("httpErrorRate", 5),
+                "httpRequestCount": int(v("httpCount", 1e5)), "httpRequestRate": v("httpRate", 100),
+                "httpResponseTimeAverage": v("httpRt", 2), "mobileSessionCount": int(v("sessions", 1e4)),
+                "networkFailureRate": v("netFail", 3),
+            }}
+        if dominio == "SYNTH":
+            return {"monitorId": guid[:12], "monitorType": "SIMPLE", "monitorSummary": {
+                "locationsFailing": int(v("failing", 3)), "successRate": round(90 + v("success", 10), 2),
+            }}
+        return {}
+
+
+# -- NRQL sintética -----------------------------------------------------------------------------
+
+def _dividir_topo(texto: str) -> List[str]:
+    """Divide por vírgulas fora de parênteses e aspas."""
+    partes, atual, nivel, aspas = [], [], 0, False
+    for c in texto:
+        if c == "'":
+            aspas = not aspas
+        elif not aspas and c == "(":
+            nivel += 1
+        elif not aspas and c == ")":
+            nivel -= 1
+        elif not aspas and nivel == 0 and c == ",":
+            partes.append("".join(atual).strip())
+            atual = []
+            continue
+        atual.append(c)
+    if "".join(atual).strip():
+        partes.append("".join(atual).strip())
+    return partes
+
+
+def _entre(nrql: str, inicio: str, fins: Tuple[str, ...]) -> str:
+    superior = nrql.upper()
+    pos = superior.find(inicio)
+    if pos < 0:
+        return ""
+    pos += len(inicio)
+    fim = min([i for i in (superior.find(f, pos) for f in fins) if i >= 0] or [len(nrql)])
+    return nrql[pos:fim].strip()
+
+
+def _colunas(nrql: str) -> List[Tuple[str, str, List[str]]]:
+    """``[(nome da coluna, função, argumentos)]`` do SELECT."""
+    colunas = []
+    for item in _dividir_topo(_entre(nrql, "SELECT ", (" FROM ",))):
+        alias = RE_ALIAS.search(item)
+        expressao = RE_ALIAS.sub("", item).strip()
+        funcao = RE_FUNCAO.match(expressao)
+        nome_funcao, argumentos = (funcao.group(1).lower(), _dividir_topo(funcao.group(2))) if funcao else ("", [])
+        if alias:
+            nome = next(g for g in alias.groups() if g)
+        elif funcao and argumentos and argumentos[0] != "*":
+            nome = f"{nome_funcao}.{argumentos[0]}"
+        else:
+            nome = nome_funcao or expressao
+        colunas.append((nome, nome_funcao, argumentos))
+    return colunas
+
+
+def _valor_coluna(conta: ContaSintetica, guid: str, coluna: Tuple[str, str, List[str]], bucket: int) -> Any:
+    nome, funcao, argumentos = coluna
+    u = conta.valor(guid, nome, bucket)
+    referencia = (nome + " " + " ".join(argumentos)).lower()
+    if funcao == "count" or funcao == "uniquecount":
+        return int(u * 1000)
+    if funcao == "histogram":
+        bins = int(argumentos[2]) if len(argumentos) > 2 and argumentos[2].isdigit() else 40
+        return {"buckets": [{"count": int(conta.valor(guid, f"{nome}|{i}", bucket) * 20)} for i in range(bins)]}
+    if funcao == "percentile":
+        quantis = [a.strip() for a in argumentos[1:]] or ["50"]
+        return {q: round(u * 3, 4) for q in quantis}
+    if funcao == "latest" and argumentos and argumentos[0] == "event":
+        return "open" if u < 0.3 else "close"
+    if "apdex" in referencia or "score" in referencia:
+        return round(0.5 + u / 2, 4)
+    if any(p in referencia for p in ("percent", "cpu", "disk", "error", "rate")):
+        return round(u * 100, 4)
+    if "total" in referencia:
+        return round((1 + u) * 1e9, 2)  # sempre >= qualquer "used" para razões plausíveis
+    if "bytes" in referencia or funcao == "sum":
+        return round(u * 1e9, 2)
+    return round(u * 1000, 4)
+
+
+def _eventos_brutos(conta: ContaSintetica, nrql: str, colunas: List[Tuple[str, str, List[str]]],
+                    agora: float) -> List[Dict[str, Any]]:
+    """Linhas de uma consulta sem agregação (``SELECT * ... LIMIT n``): uma por evento."""
+    limite = RE_LIMIT.search(nrql)
+    if limite is None:
+        total = LIMITE_EVENTOS_PADRAO
+    else:
+        total = MAX_LINHAS_EVENTOS if limite.group(1).upper() == "MAX" else min(int(limite.group(1)), MAX_LINHAS_EVENTOS)
+    campos = [c for nome, _, _ in colunas for c in (CAMPOS_EVENTO if nome == "*" else (nome,))]
+    linhas = []
+    for i in range(total):
+        linha = {}
+        for campo in campos:
+            u = conta.valor("eventos", campo, i)
+            if campo == "timestamp":
+                linha[campo] = int((agora - u * 3600) * 1000)
+            elif any(p in campo.lower() for p in ("duration", "time", "count", "percent", "number")):
+                linha[campo] = round(u * 1000, 4)
+            else:
+                linha[campo] = f"{campo}-{int(u * 50)}"
+        linhas.append(linha)
+    return linhas
+
+
+def _janela_segundos(nrql: str, agora: float) -> Tuple[float, float]:
+    """``(inicio, fim)`` em epoch segundos a partir do SINCE da NRQL."""
+    epoch = RE_SINCE_EPOCH.search(nrql)
+    if epoch:
+        valor = int(epoch.group(1))
+        return (valor / 1000 if valor > 10 ** 11 else valor), agora
+    relativo = RE_SINCE_RELATIVO.search(nrql)
+    if relativo:
+        return agora - int(relativo.group(1)) * UNIDADES_SEGUNDOS[relativo.group(2).upper()], agora
+    return agora - 3600, agora
+
+
+def responder_nrql(conta: ContaSintetica, nrql: str, agora: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Linhas de resultado sintéticas de uma NRQL."""
+    agora = time.time() if agora is None else agora
+    colunas = _colunas(nrql)
+    facets = [f.strip() for f in _dividir_topo(_entre(nrql, " FACET ", (" SINCE ", " TIMESERIES ", " LIMIT ", " UNTIL ")))]
+    if not facets and colunas and not any(funcao for _, funcao, _ in colunas) and not RE_TIMESERIES.search(nrql):
+        return _eventos_brutos(conta, nrql, colunas, agora)
+    filtro = RE_GUIDS_IN.search(nrql)
+    if filtro:
+        guids = [g.strip().strip("'").replace("\\'", "'") for g in filtro.group(1).split(",") if g.strip()]
+    elif "entity.guid" in facets:
+        # Sem filtro (ex.: incidentes/deploys da conta inteira): uma amostra fixa da conta
+        guids = [e["guid"] for e in conta.entidades if conta.valor(e["guid"], "amostra") < 0.01][:MAX_LINHAS_SEM_FILTRO]
+    else:
+        guids = [None]
+
+    buckets = [(None, None)]
+    timeseries = RE_TIMESERIES.search(nrql)
+    if timeseries:
+        passo = int(timeseries.group(1)) * UNIDADES_SEGUNDOS[timeseries.group(2).upper()]
+        inicio, fim = _janela_segundos(nrql, agora)
+        primeiro = int(inicio // passo) * passo
+        buckets = [(b, b + passo) for b in range(primeiro, int(fim) + 1, passo)][-MAX_BUCKETS:]
+
+    linhas = []
+    for guid in guids:
+        if guid is not None and guid not in conta.por_guid:
+            continue
+        extras = [f for f in facets if f != "entity.guid"]
+        variantes = [[]] if not extras else [[f"{f}-{n}" for f in extras] for n in range(2)]
+        for variante in variantes:
+            for inicio_bucket, fim_bucket in buckets:
+                chave = guid or "conta"
+                linha = {nome: _valor_coluna(conta, chave, (nome, funcao, args), inicio_bucket or 0)
+                         for nome, funcao, args in colunas}
+                if guid is not None:
+                    linha["facet"] = [guid] + variante if variante else guid
+                    linha["entity.guid"] = guid
+                elif variante:
+                    linha["facet"] = variante if len(variante) > 1 else variante[0]
+                if inicio_bucket is not None:
+                    linha["beginTimeSeconds"] = inicio_bucket
+                    linha["endTimeSeconds"] = fim_bucket
+                linhas.append(linha)
+    return linhas
+
+
+# -- GraphQL sintético ----------------------------------------------------------------------------
+
+def _filtro_entity_search(query: str, variaveis: Dict[str, Any]) -> Tuple[Optional[Set[str]], Optional[str]]:
+    """Domínios e entityType pedidos no entitySearch (None: sem filtro)."""
+    dominios = None
+    em_lista, igual, construtor = RE_DOMINIOS.search(query), RE_DOMINIO_IGUAL.search(query), RE_QUERY_BUILDER_DOMINIO.search(query)
+    if em_lista:
+        dominios = {d.strip().strip("'\"") for d in em_lista.group(1).split(",")}
+    elif igual:
+        dominios = {igual.group(1)}
+    elif construtor:
+        variavel, literal = construtor.groups()
+        dominios = {variaveis.get(variavel) if variavel else literal}
+    tipo = RE_TIPO_IGUAL.search(query)
+    return dominios, tipo.group(1) if tipo else None
+
+
+def responder_graphql(conta: ContaSintetica, query: str, variaveis: Optional[Dict[str, Any]] = None,
+                      page_size: int = PAGE_SIZE) -> Dict[str, Any]:
+    """Resposta NerdGraph sintética para as consultas usadas pelos coletores."""
+    variaveis = variaveis or {}
+    nrql = RE_NRQL_GRAPHQL.search(query)
+    if nrql:
+        bloco, literal, variavel = nrql.groups()
+        texto = bloco if bloco is not None else variaveis.get(variavel, "") if variavel else literal.replace('\\"', '"')
+        resultados = responder_nrql(conta, texto)
+        return {"data": {"actor": {"account": {"nrql": {
+            "results": resultados, "metadata": {"eventTypes": [], "facets": []},
+        }}}}}
+
+    if "entitySearch" in query:
+        dominios, tipo = _filtro_entity_search(query, variaveis)
+        filtro_conta = RE_ACCOUNT_ID.search(query)
+        selecionadas = [e for e in conta.entidades if (dominios is None or e["domain"] in dominios)
+                        and (tipo is None or e["entityType"] == tipo)]
+        if filtro_conta and int(filtro_conta.group(1)) != conta.conta:
+            selecionadas = []
+        cursor = variaveis.get("cursor")
+        inicio = int(base64.b64decode(cursor).decode()) if cursor else 0
+        pagina = selecionadas[inicio:inicio + page_size]
+        proximo = inicio + page_size
+        proximo_cursor = base64.b64encode(str(proximo).encode()).decode() if proximo < len(selecionadas) else None
+        return {"data": {"actor": {"entitySearch": {
+            "count": len(selecionadas),
+            "results": {"entities": pagina, "nextCursor": proximo_cursor},
+        }}}}
+
+    if re.search(r"\bentities\s*\(\s*guids", query):
+        guids = variaveis.get("guids") or []
+        entidades = []
+        for guid in guids:
+            entidade = conta.por_guid.get(guid)
+            if entidade:
+                entidades.append(dict(entidade, **conta.summary(entidade)))
+        return {"data": {"actor": {"entities": entidades}}}
+
+    if re.search(r"\bentity\s*\(\s*guid", query):
+        guid = variaveis.get("guid")
+        if not guid:
+            literal = RE_GUID_LITERAL.search(query)
+            guid = literal.group(1) if literal else None
+        entidade = conta.por_guid.get(guid)
+        return {"data": {"actor": {"entity": dict(entidade, **conta.summary(entidade)) if entidade else None}}}
+
+    return {"data": {"actor": {}}}
+
+
+# -- Gravações (record/replay) --------------------------------------------------------------------
+
+def chave_gravacao(caminho: str, corpo: Any) -> str:
+    normalizado = dict(corpo) if isinstance(corpo, dict) else {"corpo": corpo}
+    if isinstance(normalizado.get("query"), str):
+        normalizado["query"] = " ".join(normalizado["query"].split())
+    return hashlib.sha1(json.dumps([caminho, normalizado], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Gravacoes:
+    """Respostas gravadas por chave, persistidas em um arquivo JSON."""
+
+    def __init__(self, caminho: Optional[str] = None):
+        self.caminho = caminho
+        self.respostas: Dict[str, Any] = {}
+        if caminho and os.path.exists(caminho):
+            with open(caminho, "r", encoding="utf-8") as f:
+                self.respostas = json.load(f)
+            logger.info(f"{len(self.respostas)} respostas gravadas carregadas de {caminho}")
+
+    def save(self):
+        if not self.caminho:
+            return
+        tmp = f"{self.caminho}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.respostas, f, ensure_ascii=False)
+        os.replace(tmp, self.caminho)
+
+
+# -- Servidor ------------------------------------------------------------------------------------
+
+class FakeNewRelicServer:
+    """Aplicação aiohttp que atende /graphql e /v1/accounts/{conta}/query."""
+
+    def __init__(self, config: Optional[ConfigServidor] = None):
+        self.config = config or ConfigServidor()
+        self.conta = ContaSintetica(self.config.entidades, self.config.conta, self.config.semente, self.config.distribuicao)
+        self.gravacoes = Gravacoes(self.config.arquivo_gravacoes)
+        self._rng = random.Random(self.config.semente)
+        self._janela_rps: collections.deque = collections.deque()
+        self._runner: Optional[web.AppRunner] = None
+        self._upstream: Optional[ClientSession] = None
+        self.url: Optional[str] = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats: Dict[str, Any] = {
+            "requisicoes": 0, "graphql": 0, "nrql": 0, "rate_limited": 0,
+            "replay_hits": 0, "replay_misses": 0, "gravadas": 0, "bytes_enviados": 0,
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/graphql", self._graphql)
+        app.router.add_get("/v1/accounts/{conta}/query", self._nrql_rest)
+        app.router.add_get("/__stats", self._get_stats)
+        app.router.add_post("/__stats/reset", self._reset_stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", porta: int = 0) -> str:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, porta)
+        await site.start()
+        porta_real = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{porta_real}"
+        logger.info(f"Servidor New Relic local em {self.url} (modo={self.config.modo}, entidades={self.config.entidades})")
+        return self.url
+
+    async def stop(self):
+        if self.config.modo == MODO_GRAVAR:
+            self.gravacoes.save()
+        if self._upstream is not None:
+            await self._upstream.close()
+            self._upstream = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def _limitar(self) -> Optional[web.Response]:
+        """Resposta 429 quando a requisição cai na injeção aleatória ou estoura o limite por segundo."""
+        agora = time.monotonic()
+        estourou = False
+        if self.config.limite_rps:
+            while self._janela_rps and agora - self._janela_rps[0] > 1.0:
+                self._janela_rps.popleft()
+            estourou = len(self._janela_rps) >= self.config.limite_rps
+            if not estourou:
+                self._janela_rps.append(agora)
+        if estourou or (self.config.taxa_429 and self._rng.random() < self.config.taxa_429):
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"errors": [{"message": "Too many requests"}]}, status=429,
+                headers={"Retry-After": str(self.config.retry_after)},
+            )
+        return None
+
+    async def _atrasar(self):
+        atraso = self.config.latencia + (self._rng.uniform(0, self.config.jitter) if self.config.jitter else 0)
+        if atraso > 0:
+            await asyncio.sleep(atraso)
+
+    async def _responder(self, request: web.Request, chave: str, sintetico) -> web.Response:
+        self.stats["requisicoes"] += 1
+        limitada = self._limitar()
+        if limitada is not None:
+            return limitada
+        await self._atrasar()
+
+        if self.config.modo == MODO_GRAVAR:
+            resposta = await self._repassar(request)
+            self.gravacoes.respostas[chave] = resposta
+            self.stats["gravadas"] += 1
+        elif self.config.modo == MODO_REPLAY and chave in self.gravacoes.respostas:
+            resposta = self.gravacoes.respostas[chave]
+            self.stats["replay_hits"] += 1
+        else:
+            if self.config.modo == MODO_REPLAY:
+                self.stats["replay_misses"] += 1
+            resposta = sintetico()
+        corpo = json.dumps(resposta)
+        self.stats["bytes_enviados"] += len(corpo)
+        return web.Response(text=corpo, content_type="application/json")
+
+    async def _repassar(self, request: web.Request) -> Any:
+        if not self.config.upstream:
+            raise web.HTTPBadGateway(text="modo gravar exige upstream")
+        if self._upstream is None:
+            self._upstream = ClientSession()
+        cabecalhos = {k: v for k, v in request.headers.items() if k.lower() in ("api-key", "x-query-key", "x-api-key", "content-type")}
+        url = f"{self.config.upstream}{request.rel_url}"
+        if request.method == "POST":
+            async with self._upstream.post(url, data=await request.read(), headers=cabecalhos) as resposta:
+                return await resposta.json(content_type=None)
+        async with self._upstream.get(url, headers=cabecalhos) as resposta:
+            return await resposta.json(content_type=None)
+
+    async def _graphql(self, request: web.Request) -> web.Response:
+        corpo = await request.json()
+        self.stats["graphql"] += 1
+        query = corpo.get("query") or ""
+        if "nrql(" in query:
+            self.stats["nrql"] += 1
+        return await self._responder(
+            request, chave_gravacao("/graphql", corpo),
+            lambda: responder_graphql(self.conta, query, corpo.get("variables"), self.config.page_size),
+        )
+
+    async def _nrql_rest(self, request: web.Request) -> web.Response:
+        nrql = request.query.get("nrql", "")
+        self.stats["nrql"] += 1
+        return await self._responder(
+            request, chave_gravacao(request.path, {"nrql": nrql}),
+            lambda: {"results": responder_nrql(self.conta, nrql)},
+        )
+
+    async def _get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats, entidades=len(self.conta.entidades), modo=self.config.modo))
+
+    async def _reset_stats(self, request: web.Request) -> web.Response:
+        self.reset_stats()
+        return web.json_response({"ok": True})
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Servidor New Relic local (NerdGraph/NRQL) para testes e benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--entidades", type=int, default=1000)
+    parser.add_argument("--conta", type=int, default=1)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--modo", choices=[MODO_SINTETICO, MODO_REPLAY, MODO_GRAVAR], default=MODO_SINTETICO)
+    parser.add_argument("--gravacoes", help="arquivo JSON de gravações (modos replay/gravar)")
+    parser.add_argument("--upstream", default="https://api.newrelic.com", help="API real usada no modo gravar")
+    parser.add_argument("--latencia", type=float, default=0.0, help="latência fixa por requisição (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latência extra aleatória até este valor (s)")
+    parser.add_argument("--taxa-429", type=float, default=0.0, help="probabilidade de responder 429")
+    parser.add_argument("--limite-rps", type=float, default=None, help="requisições por segundo antes de 429")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s %(name)s: %(message)s")
+    servidor = FakeNewRelicServer(ConfigServidor(
+        entidades=args.entidades, conta=args.conta, semente=args.semente, modo=args.modo,
+        arquivo_gravacoes=args.gravacoes, upstream=args.upstream, latencia=args.latencia,
+        jitter=args.jitter, taxa_429=args.taxa_429, limite_rps=args.limite_rps, page_size=args.page_size,
+    ))
+
+    async def rodar():
+        url = await servidor.start(args.host, args.porta)
+        print(f"NEW_RELIC_BASE_URL={url}")
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await servidor.stop()
+
+    try:
+        asyncio.run(rodar())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,8 @@ if current_dir.name != "backend":
     if utils_dir.exists():
         sys.path.append(str(utils_dir))
 
+from utils import mmap_cache
+
 class FrontendIntegrator:
     """
     Integra os dados coletados do New Relic com o Frontend.
@@ -81,6 +83,21 @@ class FrontendIntegrator:
         
         logger.info(f"Integrador Frontend inicializado. Diretório de dados: {self.frontend_data_dir}")
     
+    def _load_mapped_cache(self):
+        """
+        Cache lido do ``cache.bin`` gravado junto com o ``cache.json`` pelo coletor, ou None se
+        ele não existir ou for mais antigo que o JSON.
+        """
+        if not mmap_cache.MMAP_CACHE_ENABLED:
+            return None
+        leitor = mmap_cache.abrir(self.cache_file.with_suffix(".bin"))
+        if leitor is None:
+            return None
+        if self.cache_file.stat().st_mtime > leitor.gravado_em:
+            leitor.fechar()
+            return None
+        return mmap_cache.DadosMapeados(leitor)
+
     async def process_all_data(self):
         """
         Processa todos os dados do cache para o formato do frontend.
@@ -94,9 +111,12 @@ class FrontendIntegrator:
                 logger.error(f"Arquivo de cache não encontrado: {self.cache_file}")
                 return False
                 
-            # Carregar cache
-            with open(self.cache_file, "r", encoding="utf-8") as f:
-                cache = json.load(f)
+            # Carregar cache: o binário mapeado (chaves decodificadas no primeiro acesso) se for
+            # tão recente quanto o cache.json, senão o próprio JSON
+            cache = self._load_mapped_cache()
+            if cache is None:
+                with open(self.cache_file, "r", encoding="utf-8") as f:
+                    cache = json.load(f)
                 
             # Verificar timestamp do cache
             timestamp = cache.get("metadata", {}).get("timestamp", "Unknown")
@@ -0,0 +1,330 @@
+"""
+Agregação incremental (janela deslizante) das métricas por período entre sincronizações.
+
+Sem isso, cada ciclo reconsulta as janelas inteiras de 24h, 7d e 30d, embora só os últimos
+minutos tenham mudado. Aqui cada entidade guarda, por métrica, os agregados parciais de cada
+bucket da série (as colunas do ``select`` da série: média + contagem, max, latest, somas do
+numerador/denominador ou o histograma mesclável dos percentis). A cada ciclo só se consulta
+``SINCE <início do último bucket>``: o bucket corrente (ainda incompleto) é substituído,
+os novos entram e os que saíram da janela mais longa são descartados. Os períodos continuam
+sendo derivados por ``utils.period_engine``, direto dos buckets guardados.
+
+Cada série é um buffer circular de tamanho fixo (uma posição por bucket da janela, ``array('d')``
+por campo), em vez de um dict por bucket: com dezenas de milhares de entidades e centenas de
+buckets, dicts aninhados chegavam a gigabytes. Séries que ficam uma janela inteira sem coleta
+são descartadas.
+
+Os buckets são alinhados ao epoch (múltiplos do tamanho do bucket) para que consultas de
+ciclos diferentes caiam exatamente nos mesmos buckets. Com isso os N últimos buckets de um
+período não são a janela deslizante ``[agora - período, agora)``: o último é parcial (só vai
+até ``agora``) e falta o começo da janela, o resto do bucket que contém ``agora - período``.
+``trechos_iniciais`` dá esse trecho de cada período; o coletor o consulta a cada ciclo (sem
+TIMESERIES, é só uma fração de bucket) e ``derivar`` o soma aos buckets guardados.
+"""
+
+import logging
+import math
+import os
+import time
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.period_engine import (
+    NUMPY_DISPONIVEL, ROLLUP_PERCENTIL, HistogramaMesclavel, SeriePlanejada, campos_da_serie,
+    derivar_percentis_de_colunas, derivar_periodos_de_matrizes, np,
+)
+
+logger = logging.getLogger(__name__)
+
+INCREMENTAL_METRICS_ENABLED = os.getenv("NEW_RELIC_INCREMENTAL_METRICS", "true").lower() == "true"
+
+# (chave da métrica, tamanho do bucket, janela)
+ChaveGrupo = Tuple[str, int, int]
+
+NAN = float("nan")
+
+
+def alinhar(instante: float, bucket: int) -> int:
+    """Início do bucket (alinhado ao epoch) que contém ``instante``."""
+    return int(instante // bucket) * bucket
+
+
+class SerieCompacta:
+    """
+    Buckets de uma entidade num buffer circular com uma posição por bucket da janela:
+    ``array('d')`` por campo numérico (NaN = sem dado) ou lista de contagens (histogramas).
+    O bucket ``b`` fica na posição ``(b // tamanho_do_bucket) % n``; só os ``n`` buckets até
+    ``cobertura`` (início do bucket corrente na última consulta) são válidos.
+    """
+    __slots__ = ("cobertura", "colunas")
+
+    def __init__(self, n: int, histograma: List[bool]):
+        self.cobertura: Optional[int] = None
+        self.colunas = [[None] * n if e_histograma else array("d", [NAN]) * n for e_histograma in histograma]
+
+
+class GrupoSeries:
+    """Séries de todas as entidades para uma métrica e uma série planejada."""
+    __slots__ = ("bucket", "n", "campos", "histograma", "series", "ultima_poda")
+
+    def __init__(self, serie: SeriePlanejada, spec_serie: Dict[str, Any]):
+        self.bucket = serie.bucket
+        self.n = max(1, serie.janela // serie.bucket)
+        self.campos = campos_da_serie(spec_serie)
+        self.histograma = [spec_serie["rollup"] == ROLLUP_PERCENTIL] * len(self.campos)
+        self.series: Dict[str, SerieCompacta] = {}
+        self.ultima_poda = 0.0
+
+    def posicao(self, inicio_bucket: int) -> int:
+        return (inicio_bucket // self.bucket) % self.n
+
+    def limpar(self, serie: SerieCompacta, posicao: int):
+        for coluna, e_histograma in zip(serie.colunas, self.histograma):
+            coluna[posicao] = None if e_histograma else NAN
+
+
+class IncrementalAggregator:
+    """Buckets de agregados parciais por entidade e métrica, atualizados só no trecho novo."""
+
+    def __init__(self):
+        self._grupos: Dict[ChaveGrupo, GrupoSeries] = {}
+        self.consultas_completas = 0
+        self.consultas_incrementais = 0
+
+    @staticmethod
+    def _chave(metrica: str, serie: SeriePlanejada) -> ChaveGrupo:
+        return (metrica, serie.bucket, serie.janela)
+
+    @staticmethod
+    def inicio_janela(serie: SeriePlanejada, agora: float) -> int:
+        """Primeiro bucket da janela mais longa da série (inclui o bucket corrente, parcial)."""
+        return alinhar(agora, serie.bucket) - (serie.janela // serie.bucket - 1) * serie.bucket
+
+    @staticmethod
+    def trechos_iniciais(serie: SeriePlanejada, agora: float) -> Dict[str, Tuple[float, int]]:
+        """
+        ``{periodo: (inicio, fim)}``: o começo da janela deslizante de cada período que fica
+        antes dos buckets alinhados, de ``agora - período`` até o início do primeiro bucket
+        inteiro (no máximo um bucket).
+        """
+        corrente = alinhar(agora, serie.bucket)
+        return {chave: (agora - n * serie.bucket, corrente - (n - 1) * serie.bucket)
+                for chave, n in serie.periodos.items()}
+
+    def inicio_consulta(self, metrica: str, guids: Iterable[str], serie: SeriePlanejada,
+                        agora: Optional[float] = None) -> int:
+        """
+        Instante a partir do qual um bloco de GUIDs precisa ser consultado: o menor bucket
+        corrente já coberto, ou a janela inteira se alguma entidade ainda não tem histórico.
+        """
+        agora = time.time() if agora is None else agora
+        inicio = self.inicio_janela(serie, agora)
+        grupo = self._grupos.get(self._chave(metrica, serie))
+        series = grupo.series if grupo is not None else {}
+        coberturas = [getattr(series.get(guid), "cobertura", None) for guid in guids]
+        if not coberturas or any(c is None or c < inicio for c in coberturas):
+            return inicio
+        return min(coberturas)
+
+    def registrar(self, metrica: str, guids: Iterable[str], serie: SeriePlanejada, linhas: List[Dict[str, Any]],
+                  desde: int, spec_serie: Dict[str, Any], agora: Optional[float] = None):
+        """Substitui os buckets a partir de ``desde`` pelas linhas da consulta e descarta os expirados."""
+        agora = time.time() if agora is None else agora
+        chave = self._chave(metrica, serie)
+        grupo = self._grupos.get(chave)
+        if grupo is None:
+            grupo = self._grupos[chave] = GrupoSeries(serie, spec_serie)
+        inicio = self.inicio_janela(serie, agora)
+        bucket_corrente = alinhar(agora, serie.bucket)
+        primeiro = max(desde, inicio)
+
+        guids = list(guids)
+        for guid in guids:
+            atual = grupo.series.get(guid)
+            if atual is None or atual.cobertura is None or atual.cobertura < inicio:
+                # Sem histórico na janela: recomeça com todas as posições vazias
+                atual = grupo.series[guid] = SerieCompacta(grupo.n, grupo.histograma)
+            # O trecho consultado é substituído por inteiro (buckets sem linha ficam vazios)
+            for inicio_bucket in range(primeiro, bucket_corrente + grupo.bucket, grupo.bucket):
+                grupo.limpar(atual, grupo.posicao(inicio_bucket))
+            atual.cobertura = bucket_corrente
+
+        alvo = set(guids)
+        for linha in linhas:
+            if not isinstance(linha, dict) or linha.get("beginTimeSeconds") is None:
+                continue
+            facet = linha.get("facet")
+            guid = (facet[0] if isinstance(facet, list) and facet else facet) or linha.get("entity.guid")
+            if guid not in alvo:
+                continue
+            inicio_bucket = alinhar(linha["beginTimeSeconds"], serie.bucket)
+            if inicio_bucket < primeiro or inicio_bucket > bucket_corrente:
+                continue
+            posicao = grupo.posicao(inicio_bucket)
+            atual = grupo.series[guid]
+            for coluna, campo, e_histograma in zip(atual.colunas, grupo.campos, grupo.histograma):
+                valor = linha.get(campo)
+                if e_histograma:
+                    contagens = HistogramaMesclavel.extrair_contagens(valor)
+                    coluna[posicao] = array("d", contagens) if contagens else None
+                elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                    coluna[posicao] = float(valor)
+
+        if agora - grupo.ultima_poda >= grupo.bucket:
+            self._podar(grupo, inicio, agora)
+
+    @staticmethod
+    def _podar(grupo: GrupoSeries, inicio: int, agora: float):
+        """Descarta as séries cujo último bucket já saiu da janela (entidades que pararam de ser coletadas)."""
+        grupo.ultima_poda = agora
+        for guid in [g for g, s in grupo.series.items() if s.cobertura is None or s.cobertura < inicio]:
+            del grupo.series[guid]
+
+    def _colunas(self, grupo: GrupoSeries, atual: Optional[SerieCompacta], desde: int, fim: int) -> List[List[Any]]:
+        """Valores de cada campo, em ordem cronológica, de ``desde`` até ``fim`` (vazios além da cobertura)."""
+        inicios = range(desde, fim + grupo.bucket, grupo.bucket)
+        colunas = []
+        for indice, e_histograma in enumerate(grupo.histograma):
+            vazio = None if e_histograma else NAN
+            if atual is None:
+                colunas.append([vazio] * len(inicios))
+                continue
+            coluna = atual.colunas[indice]
+            colunas.append([coluna[grupo.posicao(b)] if b <= atual.cobertura else vazio for b in inicios])
+        return colunas
+
+    def linhas(self, metrica: str, guids: Iterable[str], serie: SeriePlanejada,
+               agora: Optional[float] = None, desde: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Linhas ``FACET entity.guid ... TIMESERIES`` a partir dos buckets guardados (todos os
+        buckets aparecem, mesmo vazios). Por padrão cobre a janela inteira; com ``desde`` (o
+        mesmo passado a ``registrar``) devolve só os buckets novos ou refeitos no ciclo.
+        """
+        agora = time.time() if agora is None else agora
+        inicio = self.inicio_janela(serie, agora)
+        desde = inicio if desde is None else max(desde, inicio)
+        fim = alinhar(agora, serie.bucket)
+        grupo = self._grupos.get(self._chave(metrica, serie))
+        if grupo is None:
+            return [{"facet": guid, "beginTimeSeconds": b} for guid in guids for b in range(desde, fim + serie.bucket, serie.bucket)]
+        linhas = []
+        for guid in guids:
+            colunas = self._colunas(grupo, grupo.series.get(guid), desde, fim)
+            for posicao, inicio_bucket in enumerate(range(desde, fim + serie.bucket, serie.bucket)):
+                linha = {"facet": guid, "beginTimeSeconds": inicio_bucket}
+                for campo, coluna, e_histograma in zip(grupo.campos, colunas, grupo.histograma):
+                    valor = coluna[posicao]
+                    if e_histograma and valor is not None:
+                        linha[campo] = list(valor)
+                    elif not e_histograma and not math.isnan(valor):
+                        linha[campo] = valor
+                linhas.append(linha)
+        return linhas
+
+    def _valores_trecho(self, grupo: GrupoSeries, linhas: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        """Valores de cada campo por GUID na resposta (sem TIMESERIES) da consulta de um trecho inicial."""
+        valores = {}
+        for linha in linhas:
+            if not isinstance(linha, dict):
+                continue
+            facet = linha.get("facet")
+            guid = (facet[0] if isinstance(facet, list) and facet else facet) or linha.get("entity.guid")
+            if not guid:
+                continue
+            campos = []
+            for campo, e_histograma in zip(grupo.campos, grupo.histograma):
+                valor = linha.get(campo)
+                if e_histograma:
+                    contagens = HistogramaMesclavel.extrair_contagens(valor)
+                    campos.append(array("d", contagens) if contagens else None)
+                else:
+                    campos.append(float(valor) if isinstance(valor, (int, float)) and not isinstance(valor, bool) else NAN)
+            valores[guid] = campos
+        return valores
+
+    @staticmethod
+    def _derivar_colunas(grupo: GrupoSeries, guids: List[str], colunas_por_guid: List[List[List[Any]]],
+                         spec_serie: Dict[str, Any], periodos: Dict[str, int]) -> Dict[str, Dict[str, float]]:
+        if spec_serie["rollup"] == ROLLUP_PERCENTIL:
+            return derivar_percentis_de_colunas(guids, [c[0] for c in colunas_por_guid], spec_serie, periodos)
+        matrizes = {}
+        for indice, campo in enumerate(grupo.campos):
+            if NUMPY_DISPONIVEL:
+                matrizes[campo] = np.array([c[indice] for c in colunas_por_guid], dtype=float)
+            else:
+                matrizes[campo] = [[None if math.isnan(v) else v for v in c[indice]] for c in colunas_por_guid]
+        return derivar_periodos_de_matrizes(guids, matrizes, spec_serie, periodos)
+
+    def derivar(self, metrica: str, guids: Iterable[str], serie: SeriePlanejada, spec_serie: Dict[str, Any],
+                agora: Optional[float] = None,
+                trechos: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> Dict[str, Dict[str, float]]:
+        """
+        Valores por período (como ``period_engine.derivar_periodos``) direto dos buffers, sem
+        montar uma linha por bucket. Entidades sem nenhum bucket guardado ficam de fora.
+
+        ``trechos`` (``{periodo: linhas}``) são as respostas das consultas de ``trechos_iniciais``
+        no mesmo ``agora``: com eles cada período é a janela deslizante exata; sem eles, os
+        últimos N buckets alinhados.
+        """
+        agora = time.time() if agora is None else agora
+        grupo = self._grupos.get(self._chave(metrica, serie))
+        if grupo is None:
+            return {}
+        inicio = self.inicio_janela(serie, agora)
+        fim = alinhar(agora, serie.bucket)
+        presentes = [(guid, grupo.series[guid]) for guid in guids
+                     if guid in grupo.series and grupo.series[guid].cobertura is not None
+                     and grupo.series[guid].cobertura >= inicio]
+        if not presentes:
+            return {}
+        guids_presentes = [guid for guid, _ in presentes]
+        colunas_por_guid = [self._colunas(grupo, atual, inicio, fim) for _, atual in presentes]
+        if trechos is None:
+            return self._derivar_colunas(grupo, guids_presentes, colunas_por_guid, spec_serie, serie.periodos)
+
+        # Cada período: o trecho inicial como um bucket a mais antes dos seus N últimos buckets
+        resultado: Dict[str, Dict[str, float]] = {guid: {} for guid in guids_presentes}
+        vazio = [None if e_histograma else NAN for e_histograma in grupo.histograma]
+        for chave, n in serie.periodos.items():
+            trecho = self._valores_trecho(grupo, trechos.get(chave) or [])
+            colunas = [
+                [[valor] + coluna[-n:] for valor, coluna in zip(trecho.get(guid, vazio), colunas_guid)]
+                for guid, colunas_guid in zip(guids_presentes, colunas_por_guid)
+            ]
+            for guid, valores in self._derivar_colunas(grupo, guids_presentes, colunas, spec_serie, {chave: n + 1}).items():
+                resultado[guid].update(valores)
+        return resultado
+
+    def esquecer(self, guids: Iterable[str]):
+        """Descarta o histórico de entidades removidas."""
+        alvo = set(guids)
+        for grupo in self._grupos.values():
+            for guid in alvo & grupo.series.keys():
+                del grupo.series[guid]
+
+    def get_status(self) -> Dict[str, Any]:
+        series = sum(len(g.series) for g in self._grupos.values())
+        return {
+            "series": series,
+            "buckets": sum(len(g.series) * g.n for g in self._grupos.values()),
+            "bytes_estimados": sum(len(g.series) * g.n * 8 * len(g.campos) for g in self._grupos.values()),
+            "consultas_completas": self.consultas_completas,
+            "consultas_incrementais": self.consultas_incrementais,
+        }
+
+
+# Instância única do processo
+_aggregator: Optional[IncrementalAggregator] = None
+
+
+def get_incremental_aggregator() -> IncrementalAggregator:
+    """Retorna o agregador incremental compartilhado do processo."""
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = IncrementalAggregator()
+    return _aggregator
+
+
+def get_default_aggregator() -> Optional[IncrementalAggregator]:
+    """Agregador usado pelos coletores: o compartilhado, ou None se NEW_RELIC_INCREMENTAL_METRICS=false."""
+    return get_incremental_aggregator() if INCREMENTAL_METRICS_ENABLED else None
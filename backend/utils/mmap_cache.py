@@ -0,0 +1,309 @@
+"""
+Cache em disco num formato binário com índice de offsets, lido via ``mmap`` sob demanda.
+
+Na subida, ``carregar_cache_do_disco``/``get_cache_sync`` faziam ``json.loads`` do cache inteiro
+antes da primeira requisição. Com este formato a carga só lê o cabeçalho e o índice; cada chave
+do cache (``entidades``, ``logs``, ``incidentes``, ``error_traces``...) é decodificada na primeira
+vez em que é acessada, direto das páginas mapeadas do arquivo.
+
+Layout:
+    cabeçalho   MAGIC, versão, offset/tamanho da tabela de registros e do índice
+    registros   um JSON compacto por item de lista (ou por valor não-lista) de primeiro nível
+    tabela      (offset u64, tamanho u32) de cada registro
+    índice      JSON: chaves na ordem original -> lista de números de registro ou registro único,
+                GUID -> registro, momento da gravação (listas por domínio ausentes derivadas de
+                ``entidades``)
+
+Um mesmo objeto presente em várias listas (a entidade em ``entidades`` e em ``APM``) vira um
+único registro, e a leitura devolve o mesmo objeto nas duas listas, como no cache em memória.
+Cada gravação cria um arquivo novo (``<nome>.<geração>.bin``, temporário + fsync + rename) e
+remove os anteriores: no Windows um arquivo mapeado não pode ser substituído nem apagado, então
+quem ainda mapeia a geração antiga continua lendo dela, e ela é removida numa gravação seguinte.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils.cache_persistence import serializar_json
+
+logger = logging.getLogger(__name__)
+
+MMAP_CACHE_ENABLED = os.getenv("NEW_RELIC_MMAP_CACHE", "true").lower() == "true"
+
+MAGIC = b"NRCACHE\x01"
+VERSAO = 1
+CABECALHO = struct.Struct("<8sIQQQQ")  # magic, versão, tabela (offset, n), índice (offset, tamanho)
+ENTRADA = struct.Struct("<QI")  # offset, tamanho de um registro
+
+
+def geracoes(base) -> List[Path]:
+    """Arquivos gravados para ``base`` (ex.: ``historico/cache_completo.bin``), do mais antigo ao mais novo."""
+    base = Path(base)
+    return sorted(base.parent.glob(f"{base.stem}.*{base.suffix}"))
+
+
+def gravar(dados: Dict[str, Any], base) -> Dict[str, Any]:
+    """Grava ``dados`` numa nova geração do arquivo binário de ``base``. Retorna o índice gravado."""
+    base = Path(base)
+    base.parent.mkdir(parents=True, exist_ok=True)
+    destino = base.with_name(f"{base.stem}.{time.time_ns():020d}{base.suffix}")
+    temporario = destino.with_name(f".{destino.name}.{uuid.uuid4().hex[:8]}.tmp")
+    tabela: List[tuple] = []
+    por_objeto: Dict[int, int] = {}
+    guids: Dict[str, int] = {}
+    chaves: Dict[str, Any] = {}
+    try:
+        with open(temporario, "wb") as f:
+            f.write(b"\0" * CABECALHO.size)
+
+            def registrar(valor) -> int:
+                numero = por_objeto.get(id(valor))
+                if numero is not None:
+                    return numero
+                conteudo = serializar_json(valor)
+                tabela.append((f.tell(), len(conteudo)))
+                f.write(conteudo)
+                numero = len(tabela) - 1
+                if isinstance(valor, (dict, list)):
+                    # Só objetos mutáveis são compartilhados; ``dados`` mantém todos vivos durante a gravação
+                    por_objeto[id(valor)] = numero
+                if isinstance(valor, dict) and isinstance(valor.get("guid"), str):
+                    guids.setdefault(valor["guid"], numero)
+                return numero
+
+            for chave, valor in dados.items():
+                if isinstance(valor, list):
+                    chaves[chave] = [registrar(item) for item in valor]
+                else:
+                    chaves[chave] = registrar(valor)
+
+            # Listas por domínio ausentes são derivadas de ``entidades``, como em EntityStore.montar_dados
+            derivadas: Dict[str, List[int]] = {}
+            for entidade, numero in zip(dados.get("entidades") or [], chaves.get("entidades") or []):
+                if isinstance(entidade, dict):
+                    dominio = entidade.get("domain", "UNKNOWN")
+                    if dominio not in chaves:
+                        derivadas.setdefault(dominio, []).append(numero)
+            chaves.update(derivadas)
+
+            offset_tabela = f.tell()
+            f.write(b"".join(ENTRADA.pack(*entrada) for entrada in tabela))
+            indice = {"chaves": chaves, "guids": guids, "gravado_em": time.time()}
+            conteudo_indice = serializar_json(indice)
+            offset_indice = f.tell()
+            f.write(conteudo_indice)
+            f.seek(0)
+            f.write(CABECALHO.pack(MAGIC, VERSAO, offset_tabela, len(tabela), offset_indice, len(conteudo_indice)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, destino)
+    except BaseException:
+        temporario.unlink(missing_ok=True)
+        raise
+    for antigo in geracoes(base):
+        if antigo != destino:
+            try:
+                antigo.unlink()
+            except OSError:
+                # Ainda mapeado por um leitor (Windows): fica para a próxima gravação
+                pass
+    return indice
+
+
+class CacheMapeado:
+    """Leitor de um arquivo gravado por ``gravar``: decodifica registros sob demanda."""
+
+    def __init__(self, caminho):
+        self.caminho = Path(caminho)
+        with open(self.caminho, "rb") as f:
+            self._mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, versao, self._offset_tabela, self.total_registros, offset_indice, tamanho_indice = \
+                CABECALHO.unpack_from(self._mapa, 0)
+            if magic != MAGIC or versao != VERSAO:
+                raise ValueError(f"formato desconhecido ({magic!r}, versão {versao})")
+            if offset_indice + tamanho_indice > len(self._mapa):
+                raise ValueError("arquivo truncado")
+            indice = json.loads(self._mapa[offset_indice:offset_indice + tamanho_indice])
+        except Exception:
+            self._mapa.close()
+            raise
+        self.chaves: Dict[str, Any] = indice["chaves"]
+        self.guids: Dict[str, int] = indice["guids"]
+        self.gravado_em: float = indice["gravado_em"]
+        self._decodificados: Dict[int, Any] = {}
+
+    def registro(self, numero: int) -> Any:
+        if numero not in self._decodificados:
+            offset, tamanho = ENTRADA.unpack_from(self._mapa, self._offset_tabela + numero * ENTRADA.size)
+            self._decodificados[numero] = json.loads(self._mapa[offset:offset + tamanho])
+        return self._decodificados[numero]
+
+    def valor(self, chave: str) -> Any:
+        referencia = self.chaves[chave]
+        if isinstance(referencia, list):
+            return [self.registro(numero) for numero in referencia]
+        return self.registro(referencia)
+
+    def entidade(self, guid: str) -> Optional[Dict[str, Any]]:
+        """Leitura pontual de uma entidade pelo GUID, sem decodificar as demais."""
+        numero = self.guids.get(guid)
+        return self.registro(numero) if numero is not None else None
+
+    def sobrepor(self, entidade: Dict[str, Any]) -> bool:
+        """
+        Troca o registro da entidade (pelo GUID) por ``entidade`` antes de qualquer lista que o
+        contenha ser montada. Só vale para entidades já gravadas e que continuam no mesmo domínio
+        (as listas por domínio são as do arquivo); retorna False se não for o caso.
+        """
+        numero = self.guids.get(entidade.get("guid"))
+        if numero is None or self.registro(numero).get("domain") != entidade.get("domain"):
+            return False
+        self._decodificados[numero] = entidade
+        return True
+
+    def tamanho(self, chave: str) -> int:
+        referencia = self.chaves.get(chave)
+        return len(referencia) if isinstance(referencia, list) else int(referencia is not None)
+
+    @property
+    def decodificados(self) -> int:
+        return len(self._decodificados)
+
+    def fechar(self):
+        self._mapa.close()
+
+
+class DadosMapeados(dict):
+    """
+    Dict do cache cujas chaves são carregadas do arquivo mapeado no primeiro acesso. Os valores
+    carregados (e os atribuídos) ficam no próprio dict; os métodos de leitura enxergam também as
+    chaves ainda não carregadas, então o objeto funciona onde o código espera o dict do cache.
+    """
+
+    def __init__(self, leitor: CacheMapeado):
+        super().__init__()
+        self.leitor = leitor
+        self._pendentes = dict.fromkeys(leitor.chaves)
+
+    def _carregar(self, chave):
+        valor = self.leitor.valor(chave)
+        del self._pendentes[chave]
+        dict.__setitem__(self, chave, valor)
+        return valor
+
+    def __missing__(self, chave):
+        if chave in self._pendentes:
+            return self._carregar(chave)
+        raise KeyError(chave)
+
+    def __contains__(self, chave):
+        return dict.__contains__(self, chave) or chave in self._pendentes
+
+    def get(self, chave, padrao=None):
+        return self[chave] if chave in self else padrao
+
+    def __iter__(self) -> Iterator[str]:
+        # Ordem do arquivo (a do dict gravado), depois as chaves novas
+        for chave in self.leitor.chaves:
+            if chave in self._pendentes or dict.__contains__(self, chave):
+                yield chave
+        for chave in list(dict.__iter__(self)):
+            if chave not in self.leitor.chaves:
+                yield chave
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[chave] for chave in list(self)]
+
+    def items(self):
+        return [(chave, self[chave]) for chave in list(self)]
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._pendentes)
+
+    def __setitem__(self, chave, valor):
+        self._pendentes.pop(chave, None)
+        dict.__setitem__(self, chave, valor)
+
+    def __delitem__(self, chave):
+        if self._pendentes.pop(chave, 0) is None and not dict.__contains__(self, chave):
+            return
+        dict.__delitem__(self, chave)
+
+    def pop(self, chave, *padrao):
+        if chave in self._pendentes:
+            self._carregar(chave)
+        return dict.pop(self, chave, *padrao)
+
+    def setdefault(self, chave, padrao=None):
+        if chave not in self:
+            self[chave] = padrao
+        return self[chave]
+
+    def update(self, *args, **kwargs):
+        for chave, valor in dict(*args, **kwargs).items():
+            self[chave] = valor
+
+    def clear(self):
+        self._pendentes.clear()
+        dict.clear(self)
+
+    def copy(self):
+        return dict(self.items())
+
+    def derivar(self, alteracoes: Dict[str, Any], remover=()) -> "DadosMapeados":
+        """Cópia rasa com ``alteracoes`` e sem ``remover``; chaves não lidas seguem sob demanda."""
+        novo = DadosMapeados(self.leitor)
+        novo._pendentes = dict(self._pendentes)
+        dict.update(novo, dict.items(self))
+        for chave in remover:
+            if chave in novo:
+                del novo[chave]
+        novo.update(alteracoes)
+        return novo
+
+    def __eq__(self, outro):
+        return dict(self.items()) == (dict(outro.items()) if isinstance(outro, dict) else outro)
+
+    def __ne__(self, outro):
+        return not self == outro
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"DadosMapeados({self.leitor.caminho}, carregadas={list(dict.keys(self))}, pendentes={list(self._pendentes)})"
+
+    def entidade(self, guid: str) -> Optional[Dict[str, Any]]:
+        """Entidade pelo GUID, lida direto do arquivo (o mesmo objeto das listas já carregadas)."""
+        return self.leitor.entidade(guid)
+
+    def total_entidades(self) -> int:
+        if dict.__contains__(self, "entidades"):
+            return len(dict.__getitem__(self, "entidades"))
+        return self.leitor.tamanho("entidades")
+
+
+def abrir(base) -> Optional[CacheMapeado]:
+    """Leitor da geração válida mais recente de ``base``, ou None se não houver nenhuma."""
+    for caminho in reversed(geracoes(base)):
+        try:
+            return CacheMapeado(caminho)
+        except Exception as e:
+            logger.warning(f"Cache binário {caminho} ilegível: {e}")
+    return None
+
+
+def abrir_dados(base) -> Optional[DadosMapeados]:
+    """Dict do cache carregado sob demanda a partir da geração mais recente de ``base``, ou None."""
+    leitor = abrir(base)
+    return DadosMapeados(leitor) if leitor is not None else None
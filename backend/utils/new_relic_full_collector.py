@@ -44,9 +44,15 @@ if current_dir.name != "backend":
 # Importar o coletor avançado
 try:
     from backend.utils.advanced_newrelic_collector import AdvancedNewRelicCollector
+    from backend.utils.newrelic_common import close_shared_session
+    from backend.utils.delta_sync import DELTA_SYNC_ENABLED, FingerprintTable, sincronizar
+    from backend.utils import mmap_cache
 except ImportError:
     try:
         from utils.advanced_newrelic_collector import AdvancedNewRelicCollector
+        from utils.newrelic_common import close_shared_session
+        from utils.delta_sync import DELTA_SYNC_ENABLED, FingerprintTable, sincronizar
+        from utils import mmap_cache
     except ImportError:
         logger.error("Não foi possível importar o AdvancedNewRelicCollector")
         sys.exit(1)
@@ -74,6 +80,9 @@ class NewRelicFullCollector:
         # Garantir que os diretórios de cache existam
         self.cache_history_dir.mkdir(exist_ok=True)
         self.cache_detailed_dir.mkdir(exist_ok=True)
+
+        # Tabela de fingerprints da sincronização delta (entre execuções do agendador)
+        self.delta_table = FingerprintTable(self.cache_history_dir / "delta_sync_full.json").load()
         
         # Estrutura avançada do cache
         self.cache_structure = {
@@ -113,6 +122,8 @@ class NewRelicFullCollector:
             "alerts_collected": 0,
             "logs_collected": 0,
             "dashboards_collected": 0,
+            "entities_reused": 0,
+            "entities_removed": 0,
             "errors": 0
         }
         
@@ -162,6 +173,9 @@ class NewRelicFullCollector:
         """
         logger.info("Coletando todas as entidades")
         
+        # Dados completos da sincronização anterior (memória ou disco), reaproveitados pelo delta
+        previous = self._load_previous_entities()
+
         # Lista de domínios a coletar
         domains = [
             "APM", "BROWSER", "INFRA", "MOBILE", "SYNTH", "DB", 
@@ -173,32 +187,20 @@ class NewRelicFullCollector:
             logger.info(f"Coletando entidades do domínio: {domain}")
             
             try:
-                # Obter entidades do domínio
+                # Obter entidades do domínio (listagem leve: reporting, tags e alertSeverity)
                 entities = await self.collector.get_entities_by_domain(domain)
                 self.stats["entities_found"] += len(entities)
-                
-                # Coletar dados completos para cada entidade
-                complete_entities = []
-                for entity in entities:
-                    try:
-                        complete_entity = await self.collector.collect_full_entity_data(entity)
-                        complete_entities.append(complete_entity)
-                        self.stats["entities_collected"] += 1
-                        self.stats["metrics_collected"] += len(complete_entity.get("detailed_metrics", {}))
-                        
-                        # Incrementar alertas coletados
-                        alerts = complete_entity.get("alerts", {})
-                        if alerts:
-                            self.stats["alerts_collected"] += len(alerts.get("violations", []))
-                        
-                        # Incrementar logs coletados
-                        logs = complete_entity.get("logs", [])
-                        self.stats["logs_collected"] += len(logs)
-                        
-                    except Exception as e:
-                        logger.error(f"Erro ao coletar dados completos para entidade {entity.get('name')}: {e}")
-                        self.stats["errors"] += 1
-                
+
+                # Delta: só entidades novas, alteradas, em alerta ou expiradas são recoletadas;
+                # as demais reaproveitam os dados completos da sincronização anterior
+                anteriores = {e.get("guid"): e for e in previous.get(domain_lower, []) if isinstance(e, dict) and e.get("guid")}
+                complete_entities, plano = await sincronizar(
+                    self.delta_table, entities, anteriores, self._collect_complete_entities,
+                    escopo=domain, forcar=not DELTA_SYNC_ENABLED
+                )
+                self.stats["entities_reused"] += len(plano.unchanged)
+                self.stats["entities_removed"] += len(plano.removed)
+
                 # Armazenar entidades no cache
                 if domain_lower in self.cache_structure:
                     self.cache_structure[domain_lower] = complete_entities
@@ -210,7 +212,57 @@ class NewRelicFullCollector:
                 logger.error(f"Erro ao coletar entidades do domínio {domain}: {e}")
                 logger.error(traceback.format_exc())
                 self.stats["errors"] += 1
+
+        try:
+            await self.delta_table.save_async()
+        except Exception as e:
+            logger.error(f"Erro ao salvar tabela de fingerprints: {e}")
     
+    async def _collect_complete_entities(self, entities):
+        """
+        Coleta os dados completos das entidades indicadas pelo delta.
+        """
+        complete_entities = []
+        for entity in entities:
+            try:
+                complete_entity = await self.collector.collect_entity_complete_data(entity)
+                complete_entities.append(complete_entity)
+                self.stats["entities_collected"] += 1
+                self.stats["metrics_collected"] += len(complete_entity.get("detailed_metrics", {}))
+
+                # Incrementar alertas coletados
+                alerts = complete_entity.get("alerts", {})
+                if alerts:
+                    self.stats["alerts_collected"] += len(alerts.get("violations", []))
+
+                # Incrementar logs coletados
+                logs = complete_entity.get("logs", [])
+                self.stats["logs_collected"] += len(logs)
+
+            except Exception as e:
+                logger.error(f"Erro ao coletar dados completos para entidade {entity.get('name')}: {e}")
+                self.stats["errors"] += 1
+        return complete_entities
+
+    def _load_previous_entities(self):
+        """
+        Retorna as entidades por domínio da última sincronização: da memória, se este
+        coletor já sincronizou, ou do cache principal em disco.
+        """
+        previous = {
+            key: value for key, value in self.cache_structure.items()
+            if key not in ("metadata", "logs", "dashboards", "alertas", "workloads") and isinstance(value, list) and value
+        }
+        if previous or not self.cache_file.exists():
+            return previous
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            return {k: v for k, v in saved.items() if isinstance(v, list) and k not in ("alertas", "dashboards", "workloads")}
+        except Exception as e:
+            logger.warning(f"Cache anterior ilegível, sincronização delta começa do zero: {e}")
+            return {}
+
     async def collect_dashboards(self):
         """
         Coleta todos os dashboards e seus detalhes.
@@ -302,6 +354,10 @@ class NewRelicFullCollector:
                 json.dump(self.cache_structure, f, indent=2, ensure_ascii=False)
                 
             logger.info(f"✅ Cache principal salvo em: {self.cache_file}")
+
+            # Mesmo conteúdo no formato binário mapeado, lido sob demanda pelo integrador do frontend
+            if mmap_cache.MMAP_CACHE_ENABLED:
+                mmap_cache.gravar(self.cache_structure, self.cache_file.with_suffix(".bin"))
             
             # Salvar versão histórica no formato antigo (para compatibilidade)
             historical_cache = {
@@ -422,7 +478,10 @@ class NewRelicFullCollector:
 async def main():
     """Função principal"""
     collector = NewRelicFullCollector()
-    await collector.collect_all_data()
+    try:
+        await collector.collect_all_data()
+    finally:
+        await close_shared_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,196 @@
+"""
+Contas New Relic coletadas pelo processo (uma por unidade de negócio).
+
+Sem configuração, há uma única conta: a das variáveis ``NEW_RELIC_ACCOUNT_ID`` /
+``NEW_RELIC_API_KEY`` / ``NEW_RELIC_QUERY_KEY``, e tudo funciona como antes. Com
+``NEW_RELIC_ACCOUNTS`` (JSON) ou ``NEW_RELIC_ACCOUNTS_FILE`` (caminho de um arquivo JSON), o
+processo coleta várias contas em paralelo:
+
+    [
+      {"nome": "varejo", "account_id": 1234567, "api_key_env": "NR_KEY_VAREJO",
+       "query_key_env": "NR_QUERY_KEY_VAREJO", "nrql_rate": 50, "concurrency_max": 32},
+      {"nome": "financeiro", "account_id": 7654321, "api_key": "NRAK-...", "base_url": "https://api.eu.newrelic.com"}
+    ]
+
+As chaves podem vir no próprio JSON (``api_key``/``query_key``) ou do ambiente
+(``api_key_env``/``query_key_env``). Cada conta tem seu rate limiter (os limites da New Relic
+são por conta) e seu controle adaptativo de concorrência; ``base_url`` permite contas em
+regiões diferentes.
+
+A conta da coleta em andamento fica numa ``ContextVar`` (``usar_conta``): as tasks criadas
+dentro dela herdam a conta, então coletas de contas diferentes rodam no mesmo event loop sem
+misturar credenciais, buckets ou cache de respostas.
+"""
+
+import json
+import logging
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils.adaptive_concurrency import (
+    CONCURRENCY_INITIAL, CONCURRENCY_MAX, CONCURRENCY_MIN,
+    AdaptiveConcurrencyController, get_concurrency_controller,
+)
+from utils.rate_limiter import (
+    ENDPOINT_GRAPHQL, ENDPOINT_NRQL, ENDPOINT_REST, GRAPHQL_BURST, GRAPHQL_RATE, NRQL_BURST, NRQL_RATE,
+    REST_BURST, REST_RATE, NewRelicRateLimiter, get_rate_limiter,
+)
+
+logger = logging.getLogger(__name__)
+
+ACCOUNTS_ENV = "NEW_RELIC_ACCOUNTS"
+ACCOUNTS_FILE_ENV = "NEW_RELIC_ACCOUNTS_FILE"
+
+
+class ContaNewRelic:
+    """Credenciais e orçamentos de requisição de uma conta."""
+
+    def __init__(self, account_id, api_key: Optional[str], query_key: Optional[str] = None,
+                 nome: Optional[str] = None, base_url: Optional[str] = None,
+                 nrql_rate: float = NRQL_RATE, nrql_burst: float = NRQL_BURST,
+                 graphql_rate: float = GRAPHQL_RATE, graphql_burst: float = GRAPHQL_BURST,
+                 concurrency_max: int = CONCURRENCY_MAX, concurrency_initial: int = CONCURRENCY_INITIAL):
+        self.account_id = str(account_id)
+        self.api_key = api_key
+        self.query_key = query_key
+        self.nome = nome or self.account_id
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.limites = {
+            ENDPOINT_GRAPHQL: (float(graphql_rate), float(graphql_burst)),
+            ENDPOINT_NRQL: (float(nrql_rate), float(nrql_burst)),
+            ENDPOINT_REST: (REST_RATE, REST_BURST),
+        }
+        self.concurrency_max = int(concurrency_max)
+        self.concurrency_initial = int(concurrency_initial)
+        self._rate_limiter: Optional[NewRelicRateLimiter] = None
+        self._concurrency: Optional[AdaptiveConcurrencyController] = None
+
+    @classmethod
+    def de_config(cls, config: Dict[str, Any]) -> "ContaNewRelic":
+        def chave(campo):
+            if config.get(campo):
+                return config[campo]
+            variavel = config.get(f"{campo}_env")
+            return os.getenv(variavel) if variavel else None
+
+        if not config.get("account_id"):
+            raise ValueError(f"Conta New Relic sem account_id: {config.get('nome')}")
+        opcionais = ("nrql_rate", "nrql_burst", "graphql_rate", "graphql_burst", "concurrency_max", "concurrency_initial")
+        return cls(
+            config["account_id"], chave("api_key"), chave("query_key"),
+            nome=config.get("nome"), base_url=config.get("base_url"),
+            **{k: config[k] for k in opcionais if config.get(k) is not None},
+        )
+
+    @property
+    def rate_limiter(self) -> NewRelicRateLimiter:
+        if self._rate_limiter is None:
+            self._rate_limiter = NewRelicRateLimiter(self.limites)
+        return self._rate_limiter
+
+    @property
+    def concurrency(self) -> AdaptiveConcurrencyController:
+        if self._concurrency is None:
+            self._concurrency = AdaptiveConcurrencyController(
+                min_limit=min(CONCURRENCY_MIN, self.concurrency_max),
+                max_limit=self.concurrency_max,
+                initial_limit=min(self.concurrency_initial, self.concurrency_max),
+            )
+        return self._concurrency
+
+    def graphql_url(self, padrao: str) -> str:
+        return f"{self.base_url}/graphql" if self.base_url else padrao
+
+    def graphql_headers(self) -> Dict[str, str]:
+        return {"Api-Key": self.api_key or "", "Content-Type": "application/json"}
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "nome": self.nome,
+            "account_id": self.account_id,
+            "base_url": self.base_url,
+            "rate_limiter": self.rate_limiter.get_status(),
+            "concorrencia": self.concurrency.get_status(),
+        }
+
+
+def carregar_contas() -> List[ContaNewRelic]:
+    """
+    Contas configuradas em ``NEW_RELIC_ACCOUNTS``/``NEW_RELIC_ACCOUNTS_FILE``. Lista vazia quando
+    não há configuração multi-conta (o processo usa só a conta das variáveis padrão).
+    """
+    texto = os.getenv(ACCOUNTS_ENV)
+    arquivo = os.getenv(ACCOUNTS_FILE_ENV)
+    if not texto and arquivo:
+        texto = Path(arquivo).read_text(encoding="utf-8")
+    if not texto:
+        return []
+    configs = json.loads(texto)
+    if isinstance(configs, dict):
+        configs = configs.get("contas") or configs.get("accounts") or []
+    contas = [ContaNewRelic.de_config(c) for c in configs]
+    nomes = [c.nome for c in contas]
+    if len(set(nomes)) != len(nomes):
+        raise ValueError(f"Nomes de conta New Relic repetidos: {nomes}")
+    for conta in contas:
+        if not conta.api_key:
+            logger.warning(f"Conta New Relic {conta.nome} ({conta.account_id}) sem api_key configurada")
+    return contas
+
+
+# Instância única do processo (os buckets e limites de concorrência de cada conta persistem entre coletas)
+_contas: Optional[List[ContaNewRelic]] = None
+
+
+def get_contas() -> List[ContaNewRelic]:
+    """Contas configuradas, carregadas uma vez por processo."""
+    global _contas
+    if _contas is None:
+        _contas = carregar_contas()
+    return _contas
+
+
+_conta_atual: ContextVar[Optional[ContaNewRelic]] = ContextVar("conta_new_relic", default=None)
+
+
+def conta_atual() -> Optional[ContaNewRelic]:
+    """Conta da coleta em andamento, ou None (conta padrão das variáveis de ambiente)."""
+    return _conta_atual.get()
+
+
+@contextmanager
+def usar_conta(conta: Optional[ContaNewRelic]) -> Iterator[Optional[ContaNewRelic]]:
+    """Executa o bloco (e as tasks criadas nele) com as credenciais e orçamentos de ``conta``."""
+    token = _conta_atual.set(conta)
+    try:
+        yield conta
+    finally:
+        _conta_atual.reset(token)
+
+
+def get_rate_limiter_atual() -> NewRelicRateLimiter:
+    conta = conta_atual()
+    return conta.rate_limiter if conta is not None else get_rate_limiter()
+
+
+def get_concurrency_controller_atual() -> AdaptiveConcurrencyController:
+    conta = conta_atual()
+    return conta.concurrency if conta is not None else get_concurrency_controller()
+
+
+def escopo_cache(url: str) -> str:
+    """Escopo das chaves do cache de respostas: a mesma consulta em contas diferentes não colide."""
+    conta = conta_atual()
+    return url if conta is None else f"{url}#conta={conta.account_id}"
+
+
+def caminho_por_conta(caminho: Path) -> Path:
+    """Arquivo por conta (ex.: journal de checkpoint) quando há uma conta ativa."""
+    conta = conta_atual()
+    if conta is None:
+        return Path(caminho)
+    caminho = Path(caminho)
+    return caminho.with_name(f"{caminho.stem}_{conta.account_id}{caminho.suffix}")
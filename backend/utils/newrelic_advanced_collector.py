@@ -19,16 +19,29 @@ import logging
 import json
 import asyncio
 import aiohttp
-from aiohttp import ClientConnectionError, TCPConnector
+from aiohttp import ClientConnectionError
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
 from dotenv import load_dotenv
 # Importa utilitário centralizado
 from utils.newrelic_common import (
     execute_nrql_query_common,
     execute_graphql_query_common,
+    get_shared_session,
+    carregar_credenciais,
+    nr_base_url,
     log_info, log_warning, log_error
 )
+from utils.single_flight import get_single_flight
+from utils.newrelic_accounts import (
+    ContaNewRelic, caminho_por_conta, conta_atual, get_concurrency_controller_atual, get_contas, usar_conta
+)
+from utils.entity_pager import ErroDePagina, iter_pages, parse_entity_search_page
+from utils.nrql_batch import (
+    FACET_CHUNK_SIZE, METRICAS_POR_DOMINIO, NRQLBatchEngine, consultas_por_metrica, dominio_suportado, extrair_resultados_nrql,
+)
+from utils.incremental_aggregator import get_default_aggregator
+from utils.collection_journal import CHECKPOINT_ENABLED, CHECKPOINT_FILE, CollectionJournal
 
 
 
@@ -52,9 +65,7 @@ logging.getLogger().addFilter(IgnoreClientConnectionErrorFilter())
 
 load_dotenv()
 
-NEW_RELIC_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-NEW_RELIC_QUERY_KEY = os.getenv("NEW_RELIC_QUERY_KEY")
-NEW_RELIC_ACCOUNT_ID = os.getenv("NEW_RELIC_ACCOUNT_ID")
+NEW_RELIC_API_KEY, NEW_RELIC_QUERY_KEY, NEW_RELIC_ACCOUNT_ID = carregar_credenciais()
 
 if not NEW_RELIC_API_KEY or not NEW_RELIC_ACCOUNT_ID or not NEW_RELIC_QUERY_KEY:
     log_error("NEW_RELIC_API_KEY, NEW_RELIC_QUERY_KEY e NEW_RELIC_ACCOUNT_ID são obrigatórios!")
@@ -64,12 +75,12 @@ if not NEW_RELIC_API_KEY or not NEW_RELIC_ACCOUNT_ID or not NEW_RELIC_QUERY_KEY:
 TIMEOUT = 60.0  # Timeout maior para consultas complexas
 MAX_RETRIES = 3
 RETRY_DELAY = 10.0  # Delay maior para evitar bloqueio
-BATCH_SIZE = 1  # Reduzido ao mínimo para evitar rate limit e problemas de conexão
+BATCH_SIZE = 100  # Entidades por lote; rate limit e concorrência ficam com o token bucket e o controle AIMD
 
-NR_GRAPHQL_URL = "https://api.newrelic.com/graphql"
-NR_API_URL = f"https://api.newrelic.com/v2"
+NR_GRAPHQL_URL = f"{nr_base_url()}/graphql"
+NR_API_URL = f"{nr_base_url()}/v2"
 # Endpoint NRQL atualizado conforme documentação oficial
-NR_NRDB_URL = f"https://api.newrelic.com/v1/accounts/{NEW_RELIC_ACCOUNT_ID}/query"
+NR_NRDB_URL = f"{nr_base_url()}/v1/accounts/{NEW_RELIC_ACCOUNT_ID}/query"
 
 # Headers separados para cada tipo de requisição
 NRQL_HEADERS = {
@@ -82,6 +93,22 @@ GRAPHQL_HEADERS = {
     "Content-Type": "application/json"
 }
 
+# Modo agregado de traces (APM): em vez de puxar até 1000 Spans, 100 TransactionError e 200
+# CodeExecution brutos por entidade, pede à NR resumos com FACET (top spans por tempo total,
+# erros por classe, caminhos de código mais quentes) e guarda só alguns eventos de exemplo
+SPAN_AGGREGATION_ENABLED = os.getenv("NEW_RELIC_SPAN_AGGREGATION", "true").lower() == "true"
+TOP_SPANS = int(os.getenv("NEW_RELIC_TOP_SPANS", "20"))
+TOP_ERROR_CLASSES = int(os.getenv("NEW_RELIC_TOP_ERROR_CLASSES", "20"))
+TOP_CODE_PATHS = int(os.getenv("NEW_RELIC_TOP_CODE_PATHS", "20"))
+EXEMPLARES_POR_TIPO = int(os.getenv("NEW_RELIC_EXEMPLARES", "5"))
+
+def _conta_da_requisicao():
+    """``(account_id, headers GraphQL, URL GraphQL)`` da conta em coleta (ver utils.newrelic_accounts)."""
+    conta = conta_atual()
+    if conta is None:
+        return NEW_RELIC_ACCOUNT_ID, GRAPHQL_HEADERS, NR_GRAPHQL_URL
+    return conta.account_id, conta.graphql_headers(), conta.graphql_url(NR_GRAPHQL_URL)
+
 # Períodos de consulta para dados históricos
 PERIODOS = {
     "30min": "SINCE 30 MINUTES AGO",
@@ -94,11 +121,13 @@ PERIODOS = {
 async def execute_nrql_query(nrql: str, timeout: float = TIMEOUT, session: Optional[aiohttp.ClientSession] = None) -> Dict:
     """
     Executa consulta NRQL e retorna resultados. (Centralizado via utilitário)
+    As linhas (actor.account.nrql.results) também ficam em ``results`` na raiz da resposta.
     """
+    account_id, headers, url = _conta_da_requisicao()
     graphql_query = f'''
     {{
       actor {{
-        account(id: {NEW_RELIC_ACCOUNT_ID}) {{
+        account(id: {account_id}) {{
           nrql(query: "{nrql}") {{
             results
             metadata {{
@@ -111,24 +140,29 @@ async def execute_nrql_query(nrql: str, timeout: float = TIMEOUT, session: Optio
     }}
     '''
     # Utiliza função centralizada
-    return await execute_nrql_query_common(
+    resposta = await execute_nrql_query_common(
         graphql_query,
-        headers=GRAPHQL_HEADERS,
-        url=NR_GRAPHQL_URL,
+        headers=headers,
+        url=url,
         timeout=timeout,
         session=session,
         max_retries=MAX_RETRIES,
         retry_delay=RETRY_DELAY
     )
+    if isinstance(resposta, dict) and "data" in resposta and "results" not in resposta:
+        # Resposta pode vir do cache de consultas: devolve uma cópia em vez de alterá-la
+        return {**resposta, "results": extrair_resultados_nrql(resposta)}
+    return resposta
 
 async def execute_graphql_query(query: str, variables: Optional[Dict] = None, timeout: float = TIMEOUT, session: Optional[aiohttp.ClientSession] = None) -> Dict:
     """
     Executa consulta GraphQL na API do New Relic. (Centralizado via utilitário)
     """
+    _, headers, url = _conta_da_requisicao()
     return await execute_graphql_query_common(
         query,
-        headers=GRAPHQL_HEADERS,
-        url=NR_GRAPHQL_URL,
+        headers=headers,
+        url=url,
         variables=variables,
         timeout=timeout,
         session=session,
@@ -156,10 +190,11 @@ async def fetch_logs_sample(limit=100, session: Optional[aiohttp.ClientSession]
 async def fetch_dashboards_sample(limit=20, session: Optional[aiohttp.ClientSession] = None):
     """Coleta uma amostra de dashboards do New Relic via GraphQL."""
     try:
+        account_id, _, _ = _conta_da_requisicao()
         query = f'''
         {{
           actor {{
-            entitySearch(query: "type='DASHBOARD' AND accountId = {NEW_RELIC_ACCOUNT_ID}") {{
+            entitySearch(query: "type='DASHBOARD' AND accountId = {account_id}") {{
               results {{
                 entities {{
                   guid
@@ -186,50 +221,225 @@ async def fetch_dashboards_sample(limit=20, session: Optional[aiohttp.ClientSess
 async def get_all_entities(session: aiohttp.ClientSession) -> List[Dict]:
     """
     Recupera todas as entidades do New Relic via GraphQL.
+    Chamadas simultâneas (ex.: vários requests em /entidades) compartilham a mesma coleta.
     
     Returns:
         Lista de entidades com seus detalhes básicos
     """
-    # Novo padrão: busca por todos os domínios relevantes usando o campo 'query'
-    query = """
-    query EntitiesQuery($cursor: String) {
-      actor {
-        entitySearch(query: \"domain IN ('APM','BROWSER','INFRA','MOBILE','SYNTH','EXT')\") {
-          results(cursor: $cursor) {
-            entities {
-              guid
-              name
-              domain
-              entityType
-              accountId
-              tags {
-                key
-                values
-              }
-            }
-            nextCursor
+    return await get_single_flight().do(
+        ("get_all_entities", _conta_da_requisicao()[0]),
+        lambda: _fetch_all_entities(session)
+    )
+
+ENTITY_SEARCH_DOMAINS = ("APM", "BROWSER", "INFRA", "MOBILE", "SYNTH", "EXT")
+
+# Campos leves da listagem; reporting, tags e alertSeverity alimentam a sincronização delta
+ENTITY_OUTLINE_FIELDS = """
+          guid
+          name
+          domain
+          entityType
+          accountId
+          reporting
+          tags {
+            key
+            values
+          }
+          ... on AlertableEntityOutline {
+            alertSeverity
           }
+"""
+
+ENTITY_SEARCH_QUERY_TEMPLATE = """
+query EntitiesQuery($cursor: String) {
+  actor {
+    entitySearch(query: \"domain IN (%s)%s\") {
+      results(cursor: $cursor) {
+        entities {
+%s
         }
+        nextCursor
       }
     }
+  }
+}
+"""
+
+def build_entity_search_query(domains=ENTITY_SEARCH_DOMAINS, account_id=None) -> str:
+    """``account_id`` restringe a busca a uma conta (chaves com acesso a várias contas listam todas)."""
+    dominios = ",".join(f"'{d}'" for d in domains)
+    filtro_conta = f" AND accountId = {int(account_id)}" if account_id else ""
+    return ENTITY_SEARCH_QUERY_TEMPLATE % (dominios, filtro_conta, ENTITY_OUTLINE_FIELDS)
+
+ENTITY_SEARCH_QUERY = build_entity_search_query()
+
+async def iter_entity_pages(session: Optional[aiohttp.ClientSession] = None, domains: Optional[List[str]] = None,
+                            cursor: Optional[str] = None, com_cursor: bool = False) -> AsyncIterator[Any]:
+    """
+    Gera as páginas de entidades conforme chegam, buscando a próxima página (cursor)
+    enquanto o chamador processa a atual. ``domains`` restringe a busca a alguns domínios;
+    ``cursor`` e ``com_cursor`` seguem ``utils.entity_pager.iter_pages``.
     """
+    # Novo padrão: busca por todos os domínios relevantes usando o campo 'query'
+    conta = conta_atual()
+    if conta is not None:
+        query = build_entity_search_query(domains or ENTITY_SEARCH_DOMAINS, conta.account_id)
+    else:
+        query = build_entity_search_query(domains) if domains else ENTITY_SEARCH_QUERY
 
-    entities = []
-    cursor = None
-    while True:
+    async def fetch_page(cursor):
         variables = {"cursor": cursor} if cursor else {}
         result = await execute_graphql_query(query, variables, session=session)
-        if not (result and "data" in result and "actor" in result["data"]):
-            break
-        search_results = result["data"]["actor"]["entitySearch"]["results"]
-        entities.extend(search_results["entities"])
-        cursor = search_results.get("nextCursor")
-        if not cursor:
-            break
+        return parse_entity_search_page(result)
+
+    async for page in iter_pages(fetch_page, cursor=cursor, com_cursor=com_cursor):
+        yield page
+
+async def _fetch_all_entities(session: aiohttp.ClientSession) -> List[Dict]:
+    entities = []
+    async for page in iter_entity_pages(session):
+        entities.extend(page)
 
     log_info(f"Coletadas {len(entities)} entidades do New Relic")
     return entities
 
+ENTITY_OUTLINE_QUERY = """
+query EntityOutlineQuery($guid: EntityGuid!) {
+  actor {
+    entity(guid: $guid) {
+      guid
+      name
+      domain
+      entityType
+      accountId
+      reporting
+      tags {
+        key
+        values
+      }
+      ... on AlertableEntity {
+        alertSeverity
+      }
+    }
+  }
+}
+"""
+
+async def get_entity_outline(guid: str, session: Optional[aiohttp.ClientSession] = None) -> Optional[Dict]:
+    """
+    Busca os campos leves (os mesmos da listagem) de uma única entidade.
+    Retorna None se a entidade não existir mais.
+    """
+    result = await execute_graphql_query(ENTITY_OUTLINE_QUERY, {"guid": guid}, session=session)
+    try:
+        return result["data"]["actor"]["entity"] or None
+    except (KeyError, TypeError):
+        return None
+
+# Fragments de resumo (summary) por tipo de entidade, compartilhados entre a consulta
+# individual (entity(guid:)) e a consulta em lote (entities(guids:)).
+# Corrigido conforme documentação GraphQL New Relic (2025):
+# Removidos campos inválidos: pageLoadTimeStdDev, pageLoadTimeWithFrustration, pageLoadTimeWithTolerating, pageLoadTimeWithSatisfied,
+# diskFreePercent, memoryFreePercent, responseTimeAverage (SyntheticMonitorSummaryData), durationAverage, locationCount, summary (GenericInfrastructureEntity)
+ENTITY_SUMMARY_FRAGMENTS = """
+    ... on ApmApplicationEntity {
+      name
+      domain
+      entityType
+      applicationId
+      apmSummary {
+        apdexScore
+        errorRate
+        hostCount
+        instanceCount
+        nonWebResponseTimeAverage
+        nonWebThroughput
+        responseTimeAverage
+        throughput
+        webResponseTimeAverage
+        webThroughput
+      }
+    }
+    ... on BrowserApplicationEntity {
+      name
+      domain
+      entityType
+      browserSummary {
+        ajaxRequestThroughput
+        ajaxResponseTimeAverage
+        jsErrorRate
+        pageLoadThroughput
+        pageLoadTimeAverage
+        pageLoadTimeMedian
+      }
+    }
+    ... on InfrastructureHostEntity {
+      name
+      domain
+      entityType
+      infrastructureSummary: hostSummary {
+        cpuUtilizationPercent
+        diskUsedPercent
+        memoryUsedPercent
+        networkReceiveRate
+        networkTransmitRate
+      }
+    }
+    ... on MobileApplicationEntity {
+      name
+      domain
+      entityType
+      mobileSummary {
+        appLaunchCount
+        crashCount
+        crashRate
+        httpErrorRate
+        httpRequestCount
+        httpRequestRate
+        httpResponseTimeAverage
+        mobileSessionCount
+        networkFailureRate
+      }
+    }
+    ... on SyntheticMonitorEntity {
+      name
+      domain
+      entityType
+      monitorId
+      monitorType
+      monitorSummary {
+        locationsFailing
+        successRate
+      }
+    }
+    ... on GenericInfrastructureEntity {
+      name
+      domain
+      entityType
+    }
+"""
+
+# Máximo de GUIDs por consulta actor { entities(guids: [...]) }
+SUMMARY_BATCH_SIZE = 25
+SUMMARY_MAX_CONCURRENT = 5
+
+def _extract_entity_summary(entity: Optional[Dict]) -> Dict:
+    """Retorna o bloco de summary correspondente ao domínio da entidade."""
+    if not entity:
+        return {}
+    domain = entity.get("domain", "UNKNOWN")
+    if domain == "APM" and "apmSummary" in entity:
+        return entity["apmSummary"] or {}
+    elif domain == "BROWSER" and "browserSummary" in entity:
+        return entity["browserSummary"] or {}
+    elif domain == "INFRA" and "infrastructureSummary" in entity:
+        return entity["infrastructureSummary"] or {}
+    elif domain == "MOBILE" and "mobileSummary" in entity:
+        return entity["mobileSummary"] or {}
+    elif domain == "SYNTH" and "monitorSummary" in entity:
+        return entity["monitorSummary"] or {}
+    return {}
+
 async def get_entity_metrics(entity_guid: str, metrics_list: List[str], period_key: str = "30min", session: Optional[aiohttp.ClientSession] = None) -> Dict:
     """
     Recupera métricas específicas para uma entidade.
@@ -244,89 +454,11 @@ async def get_entity_metrics(entity_guid: str, metrics_list: List[str], period_k
     """
     # NÃO usar period_clause nos campos GraphQL! Só em NRQL.
     # O período para GraphQL é definido por default no backend da New Relic (normalmente 30min/1h). Para períodos customizados, use NRQL.
-    metric_results = {}
-    # Corrigido conforme documentação GraphQL New Relic (2025):
-    # Removidos campos inválidos: pageLoadTimeStdDev, pageLoadTimeWithFrustration, pageLoadTimeWithTolerating, pageLoadTimeWithSatisfied,
-    # diskFreePercent, memoryFreePercent, responseTimeAverage (SyntheticMonitorSummaryData), durationAverage, locationCount, summary (GenericInfrastructureEntity)
     entity_query = f"""
     {{
       actor {{
         entity(guid: \"{entity_guid}\") {{
-          ... on ApmApplicationEntity {{
-            name
-            domain
-            entityType
-            applicationId
-            apmSummary {{
-              apdexScore
-              errorRate
-              hostCount
-              instanceCount
-              nonWebResponseTimeAverage
-              nonWebThroughput
-              responseTimeAverage
-              throughput
-              webResponseTimeAverage
-              webThroughput
-            }}
-          }}
-          ... on BrowserApplicationEntity {{
-            name
-            domain
-            entityType
-            browserSummary {{
-              ajaxRequestThroughput
-              ajaxResponseTimeAverage
-              jsErrorRate
-              pageLoadThroughput
-              pageLoadTimeAverage
-              pageLoadTimeMedian
-            }}
-          }}
-          ... on InfrastructureHostEntity {{
-            name
-            domain
-            entityType
-            infrastructureSummary: hostSummary {{
-              cpuUtilizationPercent
-              diskUsedPercent
-              memoryUsedPercent
-              networkReceiveRate
-              networkTransmitRate
-            }}
-          }}
-          ... on MobileApplicationEntity {{
-            name
-            domain
-            entityType
-            mobileSummary {{
-              appLaunchCount
-              crashCount
-              crashRate
-              httpErrorRate
-              httpRequestCount
-              httpRequestRate
-              httpResponseTimeAverage
-              mobileSessionCount
-              networkFailureRate
-            }}
-          }}
-          ... on SyntheticMonitorEntity {{
-            name
-            domain
-            entityType
-            monitorId
-            monitorType
-            monitorSummary {{
-              locationsFailing
-              successRate
-            }}
-          }}
-          ... on GenericInfrastructureEntity {{
-            name
-            domain
-            entityType
-          }}
+          {ENTITY_SUMMARY_FRAGMENTS}
         }}
       }}
     }}
@@ -335,26 +467,58 @@ async def get_entity_metrics(entity_guid: str, metrics_list: List[str], period_k
     result = await execute_graphql_query(entity_query, session=session)
 
     if result and "data" in result and "actor" in result["data"] and "entity" in result["data"]["actor"]:
-        entity = result["data"]["actor"]["entity"]
-        domain = entity.get("domain", "UNKNOWN")
-
-        if domain == "APM" and "apmSummary" in entity:
-            metric_results = entity["apmSummary"]
-        elif domain == "BROWSER" and "browserSummary" in entity:
-            metric_results = entity["browserSummary"]
-        elif domain == "INFRA" and "infrastructureSummary" in entity:
-            metric_results = entity["infrastructureSummary"]
-        elif domain == "MOBILE" and "mobileSummary" in entity:
-            metric_results = entity["mobileSummary"]
-        elif domain == "SYNTH" and "monitorSummary" in entity:
-            metric_results = entity["monitorSummary"]
-
-    return metric_results
+        return _extract_entity_summary(result["data"]["actor"]["entity"])
+    return {}
+
+async def get_entities_summaries(entity_guids: List[str], session: Optional[aiohttp.ClientSession] = None) -> Dict[str, Dict]:
+    """
+    Versão em lote de get_entity_metrics: busca o summary de até SUMMARY_BATCH_SIZE entidades
+    por requisição usando actor { entities(guids: [...]) }.
+    
+    Args:
+        entity_guids: GUIDs das entidades
+        
+    Returns:
+        Dicionário {guid: summary}. GUIDs de blocos que falharam ficam de fora do resultado.
+    """
+    guids = list(dict.fromkeys(g for g in entity_guids if g))
+    summaries: Dict[str, Dict] = {}
+    if not guids:
+        return summaries
+
+    query = """
+    query EntitiesSummaryQuery($guids: [EntityGuid]!) {
+      actor {
+        entities(guids: $guids) {
+          guid
+          %s
+        }
+      }
+    }
+    """ % ENTITY_SUMMARY_FRAGMENTS
+    semaphore = asyncio.Semaphore(SUMMARY_MAX_CONCURRENT)
+
+    async def fetch_chunk(chunk: List[str]):
+        async with semaphore:
+            result = await execute_graphql_query(query, {"guids": chunk}, session=session)
+        entities = (((result or {}).get("data") or {}).get("actor") or {}).get("entities")
+        if entities is None:
+            log_warning(f"Falha ao buscar summaries em lote para {len(chunk)} entidades: {(result or {}).get('errors') or (result or {}).get('error')}")
+            return
+        for entity in entities:
+            if entity and entity.get("guid"):
+                summaries[entity["guid"]] = _extract_entity_summary(entity)
+
+    chunks = [guids[i:i + SUMMARY_BATCH_SIZE] for i in range(0, len(guids), SUMMARY_BATCH_SIZE)]
+    await asyncio.gather(*[fetch_chunk(chunk) for chunk in chunks])
+    log_info(f"Summaries em lote: {len(summaries)}/{len(guids)} entidades em {len(chunks)} requisições")
+    return summaries
 
 async def get_entity_advanced_data(entity: Dict, period_key: str = "7d", session: Optional[aiohttp.ClientSession] = None) -> Dict:
     """
     Coleta dados avançados para uma entidade usando NRQL.
     Inclui logs, traces, backtraces, queries SQL, etc.
+    Chamadas simultâneas para a mesma entidade/período compartilham a mesma coleta.
     
     Args:
         entity: Entidade para coleta (com guid e domain)
@@ -363,6 +527,46 @@ async def get_entity_advanced_data(entity: Dict, period_key: str = "7d", session
     Returns:
         Dicionário com dados avançados
     """
+    guid = entity.get("guid")
+    if not guid:
+        return await _fetch_entity_advanced_data(entity, period_key, session)
+    return await get_single_flight().do(
+        ("get_entity_advanced_data", guid, entity.get("domain"), period_key),
+        lambda: _fetch_entity_advanced_data(entity, period_key, session)
+    )
+
+def consultas_apm_agregadas(guid: str, period_clause: str) -> Dict[str, str]:
+    """
+    NRQL do modo agregado de traces para uma entidade APM, por chave de ``advanced_data``.
+    O primeiro agregado de cada FACET define a ordenação (tempo total para spans e código).
+    """
+    filtro = f"WHERE entityGuid = '{guid}'"
+    return {
+        # Top spans por tempo total (duração x chamadas), com um trace de exemplo por span
+        "traces": (
+            f"SELECT sum(duration) AS duracao_total, count(*) AS chamadas, average(duration) AS duracao_media, "
+            f"max(duration) AS duracao_max, percentile(duration, 95) AS duracao_p95, "
+            f"filter(count(*), WHERE error IS TRUE) AS erros, latest(trace.id) AS trace_exemplo "
+            f"FROM Span {filtro} {period_clause} FACET name LIMIT {TOP_SPANS}"
+        ),
+        # Erros por classe, com a última mensagem e transação
+        "errors": (
+            f"SELECT count(*) AS ocorrencias, latest(error.message) AS ultima_mensagem, "
+            f"latest(transactionName) AS ultima_transacao, max(timestamp) AS ultima_ocorrencia "
+            f"FROM TransactionError {filtro} {period_clause} FACET error.class LIMIT {TOP_ERROR_CLASSES}"
+        ),
+        # Caminhos de código mais quentes
+        "code_execution": (
+            f"SELECT sum(codeExecutionTime) AS tempo_total, sum(codeExecutionCount) AS execucoes, "
+            f"max(codeExecutionTimePercentage) AS percentual_max "
+            f"FROM CodeExecution {filtro} {period_clause} FACET packageName, className, method LIMIT {TOP_CODE_PATHS}"
+        ),
+        # Poucos eventos brutos de exemplo (com backtrace/atributos completos) para a análise de causa raiz
+        "exemplares.errors": f"SELECT * FROM TransactionError {filtro} {period_clause} LIMIT {EXEMPLARES_POR_TIPO}",
+        "exemplares.traces": f"SELECT * FROM Span {filtro} AND error IS TRUE {period_clause} LIMIT {EXEMPLARES_POR_TIPO}",
+    }
+
+async def _fetch_entity_advanced_data(entity: Dict, period_key: str, session: Optional[aiohttp.ClientSession]) -> Dict:
     guid = entity.get("guid")
     domain = entity.get("domain", "UNKNOWN")
     entity_name = entity.get("name", "")
@@ -385,7 +589,32 @@ async def get_entity_advanced_data(entity: Dict, period_key: str = "7d", session
         "relationships": []
     }
     # Tarefas em paralelo para APM
-    if domain == "APM":
+    if domain == "APM" and SPAN_AGGREGATION_ENABLED:
+        consultas = consultas_apm_agregadas(guid, period_clause)
+        # SQL lento já é agregado: mesma consulta do modo bruto
+        consultas["queries"] = (
+            f"SELECT count(*), average(duration), max(duration), sum(databaseCallCount) as totalDatabaseCalls, min(timestamp) "
+            f"FROM Transaction WHERE entityGuid = '{guid}' AND databaseCallCount > 0 {period_clause} LIMIT 50"
+        )
+        results = await asyncio.gather(*(execute_nrql_query(q, session=session) for q in consultas.values()), return_exceptions=True)
+        advanced_data["exemplares"] = {"errors": [], "traces": []}
+        advanced_data["modo_traces"] = "agregado"
+        for chave, result in zip(consultas, results):
+            if isinstance(result, Exception):
+                log_warning(f"Erro na coleta avançada de {entity_name}: {str(result)}")
+                continue
+            if "error" in result:
+                log_warning(f"Erro na API para {entity_name}: {result['error']}")
+                continue
+            if "results" not in result:
+                log_warning(f"[DEBUG] Resposta NRQL sem campo 'results' para {entity_name}, consulta {chave}: {result}")
+                continue
+            if chave.startswith("exemplares."):
+                advanced_data["exemplares"][chave.split(".", 1)[1]] = result["results"]
+            else:
+                advanced_data[chave] = result["results"]
+
+    elif domain == "APM":
         tasks = []
         # 1. Query para erros e backtraces
         error_query = f"SELECT * FROM TransactionError WHERE entityGuid = '{guid}' {period_clause} LIMIT 100"
@@ -542,13 +771,33 @@ async def get_entity_advanced_data(entity: Dict, period_key: str = "7d", session
         advanced_data["relationships"] = relations_result["data"]["actor"]["entity"]["relatedEntities"]
     return advanced_data
 
-async def collect_entity_complete_data(entity: Dict, session: Optional[aiohttp.ClientSession] = None, semaphore: Optional[asyncio.Semaphore] = None) -> Dict:
+# Queries NRQL por entidade do modo bruto de _fetch_entity_advanced_data (manter em sincronia)
+CONSULTAS_AVANCADAS_POR_DOMINIO = {"APM": 4, "INFRA": 3, "BROWSER": 3}
+
+def custo_coleta_entidade(entity: Dict) -> float:
+    """
+    Requisições à API gastas por ``collect_entities_complete_data`` para uma entidade: as
+    consultas avançadas do domínio, a de relacionamentos (GraphQL) e a fração das consultas em
+    lote (summaries e métricas FACET por período) que cabe à entidade.
+    """
+    domain = entity.get("domain")
+    if domain == "APM" and SPAN_AGGREGATION_ENABLED:
+        avancadas = len(consultas_apm_agregadas("", "")) + 1  # + SQL lento
+    else:
+        avancadas = CONSULTAS_AVANCADAS_POR_DOMINIO.get(domain, 0)
+    por_metrica = consultas_por_metrica(PERIODOS, incremental=get_default_aggregator() is not None)
+    em_lote = 1 / SUMMARY_BATCH_SIZE + len(METRICAS_POR_DOMINIO.get(domain, ())) * por_metrica / FACET_CHUNK_SIZE
+    return avancadas + 1 + em_lote
+
+async def collect_entity_complete_data(entity: Dict, session: Optional[aiohttp.ClientSession] = None, semaphore: Optional[asyncio.Semaphore] = None, summary: Optional[Dict] = None, metricas_periodo: Optional[Dict] = None) -> Dict:
     """
     Coleta todos os dados possíveis para uma entidade.
     
     Args:
         entity: Entidade a ser processada
         session: ClientSession opcional para reuso
+        summary: Summary já obtido via get_entities_summaries (evita a consulta individual)
+        metricas_periodo: Métricas NRQL por período (``{periodo: {...}}``) já coletadas em lote
     Returns:
         Entidade enriquecida com todos os dados
     """
@@ -562,170 +811,370 @@ async def collect_entity_complete_data(entity: Dict, session: Optional[aiohttp.C
     try:
         if semaphore:
             async with semaphore:
-                return await _collect_entity_complete_data_inner(entity, session)
+                return await _collect_entity_complete_data_inner(entity, session, summary, metricas_periodo)
         else:
-            return await _collect_entity_complete_data_inner(entity, session)
+            return await _collect_entity_complete_data_inner(entity, session, summary, metricas_periodo)
     except Exception as e:
         log_error(f"Erro ao coletar dados completos para {entity_name}: {str(e)}")
         entity["problema"] = f"ERRO_COLETA: {str(e)}"
         return entity
 
-async def _collect_entity_complete_data_inner(entity: Dict, session: Optional[aiohttp.ClientSession]) -> Dict:
+async def _collect_entity_complete_data_inner(entity: Dict, session: Optional[aiohttp.ClientSession], summary: Optional[Dict] = None, metricas_periodo: Optional[Dict] = None) -> Dict:
     guid = entity.get("guid")
     entity_name = entity.get("name", "Unknown")
     processed_entity = entity.copy()
     processed_entity["metricas"] = {}
+    # O summary GraphQL não depende do período: busca uma vez (se não veio do lote) e replica
+    if summary is None:
+        summaries = await get_entities_summaries([guid], session=session)
+        summary = summaries.get(guid, {})
     for period_key in PERIODOS.keys():
-        metrics = await get_entity_metrics(
-            guid,
-            ["apdex", "response_time", "error_rate", "throughput"],
-            period_key,
-            session=session
-        )
-        processed_entity["metricas"][period_key] = metrics
+        processed_entity["metricas"][period_key] = dict(summary)
+        # Métricas NRQL do período (janela deslizante incremental) complementam o summary
+        processed_entity["metricas"][period_key].update((metricas_periodo or {}).get(period_key, {}))
     advanced_data = await get_entity_advanced_data(entity, "7d", session=session)
     processed_entity["dados_avancados"] = advanced_data
     processed_entity["metricas"]["timestamp"] = datetime.now().isoformat()
     return processed_entity
 
-async def collect_full_data() -> Dict[str, List[Dict]]:
+async def collect_entities_complete_data(entities: List[Dict], session: Optional[aiohttp.ClientSession] = None, semaphore: Optional[asyncio.Semaphore] = None,
+                                         ao_concluir: Optional[Callable[[Dict], None]] = None) -> List[Dict]:
+    """
+    Coleta os dados completos de uma lista de entidades (summaries em lote + dados avançados),
+    em lotes de BATCH_SIZE. Resultados inválidos (sem GUID ou domínio) são descartados.
+    ``ao_concluir`` é chamado com cada entidade válida assim que o lote dela termina.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(get_concurrency_controller_atual().max_limit)
+
+    # Summaries (apmSummary, browserSummary, ...) em lote: N/SUMMARY_BATCH_SIZE requisições
+    summaries = await get_entities_summaries([e.get("guid") for e in entities if e.get("guid")], session=session)
+
+    # Métricas por período em lote (FACET + TIMESERIES); com o agregador incremental, cada ciclo
+    # só consulta os buckets novos em vez das janelas inteiras de 24h/7d/30d
+    metricas_periodo = {}
+    if any(dominio_suportado(e.get("domain")) for e in entities):
+        engine = NRQLBatchEngine(lambda nrql: execute_nrql_query(nrql, session=session), PERIODOS, agregador=get_default_aggregator())
+        metricas_periodo = await engine.coletar(entities)
+
+    collected = []
+    for i in range(0, len(entities), BATCH_SIZE):
+        batch = entities[i:i + BATCH_SIZE]
+        lote = i // BATCH_SIZE + 1
+        log_info(f"Processando lote {lote}, {len(batch)} entidades ({i + 1}-{i + len(batch)})")
+
+        batch_tasks = [
+            collect_entity_complete_data(e, session=session, semaphore=semaphore, summary=summaries.get(e.get("guid")), metricas_periodo=metricas_periodo.get(e.get("guid")))
+            for e in batch
+        ]
+        batch_results = await asyncio.gather(*batch_tasks, return_exceptions=True)
+
+        for idx, res in enumerate(batch_results):
+            if isinstance(res, Exception):
+                log_error(f"Erro no processamento de entidade no lote {lote}, índice {idx}: {str(res)}")
+                continue
+            if not isinstance(res, dict):
+                log_warning(f"Resultado inesperado no lote {lote}, índice {idx}: {type(res)}")
+                continue
+            if not res.get("guid"):
+                log_warning(f"Entidade sem GUID no lote {lote}, índice {idx}: {res}")
+                continue
+            if not res.get("domain"):
+                log_warning(f"Entidade sem domínio no lote {lote}, índice {idx}: {res}")
+                continue
+            collected.append(res)
+            if ao_concluir is not None:
+                ao_concluir(res)
+    return collected
+
+async def collect_global_data(session: Optional[aiohttp.ClientSession] = None) -> Dict[str, Any]:
+    """
+    Coleta os dados globais do sistema (não ligados a uma entidade): status de transações,
+    amostras de logs, incidentes, TransactionError e ErrorTrace.
+    """
+    result = {}
+    global_nrql = """
+    SELECT count(*) FROM Transaction SINCE 1 hour ago COMPARE WITH 1 day ago
+    """
+    global_result = await execute_nrql_query(global_nrql, session=session)
+    if global_result and "results" in global_result:
+        result["status_global"] = global_result["results"]
+
+    # Coletar logs globais reais via NRQL
+    try:
+        logs_nrql = "SELECT * FROM Log SINCE 24 HOURS AGO LIMIT 100"
+        logs_result = await execute_nrql_query(logs_nrql, session=session)
+        logs_sample = logs_result.get("results", [])
+        if not logs_sample:
+            log_warning(f"Nenhum log real retornado pela query NRQL: {logs_nrql}")
+        result["logs"] = {"sample": logs_sample}
+    except Exception as e:
+        log_error(f"Erro ao coletar logs reais via NRQL '{logs_nrql}': {e}")
+        result["logs"] = {"sample": []}
+
+    # Coletar incidentes reais via NRQL
+    try:
+        incidents_nrql = "SELECT * FROM NrAiIncident SINCE 24 HOURS AGO LIMIT 100"
+        incidents_result = await execute_nrql_query(incidents_nrql, session=session)
+        incidents_sample = incidents_result.get("results", [])
+        if not incidents_sample:
+            log_warning(f"Nenhum incidente real retornado pela query NRQL: {incidents_nrql}")
+        result["incidentes"] = {"sample": incidents_sample}
+    except Exception as e:
+        log_error(f"Erro ao coletar incidentes reais via NRQL '{incidents_nrql}': {e}")
+        result["incidentes"] = {"sample": []}
+
+    # Coletar erros de transação reais via NRQL
+    try:
+        txerror_nrql = "SELECT * FROM TransactionError SINCE 24 HOURS AGO LIMIT 100"
+        txerror_result = await execute_nrql_query(txerror_nrql, session=session)
+        txerror_sample = txerror_result.get("results", [])
+        if not txerror_sample:
+            log_warning(f"Nenhum TransactionError real retornado pela query NRQL: {txerror_nrql}")
+        result["transaction_errors"] = {"sample": txerror_sample}
+    except Exception as e:
+        log_error(f"Erro ao coletar TransactionError reais via NRQL '{txerror_nrql}': {e}")
+        result["transaction_errors"] = {"sample": []}
+
+    # Coletar erros de aplicação reais via NRQL
+    try:
+        errtrace_nrql = "SELECT * FROM ErrorTrace SINCE 24 HOURS AGO LIMIT 100"
+        errtrace_result = await execute_nrql_query(errtrace_nrql, session=session)
+        errtrace_sample = errtrace_result.get("results", [])
+        if not errtrace_sample:
+            log_warning(f"Nenhum ErrorTrace real retornado pela query NRQL: {errtrace_nrql}")
+        result["error_traces"] = {"sample": errtrace_sample}
+    except Exception as e:
+        log_error(f"Erro ao coletar ErrorTrace reais via NRQL '{errtrace_nrql}': {e}")
+        result["error_traces"] = {"sample": []}
+    return result
+
+async def collect_full_data(ao_coletar: Optional[Callable[[Dict], None]] = None) -> Dict[str, List[Dict]]:
     """
     Coleta completa de dados do New Relic.
     
+    Args:
+        ao_coletar: chamada com cada entidade assim que ela entra no resultado (inclusive as
+            retomadas do checkpoint), para gravação em stream. Com ela, as entidades ficam só
+            com quem a passou: o resultado traz ``entidades`` vazia e apenas as contagens
+    
     Returns:
         Dicionário com entidades por domínio
     """
+    journal = None
     try:
-        connector = TCPConnector(force_close=True)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            # 1. Obtém todas as entidades do New Relic
-            log_info("Iniciando coleta avançada de dados do New Relic...")
-            entities = await get_all_entities(session=session)
-
-            # Estrutura para armazenar resultado (entidades por domínio)
-            result = {}
-            all_entities = []
-
-            # 2. Para cada entidade, coleta dados completos em lotes para evitar sobrecarga
-            total = len(entities)
-            log_info(f"Coletando dados completos para {total} entidades...")
-
-
-            # Limite global de concorrência para evitar sobrecarga
-            max_concurrent = 10
-            semaphore = asyncio.Semaphore(max_concurrent)
-            for i in range(0, total, BATCH_SIZE):
-                batch = entities[i:i + BATCH_SIZE]
-                # TODO: Futuramente, padronizar todos os logs para usar log_info do utilitário centralizado
-                # logger.info pode ser substituído por log_info para unificação completa do logging
-                log_info(f"Processando lote {i//BATCH_SIZE + 1}/{(total+BATCH_SIZE-1)//BATCH_SIZE}, "
-                         f"{len(batch)} entidades ({i+1}-{min(i+BATCH_SIZE, total)}/{total})")
-
-                batch_tasks = [collect_entity_complete_data(e, session=session, semaphore=semaphore) for e in batch]
-                batch_results = await asyncio.gather(*batch_tasks, return_exceptions=True)
-
-                for idx, res in enumerate(batch_results):
-                    if isinstance(res, Exception):
-                        log_error(f"Erro no processamento de entidade no lote {i//BATCH_SIZE + 1}, índice {idx}: {str(res)}")
-                        continue
-                    if not isinstance(res, dict):
-                        log_warning(f"Resultado inesperado no lote {i//BATCH_SIZE + 1}, índice {idx}: {type(res)}")
-                        continue
-                    if not res.get("guid"):
-                        log_warning(f"Entidade sem GUID no lote {i//BATCH_SIZE + 1}, índice {idx}: {res}")
-                        continue
-                    if not res.get("domain"):
-                        log_warning(f"Entidade sem domínio no lote {i//BATCH_SIZE + 1}, índice {idx}: {res}")
-                        continue
-                    all_entities.append(res)
-                    domain = res.get("domain", "UNKNOWN")
-                    if domain not in result:
-                        result[domain] = []
-                    result[domain].append(res)
-
-            # Adiciona lista completa de entidades ao resultado
-            result["entidades"] = all_entities
-
-            # 3. Coleta dados globais do sistema
-            global_nrql = """
-            SELECT count(*) FROM Transaction SINCE 1 hour ago COMPARE WITH 1 day ago
-            """
-            global_result = await execute_nrql_query(global_nrql, session=session)
-            if global_result and "results" in global_result:
-                result["status_global"] = global_result["results"]
+        # Pool HTTP compartilhado do processo (keep-alive entre as milhares de consultas)
+        session = get_shared_session()
+        # 1. Entidades do New Relic chegam em stream (página a página, com prefetch do cursor):
+        #    a coleta de uma página se sobrepõe à busca da seguinte
+        log_info("Iniciando coleta avançada de dados do New Relic...")
 
+        # Estrutura para armazenar resultado (entidades por domínio)
+        result = {}
+        all_entities = []
+        dominios = {}
 
-            # 4. Coletar logs globais reais via NRQL
-            try:
-                logs_nrql = "SELECT * FROM Log SINCE 24 HOURS AGO LIMIT 100"
-                logs_result = await execute_nrql_query(logs_nrql, session=session)
-                logs_sample = logs_result.get("results", [])
-                if not logs_sample:
-                    log_warning(f"Nenhum log real retornado pela query NRQL: {logs_nrql}")
-                result["logs"] = {"sample": logs_sample}
-            except Exception as e:
-                log_error(f"Erro ao coletar logs reais via NRQL '{logs_nrql}': {e}")
-                result["logs"] = {"sample": []}
-
-            # 5. Coletar incidentes reais via NRQL
-            try:
-                incidents_nrql = "SELECT * FROM NrAiIncident SINCE 24 HOURS AGO LIMIT 100"
-                incidents_result = await execute_nrql_query(incidents_nrql, session=session)
-                incidents_sample = incidents_result.get("results", [])
-                if not incidents_sample:
-                    log_warning(f"Nenhum incidente real retornado pela query NRQL: {incidents_nrql}")
-                result["incidentes"] = {"sample": incidents_sample}
-            except Exception as e:
-                log_error(f"Erro ao coletar incidentes reais via NRQL '{incidents_nrql}': {e}")
-                result["incidentes"] = {"sample": []}
-
-            # 6. Coletar erros de transação reais via NRQL
-            try:
-                txerror_nrql = "SELECT * FROM TransactionError SINCE 24 HOURS AGO LIMIT 100"
-                txerror_result = await execute_nrql_query(txerror_nrql, session=session)
-                txerror_sample = txerror_result.get("results", [])
-                if not txerror_sample:
-                    log_warning(f"Nenhum TransactionError real retornado pela query NRQL: {txerror_nrql}")
-                result["transaction_errors"] = {"sample": txerror_sample}
-            except Exception as e:
-                log_error(f"Erro ao coletar TransactionError reais via NRQL '{txerror_nrql}': {e}")
-                result["transaction_errors"] = {"sample": []}
-
-            # 7. Coletar erros de aplicação reais via NRQL
+        def adicionar(res):
+            dominio = res.get("domain", "UNKNOWN")
+            dominios[dominio] = dominios.get(dominio, 0) + 1
+            if ao_coletar:
+                ao_coletar(res)
+            else:
+                all_entities.append(res)
+                result.setdefault(dominio, []).append(res)
+
+        # Journal de checkpoint: cada entidade concluída vai para o disco na hora, e uma coleta
+        # reiniciada pula os GUIDs já concluídos e continua do último cursor registrado
+        journal = CollectionJournal(caminho_por_conta(CHECKPOINT_FILE), em_segundo_plano=True) if CHECKPOINT_ENABLED else None
+        retomada = await journal.retomar_async() if journal else None
+        # Só os GUIDs: as entidades concluídas já foram entregues a adicionar
+        concluidas = set()
+        if retomada:
+            for guid, res in retomada.concluidas.items():
+                concluidas.add(guid)
+                adicionar(res)
+            retomada.concluidas.clear()
+
+        def ao_concluir(res):
+            concluidas.add(res["guid"])
+            if journal:
+                journal.registrar_entidade(res)
+
+        # Entidades em andamento limitadas ao teto do controle adaptativo de concorrência (AIMD),
+        # que regula as requisições de fato conforme latência, erros e 429
+        max_concurrent = get_concurrency_controller_atual().max_limit
+        semaphore = asyncio.Semaphore(max_concurrent)
+
+        # 2. Para cada página, coleta dados completos em lotes para evitar sobrecarga
+        async def percorrer(cursor, posicao):
+            """
+            Percorre a listagem a partir de ``cursor`` e retorna quantas páginas concluiu. Uma
+            página com erro interrompe a coleta (ErroDePagina), exceto a primeira de uma
+            retomada: o cursor do checkpoint expirou e a função retorna 0 sem registrar nada.
+            """
+            paginas = 0
             try:
-                errtrace_nrql = "SELECT * FROM ErrorTrace SINCE 24 HOURS AGO LIMIT 100"
-                errtrace_result = await execute_nrql_query(errtrace_nrql, session=session)
-                errtrace_sample = errtrace_result.get("results", [])
-                if not errtrace_sample:
-                    log_warning(f"Nenhum ErrorTrace real retornado pela query NRQL: {errtrace_nrql}")
-                result["error_traces"] = {"sample": errtrace_sample}
-            except Exception as e:
-                log_error(f"Erro ao coletar ErrorTrace reais via NRQL '{errtrace_nrql}': {e}")
-                result["error_traces"] = {"sample": []}
-
-            # 8. Dashboards e alertas podem ser mantidos via GraphQL apenas para metadados, não eventos
-            result["dashboards"] = {"list": []}
-            result["alertas"] = {"policies": []}
-
-            # Adiciona timestamp ao resultado final
-            result["timestamp"] = datetime.now().isoformat()
-            result["total_entidades"] = len(all_entities)
-
-            # Adiciona estatísticas sobre a coleta
-            dominios = {}
-            for e in all_entities:
-                dominio = e.get("domain", "UNKNOWN")
-                dominios[dominio] = dominios.get(dominio, 0) + 1
-
-            result["contagem_por_dominio"] = dominios
-            log_info(f"Coleta completa finalizada. {len(all_entities)} entidades processadas.")
-            log_info(f"Distribuição por domínio: {dominios}")
-
-            return result
+                async for page, proximo_cursor in iter_entity_pages(session=session, cursor=cursor, com_cursor=True):
+                    if cursor is not None and not paginas and not page:
+                        return 0  # cursor expirado sem erro: não marca a listagem como concluída
+                    posicao += len(page)
+                    pendentes = [e for e in page if e.get("guid") not in concluidas]
+                    log_info(f"Página com {len(page)} entidades recebida ({posicao} até agora, {len(pendentes)} a coletar). Coletando dados completos...")
+                    if pendentes:
+                        for res in await collect_entities_complete_data(pendentes, session=session, semaphore=semaphore, ao_concluir=ao_concluir):
+                            adicionar(res)
+                    if journal:
+                        journal.registrar_pagina(proximo_cursor, posicao)
+                        await journal.aguardar()
+                    paginas += 1
+            except ErroDePagina:
+                if cursor is None or paginas:
+                    raise
+                return 0
+            return paginas
+
+        if retomada and retomada.cursor:
+            log_info(f"Retomando listagem do checkpoint (posição {retomada.posicao}, {len(concluidas)} entidades já coletadas)")
+            if not await percorrer(retomada.cursor, retomada.posicao):
+                # Cursor expirado: relista do início, ainda pulando os GUIDs concluídos
+                log_warning("Cursor do checkpoint rejeitado ou sem páginas, relistando do início")
+                await percorrer(None, 0)
+        elif not (retomada and retomada.listagem_concluida):
+            await percorrer(None, 0)
+
+        # Adiciona lista completa de entidades ao resultado
+        result["entidades"] = all_entities
+
+        # 3-7. Dados globais do sistema (status, logs, incidentes e erros)
+        result.update(await collect_global_data(session))
+
+        # 8. Dashboards e alertas podem ser mantidos via GraphQL apenas para metadados, não eventos
+        result["dashboards"] = {"list": []}
+        result["alertas"] = {"policies": []}
+
+        # Adiciona timestamp ao resultado final
+        result["timestamp"] = datetime.now().isoformat()
+        result["total_entidades"] = sum(dominios.values())
+
+        # Adiciona estatísticas sobre a coleta
+        result["contagem_por_dominio"] = dominios
+        log_info(f"Coleta completa finalizada. {result['total_entidades']} entidades processadas.")
+        log_info(f"Distribuição por domínio: {dominios}")
+
+        if journal:
+            journal.concluir()
+            await journal.aguardar()
+        return result
     except Exception as e:
         log_error(f"Erro na coleta completa: {str(e)}")
+        if journal:
+            # Mantém o journal para a próxima execução retomar daqui
+            journal.fechar()
+            try:
+                await journal.aguardar()
+            except Exception as erro_journal:
+                log_warning(f"Erro ao fechar o journal de coleta: {erro_journal}")
         return {"erro": str(e), "timestamp": datetime.now().isoformat()}
 
+async def collect_all_accounts(contas: Optional[List[ContaNewRelic]] = None,
+                               ao_coletar: Optional[Callable[[Dict], None]] = None) -> Dict[str, Any]:
+    """
+    Coleta completa de todas as contas configuradas (``utils.newrelic_accounts``) em paralelo,
+    cada uma com suas credenciais, rate limiter, orçamento de concorrência e checkpoint.
+    Sem configuração multi-conta, é o mesmo que collect_full_data.
+
+    O resultado tem o formato de collect_full_data com as entidades de todas as contas (cada
+    uma marcada com ``conta``) e os dados globais de cada conta em ``contas[nome]``. Na raiz
+    ficam, por compatibilidade, os dados globais da primeira conta coletada com sucesso.
+    """
+    contas = get_contas() if contas is None else contas
+    if not contas:
+        return await collect_full_data(ao_coletar=ao_coletar)
+
+    async def coletar(conta: ContaNewRelic):
+        def marcar(entidade):
+            entidade["conta"] = conta.nome
+            if ao_coletar:
+                ao_coletar(entidade)
+        with usar_conta(conta):
+            return await collect_full_data(ao_coletar=marcar)
+
+    log_info(f"Coletando {len(contas)} contas New Relic em paralelo: {[c.nome for c in contas]}")
+    parciais = await asyncio.gather(*(coletar(c) for c in contas))
+
+    result: Dict[str, Any] = {"entidades": [], "contas": {}}
+    falhas = {}
+    for conta, parcial in zip(contas, parciais):
+        if "erro" in parcial:
+            log_error(f"Coleta da conta {conta.nome} falhou: {parcial['erro']}")
+            falhas[conta.nome] = parcial["erro"]
+            continue
+        entidades = parcial.pop("entidades", [])
+        for dominio in parcial.get("contagem_por_dominio", {}):
+            parcial.pop(dominio, None)
+        result["entidades"].extend(entidades)
+        result["contas"][conta.nome] = dict(parcial, account_id=conta.account_id)
+    if not result["contas"]:
+        return {"erro": "; ".join(f"{nome}: {erro}" for nome, erro in falhas.items()), "timestamp": datetime.now().isoformat()}
+
+    primeira = next(iter(result["contas"].values()))
+    for chave, valor in primeira.items():
+        if chave not in ("account_id", "total_entidades", "contagem_por_dominio"):
+            result.setdefault(chave, valor)
+    dominios = {}
+    for e in result["entidades"]:
+        result.setdefault(e.get("domain", "UNKNOWN"), []).append(e)
+    # Com ao_coletar as entidades não voltam no resultado: a contagem vem de cada conta
+    for parcial in result["contas"].values():
+        for dominio, quantidade in (parcial.get("contagem_por_dominio") or {}).items():
+            dominios[dominio] = dominios.get(dominio, 0) + quantidade
+    result["contagem_por_dominio"] = dominios
+    result["total_entidades"] = sum(dominios.values())
+    result["timestamp"] = datetime.now().isoformat()
+    if falhas:
+        result["contas_com_falha"] = falhas
+    log_info(f"Coleta multi-conta finalizada: {result['total_entidades']} entidades de {len(result['contas'])} contas")
+    return result
+
+async def collect_entities_by_account(entities: List[Dict], session: Optional[aiohttp.ClientSession] = None,
+                                      contas: Optional[List[ContaNewRelic]] = None) -> List[Dict]:
+    """
+    collect_entities_complete_data com cada entidade recoletada na conta dela (campo ``conta``
+    gravado pela coleta multi-conta); as contas rodam em paralelo.
+    """
+    contas = get_contas() if contas is None else contas
+    if not contas:
+        return await collect_entities_complete_data(entities, session=session)
+    por_nome = {c.nome: c for c in contas}
+    grupos: Dict[Optional[str], List[Dict]] = {}
+    for entidade in entities:
+        grupos.setdefault(entidade.get("conta"), []).append(entidade)
+
+    async def coletar(nome, grupo):
+        with usar_conta(por_nome.get(nome)):
+            resultados = await collect_entities_complete_data(grupo, session=session)
+        if nome:
+            for res in resultados:
+                res["conta"] = nome
+        return resultados
+
+    partes = await asyncio.gather(*(coletar(nome, grupo) for nome, grupo in grupos.items()))
+    return [res for parte in partes for res in parte]
+
+async def execute_nrql_all_accounts(nrql: str, session: Optional[aiohttp.ClientSession] = None,
+                                    contas: Optional[List[ContaNewRelic]] = None) -> List[Dict]:
+    """Linhas de uma NRQL executada em todas as contas (ou só na conta padrão, sem multi-conta)."""
+    contas = get_contas() if contas is None else contas
+    if not contas:
+        return extrair_resultados_nrql(await execute_nrql_query(nrql, session=session))
+
+    async def executar(conta):
+        with usar_conta(conta):
+            return extrair_resultados_nrql(await execute_nrql_query(nrql, session=session))
+
+    partes = await asyncio.gather(*(executar(c) for c in contas))
+    return [linha for parte in partes for linha in parte]
+
 # Função principal para testar o coletor
 async def test_collector():
     """Função para testar o coletor avançado"""
@@ -733,8 +1182,8 @@ async def test_collector():
         log_info("Testando coletor avançado do New Relic...")
         
         # 1. Testa obtenção de entidades
-        async with aiohttp.ClientSession() as session:
-            entities = await get_all_entities(session=session)
+        session = get_shared_session()
+        entities = await get_all_entities(session=session)
         log_info(f"Obtidas {len(entities)} entidades")
         
         # 2. Testa coleta para uma entidade APM (se existir)
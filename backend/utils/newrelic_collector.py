@@ -13,8 +13,19 @@ import traceback
 from utils.newrelic_common import (
     execute_nrql_query_common,
     execute_graphql_query_common,
+    get_shared_session,
+    carregar_credenciais,
+    nr_graphql_url,
     log_info, log_warning, log_error
 )
+from utils.nrql_batch import NRQLBatchEngine, dominio_suportado
+from utils.rate_limiter import ENDPOINT_GRAPHQL
+from utils.task_graph import TaskGraph
+from utils.nrql_cache import get_query_cache
+from utils.single_flight import get_single_flight
+from utils.entity_pager import iter_pages
+from utils.incremental_aggregator import get_default_aggregator, get_incremental_aggregator
+from utils.newrelic_accounts import get_concurrency_controller_atual, get_rate_limiter_atual
 
 load_dotenv()
 
@@ -27,9 +38,7 @@ handler.setFormatter(formatter)
 if not logger.hasHandlers():
     logger.addHandler(handler)
 
-NEW_RELIC_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-NEW_RELIC_QUERY_KEY = os.getenv("NEW_RELIC_QUERY_KEY")
-NEW_RELIC_ACCOUNT_ID = os.getenv("NEW_RELIC_ACCOUNT_ID")
+NEW_RELIC_API_KEY, NEW_RELIC_QUERY_KEY, NEW_RELIC_ACCOUNT_ID = carregar_credenciais()
 
 # Configurações de timeout ajustadas para prevenir bloqueios no frontend
 # Valor em segundos (30 segundos é um bom equilíbrio entre tempo de espera e prevenção de erros)
@@ -70,7 +79,6 @@ class RateLimitController:
         self.rate_limit_reset_time = 0
         self.consecutive_failures = 0
         self.max_failures = 10
-        self.min_delay = 1.0  # 1 segundo mínimo entre requests
         self.max_delay = 300.0  # 5 minutos máximo
         self.base_backoff = 2.0
         
@@ -93,15 +101,26 @@ class RateLimitController:
             return True
         return False
         
-    async def wait_if_needed(self):
-        """Implementa rate limiting inteligente com circuit breaker e backoff adaptativo"""
+    async def wait_if_needed(self, endpoint: str = ENDPOINT_GRAPHQL):
+        """Aplica circuit breaker e backoff adaptativo; o ritmo das requisições vem do token bucket da conta"""
+        await self.check_circuit()
+        
+        # Limite de taxa da conta em coleta (token bucket por endpoint, respeita Retry-After)
+        await get_rate_limiter_atual().acquire(endpoint)
+            
+        self.last_request_time = time.time()
+        self.request_count += 1
+    
+    async def check_circuit(self):
+        """
+        Circuit breaker e backoff adaptativo, sem consumir token: para requisições que passam
+        pelo caminho comum (newrelic_common), que já consome um token por tentativa
+        """
         # Circuit breaker: se está aberto, bloqueia a requisição
         if self.is_circuit_open():
             logger.warning(f"Circuit breaker OPEN - Bloqueando requisição. Tempo restante: {self.circuit_timeout - (time.time() - self.circuit_opened_at):.1f}s")
             raise Exception("Circuit breaker OPEN - New Relic API temporariamente indisponível")
         
-        current_time = time.time()
-        
         # Se tivemos muitas falhas consecutivas, aumenta o delay base
         if self.consecutive_failures > 3:
             delay = min(self.base_backoff ** min(self.consecutive_failures, 8), self.max_delay)
@@ -109,14 +128,6 @@ class RateLimitController:
             jitter = delay * 0.1 * random.random()
             logger.info(f"Backoff adaptativo: {delay:.2f}s + {jitter:.2f}s jitter ({self.consecutive_failures} falhas consecutivas)")
             await asyncio.sleep(delay + jitter)
-        
-        # Delay mínimo entre requests para evitar sobrecarga
-        elif current_time - self.last_request_time < self.min_delay:
-            wait_time = self.min_delay - (current_time - self.last_request_time)
-            await asyncio.sleep(wait_time)
-            
-        self.last_request_time = time.time()
-        self.request_count += 1
     
     def record_failure(self, is_rate_limit=False):
         """Registra uma falha no controlador, potencialmente ativando circuit breaker"""
@@ -241,9 +252,6 @@ class NewRelicCollector:
             }}
             """
             
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            
             # Função auxiliar para categorizar e processar dependências
             def process_entity_for_dependency(entity_data, direction):
                 if not entity_data or not entity_data.get('guid'):
@@ -269,61 +277,49 @@ class NewRelicCollector:
                     dependencies[direction]['outros'].append(dependency)
                     return 'outros'
             
+            # Uma requisição por direção, cada uma com seu token e sua vaga no limite adaptativo
+            upstream_data, downstream_data = await asyncio.gather(
+                self.make_graphql_request(upstream_query, timeout=30),
+                self.make_graphql_request(downstream_query, timeout=30)
+            )
+            
             # Coletar dependências upstream
-            try:
+            if "error" in upstream_data:
+                logger.warning(f"Erro ao coletar dependências upstream para entidade {guid}: {upstream_data['error']}")
+            else:
                 upstream_count = 0
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                    async with session.post(self.base_url, headers=headers, json={"query": upstream_query}) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            upstream_relationships = data.get("data", {}).get("actor", {}).get("entity", {}).get("upstreamRelationships", [])
-                            
-                            if upstream_relationships:
-                                for rel in upstream_relationships:
-                                    # Em upstream, olhamos para o source (quem fornece recursos para nossa entidade)
-                                    source = rel.get('source', {})
-                                    if source and process_entity_for_dependency(source, 'upstream'):
-                                        upstream_count += 1
-                                
-                                logger.info(f"Encontradas {upstream_count} dependências upstream para entidade {guid}")
-                                dependencies["metadata"]["total_upstream"] = upstream_count
-                            else:
-                                logger.info(f"Nenhuma dependência upstream encontrada para entidade {guid}")
-                        else:
-                            error_response = await response.text()
-                            logger.warning(f"Erro ao coletar dependências upstream. Status: {response.status}. Resposta: {error_response[:200]}")
-            except aiohttp.ClientError as e:
-                logger.warning(f"Erro de conexão ao coletar dependências upstream para entidade {guid}: {e}")
-            except Exception as e:
-                logger.error(f"Erro ao processar dependências upstream: {e}")
+                upstream_relationships = (upstream_data.get("data") or {}).get("actor", {}).get("entity", {}).get("upstreamRelationships", [])
+                
+                if upstream_relationships:
+                    for rel in upstream_relationships:
+                        # Em upstream, olhamos para o source (quem fornece recursos para nossa entidade)
+                        source = rel.get('source', {})
+                        if source and process_entity_for_dependency(source, 'upstream'):
+                            upstream_count += 1
+                    
+                    logger.info(f"Encontradas {upstream_count} dependências upstream para entidade {guid}")
+                    dependencies["metadata"]["total_upstream"] = upstream_count
+                else:
+                    logger.info(f"Nenhuma dependência upstream encontrada para entidade {guid}")
             
             # Coletar dependências downstream
-            try:
+            if "error" in downstream_data:
+                logger.warning(f"Erro ao coletar dependências downstream para entidade {guid}: {downstream_data['error']}")
+            else:
                 downstream_count = 0
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                    async with session.post(self.base_url, headers=headers, json={"query": downstream_query}) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            downstream_relationships = data.get("data", {}).get("actor", {}).get("entity", {}).get("downstreamRelationships", [])
-                            
-                            if downstream_relationships:
-                                for rel in downstream_relationships:
-                                    # Em downstream, olhamos para o target (quem consome recursos da nossa entidade)
-                                    target = rel.get('target', {})
-                                    if target and process_entity_for_dependency(target, 'downstream'):
-                                        downstream_count += 1
-                                
-                                logger.info(f"Encontradas {downstream_count} dependências downstream para entidade {guid}")
-                                dependencies["metadata"]["total_downstream"] = downstream_count
-                            else:
-                                logger.info(f"Nenhuma dependência downstream encontrada para entidade {guid}")
-                        else:
-                            error_response = await response.text()
-                            logger.warning(f"Erro ao coletar dependências downstream. Status: {response.status}. Resposta: {error_response[:200]}")
-            except aiohttp.ClientError as e:
-                logger.warning(f"Erro de conexão ao coletar dependências downstream para entidade {guid}: {e}")
-            except Exception as e:
-                logger.error(f"Erro ao processar dependências downstream: {e}")
+                downstream_relationships = (downstream_data.get("data") or {}).get("actor", {}).get("entity", {}).get("downstreamRelationships", [])
+                
+                if downstream_relationships:
+                    for rel in downstream_relationships:
+                        # Em downstream, olhamos para o target (quem consome recursos da nossa entidade)
+                        target = rel.get('target', {})
+                        if target and process_entity_for_dependency(target, 'downstream'):
+                            downstream_count += 1
+                    
+                    logger.info(f"Encontradas {downstream_count} dependências downstream para entidade {guid}")
+                    dependencies["metadata"]["total_downstream"] = downstream_count
+                else:
+                    logger.info(f"Nenhuma dependência downstream encontrada para entidade {guid}")
             
             # Limpar categorias vazias
             total_deps = 0
@@ -564,16 +560,11 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        entity = data.get("data", {}).get("actor", {}).get("entity", {})
-                        return entity
-                    else:
-                        return {}
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return {}
+            entity = data.get("data", {}).get("actor", {}).get("entity", {})
+            return entity
         except Exception as e:
             logger.warning(f"Erro ao coletar health status para entidade {guid}: {e}")
             return {}
@@ -652,12 +643,13 @@ class NewRelicCollector:
             logger.warning(f"Erro ao coletar user experience para entidade {guid}: {e}")
             return {}
 
-    async def analyze_logs_for_patterns(self, guid):
+    async def analyze_logs_for_patterns(self, guid, logs=None):
         """
         Analisa logs/eventos customizados para padrões, clusters, sentimentos
         """
         try:
-            logs = await self.collect_entity_logs(guid)
+            if logs is None:
+                logs = await self.collect_entity_logs(guid)
             # Exemplo simples: clusterizar por mensagem de erro
             clusters = {}
             for log in logs:
@@ -683,12 +675,13 @@ class NewRelicCollector:
             logger.warning(f"Erro ao coletar owners/squad/team: {e}")
             return {}
 
-    async def build_entity_topology(self, guid):
+    async def build_entity_topology(self, guid, rels=None):
         """
         Constrói grafo/topologia de dependências da entidade
         """
         try:
-            rels = await self.collect_entity_related_entities(guid)
+            if rels is None:
+                rels = await self.collect_entity_related_entities(guid)
             nodes = set()
             edges = []
             for rel in rels:
@@ -796,16 +789,11 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        rels = data.get("data", {}).get("actor", {}).get("entity", {}).get("relationships", [])
-                        return rels or []
-                    else:
-                        return []
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return []
+            rels = data.get("data", {}).get("actor", {}).get("entity", {}).get("relationships", [])
+            return rels or []
         except Exception as e:
             logger.warning(f"Erro ao coletar entidades relacionadas para {guid}: {e}")
             return []
@@ -868,20 +856,15 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        entity = data.get("data", {}).get("actor", {}).get("entity", {})
-                        return {
-                            "alertSeverity": entity.get("alertSeverity"),
-                            "alertViolationsOpen": entity.get("alertViolationsOpen", []),
-                            "alertViolationsClosed": entity.get("alertViolationsClosed", [])
-                        }
-                    else:
-                        return {}
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return {}
+            entity = data.get("data", {}).get("actor", {}).get("entity", {})
+            return {
+                "alertSeverity": entity.get("alertSeverity"),
+                "alertViolationsOpen": entity.get("alertViolationsOpen", []),
+                "alertViolationsClosed": entity.get("alertViolationsClosed", [])
+            }
         except Exception as e:
             logger.warning(f"Erro ao coletar alert policies para entidade {guid}: {e}")
             return {}
@@ -908,16 +891,11 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        dashboards = data.get("data", {}).get("actor", {}).get("dashboardsSearch", {}).get("dashboards", [])
-                        return dashboards or []
-                    else:
-                        return []
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return []
+            dashboards = data.get("data", {}).get("actor", {}).get("dashboardsSearch", {}).get("dashboards", [])
+            return dashboards or []
         except Exception as e:
             logger.warning(f"Erro ao coletar dashboards para entidade {guid}: {e}")
             return []
@@ -985,16 +963,11 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        workloads = data.get("data", {}).get("actor", {}).get("entity", {}).get("workloads", {}).get("entities", [])
-                        return workloads or []
-                    else:
-                        return []
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return []
+            workloads = data.get("data", {}).get("actor", {}).get("entity", {}).get("workloads", {}).get("entities", [])
+            return workloads or []
         except Exception as e:
             logger.warning(f"Erro ao coletar workloads para entidade {guid}: {e}")
             return []
@@ -1008,7 +981,7 @@ class NewRelicCollector:
               actor {{
                 entity(guid: \"{guid}\") {{
                   alerts {{
-                    violations(filter: {state: OPEN}) {{
+                    violations(filter: {{state: OPEN}}) {{
                       id
                       label
                       level
@@ -1024,16 +997,11 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        violations = data.get("data", {}).get("actor", {}).get("entity", {}).get("alerts", {}).get("violations", [])
-                        return violations or []
-                    else:
-                        return []
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return []
+            violations = data.get("data", {}).get("actor", {}).get("entity", {}).get("alerts", {}).get("violations", [])
+            return violations or []
         except Exception as e:
             logger.warning(f"Erro ao coletar alertas para entidade {guid}: {e}")
             return []
@@ -1062,16 +1030,11 @@ class NewRelicCollector:
               }}
             }}
             """
-            headers = {'Api-Key': self.api_key, 'Content-Type': 'application/json'}
-            await self.rate_controller.wait_if_needed()
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        deployments = data.get("data", {}).get("actor", {}).get("entity", {}).get("deployments", {}).get("deployments", [])
-                        return deployments or []
-                    else:
-                        return []
+            data = await self.make_graphql_request(query, timeout=30)
+            if "error" in data:
+                return []
+            deployments = data.get("data", {}).get("actor", {}).get("entity", {}).get("deployments", {}).get("deployments", [])
+            return deployments or []
         except Exception as e:
             logger.warning(f"Erro ao coletar deployments para entidade {guid}: {e}")
             return []
@@ -1083,7 +1046,7 @@ class NewRelicCollector:
         self.api_key = api_key
         self.query_key = query_key or NEW_RELIC_QUERY_KEY
         self.account_id = account_id
-        self.base_url = "https://api.newrelic.com/graphql"
+        self.base_url = nr_graphql_url()
         self.rate_controller = RateLimitController()
         self.last_successful_request = None
         
@@ -1116,84 +1079,127 @@ class NewRelicCollector:
             retry_delay=RETRY_DELAY
         )
     
-    async def collect_entities(self) -> List[Dict]:
+    async def make_graphql_request(self, query: str, variables: Optional[Dict] = None, timeout: float = DEFAULT_TIMEOUT) -> Dict:
         """
-        Coleta entidades do New Relic usando GraphQL
+        Executa query GraphQL pelo caminho comum (token por tentativa, vaga AIMD, retry, cache),
+        sob o circuit breaker do coletor.
         """
-        try:
-            # Query GraphQL para buscar entidades
-            graphql_query = f"""
-            {{
-              actor {{
-                entitySearch(query: "accountId = {self.account_id} AND domain IN ('APM','BROWSER','INFRA','DB','MOBILE','IOT','SERVERLESS','SYNTH','EXT')") {{
-                  results {{
-                    entities {{
-                      guid
-                      name
-                      domain
-                      entityType
-                      tags {{
-                        key
-                        values
-                      }}
-                      reporting
-                    }}
+        await self.rate_controller.check_circuit()
+        self.rate_controller.last_request_time = time.time()
+        self.rate_controller.request_count += 1
+        result = await execute_graphql_query_common(
+            query,
+            headers={'Api-Key': self.api_key, 'Content-Type': 'application/json'},
+            url=self.base_url,
+            variables=variables,
+            timeout=timeout,
+            max_retries=MAX_RETRIES,
+            retry_delay=RETRY_DELAY
+        )
+        if "error" in result:
+            self.rate_controller.record_failure()
+        else:
+            self.rate_controller.record_success()
+            self.last_successful_request = datetime.now().isoformat()
+        return result
+    
+    async def _fetch_entity_page(self, cursor: Optional[str] = None):
+        """
+        Busca uma página de entidades (entitySearch com cursor).
+        Retorna (entidades reportando, próximo cursor).
+        """
+        # Query GraphQL para buscar entidades
+        graphql_query = f"""
+        query EntitiesPage($cursor: String) {{
+          actor {{
+            entitySearch(query: "accountId = {self.account_id} AND domain IN ('APM','BROWSER','INFRA','DB','MOBILE','IOT','SERVERLESS','SYNTH','EXT')") {{
+              results(cursor: $cursor) {{
+                entities {{
+                  guid
+                  name
+                  domain
+                  entityType
+                  tags {{
+                    key
+                    values
                   }}
-                  count
+                  reporting
                 }}
+                nextCursor
               }}
+              count
             }}
-            """
-            
-            headers = {
-                'Api-Key': self.api_key,
-                'Content-Type': 'application/json'
-            }
-            
-            await self.rate_controller.wait_if_needed()
-            
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
-                async with session.post(self.base_url, headers=headers, json={"query": graphql_query}) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        
-                        if "errors" in data:
-                            errors = data["errors"]
-                            logger.error(f"Erro GraphQL ao coletar entidades: {errors}")
-                            self.rate_controller.record_failure()
-                            raise Exception(f"Erro GraphQL: {errors}")
-                        
-                        # Extrai entidades
-                        entities_data = data.get("data", {}).get("actor", {}).get("entitySearch", {})
-                        entities = entities_data.get("results", {}).get("entities", [])
-                        count = entities_data.get("count", 0)
-                        # Filtra entidades que não estão reportando
-                        entities = [e for e in entities if e.get("reporting")]
-                        logger.info(f"Coletadas {len(entities)} entidades reportando de {count} total")
-                        self.rate_controller.record_success()
-                        self.last_successful_request = datetime.now().isoformat()
-                        return entities
-                    
-                    elif response.status == 429:
-                        logger.error("Rate limit atingido ao coletar entidades")
-                        self.rate_controller.record_failure(is_rate_limit=True)
-                        raise Exception("Rate limit atingido")
-                    
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Erro HTTP {response.status} ao coletar entidades: {error_text[:500]}")
-                        self.rate_controller.record_failure()
-                        raise Exception(f"Erro HTTP {response.status}")
+          }}
+        }}
+        """
+        
+        await self.rate_controller.check_circuit()
+        
+        # Caminho comum: token por tentativa, vaga AIMD e retry (páginas por cursor não são cacheadas)
+        data = await execute_graphql_query_common(
+            graphql_query,
+            headers={'Api-Key': self.api_key, 'Content-Type': 'application/json'},
+            url=self.base_url,
+            variables={"cursor": cursor} if cursor else None,
+            timeout=60,
+            max_retries=MAX_RETRIES,
+            retry_delay=RETRY_DELAY
+        )
+        
+        if "error" in data:
+            logger.error(f"Erro HTTP ao coletar entidades: {data['error']}")
+            self.rate_controller.record_failure()
+            raise Exception(f"Erro ao coletar entidades: {data['error']}")
+        
+        if "errors" in data:
+            errors = data["errors"]
+            logger.error(f"Erro GraphQL ao coletar entidades: {errors}")
+            self.rate_controller.record_failure()
+            raise Exception(f"Erro GraphQL: {errors}")
+        
+        # Extrai entidades
+        entities_data = data.get("data", {}).get("actor", {}).get("entitySearch", {})
+        results = entities_data.get("results", {}) or {}
+        entities = results.get("entities", []) or []
+        count = entities_data.get("count", 0)
+        # Filtra entidades que não estão reportando
+        reporting = [e for e in entities if e.get("reporting")]
+        logger.info(f"Página de entidades: {len(reporting)} reportando de {len(entities)} (total na conta: {count})")
+        self.rate_controller.record_success()
+        self.last_successful_request = datetime.now().isoformat()
+        return reporting, results.get("nextCursor")
+    
+    async def iter_entity_pages(self):
+        """
+        Gera páginas de entidades reportando conforme chegam (paginação por cursor),
+        buscando a próxima página enquanto o chamador processa a atual.
+        """
+        async for page in iter_pages(self._fetch_entity_page):
+            yield page
+    
+    async def collect_entities(self) -> List[Dict]:
+        """
+        Coleta entidades do New Relic usando GraphQL (todas as páginas)
+        """
+        try:
+            entities = []
+            async for page in self.iter_entity_pages():
+                entities.extend(page)
+            logger.info(f"Coletadas {len(entities)} entidades reportando")
+            return entities
                         
         except Exception as e:
             logger.error(f"Erro ao coletar entidades: {e}")
             raise e
     
-    async def collect_entity_metrics(self, entity):
+    async def collect_entity_metrics(self, entity, metricas_em_lote: Optional[Dict] = None):
         """
         Coleta métricas para uma entidade específica com base no seu tipo
         Implementa estratégias específicas por domínio/tipo para maximizar dados úteis
         Ajustado para extrair o valor real das métricas essenciais.
+        Se ``metricas_em_lote`` for informado (já coletado via FACET), as queries por período são puladas.
+        As sub-coletas rodam como grafo de dependências (TaskGraph): as independentes em paralelo,
+        sob o rate limiter global, e as derivadas assim que seus insumos estiverem prontos.
         """
         try:
             guid = entity.get('guid')
@@ -1207,95 +1213,95 @@ class NewRelicCollector:
 
             logger.info(f"Coletando métricas para entidade: {name} ({domain}/{entity_type})")
 
-            # Coleta dashboards relacionados
-            dashboards = await self.collect_entity_dashboards(guid)
-            if dashboards:
-                entity['dashboards'] = dashboards
-            # Coleta monitores sintéticos
-            synthetics = await self.collect_entity_synthetics(guid)
-            if synthetics:
-                entity['synthetics'] = synthetics
-            # Coleta eventos customizados
-            custom_events = await self.collect_entity_custom_events(guid)
-            if custom_events:
-                entity['custom_events'] = custom_events
-            # Coleta eventos de integração
-            integration_events = await self.collect_entity_integration_events(guid)
-            if integration_events:
-                entity['integration_events'] = integration_events
-            # Coleta eventos de infraestrutura
-            infra_events = await self.collect_entity_infrastructure_events(guid)
-            if infra_events:
-                entity['infra_events'] = infra_events
-            # Coleta logs recentes
-            logs = await self.collect_entity_logs(guid)
-            if logs:
-                entity['logs'] = logs
-            # Coleta entidades relacionadas
-            related_entities = await self.collect_entity_related_entities(guid)
-            if related_entities:
-                entity['related_entities'] = related_entities
-            # Coleta dependências diretas
-            dependencies = await self.collect_entity_dependencies(guid)
-            if dependencies:
-                entity['dependencies'] = dependencies
-            # Coleta alert policies/conditions
-            alert_policies = await self.collect_entity_alert_policies(guid)
-            if alert_policies:
-                entity['alert_policies'] = alert_policies
-            # Coleta crashes mobile (Swift/iOS/Android)
-            mobile_crashes = await self.collect_entity_mobile_crashes(guid)
-            if mobile_crashes:
-                entity['mobile_crashes'] = mobile_crashes
-            # Coleta queries SQL recentes
-            db_queries = await self.collect_entity_db_queries(guid)
-            if db_queries:
-                entity['db_queries'] = db_queries
-            # Coleta atributos detalhados de transações
-            tx_attributes = await self.collect_entity_transaction_attributes(guid)
-            if tx_attributes:
-                entity['transaction_attributes'] = tx_attributes
-            # Coleta status de saúde
-            health_status = await self.collect_entity_health_status(guid)
-            if health_status:
-                entity['health_status'] = health_status
-            # Coleta séries temporais
-            time_series = await self.collect_entity_time_series(guid)
-            if time_series:
-                entity['time_series'] = time_series
-            # Coleta status de dependências externas
-            dependency_status = await self.collect_entity_dependency_status(guid)
-            if dependency_status:
-                entity['dependency_status'] = dependency_status
-            # Coleta experiência do usuário
-            user_experience = await self.collect_entity_user_experience(guid)
-            if user_experience:
-                entity['user_experience'] = user_experience
-            # Analisa logs para padrões
-            log_patterns = await self.analyze_logs_for_patterns(guid)
-            if log_patterns:
-                entity['log_patterns'] = log_patterns
-            # Coleta owners/squad/team
-            owners = await self.collect_entity_owners(entity)
-            if owners:
-                entity['owners'] = owners
-            # Constrói topologia/grafo
-            topology = await self.build_entity_topology(guid)
-            if topology:
-                entity['topologia'] = topology
-            # Correlaciona alertas e deployments
-            alert_deploy_corr = await self.correlate_alerts_with_deployments(entity)
-            if alert_deploy_corr:
-                entity['alert_deployment_correlation'] = alert_deploy_corr
+            def enriquecer(chave, coletar):
+                # Grava o resultado na entidade assim que o nó termina (dependentes leem da entidade)
+                async def node(deps):
+                    resultado = await coletar(deps)
+                    if resultado:
+                        entity[chave] = resultado
+                    return resultado
+                return node
+
+            # Sub-coletas independentes (uma chamada cada, sem duplicatas)
+            independentes = {
+                'dashboards': self.collect_entity_dashboards,  # dashboards relacionados
+                'synthetics': self.collect_entity_synthetics,  # monitores sintéticos
+                'custom_events': self.collect_entity_custom_events,
+                'integration_events': self.collect_entity_integration_events,
+                'infra_events': self.collect_entity_infrastructure_events,
+                'logs': self.collect_entity_logs,  # logs recentes
+                'related_entities': self.collect_entity_related_entities,
+                'dependencies': self.collect_entity_dependencies,  # serviços externos, databases
+                'alert_policies': self.collect_entity_alert_policies,
+                'mobile_crashes': self.collect_entity_mobile_crashes,  # Swift/iOS/Android
+                'db_queries': self.collect_entity_db_queries,  # queries SQL recentes
+                'transaction_attributes': self.collect_entity_transaction_attributes,
+                'health_status': self.collect_entity_health_status,
+                'time_series': self.collect_entity_time_series,
+                'dependency_status': self.collect_entity_dependency_status,  # dependências externas
+                'user_experience': self.collect_entity_user_experience,
+                'alertas': self.collect_entity_alerts,  # alertas ativos
+                'deployments': self.collect_entity_deployments,  # deployments recentes
+                'traces': self.collect_entity_traces,  # traces/recent transactions
+                'workloads': self.collect_entity_workloads,
+            }
+
+            grafo = TaskGraph()
+            for chave, coletor in independentes.items():
+                grafo.add(chave, enriquecer(chave, lambda deps, coletor=coletor: coletor(guid)))
+            # Owners/squad/team via tags (não depende de chamadas à API)
+            grafo.add('owners', enriquecer('owners', lambda deps: self.collect_entity_owners(entity)))
+            # Métricas por período (ou as já coletadas em lote)
+            grafo.add('metricas', lambda deps: self._collect_period_metrics(entity, metricas_em_lote))
+            # Derivadas: reaproveitam os resultados das sub-coletas das quais dependem
+            grafo.add('log_patterns', enriquecer(
+                'log_patterns', lambda deps: self.analyze_logs_for_patterns(guid, logs=deps['logs'])
+            ), depends_on=['logs'])
+            grafo.add('topologia', enriquecer(
+                'topologia', lambda deps: self.build_entity_topology(guid, rels=deps['related_entities'])
+            ), depends_on=['related_entities'])
+            grafo.add('alert_deployment_correlation', enriquecer(
+                'alert_deployment_correlation', lambda deps: self.correlate_alerts_with_deployments(entity)
+            ), depends_on=['alertas', 'deployments'])
             # Explicabilidade
-            explanation = await self.explain_diagnosis(entity)
-            if explanation:
-                entity['diagnosis_explanation'] = explanation
+            grafo.add('diagnosis_explanation', enriquecer(
+                'diagnosis_explanation', lambda deps: self.explain_diagnosis(entity)
+            ), depends_on=['metricas', 'deployments'])
+
+            await grafo.run()
+            return entity
 
+        except Exception as e:
+            logger.error(f"Erro ao coletar métricas para entidade {entity.get('name', 'Desconhecida')}: {e}")
+            logger.error(traceback.format_exc())
+            return entity
+    
+    async def _collect_period_metrics(self, entity, metricas_em_lote: Optional[Dict] = None) -> Dict:
+        """
+        Coleta as métricas por período (PERIODOS) conforme o domínio da entidade
+        e grava ``metricas``/``detalhe`` na entidade.
+        """
+        guid = entity.get('guid')
+        name = entity.get('name', 'Desconhecido')
+        domain = entity.get('domain', '').upper()
+        try:
             metrics = {}
 
+            # Domínios com métricas em lote usam o mesmo motor (séries TIMESERIES) também
+            # na coleta avulsa de uma entidade, em vez de uma query por métrica e período
+            if metricas_em_lote is None and dominio_suportado(domain):
+                engine = NRQLBatchEngine(self.execute_nrql_query, PERIODOS, agregador=get_default_aggregator())
+                metricas_em_lote = (await engine.coletar([entity])).get(guid, {})
+
+            # Métricas já coletadas em lote (FACET entity.guid) dispensam as queries por entidade
+            if metricas_em_lote is not None:
+                metrics.update(metricas_em_lote)
+                periodos_pendentes = {}
+            else:
+                periodos_pendentes = PERIODOS
+
             # Coleta métricas para cada período temporal
-            for period_key, period_query in PERIODOS.items():
+            for period_key, period_query in periodos_pendentes.items():
                 period_metrics = {}
                 # Estratégia baseada no domínio da entidade
                 if domain == 'APM':
@@ -1434,29 +1440,6 @@ class NewRelicCollector:
                 if period_metrics:
                     metrics[period_key] = period_metrics
 
-            # Coleta alertas ativos e deployments recentes
-            alerts = await self.collect_entity_alerts(guid)
-            if alerts:
-                entity['alertas'] = alerts
-            deployments = await self.collect_entity_deployments(guid)
-            if deployments:
-                entity['deployments'] = deployments
-            # Coleta dependências (serviços externos, databases)
-            dependencies = await self.collect_entity_dependencies(guid)
-            if dependencies:
-                entity['dependencies'] = dependencies
-            # Coleta logs recentes (se disponíveis)
-            logs = await self.collect_entity_logs(guid)
-            if logs:
-                entity['logs'] = logs
-            # Coleta traces/recent transactions
-            traces = await self.collect_entity_traces(guid)
-            if traces:
-                entity['traces'] = traces
-            # Coleta workloads relacionados
-            workloads = await self.collect_entity_workloads(guid)
-            if workloads:
-                entity['workloads'] = workloads
             # Adiciona timestamp da coleta
             metrics['timestamp'] = datetime.now().isoformat()
             # Só adiciona métricas se houver pelo menos um período com dados
@@ -1470,49 +1453,47 @@ class NewRelicCollector:
                 entity['metricas'] = {}
                 entity['detalhe'] = "{}"
                 logger.info(f"Nenhuma métrica relevante coletada para {name}")
-            return entity
-
+            return metrics
         except Exception as e:
-            logger.error(f"Erro ao coletar métricas para entidade {entity.get('name', 'Desconhecida')}: {e}")
-            logger.error(traceback.format_exc())
-            return entity
-    
+            logger.error(f"Erro ao coletar métricas por período para {name}: {e}")
+            return {}
+
     async def collect_entities_with_metrics(self):
         """
         Coleta entidades e suas respectivas métricas
         """
         try:
-            # Coleta entidades base
-            entities = await self.collect_entities()
-            logger.info(f"Coletadas {len(entities)} entidades base. Coletando métricas...")
-            
-            # Limita processamento para não sobrecarregar API
-            MAX_CONCURRENT = 5
-            semaphore = asyncio.Semaphore(MAX_CONCURRENT)
-            
-            async def process_entity_with_semaphore(entity):
-                async with semaphore:
-                    return await self.collect_entity_metrics(entity)
-            
-            # Processa entidades em paralelo, mas limitado
-            processed_entities = await asyncio.gather(
-                *[process_entity_with_semaphore(entity) for entity in entities],
-                return_exceptions=True
-            )
-            
-            # Filtra entidades com erro
+            # Sem semáforo por entidade: cada requisição aguarda vaga no limite adaptativo (AIMD)
+            # da conta, que acompanha o limite atual em vez de fixar o paralelismo no teto
             valid_entities = []
             errors = 0
-            for result in processed_entities:
-                if isinstance(result, Exception):
-                    errors += 1
-                    logger.error(f"Erro ao processar entidade: {result}")
-                elif result.get('metricas') and any(
-                        isinstance(v, dict) and v for k, v in result['metricas'].items() if k != 'timestamp'):
-                    valid_entities.append(result)
+            total = 0
+            # Entidades chegam em stream (página a página): as métricas de uma página são
+            # coletadas enquanto a próxima página já está sendo buscada
+            async for entities in self.iter_entity_pages():
+                total += len(entities)
+                logger.info(f"Página com {len(entities)} entidades ({total} até agora). Coletando métricas...")
+                
+                # Métricas principais (APM/BROWSER/INFRA) em lote: uma query FACET por métrica/período/bloco
+                batch_engine = NRQLBatchEngine(self.execute_nrql_query, PERIODOS, agregador=get_default_aggregator())
+                metricas_em_lote = await batch_engine.coletar(entities)
+                
+                # Processa entidades em paralelo; o limite de requisições simultâneas é o do controlador
+                processed_entities = await asyncio.gather(
+                    *[self.collect_entity_metrics(entity, metricas_em_lote.get(entity.get('guid'))) for entity in entities],
+                    return_exceptions=True
+                )
+                
+                # Filtra entidades com erro
+                for result in processed_entities:
+                    if isinstance(result, Exception):
+                        errors += 1
+                        logger.error(f"Erro ao processar entidade: {result}")
+                    elif result.get('metricas') and any(
+                            isinstance(v, dict) and v for k, v in result['metricas'].items() if k != 'timestamp'):
+                        valid_entities.append(result)
             logger.info(f"Coleta concluída: {len(valid_entities)} entidades válidas com métricas, {errors} erros")
             return valid_entities
-            
         except Exception as e:
             logger.error(f"Erro na coleta de entidades com métricas: {e}")
             logger.error(traceback.format_exc())
@@ -1527,6 +1508,11 @@ class NewRelicCollector:
         return {
             "status": "healthy" if rate_status["circuit_state"] == "CLOSED" else "degraded" if rate_status["circuit_state"] == "HALF_OPEN" else "unhealthy",
             "circuit_breaker": rate_status,
+            "rate_limiter": get_rate_limiter_atual().get_status(),
+            "query_cache": get_query_cache().get_stats(),
+            "single_flight": get_single_flight().get_stats(),
+            "concurrency": get_concurrency_controller_atual().get_status(),
+            "incremental_metrics": get_incremental_aggregator().get_status(),
             "api_key_configured": bool(self.api_key),
             "account_id_configured": bool(self.account_id),
             "base_url": self.base_url,
@@ -1673,8 +1659,10 @@ class NewRelicCollector:
                         dependencies[direction_key]["outros"].append(dependency)
             
             # Executar consultas em paralelo para melhor performance
-            upstream_response = await self.make_graphql_request(upstream_query)
-            downstream_response = await self.make_graphql_request(downstream_query)
+            upstream_response, downstream_response = await asyncio.gather(
+                self.make_graphql_request(upstream_query),
+                self.make_graphql_request(downstream_query)
+            )
             
             # Processar dependências upstream
             if (upstream_response and 'data' in upstream_response and 
@@ -1802,5 +1790,52 @@ async def coletar_contexto_completo():
         logger.error(traceback.format_exc())
         return {"entidades": [], "timestamp": datetime.now().isoformat(), "error": str(e)}
 
+async def coletar_dominio_especifico(dominio: str) -> Dict[str, Any]:
+    """
+    Recoleta os dados completos de um único domínio (usado por ``atualizar_cache_incremental``).
+    Atualiza a tabela de fingerprints da sincronização delta e cria lápides para as entidades
+    do domínio que não aparecem mais na listagem.
+    """
+    from utils.newrelic_advanced_collector import iter_entity_pages, collect_entities_complete_data
+    from utils.delta_sync import get_fingerprint_table, sincronizar
+
+    dominio = dominio.upper()
+    session = get_shared_session()
+    entidades = []
+    async for page in iter_entity_pages(session=session, domains=[dominio]):
+        entidades.extend(page)
+
+    tabela = get_fingerprint_table()
+    coletadas, plano = await sincronizar(
+        tabela, entidades, {},
+        lambda alvo: collect_entities_complete_data(alvo, session=session),
+        escopo=dominio, forcar=True
+    )
+    await tabela.save_async()
+    logger.info(f"Domínio {dominio}: {len(coletadas)} entidades recoletadas, {len(plano.removed)} removidas")
+    return {"entidades": coletadas, "removidas": plano.removed, "timestamp": datetime.now().isoformat()}
+
+async def coletar_entidade_especifica(guid: str) -> Optional[Dict[str, Any]]:
+    """
+    Recoleta os dados completos de uma entidade pelo GUID (usado por ``atualizar_cache_incremental``).
+    Retorna None se a entidade não existe mais ou se a coleta falhou.
+    """
+    from utils.newrelic_advanced_collector import get_entity_outline, collect_entities_complete_data
+    from utils.delta_sync import get_fingerprint_table
+
+    session = get_shared_session()
+    entidade = await get_entity_outline(guid, session=session)
+    if not entidade:
+        logger.warning(f"Entidade {guid} não encontrada no New Relic")
+        return None
+
+    coletadas = await collect_entities_complete_data([entidade], session=session)
+    if not coletadas or str(coletadas[0].get("problema") or "").startswith("ERRO_COLETA"):
+        return None
+    tabela = get_fingerprint_table()
+    tabela.registrar_coleta(entidade)
+    await tabela.save_async()
+    return coletadas[0]
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -7,36 +7,46 @@ Este módulo NÃO altera o funcionamento dos coletores existentes. Serve como ba
 
 import asyncio
 import logging
-import time
-from typing import Optional, Dict, Any
+import os
+import weakref
+from typing import Optional, Dict, Any, Tuple
 import aiohttp
 import math
+from utils.rate_limiter import ENDPOINT_GRAPHQL, ENDPOINT_NRQL
+from utils.nrql_cache import get_query_cache
+from utils.single_flight import get_single_flight
+from utils.newrelic_accounts import escopo_cache, get_concurrency_controller_atual, get_rate_limiter_atual
 
-# RateLimitController centralizado
-class RateLimitController:
-    """
-    Controla o número de requisições por janela de tempo para evitar rate limit.
-    Pode ser usado como context manager async.
-    """
-    def __init__(self, max_requests: int, period: float):
-        self.max_requests = max_requests
-        self.period = period
-        self.timestamps = []
-        self.lock = asyncio.Lock()
+# Pool HTTP compartilhado (keep-alive) usado por todos os coletores New Relic
+HTTP_POOL_LIMIT = int(os.getenv("NEW_RELIC_HTTP_POOL_LIMIT", "100"))  # Conexões simultâneas no total
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("NEW_RELIC_HTTP_POOL_LIMIT_PER_HOST", "30"))  # Conexões por host
+HTTP_KEEPALIVE_TIMEOUT = 60.0  # Tempo (s) que uma conexão ociosa permanece aberta para reuso
+HTTP_DNS_CACHE_TTL = 300  # Cache de DNS (s)
+
+# URL base da API New Relic. Apontar NEW_RELIC_BASE_URL para o servidor local
+# (utils.fake_newrelic_server) roda coletores e benchmarks sem credenciais reais.
+NR_BASE_URL_PRODUCAO = "https://api.newrelic.com"
+CREDENCIAIS_SERVIDOR_LOCAL = ("local-api-key", "local-query-key", "1")
+
+def nr_base_url() -> str:
+    return os.getenv("NEW_RELIC_BASE_URL", NR_BASE_URL_PRODUCAO).rstrip("/")
 
-    async def __aenter__(self):
-        async with self.lock:
-            now = time.monotonic()
-            self.timestamps = [t for t in self.timestamps if now - t < self.period]
-            if len(self.timestamps) >= self.max_requests:
-                sleep_time = self.period - (now - self.timestamps[0])
-                if sleep_time > 0:
-                    await asyncio.sleep(sleep_time)
-            self.timestamps.append(time.monotonic())
-        return self
+def usando_servidor_local() -> bool:
+    """Indica se os coletores estão apontados para um servidor que não é o da New Relic."""
+    return nr_base_url() != NR_BASE_URL_PRODUCAO
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        pass
+def nr_graphql_url() -> str:
+    return f"{nr_base_url()}/graphql"
+
+def carregar_credenciais() -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Retorna ``(api_key, query_key, account_id)`` do ambiente. Contra o servidor local,
+    as variáveis ausentes recebem valores fictícios em vez de impedir a importação.
+    """
+    valores = (os.getenv("NEW_RELIC_API_KEY"), os.getenv("NEW_RELIC_QUERY_KEY"), os.getenv("NEW_RELIC_ACCOUNT_ID"))
+    if usando_servidor_local():
+        valores = tuple(v or padrao for v, padrao in zip(valores, CREDENCIAIS_SERVIDOR_LOCAL))
+    return valores
 
 # Logging utilitário padronizado
 logger = logging.getLogger("utils.newrelic_common")
@@ -50,44 +60,124 @@ def log_warning(msg: str):
 def log_error(msg: str):
     logger.error(msg)
 
+# Sessão HTTP compartilhada, uma por event loop: uma ClientSession fica presa ao loop em que foi
+# criada, e cada ``asyncio.run`` (scheduler, scripts, testes) roda num loop novo
+_shared_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+
+def get_shared_session() -> aiohttp.ClientSession:
+    """
+    Retorna a ClientSession compartilhada do event loop em execução, criando-a sob demanda.
+
+    A sessão mantém conexões keep-alive, cache de DNS e limite de conexões por host,
+    evitando um handshake TLS a cada consulta. aiohttp fala apenas HTTP/1.1; o reuso
+    das conexões é o que elimina o custo de handshake.
+    Deve ser chamada de dentro de um event loop. Se a sessão do loop foi fechada, uma
+    nova é criada; sessões de loops já encerrados são descartadas.
+    """
+    loop = asyncio.get_running_loop()
+    session = _shared_sessions.get(loop)
+    if session is None or session.closed:
+        for antigo in [l for l in list(_shared_sessions.keys()) if l.is_closed()]:
+            _shared_sessions.pop(antigo, None)
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _shared_sessions[loop] = session
+        log_info(f"Pool HTTP New Relic criado (limit={HTTP_POOL_LIMIT}, limit_per_host={HTTP_POOL_LIMIT_PER_HOST})")
+    return session
+
+async def close_shared_session():
+    """
+    Fecha a ClientSession compartilhada do event loop em execução. Deve ser chamada no
+    shutdown da aplicação (lifespan) ou ao fim de cada ``asyncio.run``.
+    """
+    session = _shared_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        try:
+            await session.close()
+            log_info("Pool HTTP New Relic fechado")
+        except Exception as e:
+            log_warning(f"Erro ao fechar pool HTTP New Relic: {e}")
+
+def resolve_session(session: Optional[aiohttp.ClientSession] = None) -> aiohttp.ClientSession:
+    """
+    Retorna a sessão informada se ainda estiver aberta; caso contrário, a sessão compartilhada.
+    """
+    if session is not None and not getattr(session, 'closed', False):
+        return session
+    if session is not None:
+        log_warning("Sessão aiohttp passada já está fechada. Usando pool compartilhado.")
+    return get_shared_session()
+
 # Execução de queries NRQL/GraphQL centralizada
+async def _post_with_retries(kind: str, endpoint: str, url: str, data: Dict, headers: Dict[str, str], timeout: float, session: Optional[aiohttp.ClientSession], max_retries: int, retry_delay: float) -> Dict:
+    """
+    POST com retry, rate limit e backoff exponencial. ``kind`` ("NRQL"/"GraphQL") é usado só no log.
+    """
+    _session = resolve_session(session)
+    # Buckets e limite de concorrência da conta em coleta (ou os do processo, sem multi-conta)
+    limiter = get_rate_limiter_atual()
+    concurrency = get_concurrency_controller_atual()
+    for attempt in range(max_retries):
+        try:
+            await limiter.acquire(endpoint)
+            # Vaga no limite adaptativo (AIMD) de requisições simultâneas
+            async with concurrency.request() as slot:
+                async with _session.post(url, json=data, headers=headers, timeout=timeout) as response:
+                    slot.mark(response.status)
+                    limiter.observe_response(endpoint, response.status, response.headers)
+                    if response.status == 200:
+                        return await response.json()
+                    log_warning(f"{kind} query failed with status {response.status}: {response.reason}")
+        except asyncio.TimeoutError:
+            delay = retry_delay * math.pow(2, attempt)
+            log_warning(f"Timeout on {kind} query attempt {attempt + 1}, aguardando {delay}s antes de tentar novamente...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            delay = retry_delay * math.pow(2, attempt)
+            log_error(f"Unexpected error on {kind} query attempt {attempt + 1}: {str(e)}. Aguardando {delay}s antes de tentar novamente...")
+            await asyncio.sleep(delay)
+    # Se todas as tentativas falharem, retorna erro padronizado
+    return {"error": "All attempts failed"}
+
+async def fetch_coalesced(cache_key, fetch) -> Dict:
+    """
+    Serve do cache de respostas; em caso de miss, coalesce chamadas idênticas em andamento
+    (single-flight) e grava a resposta no cache.
+    """
+    cache = get_query_cache()
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    async def fetch_and_store():
+        result = await fetch()
+        cache.set(cache_key, result)
+        return result
+
+    if cache_key is None:
+        return await fetch()
+    return await get_single_flight().do(cache_key, fetch_and_store)
+
 async def execute_nrql_query_common(nrql: str, headers: Dict[str, str], url: str, timeout: float = 60.0, session: Optional[aiohttp.ClientSession] = None, max_retries: int = 3, retry_delay: float = 10.0) -> Dict:
     """
     Executa consulta NRQL com retry, logging e timeout.
+    Usa a sessão informada (se aberta) ou o pool HTTP compartilhado do processo.
+    Respostas são cacheadas por (conta/endpoint, query normalizada, janela SINCE) e chamadas
+    idênticas simultâneas compartilham a mesma requisição.
     """
     data = {"query": nrql} if url.endswith("/query") else {"query": nrql}
     try:
-        # Se a sessão passada estiver fechada, cria uma nova
-        if session is not None and getattr(session, 'closed', False):
-            log_warning("Sessão aiohttp passada já está fechada. Criando nova sessão.")
-            _session = aiohttp.ClientSession()
-            close_session = True
-        else:
-            _session = session or aiohttp.ClientSession()
-            close_session = session is None
-        try:
-            for attempt in range(max_retries):
-                try:
-                    async with _session.post(url, json=data, headers=headers, timeout=timeout) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        log_warning(f"NRQL query failed with status {response.status}: {response.reason}")
-                except asyncio.TimeoutError:
-                    delay = retry_delay * math.pow(2, attempt)
-                    log_warning(f"Timeout on NRQL query attempt {attempt + 1}, aguardando {delay}s antes de tentar novamente...")
-                    await asyncio.sleep(delay)
-                except Exception as e:
-                    delay = retry_delay * math.pow(2, attempt)
-                    log_error(f"Unexpected error on NRQL query attempt {attempt + 1}: {str(e)}. Aguardando {delay}s antes de tentar novamente...")
-                    await asyncio.sleep(delay)
-            # Se todas as tentativas falharem, retorna erro padronizado
-            return {"error": "All attempts failed"}
-        finally:
-            if close_session:
-                try:
-                    await _session.close()
-                except Exception as e:
-                    log_warning(f"Erro ao fechar ClientSession: {e}")
+        cache_key = get_query_cache().make_key(escopo_cache(url), nrql)
+        return await fetch_coalesced(
+            cache_key,
+            lambda: _post_with_retries("NRQL", ENDPOINT_NRQL, url, data, headers, timeout, session, max_retries, retry_delay)
+        )
     except Exception as e:
         log_error(f"Critical error executing NRQL query: {str(e)}")
         return {"error": f"Critical error: {str(e)}"}
@@ -95,51 +185,34 @@ async def execute_nrql_query_common(nrql: str, headers: Dict[str, str], url: str
 async def execute_graphql_query_common(query: str, headers: Dict[str, str], url: str, variables: Optional[Dict] = None, timeout: float = 60.0, session: Optional[aiohttp.ClientSession] = None, max_retries: int = 3, retry_delay: float = 10.0) -> Dict:
     """
     Executa consulta GraphQL com retry, logging e timeout.
+    Usa a sessão informada (se aberta) ou o pool HTTP compartilhado do processo.
+    Mesma política de cache e coalescência de execute_nrql_query_common (mutations não são cacheadas).
     """
     data = {"query": query}
     if variables:
         data["variables"] = variables
     try:
-        # Se a sessão passada estiver fechada, cria uma nova
-        if session is not None and getattr(session, 'closed', False):
-            log_warning("Sessão aiohttp passada já está fechada. Criando nova sessão.")
-            _session = aiohttp.ClientSession()
-            close_session = True
-        else:
-            _session = session or aiohttp.ClientSession()
-            close_session = session is None
-        try:
-            for attempt in range(max_retries):
-                try:
-                    async with _session.post(url, json=data, headers=headers, timeout=timeout) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        log_warning(f"GraphQL query failed with status {response.status}: {response.reason}")
-                except asyncio.TimeoutError:
-                    delay = retry_delay * math.pow(2, attempt)
-                    log_warning(f"Timeout on GraphQL query attempt {attempt + 1}, aguardando {delay}s antes de tentar novamente...")
-                    await asyncio.sleep(delay)
-                except Exception as e:
-                    delay = retry_delay * math.pow(2, attempt)
-                    log_error(f"Unexpected error on GraphQL query attempt {attempt + 1}: {str(e)}. Aguardando {delay}s antes de tentar novamente...")
-                    await asyncio.sleep(delay)
-            # Se todas as tentativas falharem, retorna erro padronizado
-            return {"error": "All attempts failed"}
-        finally:
-            if close_session:
-                try:
-                    await _session.close()
-                except Exception as e:
-                    log_warning(f"Erro ao fechar ClientSession: {e}")
+        cache_key = get_query_cache().make_key(escopo_cache(url), query, variables)
+        return await fetch_coalesced(
+            cache_key,
+            lambda: _post_with_retries("GraphQL", ENDPOINT_GRAPHQL, url, data, headers, timeout, session, max_retries, retry_delay)
+        )
     except Exception as e:
         log_error(f"Critical error executing GraphQL query: {str(e)}\nQuery sent:\n{query}\nVariables: {variables}")
         return {"error": f"Critical error: {str(e)}", "query": query, "variables": variables}
 
 # Exemplo de interface pública do módulo
 __all__ = [
-    "RateLimitController",
     "execute_nrql_query_common",
     "execute_graphql_query_common",
+    "get_shared_session",
+    "carregar_credenciais",
+    "nr_base_url",
+    "nr_graphql_url",
+    "usando_servidor_local",
+    "close_shared_session",
+    "resolve_session",
+    "fetch_coalesced",
     "log_info",
     "log_warning",
     "log_error"
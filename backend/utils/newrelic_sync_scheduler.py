@@ -57,6 +57,9 @@ except ImportError:
             logger.error("Não foi possível importar o NewRelicFullCollector")
             sys.exit(1)
 
+from utils.collection_shards import executar_rodada_local
+from utils.newrelic_common import close_shared_session
+
 # Importar módulos de atualização do frontend
 try:
     from backend.atualizar_frontend import main as atualizar_frontend
@@ -73,15 +76,18 @@ class NewRelicSyncScheduler:
     Implementa a sincronização periódica e completa do New Relic.
     """
     
-    def __init__(self, interval_minutes=15, cache_dir="backend"):
+    def __init__(self, interval_minutes=15, cache_dir="backend", shards=1):
         """
         Inicializa o agendador de sincronização.
         
         Args:
             interval_minutes: Intervalo de sincronização em minutos
             cache_dir: Diretório onde o cache será armazenado
+            shards: Com mais de 1, cada sincronização é uma rodada distribuída em shards
+                (``utils.collection_shards``), com um processo worker por shard
         """
         self.interval_minutes = interval_minutes
+        self.shards = shards
         self.cache_dir = Path(cache_dir)
         self.collector = NewRelicFullCollector(cache_dir=cache_dir)
         self.running = False
@@ -210,7 +216,12 @@ class NewRelicSyncScheduler:
         
         try:
             # Coletar dados do New Relic
-            success = await self.collector.collect_all_data()
+            if self.shards > 1:
+                status_rodada = await executar_rodada_local(self.shards)
+                self.status["ultima_rodada_shards"] = {k: v for k, v in status_rodada.items() if k != "shards"}
+                success = "erro" not in status_rodada
+            else:
+                success = await self.collector.collect_all_data()
             
             if not success:
                 logger.error("Falha ao coletar dados do New Relic")
@@ -244,7 +255,7 @@ class NewRelicSyncScheduler:
         except Exception as e:
             logger.error(f"Erro ao salvar status: {e}")
 
-async def run_scheduler(interval_minutes, cache_dir, single_run=False):
+async def run_scheduler(interval_minutes, cache_dir, single_run=False, shards=1):
     """
     Executa o agendador de sincronização.
     
@@ -252,11 +263,15 @@ async def run_scheduler(interval_minutes, cache_dir, single_run=False):
         interval_minutes: Intervalo de sincronização em minutos
         cache_dir: Diretório onde o cache será armazenado
         single_run: Se True, executa apenas uma sincronização e termina
+        shards: Número de shards da coleta distribuída (1 = coleta em um único processo)
     """
     if single_run:
         logger.info("Modo de execução única")
-        collector = NewRelicFullCollector(cache_dir=cache_dir)
-        success = await collector.collect_all_data()
+        if shards > 1:
+            success = "erro" not in await executar_rodada_local(shards)
+        else:
+            collector = NewRelicFullCollector(cache_dir=cache_dir)
+            success = await collector.collect_all_data()
         
         if success and atualizar_frontend:
             try:
@@ -265,10 +280,11 @@ async def run_scheduler(interval_minutes, cache_dir, single_run=False):
             except Exception as e:
                 logger.error(f"Erro ao atualizar frontend: {e}")
         
+        await close_shared_session()
         return
     
     # Executar agendador
-    scheduler = NewRelicSyncScheduler(interval_minutes=interval_minutes, cache_dir=cache_dir)
+    scheduler = NewRelicSyncScheduler(interval_minutes=interval_minutes, cache_dir=cache_dir, shards=shards)
     
     # Configurar manipulador de sinal
     loop = asyncio.get_event_loop()
@@ -289,7 +305,10 @@ async def run_scheduler(interval_minutes, cache_dir, single_run=False):
             pass
     
     # Iniciar agendador
-    await scheduler.start()
+    try:
+        await scheduler.start()
+    finally:
+        await close_shared_session()
 
 def main():
     """Função principal"""
@@ -297,11 +316,13 @@ def main():
     parser.add_argument('--interval', type=int, default=15, help='Intervalo de sincronização em minutos')
     parser.add_argument('--cache-dir', type=str, default='backend', help='Diretório do cache')
     parser.add_argument('--single', action='store_true', help='Executar apenas uma vez e terminar')
+    parser.add_argument('--shards', type=int, default=int(os.getenv('NEW_RELIC_SHARDS', '1')),
+                        help='Distribuir a coleta em N shards (um processo worker por shard)')
     
     args = parser.parse_args()
     
     try:
-        asyncio.run(run_scheduler(args.interval, args.cache_dir, args.single))
+        asyncio.run(run_scheduler(args.interval, args.cache_dir, args.single, args.shards))
     except KeyboardInterrupt:
         logger.info("Programa interrompido pelo usuário")
     except Exception as e:
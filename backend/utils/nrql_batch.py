@@ -0,0 +1,370 @@
+"""
+Motor de coleta de métricas NRQL em lote.
+
+Em vez de uma query por métrica, por período e por entidade (``WHERE entity.guid = '...'``),
+envia uma única query ``FACET entity.guid`` por métrica/domínio/período sobre um bloco de GUIDs
+(``WHERE entity.guid IN (...)``) e redistribui as linhas no formato ``metricas[periodo]``
+já usado pelo ``NewRelicCollector``.
+
+Métricas escalares com descrição de ``serie`` não geram uma query por período: os períodos
+são agrupados em séries ``TIMESERIES`` (ver ``utils.period_engine``) e derivados localmente.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from utils.period_engine import SeriePlanejada, derivar_periodos, planejar_series
+from utils.incremental_aggregator import IncrementalAggregator
+
+logger = logging.getLogger(__name__)
+
+# Quantidade de GUIDs por query (mantém a NRQL dentro do limite de tamanho da API)
+FACET_CHUNK_SIZE = int(os.getenv("NEW_RELIC_FACET_CHUNK_SIZE", "50"))
+# Queries FACET simultâneas
+FACET_MAX_CONCURRENT = int(os.getenv("NEW_RELIC_FACET_MAX_CONCURRENT", "5"))
+# Deriva os períodos de uma série TIMESERIES em vez de uma query por período
+PERIOD_ENGINE_ENABLED = os.getenv("NEW_RELIC_PERIOD_ENGINE", "true").lower() == "true"
+
+# Métricas coletadas por domínio. Cada item gera uma query FACET por período e bloco de GUIDs.
+#   campo:   coluna do resultado com o valor escalar
+#   destinos: chaves preenchidas em metricas[periodo]
+#   facets:  atributos extras de FACET (métricas em lista, ex.: erros recentes)
+#   limite_por_entidade: máximo de linhas mantidas por entidade nas métricas em lista
+#   serie:   select e rollup usados para derivar os períodos de uma série TIMESERIES
+#            (métricas em lista não têm: o top N de cada período exige a própria query)
+METRICAS_POR_DOMINIO: Dict[str, List[Dict[str, Any]]] = {
+    "APM": [
+        {"chave": "apdex", "select": "average(apdexScore) as 'score'", "from": "Metric",
+         "campo": "score", "destinos": ["apdex"],
+         "serie": {"select": "average(apdexScore) as 'score', count(apdexScore) as 'amostras'",
+                   "rollup": "media", "campo": "score", "peso": "amostras"}},
+        {"chave": "response_time", "select": "max(duration) as 'max.duration'", "from": "Transaction",
+         "campo": "max.duration", "destinos": ["response_time_max", "response_time"],
+         "serie": {"select": "max(duration) as 'max.duration'", "rollup": "max", "campo": "max.duration"}},
+        {"chave": "response_time_p95", "select": "percentile(duration, 95) as 'p95'", "from": "Transaction",
+         "campo": "p95", "destinos": ["response_time_p95"],
+         "serie": {"select": "histogram(duration, 10, 100) as 'histograma'", "rollup": "percentil",
+                   "campo": "histograma", "quantil": 0.95, "teto": 10, "bins": 100}},
+        {"chave": "error_rate", "select": "latest(errorRate) as 'error_rate'", "from": "Metric",
+         "campo": "error_rate", "destinos": ["error_rate"],
+         "serie": {"select": "latest(errorRate) as 'error_rate'", "rollup": "ultimo", "campo": "error_rate"}},
+        {"chave": "recent_error", "select": "count(*)", "from": "TransactionError",
+         "facets": ["error.message", "error.class", "httpResponseCode"],
+         "limite_por_entidade": 10, "destinos": ["recent_error"]},
+        {"chave": "throughput", "select": "average(newRelic.throughput) as 'avg.qps'", "from": "Metric",
+         "campo": "avg.qps", "destinos": ["throughput"],
+         "serie": {"select": "average(newRelic.throughput) as 'avg.qps', count(newRelic.throughput) as 'amostras'",
+                   "rollup": "media", "campo": "avg.qps", "peso": "amostras"}},
+    ],
+    "BROWSER": [
+        {"chave": "apdex", "select": "average(apdexScore) as 'score'", "from": "Metric",
+         "campo": "score", "destinos": ["apdex"],
+         "serie": {"select": "average(apdexScore) as 'score', count(apdexScore) as 'amostras'",
+                   "rollup": "media", "campo": "score", "peso": "amostras"}},
+        {"chave": "page_load_time", "select": "average(pageLoadTime) as 'avg.loadTime'", "from": "PageView",
+         "campo": "avg.loadTime", "destinos": ["page_load_time"],
+         "serie": {"select": "average(pageLoadTime) as 'avg.loadTime', count(pageLoadTime) as 'amostras'",
+                   "rollup": "media", "campo": "avg.loadTime", "peso": "amostras"}},
+        {"chave": "js_errors", "select": "count(*) as 'error_count'", "from": "JavaScriptError",
+         "facets": ["errorMessage"], "limite_por_entidade": 10, "destinos": ["js_errors"]},
+    ],
+    "INFRA": [
+        {"chave": "cpu_usage", "select": "average(cpuPercent) as 'avg.cpu'", "from": "Metric",
+         "campo": "avg.cpu", "destinos": ["cpu_usage"],
+         "serie": {"select": "average(cpuPercent) as 'avg.cpu', count(cpuPercent) as 'amostras'",
+                   "rollup": "media", "campo": "avg.cpu", "peso": "amostras"}},
+        {"chave": "memory_usage",
+         "select": "average(memoryUsedBytes)/average(memoryTotalBytes)*100 as 'memory_percent'",
+         "from": "Metric", "campo": "memory_percent", "destinos": ["memory_usage"],
+         "serie": {"select": "sum(memoryUsedBytes) as 'usado', sum(memoryTotalBytes) as 'total'",
+                   "rollup": "razao", "numerador": "usado", "denominador": "total", "fator": 100}},
+        {"chave": "disk_usage", "select": "average(diskUsedPercent) as 'disk_percent'", "from": "Metric",
+         "campo": "disk_percent", "destinos": ["disk_usage"],
+         "serie": {"select": "average(diskUsedPercent) as 'disk_percent', count(diskUsedPercent) as 'amostras'",
+                   "rollup": "media", "campo": "disk_percent", "peso": "amostras"}},
+    ],
+}
+
+# Valores descartados na montagem de metricas[periodo] (mesmo critério do coletor)
+VALORES_VAZIOS = (None, [], {}, "", 0)
+
+
+def dominio_suportado(dominio: Optional[str]) -> bool:
+    """Indica se o domínio tem métricas coletadas em lote."""
+    return (dominio or "").upper() in METRICAS_POR_DOMINIO
+
+
+def _escapar_guid(guid: str) -> str:
+    return str(guid).replace("\\", "\\\\").replace("'", "\\'")
+
+
+def montar_query_facet(spec: Dict[str, Any], guids: Iterable[str], periodo_query: str) -> str:
+    """Monta a NRQL ``FACET entity.guid`` de uma métrica para um bloco de GUIDs."""
+    lista_guids = ", ".join(f"'{_escapar_guid(g)}'" for g in guids)
+    facets = ", ".join(["entity.guid"] + list(spec.get("facets", [])))
+    return (
+        f"SELECT {spec['select']} FROM {spec['from']} "
+        f"WHERE entity.guid IN ({lista_guids}) "
+        f"FACET {facets} {periodo_query} LIMIT MAX"
+    )
+
+
+def montar_query_serie(spec: Dict[str, Any], guids: Iterable[str], serie: SeriePlanejada, desde: Optional[int] = None) -> str:
+    """
+    Monta a NRQL ``FACET entity.guid ... TIMESERIES`` de uma métrica para um bloco de GUIDs.
+    Com ``desde`` (epoch em segundos) a série começa nesse instante em vez de cobrir a janela inteira.
+    """
+    lista_guids = ", ".join(f"'{_escapar_guid(g)}'" for g in guids)
+    clausula = serie.clausula if desde is None else serie.clausula_desde(desde)
+    return (
+        f"SELECT {spec['serie']['select']} FROM {spec['from']} "
+        f"WHERE entity.guid IN ({lista_guids}) "
+        f"FACET entity.guid {clausula} LIMIT MAX"
+    )
+
+
+def montar_query_trecho(spec: Dict[str, Any], guids: Iterable[str], inicio: float, fim: float) -> str:
+    """
+    NRQL com as mesmas colunas da série, sem TIMESERIES, para o intervalo ``[inicio, fim)``
+    (epoch em segundos): o trecho inicial de um período (``IncrementalAggregator.trechos_iniciais``).
+    """
+    lista_guids = ", ".join(f"'{_escapar_guid(g)}'" for g in guids)
+    return (
+        f"SELECT {spec['serie']['select']} FROM {spec['from']} "
+        f"WHERE entity.guid IN ({lista_guids}) "
+        f"FACET entity.guid SINCE {int(inicio * 1000)} UNTIL {int(fim * 1000)} LIMIT MAX"
+    )
+
+
+def consultas_por_metrica(periodos: Dict[str, str], usar_series: bool = PERIOD_ENGINE_ENABLED, incremental: bool = True) -> int:
+    """Queries FACET que ``NRQLBatchEngine.coletar`` faz por métrica e bloco de GUIDs num ciclo."""
+    if not usar_series:
+        return len(periodos)
+    series, avulsos = planejar_series(periodos)
+    # Série incremental: a consulta do trecho novo e a do trecho inicial de cada período
+    return len(avulsos) + sum(1 + (len(serie.periodos) if incremental and serie.janela > serie.bucket else 0)
+                              for serie in series)
+
+
+def extrair_resultados_nrql(resposta: Any) -> List[Dict[str, Any]]:
+    """
+    Extrai a lista de linhas de uma resposta NRQL.
+    Aceita tanto a lista de resultados quanto a resposta GraphQL bruta (actor.account.nrql.results).
+    """
+    if isinstance(resposta, list):
+        return resposta
+    if not isinstance(resposta, dict) or resposta.get("errors") or resposta.get("error"):
+        return []
+    try:
+        resultados = resposta["data"]["actor"]["account"]["nrql"]["results"]
+    except (KeyError, TypeError):
+        return []
+    return resultados if isinstance(resultados, list) else []
+
+
+def _valores_facet(linha: Dict[str, Any], nomes: List[str]) -> List[Any]:
+    """Retorna os valores de FACET de uma linha, na ordem de ``nomes``."""
+    facet = linha.get("facet")
+    if isinstance(facet, list):
+        valores = list(facet)
+    elif facet is not None:
+        valores = [facet]
+    else:
+        valores = []
+    # Completa com as colunas nomeadas quando a API não devolve a lista "facet" completa
+    for i, nome in enumerate(nomes):
+        if i >= len(valores):
+            valores.append(linha.get(nome))
+    return valores
+
+
+def distribuir_linhas(spec: Dict[str, Any], linhas: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Redistribui as linhas de uma query FACET por GUID.
+    Métricas escalares viram ``{guid: valor}``; métricas com facets extras viram ``{guid: [linhas]}``.
+    """
+    facets_extras = list(spec.get("facets", []))
+    nomes = ["entity.guid"] + facets_extras
+    por_guid: Dict[str, Any] = {}
+
+    for linha in linhas:
+        if not isinstance(linha, dict):
+            continue
+        valores = _valores_facet(linha, nomes)
+        guid = valores[0] if valores else None
+        if not guid:
+            continue
+
+        if facets_extras:
+            limite = spec.get("limite_por_entidade", 10)
+            itens = por_guid.setdefault(guid, [])
+            if len(itens) >= limite:
+                continue
+            item = {k: v for k, v in linha.items() if k not in ("facet", "entity.guid")}
+            for nome, valor in zip(facets_extras, valores[1:]):
+                item[nome] = valor
+            itens.append(item)
+        else:
+            valor = linha.get(spec["campo"])
+            # percentile() devolve {"95": valor}
+            if isinstance(valor, dict) and len(valor) == 1:
+                valor = next(iter(valor.values()))
+            if valor is not None:
+                por_guid[guid] = valor
+
+    return por_guid
+
+
+class NRQLBatchEngine:
+    """
+    Coleta as métricas de ``METRICAS_POR_DOMINIO`` para muitas entidades com queries FACET.
+
+    ``executar_query`` é a corrotina que executa uma NRQL (ex.: ``NewRelicCollector.execute_nrql_query``);
+    ``periodos`` é o mapa ``{chave_periodo: "SINCE ..."}`` do coletor;
+    ``usar_series`` liga o motor de períodos (uma série TIMESERIES por métrica);
+    com um ``agregador``, as séries longas só consultam o trecho novo desde o ciclo anterior.
+    """
+
+    def __init__(
+        self,
+        executar_query: Callable[[str], Awaitable[Any]],
+        periodos: Dict[str, str],
+        chunk_size: int = FACET_CHUNK_SIZE,
+        max_concurrent: int = FACET_MAX_CONCURRENT,
+        usar_series: bool = PERIOD_ENGINE_ENABLED,
+        agregador: Optional[IncrementalAggregator] = None,
+    ):
+        self.executar_query = executar_query
+        self.periodos = periodos
+        self.chunk_size = max(1, chunk_size)
+        self.max_concurrent = max(1, max_concurrent)
+        if usar_series:
+            self.series, self.periodos_avulsos = planejar_series(periodos)
+        else:
+            self.series, self.periodos_avulsos = [], dict(periodos)
+        self.agregador = agregador
+        self.queries_executadas = 0
+        self.queries_com_erro = 0
+
+    def _agrupar_por_dominio(self, entidades: Iterable[Dict[str, Any]]) -> Dict[str, List[str]]:
+        grupos: Dict[str, List[str]] = {}
+        vistos = set()
+        for entidade in entidades:
+            guid = entidade.get("guid")
+            dominio = (entidade.get("domain") or "").upper()
+            if not guid or guid in vistos or dominio not in METRICAS_POR_DOMINIO:
+                continue
+            vistos.add(guid)
+            grupos.setdefault(dominio, []).append(guid)
+        return grupos
+
+    async def coletar(self, entidades: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        Retorna ``{guid: {periodo: {metrica: valor}}}`` para toda entidade de domínio suportado.
+        Entidades sem dados recebem ``{}``; entidades de outros domínios ficam de fora.
+        """
+        grupos = self._agrupar_por_dominio(entidades)
+        resultado: Dict[str, Dict[str, Dict[str, Any]]] = {
+            guid: {} for guids in grupos.values() for guid in guids
+        }
+        if not resultado:
+            return resultado
+
+        semaforo = asyncio.Semaphore(self.max_concurrent)
+
+        async def rodar(query, rotulo):
+            async with semaforo:
+                self.queries_executadas += 1
+                try:
+                    resposta = await self.executar_query(query)
+                except Exception as e:
+                    self.queries_com_erro += 1
+                    logger.warning(f"Erro na query FACET {rotulo}: {e}")
+                    return None
+            if isinstance(resposta, dict) and (resposta.get("errors") or resposta.get("error")):
+                self.queries_com_erro += 1
+                logger.warning(f"Query FACET {rotulo} retornou erro")
+                return None
+            return extrair_resultados_nrql(resposta)
+
+        def gravar(spec, guid, periodo_key, valor):
+            if guid not in resultado:
+                return
+            periodo_metricas = resultado[guid].setdefault(periodo_key, {})
+            for destino in spec["destinos"]:
+                periodo_metricas[destino] = valor
+
+        async def executar(dominio, spec, periodo_key, periodo_query, bloco):
+            linhas = await rodar(montar_query_facet(spec, bloco, periodo_query), f"{spec['chave']} ({dominio}/{periodo_key})")
+            if linhas is None:
+                return
+            for guid, valor in distribuir_linhas(spec, linhas).items():
+                gravar(spec, guid, periodo_key, valor)
+
+        async def executar_serie(dominio, spec, serie, bloco):
+            rotulo = f"{spec['chave']} ({dominio}/{serie.clausula})"
+            if self.agregador is not None and serie.janela > serie.bucket:
+                # Janela deslizante: consulta só a partir do bucket corrente do ciclo anterior, mais
+                # o trecho inicial de cada período, que fica antes dos buckets alinhados
+                agora = time.time()
+                desde = self.agregador.inicio_consulta(spec["chave"], bloco, serie, agora)
+                trechos = self.agregador.trechos_iniciais(serie, agora)
+                linhas, *linhas_trechos = await asyncio.gather(
+                    rodar(montar_query_serie(spec, bloco, serie, desde=desde), rotulo),
+                    *(rodar(montar_query_trecho(spec, bloco, inicio, fim), f"{rotulo} [início de {chave}]")
+                      for chave, (inicio, fim) in trechos.items()),
+                )
+                if linhas is None:
+                    return
+                if desde == self.agregador.inicio_janela(serie, agora):
+                    self.agregador.consultas_completas += 1
+                else:
+                    self.agregador.consultas_incrementais += 1
+                self.agregador.registrar(spec["chave"], bloco, serie, linhas, desde, spec["serie"], agora)
+                if any(l is None for l in linhas_trechos):
+                    # Buckets guardados; os períodos ficam para o próximo ciclo em vez de sair incompletos
+                    return
+                # Períodos calculados direto dos buffers guardados, sem remontar a janela em linhas
+                valores_por_guid = self.agregador.derivar(spec["chave"], bloco, serie, spec["serie"], agora,
+                                                          trechos=dict(zip(trechos, linhas_trechos)))
+            else:
+                linhas = await rodar(montar_query_serie(spec, bloco, serie), rotulo)
+                if linhas is None:
+                    return
+                valores_por_guid = derivar_periodos(linhas, spec["serie"], serie.periodos)
+            for guid, valores in valores_por_guid.items():
+                for periodo_key, valor in valores.items():
+                    gravar(spec, guid, periodo_key, valor)
+
+        tarefas = []
+        for dominio, guids in grupos.items():
+            for inicio in range(0, len(guids), self.chunk_size):
+                bloco = guids[inicio:inicio + self.chunk_size]
+                for spec in METRICAS_POR_DOMINIO[dominio]:
+                    periodos_spec = self.periodos
+                    if spec.get("serie") and self.series:
+                        for serie in self.series:
+                            tarefas.append(executar_serie(dominio, spec, serie, bloco))
+                        periodos_spec = self.periodos_avulsos
+                    for periodo_key, periodo_query in periodos_spec.items():
+                        tarefas.append(executar(dominio, spec, periodo_key, periodo_query, bloco))
+
+        await asyncio.gather(*tarefas)
+
+        # Remove métricas nulas, vazias ou default (mesmo filtro do coletor por entidade)
+        for guid, periodos in resultado.items():
+            limpos = {}
+            for periodo_key, metricas in periodos.items():
+                metricas = {k: v for k, v in metricas.items() if v not in VALORES_VAZIOS}
+                if metricas:
+                    limpos[periodo_key] = metricas
+            resultado[guid] = limpos
+
+        logger.info(
+            f"Métricas em lote: {len(resultado)} entidades, {self.queries_executadas} queries FACET "
+            f"({self.queries_com_erro} com erro)"
+        )
+        return resultado
@@ -0,0 +1,188 @@
+"""
+Cache de respostas NRQL/GraphQL com TTL dependente da janela de tempo consultada.
+
+A chave combina endpoint (conta), texto normalizado da query, variáveis e o bucket de tempo
+da janela ``SINCE``: janelas curtas expiram rápido (30 s para 30 minutos), janelas longas
+duram mais (1 h para 30 dias). O tamanho é limitado em bytes com despejo LRU. Listagens
+paginadas por cursor (``entitySearch``/``nextCursor``) não são cacheadas: os cursores valem
+para um instante da listagem, e repetir páginas antigas pularia ou duplicaria entidades.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE_ENABLED = os.getenv("NEW_RELIC_QUERY_CACHE", "1").lower() not in ("0", "false", "no")
+QUERY_CACHE_MAX_BYTES = int(os.getenv("NEW_RELIC_QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# TTL (s) por tamanho máximo da janela SINCE (s), em ordem crescente
+TTL_POR_JANELA = [
+    (30 * 60, 30),             # até 30 minutos -> 30 s
+    (3 * 3600, 120),           # até 3 horas -> 2 min
+    (24 * 3600, 300),          # até 24 horas -> 5 min
+    (7 * 24 * 3600, 900),      # até 7 dias -> 15 min
+]
+TTL_JANELA_LONGA = 3600        # acima de 7 dias (ex.: 30 dias) -> 1 h
+TTL_SEM_JANELA = 60            # queries sem SINCE (metadados GraphQL)
+
+_UNIDADES = {
+    "second": 1, "seconds": 1, "minute": 60, "minutes": 60, "hour": 3600, "hours": 3600,
+    "day": 86400, "days": 86400, "week": 604800, "weeks": 604800,
+    "month": 2592000, "months": 2592000,
+}
+_RE_SINCE = re.compile(r"\bSINCE\s+(\d+)\s+([A-Za-z]+)\s+AGO\b", re.IGNORECASE)
+_RE_ESPACOS = re.compile(r"\s+")
+_RE_CURSOR = re.compile(r"\b(?:nextCursor|cursor\s*:)", re.IGNORECASE)
+
+
+def normalize_query(query: str) -> str:
+    """Colapsa espaços e quebras de linha para que variações de formatação compartilhem a entrada."""
+    return _RE_ESPACOS.sub(" ", query or "").strip()
+
+
+def since_window_seconds(query: str) -> Optional[int]:
+    """Retorna a maior janela ``SINCE N <unidade> AGO`` da query, em segundos."""
+    janelas = []
+    for valor, unidade in _RE_SINCE.findall(query or ""):
+        fator = _UNIDADES.get(unidade.lower())
+        if fator:
+            janelas.append(int(valor) * fator)
+    return max(janelas) if janelas else None
+
+
+def ttl_for_query(query: str) -> int:
+    """TTL (s) de uma query conforme a janela SINCE."""
+    janela = since_window_seconds(query)
+    if janela is None:
+        return TTL_SEM_JANELA
+    for limite, ttl in TTL_POR_JANELA:
+        if janela <= limite:
+            return ttl
+    return TTL_JANELA_LONGA
+
+
+def is_cursor_paginated(query: str, variables: Optional[Dict] = None) -> bool:
+    """Indica se a query é uma página de listagem por cursor (pede ``nextCursor`` ou recebe ``cursor``)."""
+    return bool(_RE_CURSOR.search(query or "")) or bool(variables and "cursor" in variables)
+
+
+def is_cacheable_response(resposta: Any) -> bool:
+    """Só respostas sem erro são cacheadas."""
+    if not isinstance(resposta, (dict, list)):
+        return False
+    if isinstance(resposta, dict) and (resposta.get("error") or resposta.get("errors")):
+        return False
+    return True
+
+
+class QueryResponseCache:
+    """
+    Cache LRU limitado por bytes. Os valores ficam serializados em JSON: o tamanho é exato
+    e cada leitura devolve uma cópia independente (os chamadores podem alterar o resultado).
+    """
+
+    def __init__(self, max_bytes: int = QUERY_CACHE_MAX_BYTES, enabled: bool = QUERY_CACHE_ENABLED):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._entries: "OrderedDict[Tuple, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, endpoint: str, query: str, variables: Optional[Dict] = None, now: Optional[float] = None) -> Optional[Tuple]:
+        """
+        Monta a chave (endpoint, query normalizada, variáveis, bucket de tempo).
+        Retorna None para o que não deve ser cacheado (mutations e páginas por cursor).
+        """
+        texto = normalize_query(query)
+        if texto.lower().startswith("mutation") or is_cursor_paginated(texto, variables):
+            return None
+        ttl = ttl_for_query(texto)
+        agora = time.time() if now is None else now
+        bucket = int(agora // ttl)
+        vars_key = json.dumps(variables, sort_keys=True, default=str) if variables else ""
+        return (endpoint, texto, vars_key, ttl, bucket)
+
+    def get(self, key: Optional[Tuple]) -> Optional[Any]:
+        if not self.enabled or key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expira_em, dados = entry
+            if time.time() >= expira_em:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(dados)
+
+    def set(self, key: Optional[Tuple], value: Any):
+        if not self.enabled or key is None or not is_cacheable_response(value):
+            return
+        try:
+            dados = json.dumps(value, default=str).encode("utf-8")
+        except (TypeError, ValueError) as e:
+            logger.debug(f"Resposta não serializável, não cacheada: {e}")
+            return
+        if len(dados) > self.max_bytes:
+            return
+        ttl = key[3]
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, dados)
+            self._bytes += len(dados)
+            while self._bytes > self.max_bytes and self._entries:
+                antiga = next(iter(self._entries))
+                self._remove(antiga)
+                self.evictions += 1
+
+    def _remove(self, key: Tuple):
+        _, dados = self._entries.pop(key)
+        self._bytes -= len(dados)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Instância única do processo
+_query_cache: Optional[QueryResponseCache] = None
+
+
+def get_query_cache() -> QueryResponseCache:
+    """Retorna o cache de respostas compartilhado do processo."""
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryResponseCache()
+    return _query_cache
@@ -0,0 +1,385 @@
+"""
+Motor de períodos: uma query ``TIMESERIES`` longa por métrica no lugar de uma query por período.
+
+Os períodos do coletor (30min, 3h, 24h, 7d, 30d) se sobrepõem; consultar cada um separadamente
+varre os mesmos dados várias vezes. Aqui os períodos são agrupados em séries
+(ex.: ``SINCE 30 DAYS AGO TIMESERIES 3 HOURS`` cobre 3h, 24h, 7d e 30d) e cada período é derivado
+localmente fatiando os últimos N buckets da série. O fatiamento e as agregações são vetorizados
+com numpy quando disponível; sem numpy, há uma implementação equivalente em Python puro.
+
+A NRQL limita uma série a 366 buckets, então períodos muito menores que a janela mais longa
+(ex.: 30min dentro de 30 dias) ficam em uma segunda série curta.
+"""
+
+import logging
+import math
+import re
+import warnings
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+    NUMPY_DISPONIVEL = True
+except ImportError:
+    np = None
+    NUMPY_DISPONIVEL = False
+
+logger = logging.getLogger(__name__)
+
+# Limite de buckets por série imposto pela NRQL
+MAX_BUCKETS = 366
+
+ROLLUP_MEDIA = "media"      # média ponderada pelo campo "peso" (ou média simples dos buckets)
+ROLLUP_MAX = "max"
+ROLLUP_MIN = "min"
+ROLLUP_SOMA = "soma"
+ROLLUP_ULTIMO = "ultimo"    # último bucket com valor (equivale a latest())
+ROLLUP_RAZAO = "razao"      # soma(numerador) / soma(denominador) * fator
+ROLLUP_PERCENTIL = "percentil"  # quantil de histogramas (histogram()) somados bucket a bucket
+
+_UNIDADES = {
+    "MINUTE": 60, "MINUTES": 60,
+    "HOUR": 3600, "HOURS": 3600,
+    "DAY": 86400, "DAYS": 86400,
+    "WEEK": 604800, "WEEKS": 604800,
+}
+_PERIODO_RE = re.compile(r"^\s*SINCE\s+(\d+)\s+([A-Z]+)\s+AGO\s*$", re.IGNORECASE)
+
+
+def duracao_periodo(periodo_query: str) -> Optional[int]:
+    """Converte ``"SINCE 30 MINUTES AGO"`` em segundos; None se a cláusula não for desse formato."""
+    match = _PERIODO_RE.match(periodo_query or "")
+    if not match:
+        return None
+    unidade = _UNIDADES.get(match.group(2).upper())
+    return int(match.group(1)) * unidade if unidade else None
+
+
+def formatar_duracao(segundos: int) -> str:
+    """Converte segundos na maior unidade NRQL exata (``86400`` -> ``"1 DAYS"``)."""
+    for unidade, tamanho in (("WEEKS", 604800), ("DAYS", 86400), ("HOURS", 3600), ("MINUTES", 60)):
+        if segundos % tamanho == 0:
+            return f"{segundos // tamanho} {unidade}"
+    return f"{max(1, segundos // 60)} MINUTES"
+
+
+class SeriePlanejada:
+    """Uma série TIMESERIES: janela total, tamanho do bucket e quantos buckets cada período usa."""
+
+    def __init__(self, janela: int, bucket: int, periodos: Dict[str, int]):
+        self.janela = janela
+        self.bucket = bucket
+        self.periodos = periodos
+
+    @property
+    def clausula(self) -> str:
+        return f"SINCE {formatar_duracao(self.janela)} AGO TIMESERIES {formatar_duracao(self.bucket)}"
+
+    def clausula_desde(self, inicio: int) -> str:
+        """Mesma série a partir de um instante absoluto (epoch em segundos, alinhado ao bucket)."""
+        return f"SINCE {int(inicio) * 1000} TIMESERIES {formatar_duracao(self.bucket)}"
+
+    def __repr__(self):
+        return f"SeriePlanejada({self.clausula}, {self.periodos})"
+
+
+def planejar_series(periodos: Dict[str, str], max_buckets: int = MAX_BUCKETS) -> Tuple[List[SeriePlanejada], Dict[str, str]]:
+    """
+    Agrupa os períodos em séries. Cada série usa como bucket o MDC das durações do grupo,
+    de modo que todo período seja um número exato de buckets, sem passar de ``max_buckets``.
+
+    Returns:
+        (séries, períodos que não puderam ser convertidos e seguem com query própria)
+    """
+    duracoes = {}
+    avulsos = {}
+    for chave, clausula in periodos.items():
+        duracao = duracao_periodo(clausula)
+        if duracao:
+            duracoes[chave] = duracao
+        else:
+            avulsos[chave] = clausula
+
+    series: List[SeriePlanejada] = []
+    grupo: List[Tuple[str, int]] = []
+    for chave, duracao in sorted(duracoes.items(), key=lambda item: -item[1]):
+        if grupo:
+            janela = grupo[0][1]
+            bucket = math.gcd(*(d for _, d in grupo), duracao)
+            if janela // bucket <= max_buckets:
+                grupo.append((chave, duracao))
+                continue
+            series.append(_fechar_grupo(grupo))
+        grupo = [(chave, duracao)]
+    if grupo:
+        series.append(_fechar_grupo(grupo))
+    return series, avulsos
+
+
+def _fechar_grupo(grupo: List[Tuple[str, int]]) -> SeriePlanejada:
+    janela = grupo[0][1]
+    bucket = math.gcd(*(d for _, d in grupo)) if len(grupo) > 1 else janela
+    return SeriePlanejada(janela, bucket, {chave: duracao // bucket for chave, duracao in grupo})
+
+
+class HistogramaMesclavel:
+    """
+    Sketch de percentis mesclável: histograma de largura fixa (``histogram(attr, teto, bins)``
+    da NRQL). Dois histogramas com a mesma grade se combinam somando as contagens, então
+    percentis de qualquer janela saem da soma dos buckets dela, sem reconsultar os eventos.
+    Valores acima do teto caem no último bin (mesmo critério da NRQL).
+    """
+
+    def __init__(self, teto: float, bins: int, contagens: Any = None):
+        self.teto = float(teto)
+        self.bins = int(bins)
+        self.contagens = [0.0] * self.bins
+        contagens = self.extrair_contagens(contagens)
+        if contagens:
+            self.mesclar_contagens(contagens)
+
+    @staticmethod
+    def extrair_contagens(valor: Any) -> Optional[List[float]]:
+        """Aceita a lista de contagens ou o formato ``{"buckets": [{"count": n}, ...]}``."""
+        if isinstance(valor, dict):
+            if "buckets" in valor:
+                valor = [b.get("count", 0) if isinstance(b, dict) else b for b in valor.get("buckets") or []]
+            elif "histogram" in valor:
+                return HistogramaMesclavel.extrair_contagens(valor["histogram"])
+        if isinstance(valor, (list, tuple)) and all(isinstance(c, (int, float)) for c in valor):
+            return [float(c) for c in valor]
+        return None
+
+    def mesclar_contagens(self, contagens: Sequence[float]):
+        for i, contagem in enumerate(contagens):
+            self.contagens[min(i, self.bins - 1)] += contagem or 0.0
+
+    def mesclar(self, outro: "HistogramaMesclavel"):
+        if (outro.teto, outro.bins) != (self.teto, self.bins):
+            raise ValueError("Histogramas com grades diferentes não podem ser mesclados")
+        self.mesclar_contagens(outro.contagens)
+
+    @property
+    def total(self) -> float:
+        return sum(self.contagens)
+
+    def quantil(self, q: float) -> Optional[float]:
+        total = self.total
+        if total <= 0:
+            return None
+        largura = self.teto / self.bins
+        alvo = min(max(q, 0.0), 1.0) * total
+        acumulado = 0.0
+        for i, contagem in enumerate(self.contagens):
+            if contagem and acumulado + contagem >= alvo:
+                # Interpolação linear dentro do bin
+                return largura * (i + (alvo - acumulado) / contagem)
+            acumulado += contagem
+        return self.teto
+
+
+def campos_da_serie(serie: Dict[str, Any]) -> List[str]:
+    """Colunas do resultado usadas pelo rollup de uma métrica."""
+    if serie["rollup"] == ROLLUP_RAZAO:
+        return [serie["numerador"], serie["denominador"]]
+    campos = [serie["campo"]]
+    if serie.get("peso"):
+        campos.append(serie["peso"])
+    return campos
+
+
+def _guid_da_linha(linha: Dict[str, Any]) -> Optional[str]:
+    facet = linha.get("facet")
+    if isinstance(facet, list):
+        facet = facet[0] if facet else None
+    return facet or linha.get("entity.guid")
+
+
+def montar_matrizes(linhas: Sequence[Dict[str, Any]], campos: Sequence[str]) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Organiza as linhas de uma query ``FACET entity.guid ... TIMESERIES`` em uma matriz
+    (entidades x buckets) por campo, com os buckets em ordem cronológica. Buckets sem valor
+    ficam NaN (numpy) ou None (Python puro).
+    """
+    inicios = sorted({l.get("beginTimeSeconds") for l in linhas if isinstance(l, dict) and l.get("beginTimeSeconds") is not None})
+    guids: List[str] = []
+    indice_guid: Dict[str, int] = {}
+    for linha in linhas:
+        if isinstance(linha, dict):
+            guid = _guid_da_linha(linha)
+            if guid and guid not in indice_guid:
+                indice_guid[guid] = len(guids)
+                guids.append(guid)
+    # Séries sem beginTimeSeconds (janela de um bucket só) viram uma coluna
+    indice_bucket = {inicio: i for i, inicio in enumerate(inicios)} or {None: 0}
+    n_buckets = len(indice_bucket)
+
+    if NUMPY_DISPONIVEL:
+        matrizes = {campo: np.full((len(guids), n_buckets), np.nan) for campo in campos}
+    else:
+        matrizes = {campo: [[None] * n_buckets for _ in guids] for campo in campos}
+
+    for linha in linhas:
+        if not isinstance(linha, dict):
+            continue
+        guid = _guid_da_linha(linha)
+        coluna = indice_bucket.get(linha.get("beginTimeSeconds"), n_buckets - 1)
+        if guid not in indice_guid:
+            continue
+        for campo in campos:
+            valor = linha.get(campo)
+            if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                matrizes[campo][indice_guid[guid]][coluna] = float(valor)
+    return guids, matrizes
+
+
+def _para_valor(valor: Any) -> Optional[float]:
+    if valor is None:
+        return None
+    valor = float(valor)
+    return None if math.isnan(valor) else valor
+
+
+def _rollup_numpy(matrizes: Dict[str, Any], serie: Dict[str, Any], n: int) -> List[Optional[float]]:
+    rollup = serie["rollup"]
+    with warnings.catch_warnings(), np.errstate(all="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if rollup == ROLLUP_RAZAO:
+            num = matrizes[serie["numerador"]][:, -n:]
+            den = matrizes[serie["denominador"]][:, -n:]
+            validos = ~np.isnan(num) & ~np.isnan(den)
+            soma_den = np.where(validos, den, 0).sum(axis=1)
+            resultado = np.where(validos, num, 0).sum(axis=1) / soma_den * serie.get("fator", 1)
+            resultado[soma_den == 0] = np.nan
+        else:
+            valores = matrizes[serie["campo"]][:, -n:]
+            if rollup == ROLLUP_MEDIA and serie.get("peso"):
+                pesos = matrizes[serie["peso"]][:, -n:]
+                validos = ~np.isnan(valores) & ~np.isnan(pesos)
+                soma_pesos = np.where(validos, pesos, 0).sum(axis=1)
+                resultado = np.where(validos, valores * pesos, 0).sum(axis=1) / soma_pesos
+                resultado[soma_pesos == 0] = np.nan
+            elif rollup == ROLLUP_MEDIA:
+                resultado = np.nanmean(valores, axis=1)
+            elif rollup == ROLLUP_MAX:
+                resultado = np.nanmax(valores, axis=1)
+            elif rollup == ROLLUP_MIN:
+                resultado = np.nanmin(valores, axis=1)
+            elif rollup == ROLLUP_SOMA:
+                resultado = np.nansum(valores, axis=1)
+                resultado[np.isnan(valores).all(axis=1)] = np.nan
+            elif rollup == ROLLUP_ULTIMO:
+                presentes = ~np.isnan(valores)
+                ultimo = n - 1 - np.argmax(presentes[:, ::-1], axis=1)
+                resultado = valores[np.arange(valores.shape[0]), ultimo]
+                resultado[~presentes.any(axis=1)] = np.nan
+            else:
+                raise ValueError(f"Rollup desconhecido: {rollup}")
+    return [_para_valor(v) for v in resultado]
+
+
+def _rollup_python(matrizes: Dict[str, Any], serie: Dict[str, Any], n: int) -> List[Optional[float]]:
+    rollup = serie["rollup"]
+    if rollup == ROLLUP_RAZAO:
+        resultado = []
+        for num, den in zip(matrizes[serie["numerador"]], matrizes[serie["denominador"]]):
+            pares = [(a, b) for a, b in zip(num[-n:], den[-n:]) if a is not None and b is not None]
+            soma_den = sum(b for _, b in pares)
+            resultado.append(sum(a for a, _ in pares) / soma_den * serie.get("fator", 1) if soma_den else None)
+        return resultado
+
+    linhas = matrizes[serie["campo"]]
+    pesos = matrizes[serie["peso"]] if rollup == ROLLUP_MEDIA and serie.get("peso") else [None] * len(linhas)
+    resultado = []
+    for linha, linha_pesos in zip(linhas, pesos):
+        janela = linha[-n:]
+        presentes = [v for v in janela if v is not None]
+        if not presentes:
+            resultado.append(None)
+        elif rollup == ROLLUP_MEDIA and linha_pesos is not None:
+            pares = [(v, p) for v, p in zip(janela, linha_pesos[-n:]) if v is not None and p is not None]
+            soma_pesos = sum(p for _, p in pares)
+            resultado.append(sum(v * p for v, p in pares) / soma_pesos if soma_pesos else None)
+        elif rollup == ROLLUP_MEDIA:
+            resultado.append(sum(presentes) / len(presentes))
+        elif rollup == ROLLUP_MAX:
+            resultado.append(max(presentes))
+        elif rollup == ROLLUP_MIN:
+            resultado.append(min(presentes))
+        elif rollup == ROLLUP_SOMA:
+            resultado.append(sum(presentes))
+        elif rollup == ROLLUP_ULTIMO:
+            resultado.append(presentes[-1])
+        else:
+            raise ValueError(f"Rollup desconhecido: {rollup}")
+    return resultado
+
+
+def derivar_periodos(linhas: Sequence[Dict[str, Any]], serie: Dict[str, Any], periodos: Dict[str, int]) -> Dict[str, Dict[str, float]]:
+    """
+    Deriva o valor de cada período a partir de uma série.
+
+    Args:
+        linhas: Resultado NRQL de ``FACET entity.guid ... TIMESERIES``
+        serie: Descrição da métrica (``rollup``, ``campo``, ``peso``, ``numerador``...)
+        periodos: ``{chave_periodo: quantidade de buckets finais}``
+
+    Returns:
+        ``{guid: {chave_periodo: valor}}`` (períodos sem dados ficam de fora)
+    """
+    if serie["rollup"] == ROLLUP_PERCENTIL:
+        return _derivar_percentis(linhas, serie, periodos)
+    guids, matrizes = montar_matrizes(linhas, campos_da_serie(serie))
+    return derivar_periodos_de_matrizes(guids, matrizes, serie, periodos)
+
+
+def derivar_periodos_de_matrizes(guids: Sequence[str], matrizes: Dict[str, Any], serie: Dict[str, Any],
+                                 periodos: Dict[str, int]) -> Dict[str, Dict[str, float]]:
+    """Mesmo que ``derivar_periodos``, a partir das matrizes (formato de ``montar_matrizes``)."""
+    por_guid: Dict[str, Dict[str, float]] = {guid: {} for guid in guids}
+    if not guids:
+        return por_guid
+    rollup = _rollup_numpy if NUMPY_DISPONIVEL else _rollup_python
+    for chave, n_buckets in periodos.items():
+        for guid, valor in zip(guids, rollup(matrizes, serie, max(1, n_buckets))):
+            if valor is not None:
+                por_guid[guid][chave] = valor
+    return por_guid
+
+
+def derivar_percentis_de_colunas(guids: Sequence[str], colunas: Sequence[Sequence[Optional[Sequence[float]]]],
+                                 serie: Dict[str, Any], periodos: Dict[str, int]) -> Dict[str, Dict[str, float]]:
+    """
+    Percentis por período a partir das contagens dos histogramas de cada bucket (uma coluna
+    cronológica por entidade, None nos buckets sem dados).
+    """
+    resultado: Dict[str, Dict[str, float]] = {}
+    for guid, coluna in zip(guids, colunas):
+        resultado[guid] = {}
+        for chave, n_buckets in periodos.items():
+            sketch = HistogramaMesclavel(serie["teto"], serie["bins"])
+            for contagens in coluna[-max(1, n_buckets):]:
+                if contagens:
+                    sketch.mesclar_contagens(contagens)
+            valor = sketch.quantil(serie.get("quantil", 0.95))
+            if valor is not None:
+                resultado[guid][chave] = valor
+    return resultado
+
+
+def _derivar_percentis(linhas: Sequence[Dict[str, Any]], serie: Dict[str, Any], periodos: Dict[str, int]) -> Dict[str, Dict[str, float]]:
+    inicios = sorted({l.get("beginTimeSeconds") for l in linhas if isinstance(l, dict) and l.get("beginTimeSeconds") is not None})
+    por_guid_bucket: Dict[str, Dict[Any, List[float]]] = {}
+    for linha in linhas:
+        if not isinstance(linha, dict):
+            continue
+        guid = _guid_da_linha(linha)
+        contagens = HistogramaMesclavel.extrair_contagens(linha.get(serie["campo"]))
+        if guid:
+            buckets = por_guid_bucket.setdefault(guid, {})
+            if contagens:
+                buckets[linha.get("beginTimeSeconds")] = contagens
+
+    guids = list(por_guid_bucket)
+    colunas = [[por_guid_bucket[guid].get(inicio) for inicio in (inicios or [None])] for guid in guids]
+    return derivar_percentis_de_colunas(guids, colunas, serie, periodos)
@@ -0,0 +1,317 @@
+"""
+Agendador de coleta por prioridade (entidades "quentes" x "frias").
+
+Em vez de recoletar tudo a cada intervalo fixo, cada entidade tem um nível de prioridade
+e um próximo horário de coleta numa fila de prioridade (heapq):
+
+- QUENTE: incidente aberto (NrAiIncident), deploy recente, apdex ruim ou taxa de erro subindo;
+  recoletada a cada ~1 minuto.
+- MORNA: entidade saudável que está reportando; cadência média.
+- FRIA: entidade que não reporta; cadência longa.
+
+Cada ciclo respeita um orçamento de queries, do qual saem primeiro as queries de sinais
+(incidentes e deploys, em cada conta) e depois o custo de cada entidade escolhida. Entre as entidades vencidas, a escolha segue
+o peso do nível somado ao tempo de atraso (aging), e uma entidade atrasada além de
+``MAX_STARVATION`` passa na frente de todas, então nenhuma fica sem coleta indefinidamente.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils.nrql_batch import extrair_resultados_nrql
+
+logger = logging.getLogger(__name__)
+
+NIVEL_QUENTE = "quente"
+NIVEL_MORNO = "morno"
+NIVEL_FRIO = "frio"
+
+INTERVALO_POR_NIVEL = {
+    NIVEL_QUENTE: int(os.getenv("NEW_RELIC_PRIORITY_HOT_INTERVAL", "60")),
+    NIVEL_MORNO: int(os.getenv("NEW_RELIC_PRIORITY_WARM_INTERVAL", "900")),
+    NIVEL_FRIO: int(os.getenv("NEW_RELIC_PRIORITY_COLD_INTERVAL", "21600")),
+}
+PESO_POR_NIVEL = {NIVEL_QUENTE: 100.0, NIVEL_MORNO: 10.0, NIVEL_FRIO: 1.0}
+
+PRIORITY_SCHEDULER_ENABLED = os.getenv("NEW_RELIC_PRIORITY_SCHEDULER", "true").lower() == "true"
+PRIORITY_TICK = int(os.getenv("NEW_RELIC_PRIORITY_TICK", "30"))  # segundos entre ciclos
+CYCLE_QUERY_BUDGET = int(os.getenv("NEW_RELIC_PRIORITY_QUERY_BUDGET", "200"))  # queries por ciclo
+# Custo padrão por entidade; o cache usa o custo real por domínio (custo_coleta_entidade)
+QUERIES_POR_ENTIDADE = float(os.getenv("NEW_RELIC_PRIORITY_QUERIES_PER_ENTITY", "8"))
+AGING_SECONDS = 60.0           # +1 ponto de prioridade por minuto de atraso
+MAX_STARVATION = int(os.getenv("NEW_RELIC_PRIORITY_MAX_STARVATION", str(4 * 3600)))  # segundos
+
+APDEX_RUIM = 0.7
+ERROR_RATE_MINIMO = 1.0        # % de erro abaixo do qual não se considera "subindo"
+ERROR_RATE_FATOR_ALTA = 1.5    # 30min acima de 1.5x a média de 24h
+
+INCIDENTES_NRQL = "SELECT latest(event) AS 'evento' FROM NrAiIncident FACET entity.guid SINCE 24 HOURS AGO LIMIT MAX"
+DEPLOYS_NRQL = "SELECT count(*) FROM Deployment FACET entity.guid SINCE 1 HOUR AGO LIMIT MAX"
+QUERIES_DE_SINAIS = 2  # por conta consultada
+
+Coletor = Callable[[List[Dict[str, Any]]], Awaitable[List[Dict[str, Any]]]]
+
+
+class SinaisPrioridade:
+    """Sinais externos às métricas da entidade: incidentes abertos e deploys recentes."""
+
+    def __init__(self, incidentes: Optional[Set[str]] = None, deploys: Optional[Set[str]] = None):
+        self.incidentes = set(incidentes or ())
+        self.deploys = set(deploys or ())
+
+
+def _guid_facet(linha: Dict[str, Any]) -> Optional[str]:
+    facet = linha.get("facet")
+    if isinstance(facet, list):
+        facet = facet[0] if facet else None
+    return facet or linha.get("entity.guid")
+
+
+async def coletar_sinais(executar_nrql: Callable[[str], Awaitable[Any]]) -> SinaisPrioridade:
+    """Busca incidentes abertos e deploys recentes (uma query FACET entity.guid para cada)."""
+    sinais = SinaisPrioridade()
+    try:
+        for linha in extrair_resultados_nrql(await executar_nrql(INCIDENTES_NRQL)):
+            if isinstance(linha, dict) and str(linha.get("evento") or "").lower() == "open":
+                guid = _guid_facet(linha)
+                if guid:
+                    sinais.incidentes.add(guid)
+    except Exception as e:
+        logger.warning(f"Erro ao buscar incidentes abertos para priorização: {e}")
+    try:
+        for linha in extrair_resultados_nrql(await executar_nrql(DEPLOYS_NRQL)):
+            guid = _guid_facet(linha) if isinstance(linha, dict) else None
+            if guid:
+                sinais.deploys.add(guid)
+    except Exception as e:
+        logger.warning(f"Erro ao buscar deploys recentes para priorização: {e}")
+    return sinais
+
+
+def _metrica(entidade: Dict[str, Any], periodo: str, *nomes: str) -> Optional[float]:
+    valores = (entidade.get("metricas") or {}).get(periodo) or {}
+    for nome in nomes:
+        valor = valores.get(nome)
+        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            return float(valor)
+    return None
+
+
+def classificar(entidade: Dict[str, Any], sinais: Optional[SinaisPrioridade] = None) -> Tuple[str, List[str]]:
+    """Retorna ``(nivel, motivos)`` de uma entidade."""
+    sinais = sinais or SinaisPrioridade()
+    guid = entidade.get("guid")
+    motivos = []
+    if guid in sinais.incidentes:
+        motivos.append("incidente_aberto")
+    if guid in sinais.deploys:
+        motivos.append("deploy_recente")
+
+    apdex = _metrica(entidade, "30min", "apdex", "apdexScore")
+    if apdex is not None and apdex < APDEX_RUIM:
+        motivos.append("apdex_ruim")
+
+    erro_recente = _metrica(entidade, "30min", "error_rate", "errorRate")
+    erro_base = _metrica(entidade, "24h", "error_rate", "errorRate")
+    if erro_recente is not None and erro_recente > ERROR_RATE_MINIMO:
+        if erro_base is None or erro_recente > erro_base * ERROR_RATE_FATOR_ALTA:
+            motivos.append("erro_subindo")
+
+    if motivos:
+        return NIVEL_QUENTE, motivos
+    if entidade.get("reporting") is False:
+        return NIVEL_FRIO, ["sem_reporte"]
+    return NIVEL_MORNO, []
+
+
+class _EntradaAgenda:
+    __slots__ = ("guid", "entidade", "nivel", "motivos", "proxima", "ultima_coleta", "versao")
+
+    def __init__(self, entidade: Dict[str, Any], proxima: float):
+        self.guid = entidade["guid"]
+        self.entidade = entidade
+        self.nivel = NIVEL_MORNO
+        self.motivos: List[str] = []
+        self.proxima = proxima
+        self.ultima_coleta: Optional[float] = None
+        self.versao = 0
+
+
+class PriorityCollectionScheduler:
+    """
+    Fila de prioridade de coletas por entidade com orçamento de queries por ciclo.
+
+    Uso:
+        agendador = PriorityCollectionScheduler(coletar, executar_nrql)
+        agendador.atualizar_entidades(entidades)
+        await agendador.atualizar_sinais()
+        atualizadas = await agendador.executar_ciclo()
+    """
+
+    def __init__(
+        self,
+        coletar: Coletor,
+        executar_nrql: Optional[Callable[[str], Awaitable[Any]]] = None,
+        orcamento: int = CYCLE_QUERY_BUDGET,
+        custo_entidade: Callable[[Dict[str, Any]], float] = lambda entidade: QUERIES_POR_ENTIDADE,
+        custo_sinais: float = QUERIES_DE_SINAIS,
+        intervalos: Optional[Dict[str, int]] = None,
+        aging_seconds: float = AGING_SECONDS,
+        max_starvation: float = MAX_STARVATION,
+    ):
+        self.coletar = coletar
+        self.executar_nrql = executar_nrql
+        self.orcamento = orcamento
+        self.custo_entidade = custo_entidade
+        self.custo_sinais = custo_sinais
+        self.intervalos = dict(INTERVALO_POR_NIVEL, **(intervalos or {}))
+        self.aging_seconds = aging_seconds
+        self.max_starvation = max_starvation
+        self.sinais = SinaisPrioridade()
+        self._entradas: Dict[str, _EntradaAgenda] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._seq = itertools.count()
+        self.ciclos = 0
+        self.coletas = 0
+        self.adiadas_por_orcamento = 0
+        self._gasto_sinais = 0.0  # queries de sinais ainda não descontadas de um ciclo
+        self.gasto_ultimo_ciclo = 0.0
+
+    def _agendar(self, entrada: _EntradaAgenda, proxima: float):
+        entrada.proxima = proxima
+        entrada.versao += 1
+        heapq.heappush(self._heap, (proxima, next(self._seq), entrada.guid, entrada.versao))
+
+    def _reclassificar(self, entrada: _EntradaAgenda, agora: float):
+        nivel, motivos = classificar(entrada.entidade, self.sinais)
+        entrada.motivos = motivos
+        if nivel == entrada.nivel:
+            return
+        entrada.nivel = nivel
+        # Ficou mais quente: antecipa a próxima coleta para a cadência do novo nível
+        base = entrada.ultima_coleta if entrada.ultima_coleta is not None else agora
+        antecipada = max(agora, base + self.intervalos[nivel])
+        if antecipada < entrada.proxima:
+            self._agendar(entrada, antecipada)
+
+    def atualizar_entidades(self, entidades: Iterable[Dict[str, Any]], agora: Optional[float] = None):
+        """Sincroniza a agenda com a lista atual: novas entram vencidas, ausentes saem."""
+        agora = time.time() if agora is None else agora
+        vistos = set()
+        for entidade in entidades:
+            guid = entidade.get("guid")
+            if not guid:
+                continue
+            vistos.add(guid)
+            entrada = self._entradas.get(guid)
+            if entrada is None:
+                entrada = _EntradaAgenda(entidade, agora)
+                self._entradas[guid] = entrada
+                entrada.nivel, entrada.motivos = classificar(entidade, self.sinais)
+                self._agendar(entrada, agora)
+            else:
+                entrada.entidade = entidade
+                self._reclassificar(entrada, agora)
+        for guid in [g for g in self._entradas if g not in vistos]:
+            del self._entradas[guid]
+
+    def aplicar_sinais(self, sinais: SinaisPrioridade, agora: Optional[float] = None):
+        agora = time.time() if agora is None else agora
+        self.sinais = sinais
+        for entrada in self._entradas.values():
+            self._reclassificar(entrada, agora)
+
+    async def atualizar_sinais(self, agora: Optional[float] = None):
+        """
+        Busca incidentes e deploys (se houver executor NRQL) e reclassifica a agenda. As queries
+        gastas saem do orçamento do próximo ciclo.
+        """
+        if self.executar_nrql is not None:
+            self._gasto_sinais += self.custo_sinais
+            self.aplicar_sinais(await coletar_sinais(self.executar_nrql), agora)
+
+    def _pontuacao(self, entrada: _EntradaAgenda, agora: float) -> float:
+        atraso = max(0.0, agora - entrada.proxima)
+        if atraso >= self.max_starvation:
+            return float("inf")
+        return PESO_POR_NIVEL[entrada.nivel] + atraso / self.aging_seconds
+
+    def selecionar(self, agora: Optional[float] = None, orcamento: Optional[float] = None) -> List[_EntradaAgenda]:
+        """
+        Retira da fila as entidades vencidas que cabem no orçamento, da maior para a menor
+        pontuação. As que não couberem continuam na fila (e acumulam atraso).
+        """
+        agora = time.time() if agora is None else agora
+        orcamento = self.orcamento if orcamento is None else orcamento
+        # Queries de sinais já feitas neste ciclo contam no orçamento
+        gasto, self._gasto_sinais = self._gasto_sinais, 0.0
+        vencidas = []
+        while self._heap and self._heap[0][0] <= agora:
+            _, _, guid, versao = heapq.heappop(self._heap)
+            entrada = self._entradas.get(guid)
+            if entrada is not None and entrada.versao == versao:
+                vencidas.append(entrada)
+
+        vencidas.sort(key=lambda e: self._pontuacao(e, agora), reverse=True)
+        escolhidas = []
+        for entrada in vencidas:
+            custo = self.custo_entidade(entrada.entidade)
+            if gasto + custo <= orcamento:
+                escolhidas.append(entrada)
+                gasto += custo
+            else:
+                self.adiadas_por_orcamento += 1
+                heapq.heappush(self._heap, (entrada.proxima, next(self._seq), entrada.guid, entrada.versao))
+        self.gasto_ultimo_ciclo = gasto
+        return escolhidas
+
+    async def executar_ciclo(self, agora: Optional[float] = None, orcamento: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Coleta as entidades escolhidas e reagenda cada uma conforme o nível."""
+        agora = time.time() if agora is None else agora
+        escolhidas = self.selecionar(agora, orcamento)
+        self.ciclos += 1
+        if not escolhidas:
+            return []
+
+        por_nivel: Dict[str, int] = {}
+        for entrada in escolhidas:
+            por_nivel[entrada.nivel] = por_nivel.get(entrada.nivel, 0) + 1
+        logger.info(f"Ciclo de coleta priorizada: {len(escolhidas)} entidades {por_nivel}")
+
+        try:
+            resultados = await self.coletar([e.entidade for e in escolhidas])
+        except Exception as e:
+            logger.error(f"Erro no ciclo de coleta priorizada: {e}")
+            resultados = []
+
+        atualizadas = {r.get("guid"): r for r in resultados if isinstance(r, dict) and r.get("guid")}
+        for entrada in escolhidas:
+            if entrada.guid not in self._entradas:
+                continue
+            if entrada.guid in atualizadas:
+                entrada.entidade = atualizadas[entrada.guid]
+                entrada.ultima_coleta = agora
+                self.coletas += 1
+                entrada.nivel, entrada.motivos = classificar(entrada.entidade, self.sinais)
+            self._agendar(entrada, agora + self.intervalos[entrada.nivel])
+        return list(atualizadas.values())
+
+    def get_status(self) -> Dict[str, Any]:
+        por_nivel: Dict[str, int] = {}
+        for entrada in self._entradas.values():
+            por_nivel[entrada.nivel] = por_nivel.get(entrada.nivel, 0) + 1
+        return {
+            "entidades": len(self._entradas),
+            "por_nivel": por_nivel,
+            "orcamento_por_ciclo": self.orcamento,
+            "gasto_ultimo_ciclo": round(self.gasto_ultimo_ciclo, 1),
+            "ciclos": self.ciclos,
+            "coletas": self.coletas,
+            "adiadas_por_orcamento": self.adiadas_por_orcamento,
+            "incidentes_abertos": len(self.sinais.incidentes),
+            "deploys_recentes": len(self.sinais.deploys),
+        }
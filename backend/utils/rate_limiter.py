@@ -0,0 +1,233 @@
+"""
+Rate limiter único (token bucket) compartilhado por todos os coletores New Relic do processo.
+
+Mantém um bucket por família de endpoint (GraphQL/NerdGraph, NRQL/Insights e REST v2).
+Cada requisição consome um token; os tokens são repostos continuamente na taxa configurada,
+permitindo rajadas até a capacidade do bucket. Respostas 429 e os headers ``Retry-After`` /
+``X-RateLimit-*`` pausam o bucket correspondente para todos os chamadores ao mesmo tempo.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# Taxas (requisições/s) e capacidades (rajada) por endpoint, ajustáveis por ambiente.
+# NRQL: a New Relic permite ~3.000 consultas/min por conta (50/s).
+GRAPHQL_RATE = float(os.getenv("NEW_RELIC_GRAPHQL_RATE", "25"))
+GRAPHQL_BURST = float(os.getenv("NEW_RELIC_GRAPHQL_BURST", "50"))
+NRQL_RATE = float(os.getenv("NEW_RELIC_NRQL_RATE", "50"))
+NRQL_BURST = float(os.getenv("NEW_RELIC_NRQL_BURST", "50"))
+REST_RATE = float(os.getenv("NEW_RELIC_REST_RATE", "10"))
+REST_BURST = float(os.getenv("NEW_RELIC_REST_BURST", "20"))
+
+# Pausa usada quando a API responde 429 sem Retry-After
+DEFAULT_RETRY_AFTER = 60.0
+# Limite superior de qualquer pausa imposta por headers (proteção contra valores absurdos)
+MAX_RETRY_AFTER = 600.0
+
+ENDPOINT_GRAPHQL = "graphql"
+ENDPOINT_NRQL = "nrql"
+ENDPOINT_REST = "rest"
+
+
+class TokenBucket:
+    """
+    Bucket de tokens assíncrono.
+
+    ``acquire`` reserva o token imediatamente (o saldo pode ficar negativo) e dorme até que os
+    tokens repostos cubram a reserva. Cada reserva é uma posição numa fila (total reservado até
+    ela), então os chamadores são liberados na ordem de chegada, um a cada ``1/rate`` segundos,
+    inclusive depois de uma pausa.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate e capacity devem ser positivos")
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()  # durante uma pausa, fica no fim dela: nada é reposto até lá
+        self.paused_until = 0.0
+        self._creditado = capacity  # total de tokens já disponibilizados (saldo = creditado - reservado)
+        self._reservado = 0.0
+        self.acquired = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self._creditado += tokens - self.tokens
+            self.tokens = tokens
+            self.updated_at = now
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        """Consome ``tokens`` e aguarda se necessário. Retorna o tempo total de espera (s)."""
+        inicio = time.monotonic()
+        self._refill(inicio)
+        self.tokens -= tokens
+        self._reservado += tokens
+        posicao = self._reservado
+        self.acquired += 1
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            # Uma resposta 429 pode ter adiado a reposição enquanto dormíamos
+            falta = posicao - self._creditado
+            wait = max(self.updated_at - now, 0.0) + (falta / self.rate if falta > 0 else 0.0)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            waited = time.monotonic() - inicio
+        self.total_wait += waited
+        return waited
+
+    def pause(self, seconds: float):
+        """
+        Bloqueia o bucket por ``seconds`` (ex.: Retry-After): zera o saldo de rajada e só volta
+        a repor tokens quando a pausa termina, para não liberar uma rajada logo depois dela.
+        """
+        seconds = min(max(seconds, 0.0), MAX_RETRY_AFTER)
+        now = time.monotonic()
+        if now + seconds > self.paused_until:
+            self._refill(now)
+            if self.tokens > 0:
+                self._creditado -= self.tokens
+                self.tokens = 0.0
+            self.paused_until = now + seconds
+            self.updated_at = max(self.updated_at, self.paused_until)
+            logger.warning(f"Rate limit ({self.name}): pausando requisições por {seconds:.1f}s")
+
+    def get_status(self) -> Dict:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "rate": self.rate,
+            "capacity": self.capacity,
+            "tokens": round(self.tokens, 2),
+            "paused_for": round(max(0.0, self.paused_until - now), 2),
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "total_wait": round(self.total_wait, 2),
+        }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Converte um header Retry-After (segundos ou data HTTP) em segundos."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    if headers is None:
+        return None
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.lower())
+    return value
+
+
+def endpoint_for_url(url: str) -> str:
+    """Classifica a URL da New Relic na família de endpoint (bucket) correspondente."""
+    url = (url or "").lower()
+    if "graphql" in url:
+        return ENDPOINT_GRAPHQL
+    if "insights" in url or url.rstrip("/").endswith("/query"):
+        return ENDPOINT_NRQL
+    return ENDPOINT_REST
+
+
+class NewRelicRateLimiter:
+    """Conjunto de buckets por endpoint compartilhado por todos os coletores."""
+
+    def __init__(self, limits: Optional[Dict[str, tuple]] = None):
+        limits = limits or {
+            ENDPOINT_GRAPHQL: (GRAPHQL_RATE, GRAPHQL_BURST),
+            ENDPOINT_NRQL: (NRQL_RATE, NRQL_BURST),
+            ENDPOINT_REST: (REST_RATE, REST_BURST),
+        }
+        self.buckets: Dict[str, TokenBucket] = {
+            name: TokenBucket(name, rate, capacity) for name, (rate, capacity) in limits.items()
+        }
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        return self.buckets.get(endpoint) or self.buckets[ENDPOINT_REST]
+
+    async def acquire(self, endpoint: str) -> float:
+        """Aguarda um token do bucket do endpoint. Retorna o tempo de espera (s)."""
+        return await self.bucket(endpoint).acquire()
+
+    def observe_response(self, endpoint: str, status: int, headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        """
+        Ajusta o bucket a partir da resposta HTTP.
+        Retorna a pausa aplicada (s), ou None se a resposta não indicou limite.
+        """
+        bucket = self.bucket(endpoint)
+        retry_after = parse_retry_after(_header(headers, "Retry-After"))
+
+        if status == 429:
+            bucket.throttled += 1
+            pause = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+            bucket.pause(pause)
+            return pause
+
+        # Headers X-RateLimit-*: sem saldo restante, pausa até o reset da janela
+        remaining = _header(headers, "X-RateLimit-Remaining")
+        if remaining is not None:
+            try:
+                esgotado = float(remaining) <= 0
+            except ValueError:
+                esgotado = False
+            if esgotado:
+                pause = retry_after
+                reset = _header(headers, "X-RateLimit-Reset")
+                if pause is None and reset is not None:
+                    try:
+                        reset_value = float(reset)
+                        # Valores grandes são epoch; pequenos são segundos até o reset
+                        pause = reset_value - time.time() if reset_value > 1e9 else reset_value
+                    except ValueError:
+                        pause = None
+                if pause is not None and pause > 0:
+                    bucket.pause(pause)
+                    return pause
+        elif retry_after:
+            bucket.pause(retry_after)
+            return retry_after
+        return None
+
+    def get_status(self) -> Dict[str, Dict]:
+        return {name: bucket.get_status() for name, bucket in self.buckets.items()}
+
+
+# Instância única do processo
+_rate_limiter: Optional[NewRelicRateLimiter] = None
+
+
+def get_rate_limiter() -> NewRelicRateLimiter:
+    """Retorna o rate limiter compartilhado do processo, criando-o sob demanda."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = NewRelicRateLimiter()
+    return _rate_limiter
@@ -0,0 +1,275 @@
+"""
+Gravação do cache completo em segmentos NDJSON durante a coleta.
+
+Antes, ``atualizar_cache_completo_avancado`` só gravava no fim: com o resultado inteiro em
+memória, montava um único ``json.dumps(resultado, indent=2)`` (uma cópia inteira do cache em
+string) e escrevia ``cache_completo.json`` de uma vez. Aqui cada entidade vai para o disco
+assim que é coletada, uma por linha, em arquivos de segmento de tamanho limitado; o pico de
+memória da gravação passa a ser o de uma entidade.
+
+Layout (``SEGMENT_DIR``):
+    manifest.json                  geração ativa, segmentos e contagens
+    <geracao>/seg-00000.ndjson     uma entidade por linha
+    <geracao>/globais.json         o resto do resultado (status, logs, incidentes...)
+
+Uma geração só passa a valer quando o manifesto que aponta para ela é gravado (arquivo
+temporário + fsync + rename): uma coleta que cai no meio deixa a geração anterior intacta. As
+listas por domínio (``APM``, ``BROWSER``...) não são gravadas; a leitura as remonta agrupando
+as entidades por ``domain``, de modo que o cache em memória sai dos mesmos registros.
+
+Gerações já gravadas em outro lugar (a saída de cada shard de ``utils.collection_shards``) são
+publicadas por ``publicar_geracao`` sem reler as entidades: os arquivos de segmento entram na
+geração nova por hard link (ou cópia) e o manifesto marca a ``origem``, pela qual o servidor
+reconhece uma geração gravada por outro processo e a carrega.
+
+O ``cache_completo.json`` continua disponível como artefato de compatibilidade
+(``NEW_RELIC_CACHE_JSON_EXPORT``), gravado em stream a partir dos mesmos dados.
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils.cache_persistence import gravar_atomico, serializar_texto
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_CACHE_ENABLED = os.getenv("NEW_RELIC_SEGMENT_CACHE", "true").lower() == "true"
+SEGMENT_DIR = Path("historico") / "segmentos"
+SEGMENT_MAX_RECORDS = int(os.getenv("NEW_RELIC_SEGMENT_MAX_RECORDS", "500"))
+SEGMENT_MAX_BYTES = int(os.getenv("NEW_RELIC_SEGMENT_MAX_BYTES", str(16 * 1024 * 1024)))
+JSON_EXPORT_ENABLED = os.getenv("NEW_RELIC_CACHE_JSON_EXPORT", "true").lower() == "true"
+
+MANIFESTO = "manifest.json"
+GERACAO_ABANDONADA = 24 * 3600  # segundos sem escrita até uma geração órfã ser apagada
+VERSAO_MANIFESTO = 1
+ORIGEM_SHARDS = "shards"  # geração publicada pelo coordenador da coleta em shards
+
+
+_serializar = serializar_texto
+
+
+def _gravar_atomico(destino: Path, conteudo: str):
+    gravar_atomico(destino, conteudo.encode("utf-8"))
+
+
+class SegmentWriter:
+    """Grava as entidades de uma coleta numa geração nova de segmentos."""
+
+    def __init__(self, raiz=SEGMENT_DIR, max_registros: int = SEGMENT_MAX_RECORDS,
+                 max_bytes: int = SEGMENT_MAX_BYTES):
+        self.raiz = Path(raiz)
+        self.max_registros = max(1, max_registros)
+        self.max_bytes = max_bytes
+        self.geracao = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.diretorio = self.raiz / self.geracao
+        self.segmentos: List[Dict[str, Any]] = []
+        self.dominios: Dict[str, int] = {}
+        self.total = 0
+        self._arquivo = None
+
+    def _abrir_segmento(self):
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        nome = f"seg-{len(self.segmentos):05d}.ndjson"
+        self._arquivo = open(self.diretorio / nome, "w", encoding="utf-8")
+        self.segmentos.append({"arquivo": f"{self.geracao}/{nome}", "registros": 0, "bytes": 0})
+
+    def _fechar_segmento(self):
+        if self._arquivo is not None:
+            self._arquivo.flush()
+            os.fsync(self._arquivo.fileno())
+            self._arquivo.close()
+            self._arquivo = None
+
+    def escrever(self, entidade: Dict[str, Any]):
+        """Anexa uma entidade ao segmento atual (abrindo o próximo quando este enche)."""
+        atual = self.segmentos[-1] if self.segmentos else None
+        if atual is None or atual["registros"] >= self.max_registros or atual["bytes"] >= self.max_bytes:
+            self._fechar_segmento()
+            self._abrir_segmento()
+            atual = self.segmentos[-1]
+        linha = _serializar(entidade) + "\n"
+        self._arquivo.write(linha)
+        self._arquivo.flush()
+        atual["registros"] += 1
+        atual["bytes"] += len(linha.encode("utf-8"))
+        dominio = entidade.get("domain", "UNKNOWN")
+        self.dominios[dominio] = self.dominios.get(dominio, 0) + 1
+        self.total += 1
+
+    def finalizar(self, dados: Optional[Dict[str, Any]] = None, origem: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Fecha a geração: grava os dados globais (``dados`` sem a lista de entidades nem as listas
+        por domínio), publica o manifesto e remove as gerações anteriores.
+        """
+        self._fechar_segmento()
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        globais = {k: v for k, v in (dados or {}).items() if k != "entidades" and k not in self.dominios}
+        _gravar_atomico(self.diretorio / "globais.json", _serializar(globais))
+        manifesto = {
+            "versao": VERSAO_MANIFESTO,
+            "geracao": self.geracao,
+            "timestamp": globais.get("timestamp") or datetime.now().isoformat(),
+            "gravado_em": time.time(),
+            "total_registros": self.total,
+            "contagem_por_dominio": dict(self.dominios),
+            "segmentos": self.segmentos,
+            "globais": f"{self.geracao}/globais.json",
+        }
+        if origem:
+            manifesto["origem"] = origem
+        anterior = ler_manifesto(self.raiz)
+        _gravar_atomico(self.raiz / MANIFESTO, json.dumps(manifesto, ensure_ascii=False, indent=2))
+        self._remover_geracoes_antigas(anterior.get("geracao") if anterior else None)
+        logger.info(f"Cache em segmentos gravado: {self.total} entidades em {len(self.segmentos)} segmentos ({self.geracao})")
+        return manifesto
+
+    def abortar(self):
+        """Descarta a geração em andamento; o manifesto continua apontando para a anterior."""
+        if self._arquivo is not None:
+            self._arquivo.close()
+            self._arquivo = None
+        shutil.rmtree(self.diretorio, ignore_errors=True)
+
+    def _remover_geracoes_antigas(self, anterior: Optional[str]):
+        # Outra gravação pode estar em andamento em paralelo (ex.: coleta completa enquanto o
+        # agendador salva o cache): além da geração substituída, só saem diretórios abandonados
+        limite = time.time() - GERACAO_ABANDONADA
+        for caminho in self.raiz.iterdir():
+            if not caminho.is_dir() or caminho.name == self.geracao:
+                continue
+            if caminho.name == anterior or caminho.stat().st_mtime < limite:
+                shutil.rmtree(caminho, ignore_errors=True)
+
+
+def ler_manifesto(raiz=SEGMENT_DIR) -> Optional[Dict[str, Any]]:
+    caminho = Path(raiz) / MANIFESTO
+    if not caminho.exists():
+        return None
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            manifesto = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Manifesto de segmentos ilegível ({caminho}): {e}")
+        return None
+    return manifesto if manifesto.get("versao") == VERSAO_MANIFESTO else None
+
+
+def iter_registros(manifesto: Dict[str, Any], raiz=SEGMENT_DIR) -> Iterator[Dict[str, Any]]:
+    """Entidades da geração do manifesto, em ordem de gravação."""
+    raiz = Path(raiz)
+    for segmento in manifesto.get("segmentos", []):
+        with open(raiz / segmento["arquivo"], "r", encoding="utf-8") as f:
+            for linha in f:
+                if linha.strip():
+                    yield json.loads(linha)
+
+
+def carregar_dados(raiz=SEGMENT_DIR) -> Optional[Dict[str, Any]]:
+    """
+    Remonta o dicionário do cache (globais + ``entidades`` + listas por domínio) a partir da
+    geração ativa. Devolve None se não houver geração válida.
+    """
+    raiz = Path(raiz)
+    manifesto = ler_manifesto(raiz)
+    if manifesto is None:
+        return None
+    try:
+        with open(raiz / manifesto["globais"], "r", encoding="utf-8") as f:
+            dados = json.load(f)
+        entidades = list(iter_registros(manifesto, raiz))
+    except (OSError, KeyError, json.JSONDecodeError) as e:
+        logger.warning(f"Geração {manifesto.get('geracao')} do cache em segmentos ilegível: {e}")
+        return None
+    if len(entidades) != manifesto.get("total_registros"):
+        logger.warning(f"Geração {manifesto.get('geracao')} incompleta: {len(entidades)} de {manifesto.get('total_registros')} entidades")
+        return None
+    for entidade in entidades:
+        dados.setdefault(entidade.get("domain", "UNKNOWN"), []).append(entidade)
+    dados["entidades"] = entidades
+    return dados
+
+
+def _vincular(origem: Path, destino: Path):
+    try:
+        os.link(origem, destino)
+    except OSError:
+        shutil.copyfile(origem, destino)
+
+
+def publicar_geracao(saidas: List, raiz=SEGMENT_DIR, globais: Optional[Dict[str, Any]] = None,
+                     origem: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Publica em ``raiz`` uma geração com os segmentos das gerações ativas de ``saidas`` (diretórios
+    com manifesto próprio), na ordem dada, sem desserializar as entidades. Os dados globais são os
+    da primeira saída atualizados com ``globais`` (chaves com None são retiradas). As saídas não
+    são alteradas.
+    """
+    writer = SegmentWriter(raiz)
+    try:
+        writer.diretorio.mkdir(parents=True, exist_ok=True)
+        base = None
+        for saida in map(Path, saidas):
+            manifesto = ler_manifesto(saida)
+            if manifesto is None:
+                raise RuntimeError(f"Saída sem manifesto válido: {saida}")
+            if base is None:
+                with open(saida / manifesto["globais"], "r", encoding="utf-8") as f:
+                    base = json.load(f)
+            for segmento in manifesto["segmentos"]:
+                nome = f"seg-{len(writer.segmentos):05d}.ndjson"
+                _vincular(saida / segmento["arquivo"], writer.diretorio / nome)
+                writer.segmentos.append(dict(segmento, arquivo=f"{writer.geracao}/{nome}"))
+            for dominio, quantidade in manifesto.get("contagem_por_dominio", {}).items():
+                writer.dominios[dominio] = writer.dominios.get(dominio, 0) + quantidade
+            writer.total += manifesto.get("total_registros", 0)
+        dados = {k: v for k, v in dict(base or {}, **(globais or {})).items() if v is not None}
+        dados["total_entidades"] = writer.total
+        dados["contagem_por_dominio"] = dict(writer.dominios)
+        return writer.finalizar(dados, origem=origem)
+    except BaseException:
+        writer.abortar()
+        raise
+
+
+def gravar_dados(dados: Dict[str, Any], raiz=SEGMENT_DIR, **kwargs) -> Dict[str, Any]:
+    """Grava um dicionário de cache já montado como uma geração nova de segmentos."""
+    writer = SegmentWriter(raiz, **kwargs)
+    try:
+        for entidade in dados.get("entidades") or []:
+            writer.escrever(entidade)
+        return writer.finalizar(dados)
+    except BaseException:
+        writer.abortar()
+        raise
+
+
+def exportar_json(dados: Dict[str, Any], destino: Path):
+    """
+    Grava ``dados`` como JSON (o ``cache_completo.json`` de compatibilidade) item a item, sem
+    montar o documento inteiro numa string. Troca o arquivo de destino por rename.
+    """
+    destino = Path(destino)
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    temporario = destino.with_name(f".{destino.name}.{os.getpid()}.tmp")
+    with open(temporario, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i, (chave, valor) in enumerate(dados.items()):
+            f.write(("," if i else "") + "\n" + _serializar(chave) + ": ")
+            if isinstance(valor, list):
+                f.write("[")
+                for j, item in enumerate(valor):
+                    f.write(("," if j else "") + "\n" + _serializar(item))
+                f.write("\n]")
+            else:
+                f.write(_serializar(valor))
+        f.write("\n}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, destino)
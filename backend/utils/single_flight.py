@@ -0,0 +1,81 @@
+"""
+Coalescência de requisições idênticas em andamento (single-flight).
+
+Quando vários chamadores pedem a mesma consulta ao mesmo tempo (ex.: muitos usuários abrindo
+o mesmo incidente), apenas o primeiro dispara a chamada à New Relic; os demais aguardam o
+mesmo future e recebem o mesmo resultado (ou a mesma exceção).
+"""
+
+import asyncio
+import copy
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    ``await flight.do(chave, fabrica)`` executa ``fabrica()`` uma única vez por chave enquanto
+    houver uma execução em andamento.
+
+    A execução roda em uma task própria: o cancelamento de um chamador não cancela a consulta
+    dos demais. Quando a chamada foi compartilhada, cada chamador recebe uma cópia do resultado,
+    para que alterações de um não afetem os outros.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        flight = self._flights.get(key)
+        if flight is None or flight.task.done() or flight.task.get_loop() is not loop:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+            # Remove a entrada assim que a execução termina (antes de acordar os chamadores)
+            flight.task.add_done_callback(lambda _t, k=key, f=flight: self._forget(k, f))
+            self.executions += 1
+        else:
+            flight.waiters += 1
+            self.coalesced += 1
+            logger.debug(f"Requisição coalescida com chamada em andamento: {key!r:.120}")
+
+        result = await asyncio.shield(flight.task)
+        return copy.deepcopy(result) if flight.waiters else result
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
+
+
+# Instância única do processo
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """Retorna o coordenador single-flight compartilhado do processo."""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
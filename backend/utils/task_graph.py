@@ -0,0 +1,83 @@
+"""
+Grafo de tarefas assíncronas com dependências declaradas.
+
+Cada nó é uma corrotina que recebe o dicionário de resultados das suas dependências.
+Nós independentes rodam em paralelo; um nó só começa quando todas as dependências terminaram.
+A latência total passa a ser a da cadeia de dependências mais longa, e não a soma de todas as chamadas.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+NodeFunc = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class TaskGraph:
+    """
+    Uso:
+        grafo = TaskGraph()
+        grafo.add("logs", lambda r: coletor.collect_entity_logs(guid))
+        grafo.add("padroes", lambda r: analisar(r["logs"]), depends_on=["logs"])
+        resultados = await grafo.run()
+
+    Falhas de um nó são registradas em ``errors`` e o resultado do nó vira ``None``;
+    os dependentes continuam executando com esse valor.
+    """
+
+    def __init__(self):
+        self._nodes: Dict[str, NodeFunc] = {}
+        self._deps: Dict[str, List[str]] = {}
+        self.errors: Dict[str, Exception] = {}
+
+    def add(self, name: str, func: NodeFunc, depends_on: Iterable[str] = ()):
+        if name in self._nodes:
+            raise ValueError(f"Nó duplicado no grafo: {name}")
+        self._nodes[name] = func
+        self._deps[name] = list(depends_on)
+        return self
+
+    def _validate(self):
+        for name, deps in self._deps.items():
+            for dep in deps:
+                if dep not in self._nodes:
+                    raise ValueError(f"Nó '{name}' depende de '{dep}', que não existe")
+        # Detecção de ciclo (DFS)
+        state: Dict[str, int] = {}
+
+        def visit(node: str, path: List[str]):
+            if state.get(node) == 1:
+                raise ValueError(f"Ciclo de dependências: {' -> '.join(path + [node])}")
+            if state.get(node) == 2:
+                return
+            state[node] = 1
+            for dep in self._deps[node]:
+                visit(dep, path + [node])
+            state[node] = 2
+
+        for node in self._nodes:
+            visit(node, [])
+
+    async def run(self) -> Dict[str, Any]:
+        """Executa todos os nós respeitando as dependências e retorna ``{nome: resultado}``."""
+        self._validate()
+        results: Dict[str, Any] = {}
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def run_node(name: str):
+            deps = self._deps[name]
+            if deps:
+                await asyncio.gather(*(tasks[dep] for dep in deps))
+            try:
+                results[name] = await self._nodes[name]({dep: results.get(dep) for dep in deps})
+            except Exception as e:
+                logger.warning(f"Tarefa '{name}' falhou: {e}")
+                self.errors[name] = e
+                results[name] = None
+
+        for name in self._nodes:
+            tasks[name] = asyncio.ensure_future(run_node(name))
+        await asyncio.gather(*tasks.values())
+        return results
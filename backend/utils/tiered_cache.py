@@ -0,0 +1,401 @@
+"""
+Cache em camadas para visões calculadas e resultados de consultas.
+
+``get_cache(tipo_cache=...)`` aceitava ``rapido`` (30 s), ``padrao`` (1 h) e ``longo`` (24 h),
+mas os três liam o mesmo dict e só mudava a idade aceita. Aqui cada camada guarda entradas de
+verdade, com limite de bytes, tempo máximo de permanência e despejo LRU:
+
+    quente  LRU em memória do processo (JSON serializado: tamanho exato, cada leitura é uma cópia)
+    morna   SQLite em disco, JSON sem compressão
+    fria    SQLite em disco, JSON comprimido (zlib), retenção longa para dados históricos
+
+Uma entrada nasce na camada quente. Quando passa do tempo de permanência da camada, ou é a menos
+usada de uma camada cheia, desce para a seguinte (a fria descarta). Um acerto na morna ou na fria
+promove a entrada para a camada mais alta que ainda comporta a idade dela. A idade conta do
+momento em que o valor foi calculado (não muda ao trocar de camada); cada entrada guarda também,
+opcionalmente, a versão do cache principal de que foi derivada.
+
+No event loop só a camada quente é consultada (``obter_async``/``guardar_async``): ela tem lock
+próprio, curto, e não espera o das camadas em disco, que a thread de persistência segura durante
+leituras, gravações e compressão no SQLite. O que passa da quente roda num executor.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.cache_persistence import desserializar_json, serializar_json
+
+logger = logging.getLogger(__name__)
+
+TIERED_CACHE_ENABLED = os.getenv("NEW_RELIC_TIERED_CACHE", "true").lower() == "true"
+
+CAMADA_QUENTE_MAX_BYTES = int(os.getenv("NEW_RELIC_CACHE_QUENTE_MAX_BYTES", str(64 * 1024 * 1024)))
+CAMADA_MORNA_MAX_BYTES = int(os.getenv("NEW_RELIC_CACHE_MORNA_MAX_BYTES", str(512 * 1024 * 1024)))
+CAMADA_FRIA_MAX_BYTES = int(os.getenv("NEW_RELIC_CACHE_FRIA_MAX_BYTES", str(1024 * 1024 * 1024)))  # já comprimidos
+CAMADA_QUENTE_TTL = int(os.getenv("NEW_RELIC_CACHE_QUENTE_TTL", "300"))           # 5 min em memória
+CAMADA_MORNA_TTL = int(os.getenv("NEW_RELIC_CACHE_MORNA_TTL", "86400"))           # 24 h
+CAMADA_FRIA_TTL = int(os.getenv("NEW_RELIC_CACHE_FRIA_TTL", str(30 * 86400)))     # 30 dias
+MANUTENCAO_INTERVALO = 60  # segundos entre varreduras de entradas vencidas
+
+CAMADA_MORNA_FILE = Path("historico") / "cache_morno.sqlite3"
+CAMADA_FRIA_FILE = Path("historico") / "cache_frio.sqlite3"
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS entradas (
+    chave TEXT PRIMARY KEY,
+    conteudo BLOB NOT NULL,
+    tamanho INTEGER NOT NULL,
+    criado_em REAL NOT NULL,
+    versao INTEGER,
+    acessado_em REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entradas_acesso ON entradas (acessado_em);
+CREATE INDEX IF NOT EXISTS idx_entradas_criacao ON entradas (criado_em);
+"""
+
+
+# Resposta de ``obter_quente`` quando a camada quente não tem a entrada (None é um valor válido)
+AUSENTE = object()
+
+
+class Entrada:
+    """Valor serializado (JSON) com o momento do cálculo e a versão de origem."""
+    __slots__ = ("conteudo", "criado_em", "versao")
+
+    def __init__(self, conteudo: bytes, criado_em: float, versao: Optional[int] = None):
+        self.conteudo = conteudo
+        self.criado_em = criado_em
+        self.versao = versao
+
+
+class CamadaMemoria:
+    """Camada quente: LRU em memória limitado por bytes (lock próprio, só em operações de dict)."""
+
+    def __init__(self, nome: str = "quente", max_bytes: int = CAMADA_QUENTE_MAX_BYTES, ttl: float = CAMADA_QUENTE_TTL):
+        self.nome = nome
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entradas: "OrderedDict[str, Entrada]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.bytes = 0
+
+    def obter(self, chave: str) -> Optional[Entrada]:
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None:
+                self._entradas.move_to_end(chave)
+            return entrada
+
+    def guardar(self, chave: str, entrada: Entrada) -> List[Tuple[str, Entrada]]:
+        """Guarda a entrada e devolve as despejadas (menos usadas) para caber no limite."""
+        with self._lock:
+            self.remover(chave)
+            self._entradas[chave] = entrada
+            self.bytes += len(entrada.conteudo)
+            despejadas = []
+            while self.bytes > self.max_bytes and len(self._entradas) > 1:
+                antiga = next(iter(self._entradas))
+                despejadas.append((antiga, self.remover(antiga)))
+            return despejadas
+
+    def remover(self, chave: str) -> Optional[Entrada]:
+        with self._lock:
+            entrada = self._entradas.pop(chave, None)
+            if entrada is not None:
+                self.bytes -= len(entrada.conteudo)
+            return entrada
+
+    descartar = remover
+
+    def vencidas(self, agora: float) -> List[Tuple[str, Entrada]]:
+        """Remove e devolve as entradas mais velhas que o tempo de permanência da camada."""
+        with self._lock:
+            chaves = [chave for chave, entrada in self._entradas.items() if agora - entrada.criado_em >= self.ttl]
+            return [(chave, self.remover(chave)) for chave in chaves]
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+            self.bytes = 0
+
+    def fechar(self):
+        pass
+
+
+class CamadaDisco:
+    """Camada em disco (SQLite): LRU por ``acessado_em``, limitada pelos bytes gravados."""
+
+    def __init__(self, nome: str, caminho, max_bytes: int, ttl: float, comprimir: bool = False):
+        self.nome = nome
+        self.caminho = Path(caminho)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.comprimir = comprimir
+        self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        self._conexao = sqlite3.connect(self.caminho, check_same_thread=False, isolation_level=None)
+        self._conexao.execute("PRAGMA journal_mode=WAL")
+        self._conexao.execute("PRAGMA synchronous=NORMAL")
+        self._conexao.executescript(ESQUEMA)
+        self.bytes = self._conexao.execute("SELECT COALESCE(SUM(tamanho), 0) FROM entradas").fetchone()[0]
+
+    def _entrada(self, conteudo: bytes, criado_em: float, versao: Optional[int]) -> Entrada:
+        return Entrada(zlib.decompress(conteudo) if self.comprimir else bytes(conteudo), criado_em, versao)
+
+    def obter(self, chave: str) -> Optional[Entrada]:
+        linha = self._conexao.execute(
+            "SELECT conteudo, criado_em, versao FROM entradas WHERE chave = ?", (chave,)).fetchone()
+        if linha is None:
+            return None
+        self._conexao.execute("UPDATE entradas SET acessado_em = ? WHERE chave = ?", (time.time(), chave))
+        return self._entrada(*linha)
+
+    def guardar(self, chave: str, entrada: Entrada) -> List[Tuple[str, Entrada]]:
+        conteudo = zlib.compress(entrada.conteudo, 6) if self.comprimir else entrada.conteudo
+        self.descartar(chave)
+        self._conexao.execute(
+            "INSERT INTO entradas (chave, conteudo, tamanho, criado_em, versao, acessado_em) VALUES (?, ?, ?, ?, ?, ?)",
+            (chave, conteudo, len(conteudo), entrada.criado_em, entrada.versao, time.time()))
+        self.bytes += len(conteudo)
+        despejadas = []
+        while self.bytes > self.max_bytes:
+            linha = self._conexao.execute(
+                "SELECT chave FROM entradas WHERE chave != ? ORDER BY acessado_em, rowid LIMIT 1", (chave,)).fetchone()
+            if linha is None:
+                break
+            despejadas.append((linha[0], self.remover(linha[0])))
+        return despejadas
+
+    def remover(self, chave: str) -> Optional[Entrada]:
+        linha = self._conexao.execute(
+            "SELECT conteudo, criado_em, versao, tamanho FROM entradas WHERE chave = ?", (chave,)).fetchone()
+        if linha is None:
+            return None
+        self._conexao.execute("DELETE FROM entradas WHERE chave = ?", (chave,))
+        self.bytes -= linha[3]
+        return self._entrada(*linha[:3])
+
+    def descartar(self, chave: str):
+        """Remove sem ler o conteúdo."""
+        linha = self._conexao.execute("SELECT tamanho FROM entradas WHERE chave = ?", (chave,)).fetchone()
+        if linha is not None:
+            self._conexao.execute("DELETE FROM entradas WHERE chave = ?", (chave,))
+            self.bytes -= linha[0]
+
+    def vencidas(self, agora: float) -> List[Tuple[str, Entrada]]:
+        chaves = [linha[0] for linha in self._conexao.execute(
+            "SELECT chave FROM entradas WHERE criado_em <= ?", (agora - self.ttl,)).fetchall()]
+        return [(chave, self.remover(chave)) for chave in chaves]
+
+    def __len__(self):
+        return self._conexao.execute("SELECT COUNT(*) FROM entradas").fetchone()[0]
+
+    def limpar(self):
+        self._conexao.execute("DELETE FROM entradas")
+        self.bytes = 0
+
+    def fechar(self):
+        self._conexao.close()
+
+
+class TieredCache:
+    """
+    Camadas quente -> morna -> fria com promoção nos acertos e rebaixamento por idade ou despejo.
+    Seguro entre threads (a gravação das consultas roda na thread de persistência).
+    """
+
+    def __init__(self, camadas: Optional[List[Any]] = None):
+        self.camadas = camadas if camadas is not None else [
+            CamadaMemoria(),
+            CamadaDisco("morna", CAMADA_MORNA_FILE, CAMADA_MORNA_MAX_BYTES, CAMADA_MORNA_TTL),
+            CamadaDisco("fria", CAMADA_FRIA_FILE, CAMADA_FRIA_MAX_BYTES, CAMADA_FRIA_TTL, comprimir=True),
+        ]
+        self._lock = threading.RLock()
+        self._ultima_manutencao = time.time()
+        self.stats = {
+            "acertos": {camada.nome: 0 for camada in self.camadas},
+            "faltas": 0, "desatualizadas": 0, "promocoes": 0, "rebaixamentos": 0, "descartes": 0,
+        }
+
+    @property
+    def caminho(self) -> Optional[Path]:
+        """Arquivo da primeira camada em disco (identifica a instância do diretório de trabalho)."""
+        return next((camada.caminho for camada in self.camadas if isinstance(camada, CamadaDisco)), None)
+
+    def _nivel_para(self, nivel: int, entrada: Entrada, agora: float) -> int:
+        """
+        Primeira camada a partir de ``nivel`` que comporta a idade da entrada e em que ela ocupa
+        no máximo um quarto do limite (uma entrada grande não esvazia a camada sozinha).
+        """
+        while nivel < len(self.camadas):
+            camada = self.camadas[nivel]
+            if agora - entrada.criado_em < camada.ttl and len(entrada.conteudo) <= camada.max_bytes // 4:
+                break
+            nivel += 1
+        return nivel
+
+    def _inserir(self, nivel: int, chave: str, entrada: Entrada, agora: float):
+        """Coloca a entrada na camada ``nivel`` ou abaixo; as despejadas descem uma camada."""
+        nivel = self._nivel_para(nivel, entrada, agora)
+        if nivel >= len(self.camadas):
+            self.stats["descartes"] += 1
+            return
+        for despejada, entrada_despejada in self.camadas[nivel].guardar(chave, entrada):
+            self.stats["rebaixamentos"] += 1
+            self._inserir(nivel + 1, despejada, entrada_despejada, agora)
+
+    def guardar(self, chave: str, valor: Any, versao: Optional[int] = None, criado_em: Optional[float] = None):
+        self.guardar_serializado(chave, serializar_json(valor), versao, criado_em)
+
+    def guardar_serializado(self, chave: str, conteudo: bytes, versao: Optional[int] = None, criado_em: Optional[float] = None):
+        """Guarda um valor já serializado em JSON (ex.: o mesmo conteúdo gravado num arquivo)."""
+        agora = time.time()
+        with self._lock:
+            for camada in self.camadas:
+                camada.descartar(chave)
+            self._inserir(0, chave, Entrada(conteudo, criado_em if criado_em is not None else agora, versao), agora)
+            self._manutencao_periodica(agora)
+
+    @staticmethod
+    def _serve(entrada: Entrada, agora: float, idade_maxima: Optional[float], versao: Optional[int]) -> bool:
+        return (idade_maxima is None or agora - entrada.criado_em <= idade_maxima) and \
+            (versao is None or entrada.versao == versao)
+
+    def obter_quente(self, chave: str, idade_maxima: Optional[float] = None, versao: Optional[int] = None) -> Any:
+        """
+        Como ``obter``, mas só na camada quente e sem o lock das camadas em disco (pode rodar no
+        event loop). Retorna ``AUSENTE`` se a entrada não estiver lá ou não servir a quem pede.
+        """
+        camada = self.camadas[0]
+        if not isinstance(camada, CamadaMemoria):
+            return AUSENTE
+        agora = time.time()
+        entrada = camada.obter(chave)
+        if entrada is None or agora - entrada.criado_em >= camada.ttl or not self._serve(entrada, agora, idade_maxima, versao):
+            return AUSENTE
+        self.stats["acertos"][camada.nome] += 1
+        return desserializar_json(entrada.conteudo)
+
+    async def obter_async(self, chave: str, idade_maxima: Optional[float] = None, versao: Optional[int] = None, padrao: Any = None) -> Any:
+        """``obter`` para o event loop: a camada quente responde ali mesmo; as em disco, num executor."""
+        valor = self.obter_quente(chave, idade_maxima, versao)
+        if valor is not AUSENTE:
+            return valor
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.obter, chave, idade_maxima, versao, padrao))
+
+    async def guardar_async(self, chave: str, valor: Any, versao: Optional[int] = None, criado_em: Optional[float] = None):
+        """``guardar`` num executor (serialização e rebaixamentos para o disco fora do event loop)."""
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.guardar, chave, valor, versao, criado_em))
+
+    def obter(self, chave: str, idade_maxima: Optional[float] = None, versao: Optional[int] = None, padrao: Any = None) -> Any:
+        """
+        Valor da chave se houver, com no máximo ``idade_maxima`` segundos e (se informada) da
+        ``versao`` pedida; senão ``padrao``. Entradas velhas demais para quem pede não são apagadas:
+        servem a quem aceita mais idade.
+        """
+        agora = time.time()
+        with self._lock:
+            self._manutencao_periodica(agora)
+            for nivel, camada in enumerate(self.camadas):
+                entrada = camada.obter(chave)
+                if entrada is None:
+                    continue
+                if agora - entrada.criado_em >= camada.ttl:
+                    # Passou do tempo de permanência: desce e a busca continua nas camadas de baixo
+                    camada.remover(chave)
+                    self.stats["rebaixamentos"] += 1
+                    self._inserir(nivel + 1, chave, entrada, agora)
+                    continue
+                if not self._serve(entrada, agora, idade_maxima, versao):
+                    self.stats["desatualizadas"] += 1
+                    return padrao
+                self.stats["acertos"][camada.nome] += 1
+                if self._nivel_para(0, entrada, agora) < nivel:
+                    camada.remover(chave)
+                    self.stats["promocoes"] += 1
+                    self._inserir(0, chave, entrada, agora)
+                conteudo = entrada.conteudo
+                break
+            else:
+                self.stats["faltas"] += 1
+                return padrao
+        return desserializar_json(conteudo)
+
+    def remover(self, chave: str):
+        with self._lock:
+            for camada in self.camadas:
+                camada.descartar(chave)
+
+    def manutencao(self, agora: Optional[float] = None):
+        """Rebaixa (ou descarta, na última camada) as entradas que passaram do tempo de permanência."""
+        agora = time.time() if agora is None else agora
+        with self._lock:
+            self._ultima_manutencao = agora
+            for nivel, camada in enumerate(self.camadas):
+                for chave, entrada in camada.vencidas(agora):
+                    self.stats["rebaixamentos"] += 1
+                    self._inserir(nivel + 1, chave, entrada, agora)
+
+    def _manutencao_periodica(self, agora: float):
+        if agora - self._ultima_manutencao >= MANUTENCAO_INTERVALO:
+            try:
+                self.manutencao(agora)
+            except Exception as e:
+                logger.error(f"Erro na manutenção do cache em camadas: {e}")
+
+    def limpar(self):
+        with self._lock:
+            for camada in self.camadas:
+                camada.limpar()
+
+    def fechar(self):
+        with self._lock:
+            for camada in self.camadas:
+                camada.fechar()
+
+    def get_status(self) -> Dict[str, Any]:
+        with self._lock:
+            acertos = sum(self.stats["acertos"].values())
+            consultas = acertos + self.stats["faltas"] + self.stats["desatualizadas"]
+            return {
+                **self.stats,
+                "acertos": dict(self.stats["acertos"]),
+                "taxa_acerto": round(acertos / consultas, 4) if consultas else 0.0,
+                "camadas": [
+                    {
+                        "nome": camada.nome,
+                        "entradas": len(camada),
+                        "bytes": camada.bytes,
+                        "max_bytes": camada.max_bytes,
+                        "ttl_segundos": camada.ttl,
+                    }
+                    for camada in self.camadas
+                ],
+            }
+
+
+# Instância única do processo (uma por diretório de trabalho: os arquivos das camadas são relativos a ele)
+_tiered_cache: Optional[TieredCache] = None
+
+
+def get_tiered_cache() -> TieredCache:
+    """Cache em camadas compartilhado do processo."""
+    global _tiered_cache
+    if _tiered_cache is None or _tiered_cache.caminho.resolve() != CAMADA_MORNA_FILE.resolve():
+        if _tiered_cache is not None:
+            _tiered_cache.fechar()
+        _tiered_cache = TieredCache()
+    return _tiered_cache